@@ -0,0 +1,220 @@
+"""
+Rettifiche massive dei portafogli (aggiunta/rimozione su una sezione)
+Lista JSON o CSV applicati con poche istruzioni set-based, esito per ogni riga
+"""
+
+import csv
+import io
+import logging
+from decimal import Decimal, InvalidOperation
+
+from backend.shared.ledger import ledger_context
+
+logger = logging.getLogger(__name__)
+
+SECTIONS = ('free_capital', 'referral_bonus', 'profits')
+OPERATIONS = ('add', 'remove')
+MAX_ROWS = 50000
+
+# Tipo movimento per sezione (vincolo CHECK di portfolio_transactions)
+TRANSACTION_TYPES = {
+    ('add', 'free_capital'): 'deposit',
+    ('add', 'profits'): 'roi',
+    ('add', 'referral_bonus'): 'referral',
+}
+
+SECTION_LABELS = {
+    'free_capital': 'capitale libero',
+    'referral_bonus': 'bonus referral',
+    'profits': 'profitti',
+}
+
+
+class BulkAdjustError(Exception):
+    """Richiesta di rettifica non valida nel suo insieme"""
+    pass
+
+
+def parse_csv(stream):
+    """Righe da CSV con intestazione user_id,amount[,op][,section]"""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    reader = csv.DictReader(text)
+    if not reader.fieldnames or 'user_id' not in reader.fieldnames or 'amount' not in reader.fieldnames:
+        raise BulkAdjustError("Il CSV deve avere le colonne user_id e amount")
+    return [dict(row) for row in reader]
+
+
+def normalize_rows(rows, default_op=None, default_section='profits'):
+    """Valida le righe: ritorna (righe valide, esiti delle righe scartate)"""
+    if len(rows) > MAX_ROWS:
+        raise BulkAdjustError(f"Massimo {MAX_ROWS} righe per richiesta")
+    valid = []
+    outcomes = []
+    seen = set()
+    for row_no, row in enumerate(rows, start=1):
+        op = (row.get('op') or default_op or '').strip()
+        section = (row.get('section') or default_section or '').strip()
+        try:
+            user_id = int(row.get('user_id'))
+            amount = Decimal(str(row.get('amount'))).quantize(Decimal('0.01'))
+        except (TypeError, ValueError, InvalidOperation):
+            outcomes.append({'row': row_no, 'user_id': row.get('user_id'), 'status': 'error',
+                             'error': 'user_id o importo non valido'})
+            continue
+        error = None
+        if op not in OPERATIONS:
+            error = 'Operazione non valida (add o remove)'
+        elif section not in SECTIONS:
+            error = 'Sezione non valida'
+        elif amount <= 0:
+            error = 'L\'importo deve essere positivo'
+        elif (user_id, section) in seen:
+            error = 'Utente e sezione già presenti in un\'altra riga'
+        if error:
+            outcomes.append({'row': row_no, 'user_id': user_id, 'status': 'error', 'error': error})
+            continue
+        seen.add((user_id, section))
+        valid.append({'row': row_no, 'user_id': user_id, 'op': op, 'section': section, 'amount': amount})
+    return valid, outcomes
+
+
+def _arrays(items):
+    return (
+        [item['row'] for item in items],
+        [item['user_id'] for item in items],
+        [item['section'] for item in items],
+        [item['amount'] if item['op'] == 'add' else -item['amount'] for item in items],
+    )
+
+
+def apply_adjustments(cur, items, admin_id, all_or_nothing=True):
+    """Applica le rettifiche valide; con all_or_nothing un solo errore annulla tutto il lotto"""
+    outcomes = []
+    if not items:
+        return outcomes, False
+    rows, user_ids, sections, deltas = _arrays(items)
+
+    # 1. Portafogli mancanti per gli utenti esistenti
+    cur.execute(
+        """
+        INSERT INTO user_portfolios (user_id, free_capital, invested_capital, referral_bonus, profits)
+        SELECT DISTINCT u.id, 0, 0, 0, 0
+        FROM unnest(%s::int[]) AS a(user_id)
+        JOIN users u ON u.id = a.user_id
+        ON CONFLICT (user_id) DO NOTHING
+        """,
+        (user_ids,),
+    )
+
+    # 2. Saldi correnti con lock delle righe interessate: join interno (FOR UPDATE non si
+    # applica al lato nullable di un outer join); dopo il passo 1 manca solo chi non esiste
+    cur.execute(
+        """
+        SELECT a.row_no, a.user_id,
+               CASE a.section
+                   WHEN 'free_capital' THEN up.free_capital
+                   WHEN 'referral_bonus' THEN up.referral_bonus
+                   ELSE up.profits
+               END AS balance
+        FROM unnest(%s::int[], %s::int[], %s::text[]) AS a(row_no, user_id, section)
+        JOIN user_portfolios up ON up.user_id = a.user_id
+        ORDER BY a.user_id
+        FOR UPDATE OF up
+        """,
+        (rows, user_ids, sections),
+    )
+    balances = {row['row_no']: row for row in cur.fetchall()}
+
+    applicable = []
+    for item in items:
+        current = balances.get(item['row'])
+        if not current:
+            outcomes.append({'row': item['row'], 'user_id': item['user_id'], 'status': 'error',
+                             'error': 'Utente non trovato'})
+        elif item['op'] == 'remove' and Decimal(current['balance']) < item['amount']:
+            outcomes.append({'row': item['row'], 'user_id': item['user_id'], 'status': 'error',
+                             'error': 'Saldo insufficiente', 'balance': float(current['balance'])})
+        else:
+            applicable.append(item)
+
+    if outcomes and all_or_nothing:
+        return outcomes + [
+            {'row': item['row'], 'user_id': item['user_id'], 'status': 'skipped'} for item in applicable
+        ], False
+    if not applicable:
+        return outcomes, False
+
+    rows, user_ids, sections, deltas = _arrays(applicable)
+
+    # 3. Aggiornamento dei saldi: una riga per utente con i delta di tutte le sezioni
+    with ledger_context(cur, 'adjustment', 'Rettifica massiva admin', reference_type='admin_adjustment'):
+        cur.execute(
+            """
+            UPDATE user_portfolios up
+            SET free_capital = up.free_capital + v.free_capital,
+                referral_bonus = up.referral_bonus + v.referral_bonus,
+                profits = up.profits + v.profits,
+                updated_at = NOW()
+            FROM (
+                SELECT user_id,
+                       COALESCE(SUM(delta) FILTER (WHERE section = 'free_capital'), 0) AS free_capital,
+                       COALESCE(SUM(delta) FILTER (WHERE section = 'referral_bonus'), 0) AS referral_bonus,
+                       COALESCE(SUM(delta) FILTER (WHERE section = 'profits'), 0) AS profits
+                FROM unnest(%s::int[], %s::text[], %s::numeric[]) AS a(user_id, section, delta)
+                GROUP BY user_id
+            ) v
+            WHERE up.user_id = v.user_id
+            RETURNING up.user_id, up.free_capital, up.referral_bonus, up.profits
+            """,
+            (user_ids, sections, deltas),
+        )
+        after = {row['user_id']: row for row in cur.fetchall()}
+
+    # 4. Movimenti di portafoglio (multi-riga)
+    tx_types = [TRANSACTION_TYPES.get((item['op'], item['section']), 'withdrawal') for item in applicable]
+    descriptions = [
+        f"Rettifica admin: {'aggiunta' if item['op'] == 'add' else 'rimozione'} {SECTION_LABELS[item['section']]}"
+        for item in applicable
+    ]
+    balances_after = [after[item['user_id']][item['section']] for item in applicable]
+    cur.execute(
+        """
+        INSERT INTO portfolio_transactions
+            (user_id, type, amount, balance_before, balance_after, description, reference_type, status)
+        SELECT a.user_id, a.type, ABS(a.delta), a.balance_after - a.delta, a.balance_after,
+               a.description, 'admin_adjustment', 'completed'
+        FROM unnest(%s::int[], %s::text[], %s::numeric[], %s::numeric[], %s::text[])
+             AS a(user_id, type, delta, balance_after, description)
+        """,
+        (user_ids, tx_types, deltas, balances_after, descriptions),
+    )
+
+    # 5. Audit: una riga per rettifica più il riepilogo del lotto
+    details = [
+        f"{'Aggiunta' if item['op'] == 'add' else 'Rimozione'} {SECTION_LABELS[item['section']]} {item['amount']} EUR"
+        for item in applicable
+    ]
+    actions = [f"portfolio_{item['op']}" for item in applicable]
+    cur.execute(
+        """
+        INSERT INTO admin_actions (admin_id, action, target_type, target_id, details)
+        SELECT %s, a.action, 'user', a.user_id, a.details
+        FROM unnest(%s::text[], %s::int[], %s::text[]) AS a(action, user_id, details)
+        UNION ALL
+        SELECT %s, 'portfolio_bulk_adjust', 'bulk_users', 0, %s
+        """,
+        (admin_id, actions, user_ids, details,
+         admin_id, f"Rettifica massiva su {len(applicable)} righe ({len(set(user_ids))} utenti)"),
+    )
+
+    for item in applicable:
+        outcomes.append({
+            'row': item['row'],
+            'user_id': item['user_id'],
+            'status': 'applied',
+            'op': item['op'],
+            'section': item['section'],
+            'amount': float(item['amount']),
+            'balance_after': float(after[item['user_id']][item['section']]),
+        })
+    return outcomes, True
@@ -0,0 +1,402 @@
+"""
+Report analytics in Excel e PDF
+Excel scritto in streaming (memoria costante); il canvas PDF tiene le pagine in memoria fino
+al salvataggio, quindi il dettaglio PDF è limitato a PDF_MAX_DETAIL_ROWS righe.
+Gli export grandi girano in background; un job il cui worker è morto viene segnato come fallito.
+"""
+
+import os
+import hashlib
+import uuid
+import logging
+import threading
+from datetime import datetime
+
+from psycopg.types.json import Jsonb
+
+logger = logging.getLogger(__name__)
+
+# Oltre questa stima di righe l'export viene eseguito in background
+ASYNC_ROW_THRESHOLD = int(os.environ.get("ANALYTICS_EXPORT_ASYNC_ROWS", "20000"))
+# Righe per blocco lette dal cursore server-side
+FETCH_SIZE = 2000
+# Righe di dettaglio nel PDF (oltre: usare l'export Excel)
+PDF_MAX_DETAIL_ROWS = int(os.environ.get("ANALYTICS_PDF_MAX_DETAIL_ROWS", "5000"))
+# Tempo concesso a un job appena creato per prendere il proprio lock
+JOB_START_GRACE = '1 minute'
+
+DETAIL_HEADER = ['Data', 'ID Investimento', 'Email', 'Codice Progetto', 'Progetto', 'Importo €', 'Stato']
+
+DETAIL_QUERY = """
+    SELECT i.created_at, i.id, u.email, p.code, COALESCE(p.title, p.name) AS project_title,
+           i.amount, i.status
+    FROM investments i
+    JOIN users u ON u.id = i.user_id
+    JOIN projects p ON p.id = i.project_id
+    WHERE i.created_at BETWEEN %s AND %s
+    ORDER BY i.created_at, i.id
+"""
+
+MIMETYPES = {
+    'excel': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'pdf': 'application/pdf',
+}
+EXTENSIONS = {'excel': 'xlsx', 'pdf': 'pdf'}
+
+
+def get_conn():
+    from backend.shared.database import get_connection
+    return get_connection()
+
+
+def ensure_report_jobs_table(cur):
+    """Crea la tabella report_jobs se non esiste"""
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS report_jobs (
+            id SERIAL PRIMARY KEY,
+            report_type TEXT NOT NULL,
+            format TEXT NOT NULL CHECK (format IN ('excel','pdf')),
+            params JSONB NOT NULL DEFAULT '{}'::jsonb,
+            status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued','running','completed','failed')),
+            file_path TEXT,
+            row_count INT,
+            error TEXT,
+            created_by INT REFERENCES users(id) ON DELETE SET NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            completed_at TIMESTAMPTZ
+        )
+        """
+    )
+
+
+def _period_bounds(analytics_data):
+    start_dt = datetime.fromisoformat(analytics_data['start_date'])
+    end_dt = datetime.fromisoformat(analytics_data['end_date'])
+    return start_dt, end_dt
+
+
+def includes_detail(export_type):
+    """Il dettaglio investimenti è incluso solo nel report completo"""
+    return export_type != 'projects_performance'
+
+
+def estimate_rows(cur, analytics_data, export_type):
+    """Stima delle righe del report (dettaglio investimenti nel periodo)"""
+    rows = len(analytics_data.get('top_projects', []))
+    if includes_detail(export_type):
+        start_dt, end_dt = _period_bounds(analytics_data)
+        cur.execute(
+            "SELECT COUNT(*) AS total FROM investments WHERE created_at BETWEEN %s AND %s",
+            (start_dt, end_dt),
+        )
+        rows += cur.fetchone()['total']
+    return rows
+
+
+def iter_detail_rows(analytics_data):
+    """Righe del dettaglio investimenti da cursore server-side"""
+    start_dt, end_dt = _period_bounds(analytics_data)
+    with get_conn() as conn:
+        with conn.cursor(name=f"report_detail_{uuid.uuid4().hex}") as cur:
+            cur.itersize = FETCH_SIZE
+            cur.execute(DETAIL_QUERY, (start_dt, end_dt))
+            for row in cur:
+                yield [
+                    row['created_at'].strftime('%Y-%m-%d %H:%M') if row['created_at'] else '',
+                    row['id'],
+                    row['email'],
+                    row['code'],
+                    row['project_title'],
+                    float(row['amount'] or 0),
+                    row['status'],
+                ]
+
+
+def summary_rows(analytics_data):
+    """Righe KPI e metriche secondarie (stesse voci dell'export CSV)"""
+    kpis = analytics_data.get('kpis', {})
+    metrics = analytics_data.get('metrics', {})
+    return [
+        ['Revenue Totale', float(kpis.get('total_revenue', 0)), f"{kpis.get('revenue_change', 0):.1f}%"],
+        ['Nuovi Utenti', kpis.get('new_users', 0), f"{kpis.get('users_change', 0):.1f}%"],
+        ['Volume Investimenti', float(kpis.get('investment_volume', 0)), f"{kpis.get('investment_change', 0):.1f}%"],
+        ['Progetti Attivi', kpis.get('active_projects', 0), kpis.get('projects_change', 0)],
+        ['Tasso Conversione', f"{metrics.get('conversion_rate', 0):.1f}%", ''],
+        ['Investimento Medio', float(metrics.get('avg_investment', 0)), ''],
+        ['RA Medio', f"{metrics.get('avg_roi', 0):.1f}%", ''],
+        ['KYC Pendenti', metrics.get('kyc_pending', 0), ''],
+        ['Tempo Approvazione Medio', f"{metrics.get('avg_approval_time', 0):.1f} giorni", ''],
+        ['Retention Rate', f"{metrics.get('retention_rate', 0):.1f}%", ''],
+    ]
+
+
+PROJECTS_HEADER = ['Codice', 'Titolo', 'RA %', 'Volume €', 'Investitori', 'Finanziamento %', 'Stato']
+
+
+def project_rows(analytics_data):
+    return [
+        [p.get('code'), p.get('title'), p.get('roi'), p.get('volume'),
+         p.get('investors'), p.get('funding_percentage'), p.get('status')]
+        for p in analytics_data.get('top_projects', [])
+    ]
+
+
+def write_excel(path, analytics_data, export_type):
+    """Scrive il report con workbook write-only: le righe vanno su disco man mano"""
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    row_count = 0
+
+    if export_type != 'projects_performance':
+        ws = wb.create_sheet('Riepilogo')
+        ws.append(['Periodo', analytics_data.get('start_date'), analytics_data.get('end_date')])
+        ws.append([])
+        ws.append(['Metrica', 'Valore', 'Variazione %'])
+        for row in summary_rows(analytics_data):
+            ws.append(row)
+
+    ws = wb.create_sheet('Progetti')
+    ws.append(PROJECTS_HEADER)
+    for row in project_rows(analytics_data):
+        ws.append(row)
+        row_count += 1
+
+    if includes_detail(export_type):
+        ws = wb.create_sheet('Investimenti')
+        ws.append(DETAIL_HEADER)
+        for row in iter_detail_rows(analytics_data):
+            ws.append(row)
+            row_count += 1
+
+    wb.save(path)
+    return row_count
+
+
+class _PdfWriter:
+    """Impaginazione a righe su canvas: ogni pagina viene chiusa appena piena"""
+
+    def __init__(self, path, title):
+        from reportlab.lib.pagesizes import A4
+        from reportlab.pdfgen import canvas
+
+        self.width, self.height = A4
+        self.canvas = canvas.Canvas(path, pagesize=A4, pageCompression=1)
+        self.title = title
+        self.margin = 40
+        self.line_height = 13
+        self.page = 0
+        self._new_page()
+
+    def _new_page(self):
+        if self.page:
+            self.canvas.showPage()
+        self.page += 1
+        self.y = self.height - self.margin
+        self.canvas.setFont('Helvetica', 8)
+        self.canvas.drawRightString(self.width - self.margin, self.margin / 2, f"Pagina {self.page}")
+        self.canvas.setFont('Helvetica-Bold', 11)
+        self.canvas.drawString(self.margin, self.y, self.title)
+        self.y -= self.line_height * 2
+
+    def _ensure_space(self, lines=1):
+        if self.y - self.line_height * lines < self.margin:
+            self._new_page()
+
+    def heading(self, text):
+        self._ensure_space(3)
+        self.y -= self.line_height / 2
+        self.canvas.setFont('Helvetica-Bold', 10)
+        self.canvas.drawString(self.margin, self.y, text)
+        self.y -= self.line_height
+
+    def row(self, values, widths, bold=False):
+        self._ensure_space()
+        self.canvas.setFont('Helvetica-Bold' if bold else 'Helvetica', 8)
+        x = self.margin
+        for value, width in zip(values, widths):
+            text = '' if value is None else str(value)
+            max_chars = max(int(width / 4.2), 4)
+            if len(text) > max_chars:
+                text = text[:max_chars - 1] + '…'
+            self.canvas.drawString(x, self.y, text)
+            x += width
+        self.y -= self.line_height
+
+    def save(self):
+        self.canvas.save()
+
+
+def write_pdf(path, analytics_data, export_type):
+    """Scrive il report PDF riga per riga dal cursore"""
+    pdf = _PdfWriter(
+        path,
+        f"Report Analytics {analytics_data.get('start_date', '')[:10]} - {analytics_data.get('end_date', '')[:10]}",
+    )
+    row_count = 0
+
+    if export_type != 'projects_performance':
+        pdf.heading('KPI e metriche')
+        widths = [200, 150, 100]
+        pdf.row(['Metrica', 'Valore', 'Variazione %'], widths, bold=True)
+        for row in summary_rows(analytics_data):
+            pdf.row(row, widths)
+
+    pdf.heading('Performance progetti')
+    widths = [60, 170, 45, 70, 55, 65, 50]
+    pdf.row(PROJECTS_HEADER, widths, bold=True)
+    for row in project_rows(analytics_data):
+        pdf.row(row, widths)
+        row_count += 1
+
+    if includes_detail(export_type):
+        pdf.heading('Dettaglio investimenti')
+        widths = [75, 55, 130, 60, 110, 55, 45]
+        pdf.row(DETAIL_HEADER, widths, bold=True)
+        detail_rows = 0
+        for row in iter_detail_rows(analytics_data):
+            if detail_rows >= PDF_MAX_DETAIL_ROWS:
+                pdf.heading(f"Dettaglio limitato a {PDF_MAX_DETAIL_ROWS} righe: per l'elenco completo usare l'export Excel")
+                break
+            pdf.row(row, widths)
+            detail_rows += 1
+        row_count += detail_rows
+
+    pdf.save()
+    return row_count
+
+
+WRITERS = {'excel': write_excel, 'pdf': write_pdf}
+
+
+def build_report(directory, format_type, analytics_data, export_type):
+    """Genera il file del report e ritorna (path, righe scritte)"""
+    os.makedirs(directory, exist_ok=True)
+    filename = f"analytics_{export_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.{EXTENSIONS[format_type]}"
+    path = os.path.join(directory, filename)
+    try:
+        row_count = WRITERS[format_type](path, analytics_data, export_type)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return path, row_count
+
+
+def enqueue_report(directory, format_type, analytics_data, export_type, admin_id):
+    """Registra il job e avvia la generazione in un thread separato dal worker web"""
+    with get_conn() as conn, conn.cursor() as cur:
+        ensure_report_jobs_table(cur)
+        cur.execute(
+            """
+            INSERT INTO report_jobs (report_type, format, params, created_by)
+            VALUES ('analytics', %s, %s, %s)
+            RETURNING id
+            """,
+            (format_type, Jsonb({'export_type': export_type,
+                                 'period': analytics_data.get('period'),
+                                 'start_date': analytics_data.get('start_date'),
+                                 'end_date': analytics_data.get('end_date')}), admin_id),
+        )
+        job_id = cur.fetchone()['id']
+        conn.commit()
+
+    threading.Thread(
+        target=_run_job,
+        args=(job_id, directory, format_type, analytics_data, export_type),
+        name=f"report-job-{job_id}",
+        daemon=True,
+    ).start()
+    return job_id
+
+
+def _job_lock_id(job_id):
+    digest = hashlib.sha1(f"report_job|{job_id}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def _run_job(job_id, directory, format_type, analytics_data, export_type):
+    # Lock di sessione tenuto per tutta la durata del job: se il worker muore la connessione
+    # si chiude, il lock si libera e fail_stale_jobs riconosce il job come orfano
+    with get_conn() as lock_conn, lock_conn.cursor() as lock_cur:
+        lock_conn.autocommit = True
+        lock_cur.execute("SELECT pg_advisory_lock(%s)", (_job_lock_id(job_id),))
+        try:
+            _execute_job(job_id, directory, format_type, analytics_data, export_type)
+        finally:
+            lock_cur.execute("SELECT pg_advisory_unlock(%s)", (_job_lock_id(job_id),))
+
+
+def _execute_job(job_id, directory, format_type, analytics_data, export_type):
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE report_jobs SET status = 'running' WHERE id = %s AND status = 'queued'", (job_id,))
+        started = cur.rowcount
+        conn.commit()
+    if not started:
+        logger.warning(f"Report {job_id} non più in coda, generazione annullata")
+        return
+    try:
+        path, row_count = build_report(directory, format_type, analytics_data, export_type)
+    except Exception as e:
+        logger.exception(f"Errore nella generazione report {job_id}: {e}")
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute(
+                "UPDATE report_jobs SET status = 'failed', error = %s, completed_at = NOW() WHERE id = %s",
+                (str(e), job_id),
+            )
+            conn.commit()
+        return
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE report_jobs
+            SET status = 'completed', file_path = %s, row_count = %s, completed_at = NOW()
+            WHERE id = %s
+            """,
+            (path, row_count, job_id),
+        )
+        conn.commit()
+    logger.info(f"Report {job_id} completato: {row_count} righe in {path}")
+
+
+def fail_stale_jobs(cur):
+    """Segna come falliti i job in coda/in esecuzione senza un worker vivo (lock libero)"""
+    ensure_report_jobs_table(cur)
+    cur.execute(
+        f"""
+        SELECT id FROM report_jobs
+        WHERE status IN ('queued', 'running') AND created_at < NOW() - INTERVAL '{JOB_START_GRACE}'
+        """
+    )
+    failed = []
+    for job in cur.fetchall():
+        lock_id = _job_lock_id(job['id'])
+        cur.execute("SELECT pg_try_advisory_lock(%s) AS locked", (lock_id,))
+        if not cur.fetchone()['locked']:
+            continue
+        try:
+            cur.execute(
+                """
+                UPDATE report_jobs
+                SET status = 'failed', error = 'Job interrotto (riavvio del worker)', completed_at = NOW()
+                WHERE id = %s AND status IN ('queued', 'running')
+                """,
+                (job['id'],),
+            )
+            if cur.rowcount:
+                failed.append(job['id'])
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (lock_id,))
+    if failed:
+        logger.warning(f"Report interrotti segnati come falliti: {failed}")
+    return failed
+
+
+def get_job(job_id):
+    with get_conn() as conn, conn.cursor() as cur:
+        fail_stale_jobs(cur)
+        cur.execute("SELECT * FROM report_jobs WHERE id = %s", (job_id,))
+        job = cur.fetchone()
+        conn.commit()
+    return job
@@ -1,5 +1,6 @@
 import os
 import uuid
+import base64
 import time
 import logging
 import json
@@ -67,6 +68,40 @@ admin_bp = Blueprint("admin", __name__)
 
 # Importa decoratori di autorizzazione
 from backend.auth.decorators import admin_required
+from backend.shared.referral_tree import (
+    ReferralTreeError, ensure_referral_closure, rebuild_referral_closure,
+    closure_move_subtree, closure_remove_user, get_downline, get_network_summary
+)
+from backend.shared.referral_stats import (
+    ensure_referral_stats_table, rebuild_referral_stats, refresh_referral_stats, refresh_referrer_stats,
+    get_referral_ancestors
+)
+from backend.shared.referral_accrual import parse_month, preview_period, enqueue_run, get_run
+from backend.shared.settlement import (
+    SettlementError, preview_sale, settle_sale, preview_refunds, settle_cancellation, refund_investments
+)
+from backend.shared.yield_accrual import (
+    YieldAccrualError, parse_request as parse_yield_request, preview_yields, accrue_yields
+)
+from backend.shared.returns import get_returns, serialize as serialize_returns
+from backend.admin.simulator import SimulationError, parse_grid, load_investments, simulate
+from backend.shared.balances import credit as credit_balance
+from backend.shared.idempotency import idempotent
+from backend.shared.project_funding import (
+    FUNDED_SQL, ensure_funding_shards, adjust as adjust_funding,
+)
+from backend.shared.ledger import (
+    set_context as set_ledger_context, history as ledger_history, drift as ledger_drift,
+    rebuild_portfolios,
+)
+from backend.shared.portfolio_snapshots import platform_timeline, run as run_snapshots
+from backend.shared.partitioning import parse_period, period_conditions
+from backend.shared.reconciliation import (
+    run as run_reconciliation, list_discrepancies, recent_runs,
+)
+from backend.admin.bulk_adjust import (
+    BulkAdjustError, parse_csv as parse_adjust_csv, normalize_rows, apply_adjustments
+)
 
 # Route temporanea per notifiche rimosse - restituisce 404 pulito
 @admin_bp.get("/api/notifications/unread-count")
@@ -127,7 +162,8 @@ def projects_list():
         if status:
             q.append("status=%s"); params.append(status)
         where = ("WHERE "+" AND ".join(q)) if q else ""
-        sql = f"""SELECT * FROM projects {where} ORDER BY 
+        # funded_amount della riga sostituito dal totale raccolto (base + shard)
+        sql = f"""SELECT p.*, {FUNDED_SQL} AS funded_amount FROM projects p {where} ORDER BY 
             CASE 
                 WHEN status = 'active' THEN 1
                 WHEN status = 'completed' THEN 2
@@ -137,6 +173,7 @@ def projects_list():
             END,
             created_at DESC"""
         with get_conn() as conn, conn.cursor() as cur:
+            ensure_funding_shards(cur)
             cur.execute(sql, params)
             rows = cur.fetchall()
             
@@ -360,11 +397,12 @@ def project_cancel_data(pid):
     """Ottiene i dati necessari per l'annullamento di un progetto"""
     with get_conn() as conn, conn.cursor() as cur:
         # Dettagli progetto (solo se attivo)
-        cur.execute("""
-            SELECT id, code, title, description, total_amount, funded_amount, 
-                   min_investment, status, created_at
-            FROM projects 
-            WHERE id = %s AND status = 'active'
+        ensure_funding_shards(cur)
+        cur.execute(f"""
+            SELECT p.id, p.code, p.title, p.description, p.total_amount, {FUNDED_SQL} AS funded_amount,
+                   p.min_investment, p.status, p.created_at
+            FROM projects p
+            WHERE p.id = %s AND p.status = 'active'
         """, (pid,))
         project = cur.fetchone()
         
@@ -396,7 +434,8 @@ def project_detail(pid):
     if request.headers.get('Content-Type') == 'application/json' or request.args.get('format') == 'json':
         with get_conn() as conn, conn.cursor() as cur:
             # Dettagli progetto
-            cur.execute("SELECT * FROM projects WHERE id=%s", (pid,))
+            ensure_funding_shards(cur)
+            cur.execute(f"SELECT p.*, {FUNDED_SQL} AS funded_amount FROM projects p WHERE p.id=%s", (pid,))
             project = cur.fetchone()
             if not project:
                 abort(404)
@@ -499,6 +538,9 @@ def projects_edit(pid):
         
         cur.execute(sql, params)
         
+        # Capacità degli shard calcolate sul vecchio totale/stato: consolida e ridistribuisci
+        if data.get('total_amount') or data.get('status'):
+            adjust_funding(cur, pid, 0)
         
         conn.commit()
     
@@ -511,148 +553,43 @@ def projects_edit(pid):
 @admin_bp.post("/projects/<int:pid>/cancel")
 @admin_required
 def projects_cancel(pid):
-    """Annulla un progetto e rimborsa gli investitori"""
+    """Annulla un progetto e rimborsa gli investitori.
+
+    Input JSON opzionale: { "dry_run": true } per l'anteprima dei rimborsi
+    """
+    data = request.get_json(silent=True) or {}
     try:
         with get_conn() as conn, conn.cursor() as cur:
-            # Verifica che il progetto esista e sia attivo
-            cur.execute("""
-                SELECT id, name, funded_amount, status 
-                FROM projects 
-                WHERE id = %s AND status = 'active'
-            """, (pid,))
-            project = cur.fetchone()
-            
-            if not project:
-                return jsonify({"error": "Progetto non trovato o non attivo"}), 404
-            
-            # Ottieni tutti gli investimenti attivi per questo progetto
-            cur.execute("""
-                SELECT i.id, i.user_id, i.amount, u.email
-                FROM investments i
-                JOIN users u ON u.id = i.user_id
-                WHERE i.project_id = %s AND i.status = 'active'
-            """, (pid,))
-            investments = cur.fetchall()
-            
-            # Rimborsa tutti gli investimenti attivi
-            for investment in investments:
-                user_id = investment['user_id']
-                amount = investment['amount']
-                
-                # Aggiorna il portfolio dell'utente: rimuovi da invested_capital e aggiungi a free_capital
-                cur.execute("""
-                    UPDATE user_portfolios 
-                    SET invested_capital = invested_capital - %s,
-                        free_capital = free_capital + %s
-                    WHERE user_id = %s
-                """, (amount, amount, user_id))
-                
-                # Se il portfolio non esiste, crealo
-                if cur.rowcount == 0:
-                    cur.execute("""
-                        INSERT INTO user_portfolios (user_id, free_capital, invested_capital, profits, referral_bonus)
-                        VALUES (%s, %s, 0, 0, 0)
-                    """, (user_id, amount))
-                
-                # Aggiorna lo status dell'investimento a cancelled
-                cur.execute("""
-                    UPDATE investments 
-                    SET status = 'cancelled'
-                    WHERE id = %s
-                """, (investment['id'],))
-            
-            # Aggiorna lo status del progetto a cancelled (rimuovi updated_at che non esiste)
-            cur.execute("""
-                UPDATE projects 
-                SET status = 'cancelled'
-                WHERE id = %s
-            """, (pid,))
+            if data.get("dry_run"):
+                preview = preview_refunds(cur, pid)
+                conn.rollback()
+                return jsonify({"dry_run": True, **preview})
             
+            # Rimborsi, investimenti e progetto in un'unica transazione
+            result = settle_cancellation(cur, pid)
             conn.commit()
             
             return jsonify({
                 "success": True,
-                "message": f"Progetto annullato con successo. Rimborsati {len(investments)} investimenti per un totale di €{project['funded_amount']:,.2f}",
-                "refunded_investments": len(investments),
-                "total_refunded": float(project['funded_amount'])
+                "message": f"Progetto annullato con successo. Rimborsati {result['refunded_investments']} investimenti per un totale di €{result['total_refunded']:,.2f}",
+                "refunded_investments": result['refunded_investments'],
+                "total_refunded": result['total_refunded']
             })
-            
+    
+    except SettlementError as e:
+        return jsonify({"error": str(e)}), e.status_code
     except Exception as e:
         return jsonify({"error": f"Errore durante l'annullamento: {str(e)}"}), 500
 
-def process_referral_bonus(cur, user_id, profit_amount, project_id):
-    """Processa i bonus referral per un utente che ha ricevuto profitti"""
-    try:
-        # Assicurati che profit_amount sia un float
-        profit_amount = float(profit_amount)
-        
-        # Trova chi ha invitato questo utente
-        cur.execute("""
-            SELECT u.referred_by as referrer_id, r.is_vip
-            FROM users u
-            JOIN users r ON r.id = u.referred_by
-            WHERE u.id = %s AND u.referred_by IS NOT NULL
-        """, (user_id,))
-        referral_data = cur.fetchone()
-        
-        if not referral_data:
-            # Nessun referral trovato, il 2% va all'utente ID 2
-            bonus_amount = profit_amount * 0.02
-            
-            # Usa UPSERT per evitare problemi di concorrenza
-            cur.execute("""
-                INSERT INTO user_portfolios (user_id, free_capital, invested_capital, profits, referral_bonus)
-                VALUES (2, 0, 0, 0, %s)
-                ON CONFLICT (user_id) 
-                DO UPDATE SET referral_bonus = user_portfolios.referral_bonus + %s
-            """, (bonus_amount, bonus_amount))
-            
-            return {"referrer_id": 2, "bonus_amount": float(bonus_amount), "is_vip": False, "source": "default"}
-        
-        referrer_id = referral_data['referrer_id']
-        is_vip = referral_data['is_vip']
-        
-        # Calcola bonus: 5% per VIP, 3% per non-VIP
-        bonus_percentage = 0.05 if is_vip else 0.03
-        bonus_amount = float(profit_amount) * bonus_percentage
-        
-        # Usa UPSERT per il referrer
-        cur.execute("""
-            INSERT INTO user_portfolios (user_id, free_capital, invested_capital, profits, referral_bonus)
-            VALUES (%s, 0, 0, 0, %s)
-            ON CONFLICT (user_id) 
-            DO UPDATE SET referral_bonus = user_portfolios.referral_bonus + %s
-        """, (referrer_id, bonus_amount, bonus_amount))
-        
-        # Se non è VIP, il 2% va all'utente ID 2
-        if not is_vip:
-            additional_bonus = float(profit_amount) * 0.02
-            cur.execute("""
-                INSERT INTO user_portfolios (user_id, free_capital, invested_capital, profits, referral_bonus)
-                VALUES (2, 0, 0, 0, %s)
-                ON CONFLICT (user_id) 
-                DO UPDATE SET referral_bonus = user_portfolios.referral_bonus + %s
-            """, (additional_bonus, additional_bonus))
-        
-        return {
-            "referrer_id": referrer_id, 
-            "bonus_amount": float(bonus_amount), 
-            "is_vip": is_vip,
-            "source": "referral"
-        }
-        
-    except Exception as e:
-        logger.error(f"Errore nel processare referral bonus per user {user_id}: {e}")
-        return None
-
 
 # ============ PROGETTI: VENDITA SEMPLIFICATA ======================
 @admin_bp.post("/projects/<int:pid>/sell")
 @admin_required
 def projects_sell(pid):
-    """Imposta il progetto come 'sold', distribuisce i profitti agli investitori e calcola i bonus referral.
+    """Imposta il progetto come 'sold' e distribuisce capitale e profitti netti agli investitori.
 
-    Input JSON: { "sale_price": number }
+    Input JSON: { "sale_price": number, "dry_run": bool }
+    Con dry_run restituisce gli importi per investitore senza modificare nulla.
     """
     try:
         data = request.get_json() or {}
@@ -661,111 +598,89 @@ def projects_sell(pid):
             return jsonify({"error": "Inserisci un prezzo di vendita valido"}), 400
         
         with get_conn() as conn, conn.cursor() as cur:
-            conn.autocommit = False
-
-            # Blocco il progetto e leggo i dati essenziali
-            cur.execute(
-                """
-                SELECT id, status, COALESCE(funded_amount, 0) AS funded_amount
-                FROM projects 
-                WHERE id = %s
-                """,
-                (pid,),
-            )
-            project = cur.fetchone()
-            if not project:
-                return jsonify({"error": "Progetto non trovato"}), 404
+            if data.get("dry_run"):
+                preview = preview_sale(cur, pid, sale_price)
+                conn.rollback()
+                return jsonify({"dry_run": True, **preview})
             
-            # dict_row: accedi per chiave
-            project_status = project.get('status') if isinstance(project, dict) else project[1]
-            if project_status != "completed":
-                return jsonify({"error": "Il progetto deve essere in stato 'completed'"}), 400
-
-            # Recupero investimenti attivi
-            cur.execute(
-                """
-                SELECT id, user_id, amount
-                FROM investments
-                WHERE project_id = %s AND status = 'active'
-                """,
-                (pid,),
+            # Liquidazione di tutti gli investitori in un'unica transazione
+            result = settle_sale(cur, pid, sale_price)
+            conn.commit()
+            
+            return jsonify(
+                {
+                    "success": True,
+                    "message": "Vendita completata. Profitti distribuiti, bonus referral in maturazione nel run mensile.",
+                    "total_profit": result['total_profit'],
+                    "investors": result['investors'],
+                }
             )
-            investments = cur.fetchall() or []
-
-            # Calcolo totale investito (fallback a somma investimenti se funded_amount non affidabile)
-            funded_amount_value = project.get('funded_amount') if isinstance(project, dict) else project[2]
-            total_invested = float(funded_amount_value or 0)
-            if total_invested <= 0 and investments:
-                total_invested = sum(float(inv.get('amount') if isinstance(inv, dict) else inv[2]) for inv in investments)
-
-            if total_invested <= 0:
-                return jsonify({"error": "Nessun investimento registrato per il progetto"}), 400
+    
+    except SettlementError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        return jsonify({"error": f"Errore durante la vendita: {str(e)}"}), 500
 
-            total_profit = float(sale_price) - total_invested
+@admin_bp.post("/projects/<int:pid>/yields")
+@admin_required
+@idempotent
+def projects_accrue_yields(pid):
+    """Matura i rendimenti del periodo per tutti gli investimenti attivi del progetto.
 
-            # Calcola profit_percentage e aggiorna progetto a 'sold'
-            profit_percentage = (total_profit / total_invested) * 100 if total_invested > 0 else 0
-            cur.execute(
-                """
-                    UPDATE projects 
-                SET status = 'sold', sale_price = %s, sold_at = NOW(), profit_percentage = %s
-                    WHERE id = %s
-                """,
-                (sale_price, profit_percentage, pid),
-            )
+    Input JSON: { "period_start": "AAAA-MM-GG", "period_end": "AAAA-MM-GG", "annual_rate": number, "dry_run": bool }
+    Con dry_run restituisce i rendimenti per investimento senza modificare nulla.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        period_start, period_end, annual_rate = parse_yield_request(data)
+        with get_conn() as conn, conn.cursor() as cur:
+            if data.get("dry_run"):
+                preview = preview_yields(cur, pid, period_start, period_end, annual_rate)
+                conn.rollback()
+                return jsonify({"dry_run": True, **preview})
 
-            # Imposto tutti gli investimenti a completed
-            cur.execute(
-                """
-                UPDATE investments SET status = 'completed' WHERE project_id = %s AND status = 'active'
-                """,
-                (pid,),
-            )
+            result = accrue_yields(cur, pid, period_start, period_end, annual_rate)
+            conn.commit()
+            return jsonify({"success": True, **result})
 
-            # Distribuzione profitti proporzionale e bonus referral
-            for inv in investments:
-                investment_amount = float(inv.get('amount') if isinstance(inv, dict) else inv[2])
-                if investment_amount <= 0:
-                    continue
-                user_id = int(inv.get('user_id') if isinstance(inv, dict) else inv[1])
-                profit_share = (investment_amount / total_invested) * total_profit
-
-                # Calcola i bonus referral PRIMA di aggiornare i profitti
-                referral_result = process_referral_bonus(cur, user_id, profit_share, pid)
-                total_referral_bonus = referral_result.get('bonus_amount', 0)
-                
-                # Se non è VIP, aggiungi anche il 2% che va all'utente ID 2
-                if not referral_result.get('is_vip', False):
-                    total_referral_bonus += profit_share * 0.02
+    except YieldAccrualError as e:
+        return jsonify({"error": str(e)}), e.status_code
+    except Exception as e:
+        return jsonify({"error": f"Errore durante la maturazione dei rendimenti: {str(e)}"}), 500
 
-                # Calcola profitto netto (profitto - bonus referral)
-                net_profit = profit_share - total_referral_bonus
+@admin_bp.get("/projects/<int:pid>/returns")
+@admin_required
+def projects_returns(pid):
+    """Rendimenti effettivi del progetto (XIRR / TWR) e di ogni suo investitore"""
+    with get_conn() as conn, conn.cursor() as cur:
+        project = get_returns(cur, 'project', project_ids=[pid])
+        investors = get_returns(cur, 'position', project_ids=[pid])
+    return jsonify({
+        "project": serialize_returns(project[0]) if project else None,
+        "investors": [serialize_returns(row) for row in investors],
+    })
 
-                # Upsert su user_portfolios: aggiungo ai profits (netto) e restituisco il capitale investito
-                cur.execute(
-                    """
-                    INSERT INTO user_portfolios (user_id, free_capital, invested_capital, referral_bonus, profits)
-                                    VALUES (%s, %s, -%s, 0, %s)
-                                    ON CONFLICT (user_id) 
-                    DO UPDATE SET 
-                        profits = user_portfolios.profits + EXCLUDED.profits,
-                        free_capital = user_portfolios.free_capital + EXCLUDED.free_capital,
-                        invested_capital = user_portfolios.invested_capital + EXCLUDED.invested_capital
-                    """,
-                    (user_id, investment_amount, investment_amount, net_profit),
-                )
+@admin_bp.post("/projects/<int:pid>/simulate")
+@admin_required
+def projects_simulate_sale(pid):
+    """Simulazione what-if della vendita su una griglia di prezzi e commissioni.
 
-                conn.commit()
-            return jsonify(
-                {
-                    "success": True,
-                    "message": "Vendita completata. Profitti e referral distribuiti.",
-                    "total_profit": total_profit,
-                }
-            )
-                
+    Input JSON: { "sale_prices": [number] | {"min", "max", "steps"}, "fee_rates": [0..1] }
+    """
+    data = request.get_json() or {}
+    try:
+        sale_prices, fee_rates = parse_grid(data)
+        with get_conn() as conn, conn.cursor() as cur:
+            project, investments = load_investments(cur, pid)
+            conn.rollback()
+        if not project:
+            return jsonify({"error": "Progetto non trovato"}), 404
+        return jsonify(simulate(project, investments, sale_prices, fee_rates))
+    except SimulationError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        return jsonify({"error": f"Errore durante la vendita: {str(e)}"}), 500
+        logger.exception(f"Errore nella simulazione vendita progetto {pid}: {e}")
+        return jsonify({"error": f"Errore durante la simulazione: {str(e)}"}), 500
 
 @admin_bp.delete("/projects/<int:pid>")
 @admin_required
@@ -801,33 +716,7 @@ def projects_delete(pid):
                 })
             else:
                 # Per progetti non venduti: rimborsa gli investimenti attivi
-                cur.execute("""
-                    SELECT i.id, i.user_id, i.amount, u.email
-                    FROM investments i
-                    JOIN users u ON u.id = i.user_id
-                    WHERE i.project_id = %s AND i.status = 'active'
-                """, (pid,))
-                investments = cur.fetchall()
-                
-                # Rimborsa tutti gli investimenti attivi
-                for investment in investments:
-                    user_id = investment['user_id']
-                    amount = investment['amount']
-                    
-                    # Aggiorna il portfolio dell'utente: rimuovi da invested_capital e aggiungi a free_capital
-                    cur.execute("""
-                        UPDATE user_portfolios 
-                        SET invested_capital = invested_capital - %s,
-                            free_capital = free_capital + %s
-                        WHERE user_id = %s
-                    """, (amount, amount, user_id))
-                    
-                    # Se il portfolio non esiste, crealo
-                    if cur.rowcount == 0:
-                        cur.execute("""
-                            INSERT INTO user_portfolios (user_id, free_capital, invested_capital, profits, referral_bonus)
-                            VALUES (%s, %s, 0, 0, 0)
-                        """, (user_id, amount))
+                refunds = refund_investments(cur, pid)
                 
                 # Elimina tutti gli investimenti per questo progetto
                 cur.execute("DELETE FROM investments WHERE project_id = %s", (pid,))
@@ -840,7 +729,7 @@ def projects_delete(pid):
                 
                 return jsonify({
                     "deleted": True, 
-                    "message": f"Progetto eliminato. Rimborsati {len(investments)} investimenti per un totale di €{project.get('funded_amount', 0) if isinstance(project, dict) else project[2]:,.2f}"
+                    "message": f"Progetto eliminato. Rimborsati {refunds['refunded_investments']} investimenti per un totale di €{refunds['total_refunded']:,.2f}"
                 })
             
     except Exception as e:
@@ -1255,32 +1144,26 @@ def get_portfolio_overview():
         """)
         top_users = cur.fetchall()
         
-        # Timeline crescita (ultimi 30 giorni)
-        cur.execute("""
-            SELECT 
-                DATE(pt.created_at) as date,
-                SUM(CASE WHEN pt.amount > 0 THEN pt.amount ELSE 0 END) as daily_inflow,
-                SUM(CASE WHEN pt.amount < 0 THEN ABS(pt.amount) ELSE 0 END) as daily_outflow
-            FROM portfolio_transactions pt
-            WHERE pt.created_at >= NOW() - INTERVAL '30 days'
-            GROUP BY DATE(pt.created_at)
-            ORDER BY date
-        """)
-        timeline_data = cur.fetchall()
-        
-        # Processa timeline per chart
-        labels = []
-        total_capital_timeline = []
-        invested_capital_timeline = []
+        # Timeline crescita (ultimi 30 giorni) dagli snapshot giornalieri
+        timeline = platform_timeline(cur, 30)
+        labels = [day['snapshot_date'].strftime('%d/%m') for day in timeline]
+        total_capital_timeline = [
+            float(day['free_capital'] + day['invested_capital'] + day['referral_bonus'] + day['profits'])
+            for day in timeline
+        ]
+        invested_capital_timeline = [float(day['invested_capital']) for day in timeline]
         
-        running_total = 0
-        running_invested = 0
+        # Variazione del capitale rispetto al primo giorno della serie
+        first_total = total_capital_timeline[0]
+        capital_change = round((total_capital_timeline[-1] - first_total) / first_total * 100, 1) if first_total else 0
         
-        for day in timeline_data:
-            labels.append(day['date'].strftime('%d/%m'))
-            running_total += (day['daily_inflow'] - day['daily_outflow'])
-            total_capital_timeline.append(running_total)
-            invested_capital_timeline.append(running_invested)  # Simplified
+        cur.execute("""
+            SELECT
+                (SELECT COUNT(*) FROM user_portfolios WHERE referral_bonus > 0) AS bonus_users,
+                (SELECT AVG(profit_earned / amount * 100) FROM investments
+                 WHERE status = 'completed' AND profit_earned IS NOT NULL) AS average_roi
+        """)
+        extra = cur.fetchone()
         
         return {
             "overview": {
@@ -1290,9 +1173,9 @@ def get_portfolio_overview():
                 "bonus_total": overview['total_bonus'],
                 "profits_total": overview['total_profits'],
                 "total_users": overview['total_users'],
-                "capital_change": 5.2,  # Mock data
-                "bonus_users": 45,      # Mock data
-                "average_roi": 8.5      # Mock data
+                "capital_change": capital_change,
+                "bonus_users": extra['bonus_users'],
+                "average_roi": round(float(extra['average_roi'] or 0), 1)
             },
             "transactions": transactions,
             "topUsers": top_users,
@@ -1307,36 +1190,128 @@ def get_portfolio_overview():
 @admin_required
 def portfolio_timeline():
     """Timeline crescita portfolio per periodo specifico"""
-    period = int(request.args.get('period', 30))
+    period = min(max(request.args.get('period', 30, type=int) or 30, 1), 3650)
     
     with get_conn() as conn, conn.cursor() as cur:
-        cur.execute("""
-            SELECT 
-                DATE(pt.created_at) as date,
-                SUM(CASE WHEN pt.amount > 0 THEN pt.amount ELSE 0 END) as daily_inflow,
-                SUM(CASE WHEN pt.amount < 0 THEN ABS(pt.amount) ELSE 0 END) as daily_outflow
-            FROM portfolio_transactions pt
-            WHERE pt.created_at >= NOW() - INTERVAL '%s days'
-            GROUP BY DATE(pt.created_at)
-            ORDER BY date
-        """, (period,))
-        
-        timeline_data = cur.fetchall()
-        
-        labels = []
-        total_capital_timeline = []
-        invested_capital_timeline = []
+        timeline = platform_timeline(cur, period)
+    
+    return jsonify({
+        "labels": [day['snapshot_date'].strftime('%d/%m') for day in timeline],
+        "total_capital": [
+            float(day['free_capital'] + day['invested_capital'] + day['referral_bonus'] + day['profits'])
+            for day in timeline
+        ],
+        "invested_capital": [float(day['invested_capital']) for day in timeline],
+        "free_capital": [float(day['free_capital']) for day in timeline],
+        "referral_bonus": [float(day['referral_bonus']) for day in timeline],
+        "profits": [float(day['profits']) for day in timeline],
+        "deposits": [float(day.get('deposits') or 0) for day in timeline],
+        "withdrawals": [float(day.get('withdrawals') or 0) for day in timeline]
+    })
+
+@admin_bp.post("/portfolio/snapshots/run")
+@admin_required
+def portfolio_snapshots_run():
+    """Calcola gli snapshot giornalieri mancanti o ricalcola un intervallo.
+    Body JSON: { from?: 'AAAA-MM-GG', to?: 'AAAA-MM-GG' }
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        start = date.fromisoformat(data['from']) if data.get('from') else None
+        end = date.fromisoformat(data['to']) if data.get('to') else None
+        days = run_snapshots(start, end)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if days is None:
+        return jsonify({'error': 'Calcolo snapshot già in corso'}), 409
+    return jsonify({'success': True, 'days': days})
+
+@admin_bp.get("/portfolio/reconciliation")
+@admin_required
+def portfolio_reconciliation():
+    """Report riconciliazione saldi"""
+    return render_template('admin/portfolio/reconciliation.html')
+
+@admin_bp.get("/api/portfolio/reconciliation")
+@admin_required
+def api_portfolio_reconciliation():
+    """Differenze aperte tra saldi attesi e user_portfolios, con gli ultimi run"""
+    limit = min(max(request.args.get('limit', 100, type=int) or 100, 1), 500)
+    offset = max(request.args.get('offset', 0, type=int) or 0, 0)
+    section = request.args.get('section') or None
+    with get_conn() as conn, conn.cursor() as cur:
+        rows = list_discrepancies(cur, limit, offset, section)
+        runs = recent_runs(cur)
+    return jsonify({
+        'total': rows[0]['total'] if rows else 0,
+        'discrepancies': [
+            {
+                'user_id': row['user_id'],
+                'name': f"{row['nome'] or ''} {row['cognome'] or ''}".strip(),
+                'email': row['email'],
+                'section': row['section'],
+                'expected': float(row['expected']),
+                'actual': float(row['actual']),
+                'difference': float(row['difference']),
+                'first_seen_at': row['first_seen_at'].isoformat(),
+                'last_seen_at': row['last_seen_at'].isoformat(),
+            }
+            for row in rows
+        ],
+        'runs': [
+            {
+                **run,
+                'since': run['since'].isoformat() if run['since'] else None,
+                'started_at': run['started_at'].isoformat(),
+                'completed_at': run['completed_at'].isoformat() if run['completed_at'] else None,
+                'total_difference': float(run['total_difference']),
+            }
+            for run in runs
+        ],
+    })
+
+@admin_bp.post("/api/portfolio/reconciliation/run")
+@admin_required
+def api_portfolio_reconciliation_run():
+    """Avvia una riconciliazione. Body JSON: { full?: bool } - default incrementale"""
+    data = request.get_json(silent=True) or {}
+    summary = run_reconciliation(bool(data.get('full')), session.get('user_id'))
+    if summary is None:
+        return jsonify({'error': 'Riconciliazione già in corso'}), 409
+    return jsonify({'success': True, **summary})
+
+def stream_csv_response(query, params, header, row_builder, filename_prefix, itersize=2000):
+    """Risposta CSV in streaming da un cursore server-side (memoria costante)"""
+    import csv
+    from io import StringIO
+    from flask import Response
+    
+    def generate():
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header)
         
-        for day in timeline_data:
-            labels.append(day['date'].strftime('%d/%m'))
-            total_capital_timeline.append(day['daily_inflow'] - day['daily_outflow'])
-            invested_capital_timeline.append(day['daily_inflow'] * 0.7)  # Simplified
+        # Cursore con nome: le righe arrivano dal server a blocchi di itersize
+        with get_conn() as conn:
+            with conn.cursor(name=f"{filename_prefix}_{uuid.uuid4().hex}") as cur:
+                cur.itersize = itersize
+                cur.execute(query, params)
+                for row in cur:
+                    writer.writerow(row_builder(row))
+                    if buffer.tell() >= 64 * 1024:
+                        yield buffer.getvalue()
+                        buffer.seek(0)
+                        buffer.truncate(0)
         
-        return jsonify({
-            "labels": labels,
-            "total_capital": total_capital_timeline,
-            "invested_capital": invested_capital_timeline
-        })
+        yield buffer.getvalue()
+    
+    filename = f"{filename_prefix}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+    
+    return Response(
+        generate(),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
 
 @admin_bp.get("/projects/export")
 @admin_required
@@ -1345,37 +1320,28 @@ def projects_export():
     format_type = request.args.get('format', 'csv')
     project_ids = request.args.get('ids')
     
-    with get_conn() as conn, conn.cursor() as cur:
-        if project_ids:
-            # Esporta progetti selezionati
-            ids = project_ids.split(',')
-            placeholders = ','.join(['%s'] * len(ids))
-            query = f"SELECT * FROM projects WHERE id IN ({placeholders}) ORDER BY created_at DESC"
-            cur.execute(query, ids)
-        else:
-            # Esporta tutti i progetti
-            cur.execute("SELECT * FROM projects ORDER BY created_at DESC")
-        
-        projects = cur.fetchall()
+    if project_ids:
+        # Esporta progetti selezionati
+        try:
+            ids = [int(pid) for pid in project_ids.split(',') if pid.strip()]
+        except ValueError:
+            return jsonify({'error': 'ID progetti non validi'}), 400
+        query = "SELECT * FROM projects WHERE id = ANY(%s) ORDER BY created_at DESC"
+        params = [ids]
+    else:
+        # Esporta tutti i progetti
+        query = "SELECT * FROM projects ORDER BY created_at DESC"
+        params = []
     
     if format_type == 'csv':
-        import csv
-        from io import StringIO
-        from flask import Response
-        
-        output = StringIO()
-        writer = csv.writer(output)
-        
-        # Header CSV
-        writer.writerow([
+        header = [
             'ID', 'Codice', 'Nome', 'Descrizione', 'Localit', 'Tipologia',
             'Importo Totale', 'Min Investment', 'RA', 'Stato',
             'Data Inizio', 'Data Fine', 'Data Creazione'
-        ])
+        ]
         
-        # Dati progetti
-        for project in projects:
-            writer.writerow([
+        def project_row(project):
+            return [
                 project.get('id', ''),
                 project.get('code', ''),
                 project.get('name', ''),
@@ -1387,18 +1353,15 @@ def projects_export():
                 project.get('roi', ''),
                 project.get('status', ''),
                 project.get('start_date', ''),
+                project.get('end_date', ''),
                 project.get('created_at', '')
-            ])
-        
-        output.seek(0)
-        
-        filename = f"progetti_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+            ]
         
-        return Response(
-            output.getvalue(),
-            mimetype='text/csv',
-            headers={'Content-Disposition': f'attachment; filename={filename}'}
-        )
+        return stream_csv_response(query, params, header, project_row, 'progetti_export')
+    
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute(query, params)
+        projects = cur.fetchall()
     
     return jsonify(projects)
 
@@ -1685,57 +1648,45 @@ def kyc_export():
     status = request.args.get('status')
     search = request.args.get('search')
     
-    with get_conn() as conn, conn.cursor() as cur:
-        # Build query with filters
-        where_conditions = ["u.role = 'investor'"]
-        params = []
-        
-        if status:
-            where_conditions.append("u.kyc_status = %s")
-            params.append(status)
-        
-        if search:
-            where_conditions.append("""
-                (u.nome ILIKE %s OR u.email ILIKE %s OR u.telefono ILIKE %s)
-            """)
-            search_param = f"%{search}%"
-            params.extend([search_param, search_param, search_param])
-        
-        where_clause = " AND ".join(where_conditions)
-        
-        cur.execute(f"""
-            SELECT 
-                u.id, u.nome, u.email, u.telefono, u.address,
-                u.kyc_status, u.created_at, u.kyc_notes,
-                COUNT(d.id) as documents_count
-            FROM users u
-            LEFT JOIN documents d ON d.user_id = u.id
-            LEFT JOIN doc_categories dc ON dc.id = d.category_id AND dc.is_kyc = true
-            WHERE {where_clause}
-            GROUP BY u.id, u.nome, u.email, u.telefono, u.address, 
-                     u.kyc_status, u.created_at, u.kyc_notes
-            ORDER BY u.created_at DESC
-        """, params)
-        
-        kyc_requests = cur.fetchall()
+    # Build query with filters
+    where_conditions = ["u.role = 'investor'"]
+    params = []
+    
+    if status:
+        where_conditions.append("u.kyc_status = %s")
+        params.append(status)
+    
+    if search:
+        where_conditions.append("""
+            (u.nome ILIKE %s OR u.email ILIKE %s OR u.telefono ILIKE %s)
+        """)
+        search_param = f"%{search}%"
+        params.extend([search_param, search_param, search_param])
+    
+    where_clause = " AND ".join(where_conditions)
+    
+    query = f"""
+        SELECT 
+            u.id, u.nome, u.email, u.telefono, u.address,
+            u.kyc_status, u.created_at, u.kyc_notes,
+            COUNT(d.id) as documents_count
+        FROM users u
+        LEFT JOIN documents d ON d.user_id = u.id
+        LEFT JOIN doc_categories dc ON dc.id = d.category_id AND dc.is_kyc = true
+        WHERE {where_clause}
+        GROUP BY u.id, u.nome, u.email, u.telefono, u.address, 
+                 u.kyc_status, u.created_at, u.kyc_notes
+        ORDER BY u.created_at DESC
+    """
     
     if format_type == 'csv':
-        import csv
-        from io import StringIO
-        from flask import Response
-        
-        output = StringIO()
-        writer = csv.writer(output)
-        
-        # Header CSV
-        writer.writerow([
+        header = [
             'ID', 'Nome Completo', 'Email', 'Telefono', 'Indirizzo',
             'Stato KYC', 'Data Registrazione', 'Note', 'Documenti'
-        ])
+        ]
         
-        # Dati utenti
-        for user in kyc_requests:
-            writer.writerow([
+        def kyc_row(user):
+            return [
                 user.get('id', ''),
                 user.get('nome', ''),
                 user.get('email', ''),
@@ -1745,17 +1696,13 @@ def kyc_export():
                 user.get('created_at', ''),
                 user.get('kyc_notes', ''),
                 user.get('documents_count', 0)
-            ])
+            ]
         
-        output.seek(0)
-        
-        filename = f"kyc_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        
-        return Response(
-            output.getvalue(),
-            mimetype='text/csv',
-            headers={'Content-Disposition': f'attachment; filename={filename}'}
-        )
+        return stream_csv_response(query, params, header, kyc_row, 'kyc_export')
+    
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute(query, params)
+        kyc_requests = cur.fetchall()
     
     return jsonify(kyc_requests)
 
@@ -1826,104 +1773,225 @@ def users_stats():
             'growth': round(growth, 1)
         })
 
-def get_users_list():
-    """Helper per ottenere lista utenti con filtri"""
+from backend.shared.search import search_condition, USER_SEARCH_COLUMNS
+
+USERS_PAGE_SIZE = 50
+USERS_PAGE_MAX = 200
+
+# Colonne lista utenti: statistiche investimenti calcolate solo per le righe restituite
+USERS_LIST_SELECT = """
+    SELECT 
+        u.id, u.nome, u.cognome, u.email, u.telefono, u.nome_telegram, u.address,
+        u.kyc_status, u.role, u.is_vip, u.created_at,
+        up.free_capital + up.invested_capital + up.referral_bonus + up.profits as portfolio_balance,
+        COALESCE(inv_stats.investments_count, 0) as investments_count,
+        COALESCE(inv_stats.investment_volume, 0) as investment_volume,
+        COALESCE(inv_stats.investments_count, 0) > 0 as has_investments,
+        up.referral_bonus,
+        up.profits,
+        (up.free_capital + up.invested_capital + up.referral_bonus + up.profits) as portfolio_total,
+        {sort_value} as sort_value
+    FROM users u
+    LEFT JOIN user_portfolios up ON up.user_id = u.id
+    LEFT JOIN LATERAL (
+        SELECT 
+            COUNT(*) as investments_count,
+            SUM(amount) as investment_volume
+        FROM investments i
+        WHERE i.user_id = u.id AND i.status IN ('active', 'completed')
+    ) inv_stats ON true
+    {where_clause}
+    ORDER BY {order_by}
+"""
+
+def users_list_filters(default_roles=None):
+    """Condizioni SQL e parametri della lista utenti dai filtri della richiesta"""
     kyc_status = request.args.get('kyc_status')
     role = request.args.get('role')
     investment_status = request.args.get('investment_status')
+    has_investments = request.args.get('has_investments')
     date_range = request.args.get('date_range')
     search = request.args.get('search')
-    sort = request.args.get('sort', 'created_at_desc')
+    min_balance = request.args.get('min_balance', type=float)
+    max_balance = request.args.get('max_balance', type=float)
+    
+    # Build WHERE conditions
+    where_conditions = []
+    params = []
+    
+    if kyc_status:
+        where_conditions.append("u.kyc_status = %s")
+        params.append(kyc_status)
+    
+    if role:
+        where_conditions.append("u.role = %s")
+        params.append(role)
+    elif default_roles:
+        where_conditions.append("u.role = ANY(%s)")
+        params.append(list(default_roles))
+    
+    if search:
+        # Sottostringa servita dagli indici trigram (gin_trgm_ops)
+        search_sql, search_params = search_condition(USER_SEARCH_COLUMNS, search)
+        where_conditions.append(search_sql)
+        params.extend(search_params)
+    
+    # Date range filter
+    if date_range:
+        if date_range == 'today':
+            where_conditions.append("u.created_at >= CURRENT_DATE")
+        elif date_range == 'week':
+            where_conditions.append("u.created_at >= CURRENT_DATE - INTERVAL '7 days'")
+        elif date_range == 'month':
+            where_conditions.append("u.created_at >= CURRENT_DATE - INTERVAL '30 days'")
+        elif date_range == 'quarter':
+            where_conditions.append("u.created_at >= CURRENT_DATE - INTERVAL '90 days'")
+    
+    # Investment status filter (semi-join su idx_investments_user_active)
+    if has_investments in ('true', '1'):
+        investment_status = 'with_investments'
+    elif has_investments in ('false', '0'):
+        investment_status = 'without_investments'
+    
+    if investment_status in ('with_investments', 'without_investments'):
+        negate = "" if investment_status == 'with_investments' else "NOT "
+        where_conditions.append(f"""
+            {negate}EXISTS (
+                SELECT 1 FROM investments i
+                WHERE i.user_id = u.id AND i.status IN ('active', 'completed')
+            )
+        """)
+    
+    # Balance range filter
+    if min_balance is not None:
+        where_conditions.append("COALESCE(up.free_capital + up.invested_capital + up.referral_bonus + up.profits, 0) >= %s")
+        params.append(min_balance)
+    
+    if max_balance is not None:
+        where_conditions.append("COALESCE(up.free_capital + up.invested_capital + up.referral_bonus + up.profits, 0) <= %s")
+        params.append(max_balance)
+    
+    return where_conditions, params
+
+# Ordinamenti della lista utenti: (espressione, direzione, tipo SQL del valore nel cursore).
+# Sempre con u.id come spareggio nella stessa direzione, così la paginazione keyset è stabile.
+USERS_SORTS = {
+    'created_at_desc': ('u.created_at', 'DESC', 'timestamptz'),
+    'created_at_asc': ('u.created_at', 'ASC', 'timestamptz'),
+    'name_asc': ("COALESCE(u.nome, '')", 'ASC', 'text'),
+    'name_desc': ("COALESCE(u.nome, '')", 'DESC', 'text'),
+    'kyc_status': ("""CASE u.kyc_status
+                WHEN 'verified' THEN 1
+                WHEN 'pending' THEN 2
+                WHEN 'rejected' THEN 3
+                WHEN 'unverified' THEN 4
+                ELSE 5
+            END""", 'ASC', 'int'),
+    'investment_volume': ('COALESCE(up.free_capital + up.invested_capital + up.referral_bonus + up.profits, 0)',
+                          'DESC', 'numeric'),
+}
+DEFAULT_USERS_SORT = 'created_at_desc'
+
+def users_sort(sort):
+    """Ordinamento richiesto (ValueError se non supportato)"""
+    sort = sort or DEFAULT_USERS_SORT
+    if sort not in USERS_SORTS:
+        raise ValueError(f"Ordinamento non supportato: {sort}")
+    return sort
+
+def users_order_by(sort):
+    expression, direction, _ = USERS_SORTS[sort]
+    return f"{expression} {direction}, u.id {direction}"
+
+def build_users_list_query(default_roles=None):
+    """Costruisce query e parametri della lista utenti completa (export)"""
+    sort = request.args.get('sort', DEFAULT_USERS_SORT)
+    where_conditions, params = users_list_filters(default_roles)
+    where_clause = "WHERE " + " AND ".join(where_conditions) if where_conditions else ""
+    sort = sort if sort in USERS_SORTS else DEFAULT_USERS_SORT
+    
+    query = USERS_LIST_SELECT.format(
+        where_clause=where_clause,
+        sort_value=USERS_SORTS[sort][0],
+        order_by=users_order_by(sort)
+    )
+    return query, params
+
+def encode_users_cursor(row, sort):
+    """Cursore opaco per la paginazione keyset su (valore di ordinamento, id)"""
+    raw = json.dumps([sort, None if row['sort_value'] is None else str(row['sort_value']), row['id']])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_users_cursor(cursor, sort):
+    """(valore di ordinamento, id) dal cursore; ValueError se non valido o di un altro ordinamento"""
+    cursor_sort, value, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    if cursor_sort != sort:
+        raise ValueError("Cursore di un altro ordinamento")
+    return value, int(user_id)
+
+def estimate_query_rows(cur, query, params):
+    """Stima delle righe dal planner (EXPLAIN), senza eseguire la query"""
+    cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+    plan = cur.fetchone()['QUERY PLAN']
+    return int(plan[0]['Plan']['Plan Rows'])
+
+def get_users_list(default_roles=None):
+    """Pagina di utenti con filtri in SQL e paginazione keyset su (valore di ordinamento, id)"""
+    limit = min(max(request.args.get('limit', USERS_PAGE_SIZE, type=int), 1), USERS_PAGE_MAX)
+    cursor = request.args.get('cursor')
+    count_mode = request.args.get('count', 'approx')  # approx | exact | none
+    sort = users_sort(request.args.get('sort'))
+    expression, direction, value_type = USERS_SORTS[sort]
+    
+    where_conditions, params = users_list_filters(default_roles)
+    count_where = "WHERE " + " AND ".join(where_conditions) if where_conditions else ""
+    count_params = list(params)
+    
+    if cursor:
+        try:
+            after_value, after_id = decode_users_cursor(cursor, sort)
+        except (ValueError, TypeError, UnicodeDecodeError):
+            raise ValueError("Cursore non valido")
+        where_conditions.append(
+            f"({expression}, u.id) {'<' if direction == 'DESC' else '>'} (%s::{value_type}, %s)"
+        )
+        params.extend([after_value, after_id])
+    
+    where_clause = "WHERE " + " AND ".join(where_conditions) if where_conditions else ""
+    query = USERS_LIST_SELECT.format(
+        where_clause=where_clause,
+        sort_value=expression,
+        order_by=users_order_by(sort)
+    ) + " LIMIT %s"
+    params.append(limit + 1)
     
     with get_conn() as conn, conn.cursor() as cur:
-        # Build WHERE conditions
-        where_conditions = []
-        params = []
-        
-        if kyc_status:
-            where_conditions.append("u.kyc_status = %s")
-            params.append(kyc_status)
-        
-        if role:
-            where_conditions.append("u.role = %s")
-            params.append(role)
-        
-        if search:
-            where_conditions.append("""
-                (u.nome ILIKE %s OR u.email ILIKE %s OR u.telefono ILIKE %s)
-            """)
-            search_param = f"%{search}%"
-            params.extend([search_param, search_param, search_param])
-        
-        # Date range filter
-        if date_range:
-            if date_range == 'today':
-                where_conditions.append("u.created_at >= CURRENT_DATE")
-            elif date_range == 'week':
-                where_conditions.append("u.created_at >= CURRENT_DATE - INTERVAL '7 days'")
-            elif date_range == 'month':
-                where_conditions.append("u.created_at >= CURRENT_DATE - INTERVAL '30 days'")
-            elif date_range == 'quarter':
-                where_conditions.append("u.created_at >= CURRENT_DATE - INTERVAL '90 days'")
-        
-        where_clause = "WHERE " + " AND ".join(where_conditions) if where_conditions else ""
-        
-        # Build ORDER BY
-        order_mapping = {
-            'created_at_desc': 'u.created_at DESC',
-            'created_at_asc': 'u.created_at ASC',
-            'name_asc': 'u.nome ASC',
-            'name_desc': 'u.nome DESC',
-            'kyc_status': """
-                CASE u.kyc_status 
-                    WHEN 'verified' THEN 1 
-                    WHEN 'pending' THEN 2
-                    WHEN 'rejected' THEN 3
-                    WHEN 'unverified' THEN 4
-                END
-            """,
-            'investment_volume': 'COALESCE(portfolio_total, 0) DESC'
-        }
-        order_by = order_mapping.get(sort, 'u.created_at DESC')
-        
-        # Main query
-        query = f"""
-            SELECT 
-                u.id, u.nome, u.email, u.telefono, u.address,
-                u.kyc_status, u.role, u.created_at,
-                up.free_capital + up.invested_capital + up.referral_bonus + up.profits as portfolio_balance,
-                COALESCE(inv_stats.investments_count, 0) as investments_count,
-                COALESCE(inv_stats.investment_volume, 0) as investment_volume,
-                CASE WHEN inv_stats.investments_count > 0 THEN true ELSE false END as has_investments,
-                up.referral_bonus,
-                up.profits,
-                (up.free_capital + up.invested_capital + up.referral_bonus + up.profits) as portfolio_total
-            FROM users u
-            LEFT JOIN user_portfolios up ON up.user_id = u.id
-            LEFT JOIN (
-                SELECT 
-                    user_id,
-                    COUNT(*) as investments_count,
-                    SUM(amount) as investment_volume
-                FROM investments 
-                WHERE status IN ('active', 'completed')
-                GROUP BY user_id
-            ) inv_stats ON inv_stats.user_id = u.id
-            {where_clause}
-            ORDER BY {order_by}
-        """
-        
         cur.execute(query, params)
         users = cur.fetchall()
         
-        # Investment status filter (post-query because it's complex)
-        if investment_status:
-            if investment_status == 'with_investments':
-                users = [u for u in users if u.get('has_investments')]
-            elif investment_status == 'without_investments':
-                users = [u for u in users if not u.get('has_investments')]
+        has_more = len(users) > limit
+        users = users[:limit]
         
-        return users
+        # Totale: esatto solo su richiesta, altrimenti stima del planner
+        total = None
+        count_query = f"""
+            SELECT 1 FROM users u
+            LEFT JOIN user_portfolios up ON up.user_id = u.id
+            {count_where}
+        """
+        if count_mode == 'exact':
+            cur.execute(f"SELECT COUNT(*) AS total FROM ({count_query}) filtered", count_params)
+            total = cur.fetchone()['total']
+        elif count_mode == 'approx':
+            total = estimate_query_rows(cur, count_query, count_params)
+    
+    return {
+        'users': users,
+        'next_cursor': encode_users_cursor(users[-1], sort) if has_more and users else None,
+        'has_more': has_more,
+        'total': total,
+        'total_is_estimate': count_mode == 'approx'
+    }
 
 @admin_bp.get("/users/<int:user_id>")
 @admin_required
@@ -2101,26 +2169,17 @@ def users_export():
     """Esporta dati utenti in CSV"""
     format_type = request.args.get('format', 'csv')
     
-    # Usa la stessa logica di filtri della lista
-    users = get_users_list()
-    
     if format_type == 'csv':
-        import csv
-        from io import StringIO
-        from flask import Response
-        
-        output = StringIO()
-        writer = csv.writer(output)
+        # Usa la stessa logica di filtri della lista
+        query, params = build_users_list_query()
         
-        # Header CSV
-        writer.writerow([
+        header = [
             'ID', 'Nome Completo', 'Email', 'Telefono', 'Indirizzo',
             'Stato KYC', 'Ruolo', 'Portfolio Balance', 'Investimenti', 'Data Registrazione'
-        ])
+        ]
         
-        # Dati utenti
-        for user in users:
-            writer.writerow([
+        def user_row(user):
+            return [
                 user.get('id', ''),
                 user.get('nome', ''),
                 user.get('email', ''),
@@ -2131,19 +2190,14 @@ def users_export():
                 user.get('portfolio_balance', 0),
                 user.get('investments_count', 0),
                 user.get('created_at', '')
-            ])
-        
-        output.seek(0)
+            ]
         
-        filename = f"users_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-        
-        return Response(
-            output.getvalue(),
-            mimetype='text/csv',
-            headers={'Content-Disposition': f'attachment; filename={filename}'}
-        )
+        return stream_csv_response(query, params, header, user_row, 'users_export')
     
-    return jsonify(users)
+    try:
+        return jsonify(get_users_list())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
 # =====================================================
 # API Admin: Users Management (search, filters, detail, update)
@@ -2220,49 +2274,37 @@ def api_admin_users_list():
             if not user or user['role'] != 'admin':
                 return jsonify({"error": "Accesso negato"}), 403
         
-        # Query utenti
-        with get_conn() as conn, conn.cursor() as cur:
-            cur.execute("""
-                SELECT 
-                    u.id,
-                    u.email,
-                    u.nome,
-                    u.cognome,
-                    u.telefono,
-                    u.nome_telegram,
-                    u.role,
-                    u.kyc_status,
-                    u.created_at,
-                    u.address,
-                    u.is_vip
-                FROM users u
-                WHERE u.role IN ('investor', 'user')
-                ORDER BY u.created_at DESC
-            """)
-            users = cur.fetchall()
-            
-            # Converti in formato JSON
-            users_list = []
-            for u in users:
-                users_list.append({
-                    'id': u['id'],
-                    'nome': u['nome'],
-                    'cognome': u['cognome'],
-                    'email': u['email'],
-                    'phone': u['telefono'],
-                    'telegram': u['nome_telegram'],
-                    'investor_status': 'investor' if u['role'] == 'investor' else 'admin',
-                    'kyc_status': u['kyc_status'],
-                    'created_at': u['created_at'].isoformat() if u['created_at'] else None,
-                    'address': u['address'],
-                    'is_vip': u['is_vip']
-                })
-            
-            return jsonify({
-                "status": "ok",
-                "users": users_list,
-                "total": len(users_list)
+        # Query utenti: pagina keyset con filtri SQL
+        try:
+            page = get_users_list(default_roles=('investor', 'user'))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Converti in formato JSON
+        users_list = []
+        for u in page['users']:
+            users_list.append({
+                'id': u['id'],
+                'nome': u['nome'],
+                'cognome': u['cognome'],
+                'email': u['email'],
+                'phone': u['telefono'],
+                'telegram': u['nome_telegram'],
+                'investor_status': 'investor' if u['role'] == 'investor' else 'admin',
+                'kyc_status': u['kyc_status'],
+                'created_at': u['created_at'].isoformat() if u['created_at'] else None,
+                'address': u['address'],
+                'is_vip': u['is_vip']
             })
+        
+        return jsonify({
+            "status": "ok",
+            "users": users_list,
+            "total": page['total'],
+            "total_is_estimate": page['total_is_estimate'],
+            "next_cursor": page['next_cursor'],
+            "has_more": page['has_more']
+        })
             
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -2475,7 +2517,10 @@ def api_admin_user_portfolio(user_id: int):
 @admin_bp.patch("/api/admin/users/<int:user_id>/portfolio")
 @admin_required
 def api_admin_update_portfolio(user_id: int):
-    """Aggiorna i saldi del portafoglio utente (solo admin)."""
+    """Aggiorna i saldi del portafoglio utente (solo admin).
+    Override amministrativo: imposta valori assoluti, non delta, e non passa da balances.
+    Un movimento dell'utente avvenuto dopo che l'admin ha letto i saldi viene sovrascritto
+    per scelta; il ledger registra comunque la differenza effettiva come 'adjustment'."""
     try:
         data = request.get_json() or {}
         allowed = ['free_capital', 'invested_capital', 'referral_bonus', 'profits']
@@ -2503,6 +2548,8 @@ def api_admin_update_portfolio(user_id: int):
                 params.append(value)
             params.append(user_id)
 
+            # Valori assoluti (override): nessun controllo condizionale sul saldo precedente
+            set_ledger_context(cur, 'adjustment', 'Modifica manuale admin', reference_type='admin_adjustment')
             cur.execute(f"UPDATE user_portfolios SET {', '.join(set_parts)} WHERE user_id = %s", params)
             
             # Se è stato modificato invested_capital, sincronizza con la tabella investments
@@ -2609,15 +2656,11 @@ def api_admin_update_investment(user_id: int, investment_id: int):
                     params
                 )
                 
-                # Aggiorna il funded_amount del progetto
-                cur.execute("""
-                    UPDATE projects 
-                    SET funded_amount = funded_amount + %s,
-                        updated_at = NOW()
-                    WHERE id = %s
-                """, (difference, project_id))
+                # Aggiorna la raccolta del progetto (consolida e ridistribuisce gli shard)
+                adjust_funding(cur, project_id, difference)
                 
                 # Aggiorna anche il portfolio dell'utente
+                set_ledger_context(cur, 'adjustment', 'Modifica investimento da admin', investment_id, 'investment')
                 cur.execute("""
                     UPDATE user_portfolios 
                     SET invested_capital = invested_capital + %s,
@@ -2647,83 +2690,93 @@ def api_admin_update_investment(user_id: int, investment_id: int):
 @admin_bp.post("/api/admin/users/portfolio/bulk-adjust")
 @admin_required
 def api_admin_portfolio_bulk_adjust():
-    """Aggiunge o rimuove un importo dalla sezione profits di pi utenti.
-    Body: { user_ids: [int], op: 'add'|'remove', amount: number }
+    """Aggiunge o rimuove importi dalle sezioni del portafoglio di più utenti.
+    Body JSON: { user_ids: [int], op: 'add'|'remove', amount: number }
+           oppure { items: [{user_id, amount, op?, section?}], op?, section?, all_or_nothing? }
+    Multipart: file CSV (user_id,amount[,op][,section]) più op/section/all_or_nothing nel form
     """
-    data = request.get_json() or {}
-    user_ids = data.get('user_ids') or []
-    op = data.get('op')
-    amount = data.get('amount')
-
-    if not user_ids or op not in ('add', 'remove'):
-        return jsonify({'error': 'Parametri mancanti o non validi'}), 400
     try:
-        amount = float(amount)
-    except Exception:
-        return jsonify({'error': 'Importo non valido'}), 400
-    if amount <= 0:
-        return jsonify({'error': 'L\'importo deve essere positivo'}), 400
+        if 'file' in request.files:
+            options = request.form
+            rows = parse_adjust_csv(request.files['file'].stream)
+        else:
+            options = request.get_json() or {}
+            if options.get('items') is not None:
+                rows = options.get('items') or []
+            else:
+                rows = [{'user_id': uid, 'amount': options.get('amount')} for uid in options.get('user_ids') or []]
+        if not rows:
+            return jsonify({'error': 'Parametri mancanti o non validi'}), 400
+        all_or_nothing = str(options.get('all_or_nothing', 'true')).lower() not in ('0', 'false', 'no')
+        items, outcomes = normalize_rows(rows, options.get('op'), options.get('section') or 'profits')
+    except BulkAdjustError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if outcomes and all_or_nothing:
+        outcomes += [{'row': item['row'], 'user_id': item['user_id'], 'status': 'skipped'} for item in items]
+        return jsonify({'error': 'Righe non valide', 'results': sorted(outcomes, key=lambda o: o['row'])}), 400
 
     with get_conn() as conn, conn.cursor() as cur:
         ensure_admin_actions_table(cur)
-        # Assicura che esistano le righe per ciascun utente
-        for uid in user_ids:
-            cur.execute("SELECT 1 FROM user_portfolios WHERE user_id = %s", (uid,))
-            if not cur.fetchone():
-                cur.execute(
-                    "INSERT INTO user_portfolios (user_id, free_capital, invested_capital, referral_bonus, profits) VALUES (%s, 0, 0, 0, 0)",
-                    (uid,)
-                )
-
-        if op == 'remove':
-            # Verifica sufficienza profitti per ciascun utente
-            cur.execute(
-                "SELECT user_id, profits FROM user_portfolios WHERE user_id = ANY(%s)",
-                (user_ids,)
-            )
-            rows = cur.fetchall() or []
-            insufficient = [r['user_id'] for r in rows if float(r['profits']) < amount]
-            if insufficient:
-                return jsonify({'error': 'Profitti insufficienti per alcuni utenti', 'user_ids': insufficient}), 400
-            # Esegui sottrazione
-            cur.execute(
-                "UPDATE user_portfolios SET profits = profits - %s WHERE user_id = ANY(%s)",
-                (amount, user_ids)
-            )
+        results, applied = apply_adjustments(cur, items, session.get('user_id'), all_or_nothing)
+        if applied:
+            conn.commit()
         else:
-            # Esegui addizione
-            cur.execute(
-                "UPDATE user_portfolios SET profits = profits + %s WHERE user_id = ANY(%s)",
-                (amount, user_ids)
-            )
-        # Log azione
+            conn.rollback()
+
+    results = sorted(outcomes + results, key=lambda o: o['row'])
+    applied_count = sum(1 for r in results if r['status'] == 'applied')
+    if all_or_nothing and not applied:
+        insufficient = [r['user_id'] for r in results if r.get('error') == 'Saldo insufficiente']
+        error = 'Profitti insufficienti per alcuni utenti' if insufficient else 'Alcune rettifiche non sono applicabili'
+        return jsonify({'error': error, 'user_ids': insufficient, 'results': results}), 400
+    return jsonify({
+        'success': True,
+        'applied': applied_count,
+        'failed': len(results) - applied_count,
+        'results': results
+    })
+
+
+@admin_bp.get("/api/admin/users/<int:user_id>/portfolio/ledger")
+@admin_required
+def api_admin_user_ledger(user_id: int):
+    """Movimenti del ledger di un utente. Query: section, limit (max 200), before_id"""
+    section = request.args.get('section') or None
+    limit = min(request.args.get('limit', 50, type=int) or 50, 200)
+    before_id = request.args.get('before_id', type=int)
+    with get_conn() as conn, conn.cursor() as cur:
+        rows = ledger_history(cur, user_id, section, limit, before_id)
+    return jsonify({
+        'movements': rows,
+        'next_before_id': rows[-1]['id'] if len(rows) == limit else None
+    })
+
+
+@admin_bp.post("/api/admin/portfolio/ledger/rebuild")
+@admin_required
+def api_admin_rebuild_portfolios():
+    """Riallinea user_portfolios al ledger.
+    Body JSON: { user_ids?: [int], dry_run?: bool } - dry_run restituisce solo le differenze
+    """
+    data = request.get_json(silent=True) or {}
+    user_ids = data.get('user_ids') or None
+    if user_ids is not None and not all(isinstance(uid, int) for uid in user_ids):
+        return jsonify({'error': 'user_ids non valido'}), 400
+    with get_conn() as conn, conn.cursor() as cur:
+        differences = ledger_drift(cur, user_ids)
+        if data.get('dry_run') or not differences:
+            return jsonify({'success': True, 'dry_run': bool(data.get('dry_run')), 'differences': differences, 'fixed': []})
+        ensure_admin_actions_table(cur)
+        fixed = rebuild_portfolios(cur, user_ids)
         cur.execute(
             """
             INSERT INTO admin_actions (admin_id, action, target_type, target_id, details)
-            VALUES (%s, %s, 'bulk_users', 0, %s)
+            VALUES (%s, 'portfolio_rebuild', 'portfolio', 0, %s)
             """,
-            (session.get('user_id'), f'portfolio_{op}', f'Bulk {op} profits {amount} su {len(user_ids)} utenti')
+            (session.get('user_id'), json.dumps({'user_ids': fixed})),
         )
-        # Log per-utente per tracciabilit dettagliata
-        per_user_details = 'Aggiunta profitti' if op == 'add' else 'Rimozione profitti'
-        for uid in user_ids:
-            try:
-                cur.execute(
-                    """
-                    INSERT INTO admin_actions (admin_id, action, target_type, target_id, details)
-                    VALUES (%s, %s, 'user', %s, %s)
-                    """,
-                    (
-                        session.get('user_id'),
-                        f'portfolio_{op}',
-                        uid,
-                        f"{per_user_details} {amount} EUR"
-                    )
-                )
-            except Exception:
-                pass
-
-    return jsonify({'success': True})
+    return jsonify({'success': True, 'dry_run': False, 'differences': differences, 'fixed': fixed})
 
 
 @admin_bp.post("/api/admin/users/<int:user_id>/delete")
@@ -2760,6 +2813,8 @@ def api_admin_delete_user(user_id: int):
                 return jsonify({'error': 'Non è possibile eliminare un amministratore'}), 400
 
             # Prima di eliminare: fai "slittare" tutti gli invitati diretti al referrer del target
+            stats_ancestors = get_referral_ancestors(cur, [user_id])
+            closure_remove_user(cur, user_id)
             cur.execute("SELECT referred_by FROM users WHERE id = %s", (user_id,))
             parent_row = cur.fetchone()
             parent_id = parent_row.get('referred_by') if parent_row else None
@@ -2813,6 +2868,9 @@ def api_admin_delete_user(user_id: int):
             
             # 6. Infine elimina l'utente stesso
             cur.execute("DELETE FROM users WHERE id = %s", (user_id,))
+            
+            # 7. Statistiche referral della catena sopra l'utente eliminato
+            refresh_referral_stats(cur, stats_ancestors)
 
         return jsonify({'success': True, 'message': 'Utente eliminato'})
     
@@ -2913,24 +2971,71 @@ def api_admin_reset_user_password(user_id: int):
 @admin_required
 def api_admin_user_history(user_id: int):
     """Storico immutabile delle azioni admin su un utente."""
+    from backend.shared.search import search_condition, clamp_limit
+    search = (request.args.get('search') or '').strip()
+    limit = request.args.get('limit', type=int)
+    
     with get_conn() as conn, conn.cursor() as cur:
         ensure_admin_actions_table(cur)
-        cur.execute(
-            """
+        conditions = [
+            "a.target_type IN ('user','bulk_users') AND (a.target_id = %s OR a.target_id = 0)",
+            "(a.details IS NOT NULL OR a.action IN ('user_update','portfolio_update','investment_update','portfolio_add','portfolio_remove','user_delete'))"
+        ]
+        params = [user_id]
+        
+        if search:
+            # Ricerca nei dettagli, nell'azione e nell'email admin (indici trigram, admin via users)
+            search_sql, search_params = search_condition(['a.details', 'a.action'], search)
+            search_sql = f"({search_sql} OR a.admin_id = ANY(ARRAY(SELECT id FROM users WHERE email ILIKE %s)))"
+            search_params.append(search_params[0])
+            conditions.append(search_sql)
+            params.extend(search_params)
+        
+        query = f"""
             SELECT a.id, a.admin_id, a.action, a.target_type, a.target_id, a.details, a.created_at,
                    u.email as admin_email
             FROM admin_actions a
             LEFT JOIN users u ON u.id = a.admin_id
-            WHERE a.target_type IN ('user','bulk_users') AND (a.target_id = %s OR a.target_id = 0)
-              AND (a.details ILIKE %s OR a.action IN ('user_update','portfolio_update','investment_update','portfolio_add','portfolio_remove','user_delete'))
+            WHERE {' AND '.join(conditions)}
             ORDER BY a.created_at DESC
-            """,
-            (user_id, '%')
-        )
+        """
+        if limit:
+            query += " LIMIT %s"
+            params.append(clamp_limit(limit))
+        
+        cur.execute(query, params)
         items = cur.fetchall() or []
     return jsonify({'items': items})
 
 
+@admin_bp.get("/api/search")
+@admin_required
+def api_admin_search():
+    """Ricerca fuzzy ordinata per similarità su utenti, depositi o prelievi."""
+    from backend.shared.search import SEARCH_SCOPES
+    q = (request.args.get('q') or '').strip()
+    scope = request.args.get('scope', 'users')
+    limit = request.args.get('limit', type=int)
+    
+    if scope not in SEARCH_SCOPES:
+        return jsonify({'error': f"Ambito di ricerca non valido. Usa uno di: {', '.join(SEARCH_SCOPES)}"}), 400
+    
+    if len(q) < 2:
+        return jsonify({'error': 'Inserisci almeno 2 caratteri'}), 400
+    
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            results = SEARCH_SCOPES[scope](cur, q, limit)
+    except Exception as e:
+        logger.exception(f"Errore ricerca admin ({scope}): {e}")
+        return jsonify({'error': 'Errore interno del server'}), 500
+    
+    for row in results:
+        row['score'] = round(float(row['score'] or 0), 3)
+    
+    return jsonify({'scope': scope, 'query': q, 'results': results, 'count': len(results)})
+
+
 @admin_bp.get("/api/admin/users/history")
 @admin_required
 def api_admin_users_history():
@@ -3000,6 +3105,25 @@ def analytics_data():
     """Dati analytics con filtri temporali"""
     return jsonify(get_analytics_data())
 
+@admin_bp.get("/analytics/cache-stats")
+@admin_required
+def analytics_cache_stats():
+    """Statistiche cache analytics (hit/miss/coalesced) del worker corrente"""
+    from backend.shared import analytics_cache
+    return jsonify(analytics_cache.get_stats())
+
+@admin_bp.post("/analytics/cache/clear")
+@admin_required
+def analytics_cache_clear():
+    """Invalida la cache analytics"""
+    from backend.shared import analytics_cache
+    try:
+        analytics_cache.invalidate('analytics|')
+        return jsonify({'success': True})
+    except Exception as e:
+        logger.exception(f"Errore invalidazione cache analytics: {e}")
+        return jsonify({'error': 'Errore interno del server'}), 500
+
 # =====================================================
 # Admin page: Users management UI
 # =====================================================
@@ -3022,11 +3146,20 @@ def users_management_page():
     return render_template("admin/users/list.html")
 
 def get_analytics_data():
-    """Helper per ottenere dati analytics"""
+    """Helper per ottenere dati analytics (in cache per range e filtri)"""
+    from backend.shared import analytics_cache
     period = request.args.get('period', 'month')
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
+    force = request.args.get('refresh') == '1'
     
+    key = analytics_cache.make_key('analytics', period=period, start_date=start_date, end_date=end_date)
+    return analytics_cache.get_or_compute(
+        key, lambda: compute_analytics_data(period, start_date, end_date), force=force
+    )
+
+def compute_analytics_data(period, start_date=None, end_date=None):
+    """Calcola i dati analytics per periodo o range esplicito"""
     # Calculate date range based on period
     from datetime import datetime, timedelta
     now = datetime.now()
@@ -3376,6 +3509,11 @@ def get_top_projects_performance(cur, start_dt, end_dt):
     """, (start_dt, end_dt))
     
     projects = cur.fetchall()
+    # Rendimenti effettivi dai flussi di cassa (cache investment_returns)
+    performance = {
+        row['project_id']: serialize_returns(row)
+        for row in get_returns(cur, 'project', project_ids=[project['id'] for project in projects])
+    } if projects else {}
     
     return [
         {
@@ -3383,6 +3521,8 @@ def get_top_projects_performance(cur, start_dt, end_dt):
             'code': project['code'],
             'name': project['name'],
             'roi': float(project['roi']) if project['roi'] else 0,
+            'xirr': performance.get(project['id'], {}).get('xirr'),
+            'twr': performance.get(project['id'], {}).get('twr'),
             'volume': float(project['volume']),
             'investors': project['investors'],
             'funding_percentage': float(project['funding_percentage']),
@@ -3452,9 +3592,9 @@ def analytics_export():
     if format_type == 'csv':
         return export_analytics_csv(analytics_data, export_type)
     elif format_type == 'excel':
-        return export_analytics_excel(analytics_data)
+        return export_analytics_excel(analytics_data, export_type)
     elif format_type == 'pdf':
-        return export_analytics_pdf(analytics_data)
+        return export_analytics_pdf(analytics_data, export_type)
     elif format_type == 'json':
         return jsonify(analytics_data)
     
@@ -3514,15 +3654,96 @@ def export_analytics_csv(analytics_data, export_type):
         headers={'Content-Disposition': f'attachment; filename={filename}'}
     )
 
-def export_analytics_excel(analytics_data):
-    """Esporta analytics in Excel (placeholder)"""
-    # TODO: Implement Excel export using openpyxl
-    return jsonify({'message': 'Export Excel in sviluppo'}), 501
+def export_analytics_excel(analytics_data, export_type='full'):
+    """Esporta analytics in Excel (xlsx)"""
+    return export_analytics_report('excel', analytics_data, export_type)
 
-def export_analytics_pdf(analytics_data):
-    """Esporta analytics in PDF (placeholder)"""
-    # TODO: Implement PDF export using reportlab
-    return jsonify({'message': 'Export PDF in sviluppo'}), 501
+def export_analytics_pdf(analytics_data, export_type='full'):
+    """Esporta analytics in PDF"""
+    return export_analytics_report('pdf', analytics_data, export_type)
+
+def export_analytics_report(format_type, analytics_data, export_type):
+    """Genera il report subito o, oltre la soglia di righe, come job in background"""
+    from backend.admin import reports
+    from config.paths import REPORTS_DIR
+    
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            estimated_rows = reports.estimate_rows(cur, analytics_data, export_type)
+        
+        if estimated_rows > reports.ASYNC_ROW_THRESHOLD:
+            job_id = reports.enqueue_report(REPORTS_DIR, format_type, analytics_data, export_type, session.get('user_id'))
+            return jsonify({
+                'success': True,
+                'async': True,
+                'job_id': job_id,
+                'estimated_rows': estimated_rows,
+                'status_url': url_for('admin.analytics_export_job_status', job_id=job_id),
+                'download_url': url_for('admin.analytics_export_job_download', job_id=job_id),
+                'message': 'Report in preparazione, sarà scaricabile al termine'
+            }), 202
+        
+        path, _ = reports.build_report(REPORTS_DIR, format_type, analytics_data, export_type)
+    except ImportError as e:
+        logger.error(f"Libreria export non installata: {e}")
+        return jsonify({'error': 'Export non disponibile: libreria mancante sul server'}), 501
+    except Exception as e:
+        logger.exception(f"Errore export analytics {format_type}: {e}")
+        return jsonify({'error': 'Errore nella generazione del report'}), 500
+    
+    response = send_file(
+        path,
+        mimetype=reports.MIMETYPES[format_type],
+        as_attachment=True,
+        download_name=os.path.basename(path)
+    )
+    # File temporaneo: rimosso a download concluso
+    response.call_on_close(lambda: os.path.exists(path) and os.remove(path))
+    return response
+
+@admin_bp.get("/analytics/export/jobs/<int:job_id>")
+@admin_required
+def analytics_export_job_status(job_id):
+    """Stato di un export analytics in background"""
+    from backend.admin import reports
+    
+    job = reports.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job non trovato'}), 404
+    
+    return jsonify({
+        'id': job['id'],
+        'format': job['format'],
+        'status': job['status'],
+        'row_count': job['row_count'],
+        'error': job['error'],
+        'created_at': job['created_at'].isoformat() if job['created_at'] else None,
+        'completed_at': job['completed_at'].isoformat() if job['completed_at'] else None,
+        'download_url': url_for('admin.analytics_export_job_download', job_id=job_id) if job['status'] == 'completed' else None
+    })
+
+@admin_bp.get("/analytics/export/jobs/<int:job_id>/download")
+@admin_required
+def analytics_export_job_download(job_id):
+    """Scarica l'artifact di un export analytics completato"""
+    from backend.admin import reports
+    
+    job = reports.get_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job non trovato'}), 404
+    
+    if job['status'] != 'completed':
+        return jsonify({'error': 'Report non ancora disponibile', 'status': job['status']}), 409
+    
+    if not job['file_path'] or not os.path.exists(job['file_path']):
+        return jsonify({'error': 'File del report non più disponibile'}), 410
+    
+    return send_file(
+        job['file_path'],
+        mimetype=reports.MIMETYPES[job['format']],
+        as_attachment=True,
+        download_name=os.path.basename(job['file_path'])
+    )
 
 
 
@@ -3908,14 +4129,14 @@ def user_detail_legacy(uid):
         inv = cur.fetchall()
         cur.execute("SELECT SUM(amount) AS total_bonus FROM referral_bonuses WHERE receiver_user_id=%s", (uid,))
         bonus = cur.fetchone()
-        # rete referral tabellare
+        # rete referral tabellare (closure table)
+        ensure_referral_closure(cur)
         cur.execute("""
-            WITH RECURSIVE tree AS (
-              SELECT id, referred_by, 1 AS level FROM users WHERE referred_by = %s
-              UNION ALL
-              SELECT u.id, u.referred_by, t.level+1 FROM users u
-              JOIN tree t ON u.referred_by = t.id
-            ) SELECT * FROM tree ORDER BY level
+            SELECT u.id, u.referred_by, rc.depth AS level
+            FROM referral_closure rc
+            JOIN users u ON u.id = rc.descendant_id
+            WHERE rc.ancestor_id = %s AND rc.depth > 0
+            ORDER BY rc.depth, u.id
         """, (uid,))
         net = cur.fetchall()
     return jsonify({"user": u, "investments": inv, "bonus_total": (bonus and bonus['total_bonus'] or 0), "network": net})
@@ -3924,9 +4145,17 @@ def user_detail_legacy(uid):
 @admin_required
 def user_change_referrer(uid):
     data = request.form or request.json or {}
-    referred_by = data.get('referred_by')
+    referred_by = data.get('referred_by') or None
     with get_conn() as conn, conn.cursor() as cur:
+        old_ancestors = get_referral_ancestors(cur, [uid])
         cur.execute("UPDATE users SET referred_by=%s WHERE id=%s", (referred_by, uid))
+        try:
+            closure_move_subtree(cur, uid, int(referred_by) if referred_by else None)
+        except ReferralTreeError as e:
+            conn.rollback()
+            return jsonify({"ok": False, "error": str(e)}), 400
+        refresh_referral_stats(cur, old_ancestors)
+        refresh_referrer_stats(cur, [uid])
     return jsonify({"ok": True})
 
 @admin_bp.route("/users/<int:uid>/bonuses", methods=['GET', 'POST'])
@@ -3947,6 +4176,7 @@ def user_bonuses(uid):
             VALUES (%s,%s,%s,%s,%s,%s,'accrued') RETURNING id
         """, (uid, data.get('source_user_id'), data.get('investment_id'), level, amount, month_ref))
         rid = cur.fetchone()['id']
+        refresh_referral_stats(cur, [uid])
     return jsonify({"id": rid})
 
 # ---- Gestione Investimenti ----
@@ -4029,6 +4259,7 @@ def requests_queue():
 
 @admin_bp.post("/requests/<int:rid>/approve")
 @admin_required
+@idempotent
 def requests_approve(rid):
     with get_conn() as conn, conn.cursor() as cur:
         cur.execute("UPDATE investment_requests SET state='approved', updated_at=NOW() WHERE id=%s", (rid,))
@@ -4238,6 +4469,7 @@ def deposits_api_pending():
 
 @admin_bp.post("/api/deposits/approve/<int:deposit_id>")
 @admin_required
+@idempotent
 def deposits_api_approve(deposit_id):
     """API per approvare deposito"""
     try:
@@ -4245,41 +4477,24 @@ def deposits_api_approve(deposit_id):
         admin_notes = data.get('admin_notes', '')
         
         with get_conn() as conn, conn.cursor() as cur:
-            # Verifica richiesta esiste e è pending
+            # Passaggio di stato condizionale: solo una approvazione può accreditare
             cur.execute("""
-                SELECT id, user_id, amount, status FROM deposit_requests 
-                WHERE id = %s
-            """, (deposit_id,))
+                UPDATE deposit_requests 
+                SET status = 'completed', approved_at = NOW(), approved_by = %s, admin_notes = %s
+                WHERE id = %s AND status = 'pending'
+                RETURNING user_id, amount
+            """, (session.get('user_id'), admin_notes, deposit_id))
             request_detail = cur.fetchone()
             
             if not request_detail:
-                return jsonify({'error': 'Richiesta non trovata'}), 404
-            if request_detail['status'] != 'pending':
+                cur.execute("SELECT 1 FROM deposit_requests WHERE id = %s", (deposit_id,))
+                if not cur.fetchone():
+                    return jsonify({'error': 'Richiesta non trovata'}), 404
                 return jsonify({'error': 'Solo le richieste in attesa possono essere approvate'}), 400
             
-            # Approva richiesta
-            cur.execute("""
-                UPDATE deposit_requests 
-                SET status = 'completed', approved_at = NOW(), approved_by = %s, admin_notes = %s
-                WHERE id = %s
-            """, (session.get('user_id'), admin_notes, deposit_id))
-            
-            # Aggiorna portfolio utente (crea record se non esiste)
-            cur.execute("""
-                INSERT INTO user_portfolios (user_id, free_capital, invested_capital, referral_bonus, profits, created_at, updated_at)
-                VALUES (%s, %s, 0.00, 0.00, 0.00, NOW(), NOW())
-                ON CONFLICT (user_id) 
-                DO UPDATE SET 
-                    free_capital = user_portfolios.free_capital + %s,
-                    updated_at = NOW()
-            """, (request_detail['user_id'], request_detail['amount'], request_detail['amount']))
-            
-            # Crea transazione portfolio
-            cur.execute("""
-                INSERT INTO portfolio_transactions 
-                (user_id, type, amount, description, created_at)
-                VALUES (%s, 'deposit', %s, 'Deposito approvato', NOW())
-            """, (request_detail['user_id'], request_detail['amount']))
+            # Accredito relativo (crea il portfolio se non esiste) e movimento nella stessa istruzione
+            credit_balance(cur, request_detail['user_id'], 'free_capital', request_detail['amount'],
+                           'deposit', 'Deposito approvato', deposit_id, 'deposit_request')
             
             conn.commit()
             
@@ -4290,6 +4505,7 @@ def deposits_api_approve(deposit_id):
 
 @admin_bp.post("/api/deposits/reject/<int:deposit_id>")
 @admin_required
+@idempotent
 def deposits_api_reject(deposit_id):
     """API per rifiutare deposito"""
     try:
@@ -4524,7 +4740,8 @@ def get_referral_users():
     """Ottieni lista di tutti gli utenti con dati referral"""
     try:
         with get_conn() as conn, conn.cursor() as cur:
-            # Ottieni tutti gli utenti con i loro dati referral
+            ensure_referral_stats_table(cur)
+            # Ottieni tutti gli utenti con i loro dati referral (conteggi da user_referral_stats)
             cur.execute("""
                 SELECT 
                     u.id,
@@ -4549,12 +4766,15 @@ def get_referral_users():
                         WHEN u.kyc_status = 'verified' THEN 'pending'
                         ELSE 'inactive'
                     END as status,
-                    (SELECT COUNT(*) FROM users u2 WHERE u2.referred_by = u.id) as invited_count
+                    COALESCE(rs.invited_count, 0) as invited_count,
+                    COALESCE(rs.network_size, 0) as network_size
                 FROM users u
                 LEFT JOIN user_portfolios up ON up.user_id = u.id
+                LEFT JOIN user_referral_stats rs ON rs.user_id = u.id
                 ORDER BY u.created_at DESC
             """)
             users = cur.fetchall()
+            conn.commit()
             
             return jsonify({
                 'users': users
@@ -4650,12 +4870,14 @@ def get_referral_stats():
             user_stats = cur.fetchone()
             
             # Calcola referral attivi (utenti che hanno invitato qualcuno)
+            ensure_referral_stats_table(cur)
             cur.execute("""
-                SELECT COUNT(DISTINCT referred_by) as active_referrals
-                FROM users 
-                WHERE referred_by IS NOT NULL
+                SELECT COUNT(*) as active_referrals
+                FROM user_referral_stats 
+                WHERE invited_count > 0
             """)
             active_referrals = cur.fetchone()
+            conn.commit()
             
             # Totale investito da tutti gli utenti
             cur.execute("""
@@ -4679,6 +4901,110 @@ def get_referral_stats():
         print(f"Errore nel caricamento statistiche referral: {e}")
         return jsonify({'error': 'Errore nel caricamento delle statistiche'}), 500
 
+@admin_bp.get("/api/referral/users/<int:user_id>/tree")
+@admin_required
+def get_user_referral_tree(user_id):
+    """Rete referral di un utente fino a max_depth livelli, con riepilogo per livello"""
+    max_depth = request.args.get('max_depth', 3, type=int)
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT id FROM users WHERE id = %s", (user_id,))
+            if not cur.fetchone():
+                return jsonify({'error': 'Utente non trovato'}), 404
+            
+            downline = get_downline(cur, user_id, max_depth)
+            summary = get_network_summary(cur, user_id)
+            conn.commit()
+        
+        return jsonify({
+            'user_id': user_id,
+            'max_depth': max_depth,
+            'network_size': summary['network_size'],
+            'network_volume': summary['network_volume'],
+            'levels': summary['levels'],
+            'downline': downline
+        })
+    
+    except Exception as e:
+        logger.exception(f"Errore nel caricamento albero referral {user_id}: {e}")
+        return jsonify({'error': 'Errore nel caricamento della rete referral'}), 500
+
+@admin_bp.post("/api/referral/closure/rebuild")
+@admin_required
+def rebuild_referral_tree():
+    """Ricostruisce la closure table referral da users.referred_by"""
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            ensure_referral_closure(cur)
+            count = rebuild_referral_closure(cur)
+            conn.commit()
+        return jsonify({'success': True, 'relations': count})
+    except Exception as e:
+        logger.exception(f"Errore nella ricostruzione albero referral: {e}")
+        return jsonify({'error': 'Errore nella ricostruzione della rete referral'}), 500
+
+@admin_bp.post("/api/referral/stats/rebuild")
+@admin_required
+def rebuild_referral_stats_table():
+    """Ricalcola le statistiche referral precalcolate di tutti gli utenti"""
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            ensure_referral_stats_table(cur)
+            count = rebuild_referral_stats(cur)
+            conn.commit()
+        return jsonify({'success': True, 'users': count})
+    except Exception as e:
+        logger.exception(f"Errore nel ricalcolo statistiche referral: {e}")
+        return jsonify({'error': 'Errore nel ricalcolo delle statistiche referral'}), 500
+
+@admin_bp.get("/api/referral/accrual/preview")
+@admin_required
+def referral_accrual_preview():
+    """Dry-run del run bonus referral di un mese (?month=YYYY-MM, default mese precedente)"""
+    try:
+        month_ref = parse_month(request.args.get('month'))
+    except ValueError:
+        return jsonify({'error': 'Mese non valido, usa il formato YYYY-MM'}), 400
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            preview = preview_period(cur, month_ref)
+            conn.commit()
+        return jsonify(preview)
+    except Exception as e:
+        logger.exception(f"Errore nell'anteprima bonus referral {month_ref}: {e}")
+        return jsonify({'error': 'Errore nel calcolo anteprima bonus referral'}), 500
+
+@admin_bp.post("/api/referral/accrual/run")
+@admin_required
+def referral_accrual_run():
+    """Avvia in background maturazione e pagamento dei bonus referral di un mese"""
+    data = request.get_json() or {}
+    try:
+        month_ref = parse_month(data.get('month'))
+    except ValueError:
+        return jsonify({'error': 'Mese non valido, usa il formato YYYY-MM'}), 400
+    pay = bool(data.get('pay', True))
+    try:
+        run_id = enqueue_run(month_ref, pay, session.get('user_id'))
+        return jsonify({
+            'success': True,
+            'run_id': run_id,
+            'month_ref': month_ref.isoformat(),
+            'status_url': url_for('admin.referral_accrual_run_status', run_id=run_id)
+        }), 202
+    except Exception as e:
+        logger.exception(f"Errore nell'avvio run bonus referral {month_ref}: {e}")
+        return jsonify({'error': 'Errore nell\'avvio del run bonus referral'}), 500
+
+@admin_bp.get("/api/referral/accrual/runs/<int:run_id>")
+@admin_required
+def referral_accrual_run_status(run_id):
+    """Stato di un run bonus referral"""
+    run = get_run(run_id)
+    if not run:
+        return jsonify({'error': 'Run non trovato'}), 404
+    return jsonify(run)
+
 @admin_bp.post("/api/referral/users/<int:user_id>/move")
 @admin_required
 def move_user_referral(user_id):
@@ -4705,12 +5031,18 @@ def move_user_referral(user_id):
             if user_id == new_referrer_id:
                 return jsonify({'error': 'Un utente non pu essere referrer di se stesso'}), 400
             
-            # Aggiorna il referrer
+            # Aggiorna il referrer e l'albero materializzato
+            old_ancestors = get_referral_ancestors(cur, [user_id])
             cur.execute("""
                 UPDATE users 
                 SET referred_by = %s 
                 WHERE id = %s
             """, (new_referrer_id, user_id))
+            closure_move_subtree(cur, user_id, new_referrer_id)
+            
+            # Statistiche della vecchia e della nuova catena di referrer
+            refresh_referral_stats(cur, old_ancestors)
+            refresh_referrer_stats(cur, [user_id])
             
             conn.commit()
             
@@ -4719,6 +5051,8 @@ def move_user_referral(user_id):
                 'message': 'Utente spostato con successo'
             })
         
+    except ReferralTreeError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         print(f"Errore nello spostamento utente: {e}")
         return jsonify({'error': 'Errore nello spostamento dell\'utente'}), 500
@@ -5080,12 +5414,18 @@ def transactions_dashboard():
     """Dashboard transazioni con report e grafici"""
     try:
         logger.info("Inizio caricamento dashboard transazioni")
+        # Intervallo opzionale from/to: le query leggono solo le partizioni mensili interessate
+        start, end = parse_period(request.args)
+        period_where, period_params = {}, {}
+        for alias in ('dr', 'wr', 'pt'):
+            conditions, period_params[alias] = period_conditions(f"{alias}.created_at", start, end)
+            period_where[alias] = " AND ".join(['u.id IS NOT NULL'] + conditions)
         with get_conn() as conn:
             cur = conn.cursor()
             
             # 1. STATISTICHE DEPOSITI (solo utenti attivi)
             logger.info("Caricamento statistiche depositi")
-            cur.execute("""
+            cur.execute(f"""
                 SELECT 
                     COUNT(*) as total_deposits,
                     COALESCE(SUM(dr.amount), 0) as total_deposit_amount,
@@ -5095,8 +5435,8 @@ def transactions_dashboard():
                     COUNT(CASE WHEN dr.status = 'rejected' THEN 1 END) as rejected_deposits
                 FROM deposit_requests dr
                 INNER JOIN users u ON dr.user_id = u.id
-                WHERE u.id IS NOT NULL
-            """)
+                WHERE {period_where['dr']}
+            """, period_params['dr'])
             deposits_data = cur.fetchone()
             deposits_stats = {
                 'total_deposits': deposits_data['total_deposits'] or 0,
@@ -5109,7 +5449,7 @@ def transactions_dashboard():
             logger.info(f"Statistiche depositi caricate: {deposits_stats}")
             
             # 2. STATISTICHE PRELIEVI (solo utenti attivi)
-            cur.execute("""
+            cur.execute(f"""
                 SELECT 
                     COUNT(*) as total_withdrawals,
                     COALESCE(SUM(wr.amount), 0) as total_withdrawal_amount,
@@ -5117,8 +5457,8 @@ def transactions_dashboard():
                     COALESCE(SUM(CASE WHEN wr.status = 'completed' THEN wr.amount ELSE 0 END), 0) as completed_withdrawal_amount
                 FROM withdrawal_requests wr
                 INNER JOIN users u ON wr.user_id = u.id
-                WHERE u.id IS NOT NULL
-            """)
+                WHERE {period_where['wr']}
+            """, period_params['wr'])
             withdrawals_data = cur.fetchone()
             withdrawals_stats = {
                 'total_withdrawals': withdrawals_data['total_withdrawals'] or 0,
@@ -5128,7 +5468,7 @@ def transactions_dashboard():
             }
             
             # 3. STATISTICHE PORTFOLIO (solo utenti attivi)
-            cur.execute("""
+            cur.execute(f"""
                 SELECT 
                     COUNT(*) as total_transactions,
                     COALESCE(SUM(CASE WHEN pt.type = 'deposit' THEN pt.amount ELSE 0 END), 0) as total_deposit_amount,
@@ -5140,8 +5480,8 @@ def transactions_dashboard():
                     COUNT(CASE WHEN pt.type = 'referral' THEN 1 END) as referral_transactions
                 FROM portfolio_transactions pt
                 INNER JOIN users u ON pt.user_id = u.id
-                WHERE u.id IS NOT NULL
-            """)
+                WHERE {period_where['pt']}
+            """, period_params['pt'])
             portfolio_data = cur.fetchone()
             portfolio_stats = {
                 'total_transactions': portfolio_data['total_transactions'] or 0,
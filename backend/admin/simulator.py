@@ -0,0 +1,165 @@
+"""
+Simulatore what-if della vendita di un progetto
+Carica gli investimenti una sola volta e calcola con NumPy i payout di ogni investitore
+su una griglia prezzo di vendita x commissione, con le stesse regole di backend/shared/settlement.py
+"""
+
+import logging
+
+from backend.shared.project_funding import FUNDED_SQL, ensure_funding_shards
+from backend.shared.referral_accrual import REFERRER_RATE, VIP_REFERRER_RATE, PLATFORM_RATE
+
+logger = logging.getLogger(__name__)
+
+# Limiti della griglia per restare entro una singola richiesta
+MAX_PRICES = 50
+MAX_FEES = 10
+MAX_SCENARIOS = 200
+HISTOGRAM_BINS = 10
+EDGE_CASE_SAMPLE = 20
+
+
+class SimulationError(Exception):
+    """Parametri di simulazione non validi"""
+    pass
+
+
+def load_investments(cur, project_id):
+    """Investimenti attivi del progetto con l'aliquota di trattenuta referral dell'investitore"""
+    ensure_funding_shards(cur)
+    cur.execute(
+        f"SELECT p.id, p.name, p.status, COALESCE({FUNDED_SQL}, 0) AS funded_amount FROM projects p WHERE p.id = %s",
+        (project_id,),
+    )
+    project = cur.fetchone()
+    if not project:
+        return None, []
+    cur.execute(
+        """
+        SELECT i.id, i.user_id, i.amount,
+               CASE WHEN r.id IS NULL THEN 0
+                    WHEN COALESCE(r.is_vip, FALSE) THEN %s ELSE %s END
+               + CASE WHEN COALESCE(r.is_vip, FALSE) THEN 0 ELSE %s END AS withheld_rate
+        FROM investments i
+        JOIN users u ON u.id = i.user_id
+        LEFT JOIN users r ON r.id = u.referred_by AND r.id != u.id
+        WHERE i.project_id = %s AND i.status = 'active' AND i.amount > 0
+        ORDER BY i.id
+        """,
+        (VIP_REFERRER_RATE, REFERRER_RATE, PLATFORM_RATE, project_id),
+    )
+    return project, cur.fetchall()
+
+
+def parse_grid(data):
+    """Prezzi di vendita (lista o {min, max, steps}) e commissioni (frazioni del prezzo)"""
+    prices = data.get('sale_prices')
+    if isinstance(prices, dict):
+        try:
+            low = float(prices['min'])
+            high = float(prices['max'])
+            steps = int(prices.get('steps', 10))
+        except (KeyError, TypeError, ValueError):
+            raise SimulationError("sale_prices deve contenere min, max e steps")
+        if steps < 1 or steps > MAX_PRICES or high < low:
+            raise SimulationError(f"Intervallo prezzi non valido (massimo {MAX_PRICES} passi)")
+        prices = [low + (high - low) * k / max(steps - 1, 1) for k in range(steps)] if steps > 1 else [low]
+    elif isinstance(prices, list):
+        try:
+            prices = [float(p) for p in prices]
+        except (TypeError, ValueError):
+            raise SimulationError("sale_prices deve contenere numeri")
+    else:
+        raise SimulationError("Specifica sale_prices")
+    if not prices or len(prices) > MAX_PRICES or any(p <= 0 for p in prices):
+        raise SimulationError(f"Da 1 a {MAX_PRICES} prezzi di vendita positivi")
+
+    try:
+        fees = [float(f) for f in data.get('fee_rates', [0])]
+    except (TypeError, ValueError):
+        raise SimulationError("fee_rates deve contenere numeri")
+    if not fees or len(fees) > MAX_FEES or any(f < 0 or f >= 1 for f in fees):
+        raise SimulationError(f"Da 1 a {MAX_FEES} commissioni tra 0 e 1")
+    if len(prices) * len(fees) > MAX_SCENARIOS:
+        raise SimulationError(f"Troppi scenari (massimo {MAX_SCENARIOS})")
+    return prices, fees
+
+
+def _round_cents(np, values):
+    """Arrotondamento al centesimo half-away-from-zero, come ROUND(numeric, 2) di PostgreSQL"""
+    return np.sign(values) * np.floor(np.abs(values) * 100 + 0.5) / 100
+
+
+def simulate(project, investments, sale_prices, fee_rates):
+    """Payout per investitore su tutti gli scenari: matrice scenari x investimenti"""
+    import numpy as np
+
+    ids = np.fromiter((row['id'] for row in investments), dtype=np.int64, count=len(investments))
+    amounts = np.fromiter((float(row['amount']) for row in investments), dtype=np.float64, count=len(investments))
+    rates = np.fromiter((float(row['withheld_rate']) for row in investments), dtype=np.float64, count=len(investments))
+
+    total_invested = float(project['funded_amount'] or 0)
+    if total_invested <= 0:
+        total_invested = float(amounts.sum())
+    if total_invested <= 0:
+        raise SimulationError("Nessun investimento registrato per il progetto")
+
+    # Griglia scenari (S,) e ricavo netto dopo commissione
+    price_grid, fee_grid = np.meshgrid(np.asarray(sale_prices), np.asarray(fee_rates), indexing='ij')
+    price_grid = price_grid.ravel()
+    fee_grid = fee_grid.ravel()
+    net_proceeds = price_grid * (1 - fee_grid)
+    total_profit = net_proceeds - total_invested
+
+    # Quote per investimento (S, N)
+    weights = amounts / total_invested
+    profit_share = _round_cents(np, np.outer(total_profit, weights))
+    withheld = _round_cents(np, np.where(profit_share > 0, profit_share * rates, 0.0))
+    net_profit = profit_share - withheld
+    payout = amounts + net_profit
+
+    scenarios = []
+    for s in range(price_grid.size):
+        row_payout = payout[s]
+        zero_profit = (net_profit[s] == 0) & (total_profit[s] != 0)
+        losses = net_profit[s] < 0
+        counts, edges = np.histogram(row_payout, bins=HISTOGRAM_BINS) if row_payout.size else ([], [])
+        scenarios.append({
+            'sale_price': round(float(price_grid[s]), 2),
+            'fee_rate': float(fee_grid[s]),
+            'fee_amount': round(float(price_grid[s] * fee_grid[s]), 2),
+            'total_profit': round(float(total_profit[s]), 2),
+            'profit_percentage': round(float(total_profit[s] / total_invested * 100), 4),
+            'total_payout': round(float(row_payout.sum()), 2),
+            'total_net_profit': round(float(net_profit[s].sum()), 2),
+            'total_referral_withheld': round(float(withheld[s].sum()), 2),
+            # Differenza tra profitto totale e somma delle quote arrotondate
+            'rounding_residual': round(float(total_profit[s] - profit_share[s].sum()), 2),
+            'payout_distribution': {
+                'min': round(float(row_payout.min()), 2) if row_payout.size else 0.0,
+                'p10': round(float(np.percentile(row_payout, 10)), 2) if row_payout.size else 0.0,
+                'median': round(float(np.median(row_payout)), 2) if row_payout.size else 0.0,
+                'p90': round(float(np.percentile(row_payout, 90)), 2) if row_payout.size else 0.0,
+                'max': round(float(row_payout.max()), 2) if row_payout.size else 0.0,
+                'histogram': {
+                    'counts': [int(c) for c in counts],
+                    'edges': [round(float(e), 2) for e in edges],
+                },
+            },
+            'edge_cases': {
+                'zero_profit_investments': int(zero_profit.sum()),
+                'zero_profit_sample': [int(i) for i in ids[zero_profit][:EDGE_CASE_SAMPLE]],
+                'loss_investments': int(losses.sum()),
+                'loss_sample': [int(i) for i in ids[losses][:EDGE_CASE_SAMPLE]],
+            },
+        })
+
+    return {
+        'project_id': project['id'],
+        'project_name': project['name'],
+        'project_status': project['status'],
+        'investments': int(ids.size),
+        'investors': len({row['user_id'] for row in investments}),
+        'total_invested': total_invested,
+        'scenarios': scenarios,
+    }
@@ -129,6 +129,10 @@ def create_app():
     
     app.jinja_env.globals["safe_url_for"] = safe_url_for
     
+    # Chiave di idempotenza per i form che muovono denaro (campo nascosto idempotency_key)
+    from backend.shared.idempotency import new_key as new_idempotency_key
+    app.jinja_env.globals["idempotency_key"] = new_idempotency_key
+    
     # Configura middleware di autenticazione
     try:
         from backend.auth.middleware import setup_auth_middleware
@@ -205,4 +209,42 @@ def create_app():
     except Exception as e:
         app.logger.warning(f"Impossibile creare utente admin: {e}")
     
+    # Installa ledger dei portafogli e trigger prima delle prime scritture
+    try:
+        from backend.shared.ledger import ensure_ledger
+        with get_connection() as conn, conn.cursor() as cur:
+            ensure_ledger(cur)
+    except Exception as e:
+        app.logger.warning(f"Impossibile inizializzare il ledger dei portafogli: {e}")
+    
+    # Statistiche referral e trigger dei volumi degli invitati
+    try:
+        from backend.shared.referral_stats import ensure_referral_stats_table
+        with get_connection() as conn, conn.cursor() as cur:
+            ensure_referral_stats_table(cur)
+    except Exception as e:
+        app.logger.warning(f"Impossibile inizializzare le statistiche referral: {e}")
+    
+    # Partizioni dei prossimi mesi per le tabelle storiche (se già partizionate)
+    try:
+        from backend.shared.partitioning import ensure_partitions
+        with get_connection() as conn, conn.cursor() as cur:
+            ensure_partitions(cur)
+    except Exception as e:
+        app.logger.warning(f"Impossibile creare le partizioni mensili: {e}")
+    
+    # Job in background rimasti in esecuzione da un worker terminato
+    try:
+        from backend.admin.reports import fail_stale_jobs
+        with get_connection() as conn, conn.cursor() as cur:
+            fail_stale_jobs(cur)
+    except Exception as e:
+        app.logger.warning(f"Impossibile recuperare i job di report interrotti: {e}")
+    try:
+        from backend.shared.referral_accrual import fail_stale_runs
+        with get_connection() as conn, conn.cursor() as cur:
+            fail_stale_runs(cur)
+    except Exception as e:
+        app.logger.warning(f"Impossibile recuperare i run bonus referral interrotti: {e}")
+    
     return app
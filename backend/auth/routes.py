@@ -2,6 +2,8 @@ from flask import Blueprint, request, session, redirect, url_for, render_templat
 from backend.shared.database import get_connection
 import os
 from backend.shared.validators import validate_email, validate_password, ValidationError
+from backend.shared.referral_tree import closure_add_user
+from backend.shared.referral_stats import add_network_member
 from backend.auth.middleware import create_secure_session, destroy_session
 from backend.utils.http import is_api_request
 import hashlib
@@ -260,6 +262,10 @@ def register():
 
             new_user_id = cur.fetchone()["id"]
 
+            # Albero referral materializzato (stessa transazione)
+            closure_add_user(cur, new_user_id, referred_by)
+            add_network_member(cur, new_user_id)
+
             conn.commit()
 
             flash("Registrazione completata! Ora puoi fare login.", "success")
@@ -3,16 +3,22 @@ Deposits API routes
 API per gestione ricariche: Richieste, approvazioni
 """
 
-import secrets
-import string
 from datetime import datetime
 import logging
 from decimal import Decimal
 from flask import Blueprint, request, session, jsonify, render_template
 from backend.shared.database import get_connection
 import psycopg
-from psycopg import errors as pg_errors
 from backend.shared.models import TransactionStatus
+from backend.shared.search import owner_search_condition, DEPOSIT_SEARCH_COLUMNS
+from backend.shared.balances import credit as credit_balance
+from backend.shared.idempotency import idempotent
+from backend.shared.identifiers import allocate as allocate_identifier
+from backend.shared.partitioning import is_partitioned, parse_period, period_conditions
+from backend.shared.request_batches import (
+    BatchError, parse_ids as parse_batch_ids, approve_deposits, reject_deposits, summarize as summarize_batch
+)
+from backend.shared.statement_import import StatementError, import_statement, apply_lines, get_import
 
 deposits_bp = Blueprint("deposits", __name__)
 logger = logging.getLogger(__name__)
@@ -21,37 +27,19 @@ def get_conn():
     from backend.shared.database import get_connection
     return get_connection()
 
-def generate_unique_key(length=6):
-    """Genera una chiave univoca alfanumerica"""
-    characters = string.ascii_uppercase + string.digits
-    return ''.join(secrets.choice(characters) for _ in range(length))
-
-def generate_payment_reference(user_name=None, length=12):
-    """Genera una causale bonifico unica usando il template configurato dall'admin"""
-    try:
-        with get_conn() as conn:
-            cur = conn.cursor()
-            # Ottieni il template della causale configurato dall'admin
-            cur.execute("""
-                SELECT payment_reference 
-                FROM bank_configurations 
-                WHERE is_active = true 
-                ORDER BY created_at DESC 
-                LIMIT 1
-            """)
-            result = cur.fetchone()
-            
-            if result and result['payment_reference']:
-                template = result['payment_reference']
-                # Aggiungi un identificatore unico al template
-                unique_id = generate_unique_key(6)
-                return f"{template} {unique_id}"
-    except Exception as e:
-        logger.error(f"Errore nel caricamento template causale: {e}")
-    
-    # Fallback: genera una chiave randomica
-    characters = string.ascii_uppercase + string.digits
-    return ''.join(secrets.choice(characters) for _ in range(length))
+def generate_payment_reference(cur, unique_key):
+    """Causale bonifico: template configurato dall'admin seguito dalla chiave univoca della richiesta"""
+    cur.execute("""
+        SELECT payment_reference 
+        FROM bank_configurations 
+        WHERE is_active = true 
+        ORDER BY created_at DESC 
+        LIMIT 1
+    """)
+    result = cur.fetchone()
+    template = result.get('payment_reference') if result else None
+    # La chiave è univoca, quindi lo è anche la causale
+    return f"{template} {unique_key}" if template else f"CIP-{unique_key}"
 
 def ensure_deposits_schema(cur):
     """Crea tabelle minime necessarie se mancanti (solo per ambienti dev)."""
@@ -93,6 +81,11 @@ def ensure_deposits_schema(cur):
             approved_by INT
         );
     """)
+    # Template causale configurato dall'admin
+    try:
+        cur.execute("ALTER TABLE bank_configurations ADD COLUMN IF NOT EXISTS payment_reference TEXT")
+    except Exception:
+        pass
     # Assicura presenza colonna method anche su installazioni esistenti
     try:
         cur.execute("ALTER TABLE deposit_requests ADD COLUMN IF NOT EXISTS method TEXT NOT NULL DEFAULT 'bank'")
@@ -124,9 +117,12 @@ def ensure_deposits_schema(cur):
         cur.execute("ALTER TABLE deposit_requests ADD COLUMN IF NOT EXISTS approved_by INT")
     except Exception:
         pass
-    # Assicura vincoli UNIQUE (usa indici unici, più tolleranti se la colonna già esiste)
-    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS deposit_requests_unique_key_idx ON deposit_requests (unique_key)")
-    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS deposit_requests_payment_reference_idx ON deposit_requests (payment_reference)")
+    # Assicura vincoli UNIQUE (usa indici unici, più tolleranti se la colonna già esiste).
+    # Su tabella partizionata l'unicità non può escludere created_at: bastano indici di ricerca,
+    # le chiavi sono univoche per costruzione (servizio identificatori)
+    unique = "" if is_partitioned(cur, 'deposit_requests') else "UNIQUE "
+    cur.execute(f"CREATE {unique}INDEX IF NOT EXISTS deposit_requests_unique_key_idx ON deposit_requests (unique_key)")
+    cur.execute(f"CREATE {unique}INDEX IF NOT EXISTS deposit_requests_payment_reference_idx ON deposit_requests (payment_reference)")
     # Allinea constraint di stato (alcuni ambienti potrebbero avere un set limitato)
     try:
         cur.execute("ALTER TABLE deposit_requests DROP CONSTRAINT IF EXISTS deposit_requests_status_check")
@@ -287,6 +283,7 @@ def get_deposit_request_detail(request_id):
 
 @deposits_bp.route('/api/requests/new', methods=['POST'])
 @kyc_pending_allowed
+@idempotent
 def create_deposit_request():
     """Crea una nuova richiesta di deposito"""
     uid = session.get("user_id")
@@ -407,35 +404,16 @@ def create_deposit_request():
                 else:
                     receiver_field_value = wallet_config['wallet_address']
 
-                # Ottieni nome utente per la causale
-                cur.execute("SELECT nome, cognome FROM users WHERE id = %s", (uid,))
-                user_info = cur.fetchone()
-                user_name = f"{user_info.get('nome', '')} {user_info.get('cognome', '')}".strip() if user_info else None
-                
-                # Prova inserimento con retry per evitare collisioni univoche
-                attempts = 0
-                new_request = None
-                last_error = None
-                while attempts < 5 and not new_request:
-                    attempts += 1
-                    unique_key = generate_unique_key()
-                    payment_reference = generate_payment_reference(user_name)
-                    try:
-                        cur.execute("""
-                            INSERT INTO deposit_requests 
-                            (user_id, amount, iban, method, unique_key, payment_reference, status)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s)
-                            RETURNING id, created_at
-                        """, (uid, amount, receiver_field_value, method, unique_key, payment_reference, 'pending'))
-                        new_request = cur.fetchone()
-                    except pg_errors.UniqueViolation as ue:
-                        conn.rollback()
-                        last_error = ue
-                        # Ritenta con nuove chiavi
-                        continue
-                if not new_request:
-                    logger.error("[deposits] unique key generation failed after retries: %s", last_error)
-                    return jsonify({'error': 'Errore generazione chiavi, riprovare tra poco'}), 500
+                # Chiave e causale allocate dal servizio identificatori: univoche senza retry
+                unique_key = allocate_identifier(cur, 'deposit_key')
+                payment_reference = generate_payment_reference(cur, unique_key)
+                cur.execute("""
+                    INSERT INTO deposit_requests 
+                    (user_id, amount, iban, method, unique_key, payment_reference, status)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id, created_at
+                """, (uid, amount, receiver_field_value, method, unique_key, payment_reference, 'pending'))
+                new_request = cur.fetchone()
                 
                 logger.info("[deposits] created deposit_request id=%s amount=%s user=%s", new_request['id'] if new_request else None, amount, uid)
                 
@@ -615,6 +593,10 @@ def admin_get_deposits_history():
     per_page = request.args.get('per_page', 20, type=int)
     status_filter = request.args.get('status', '')
     search = request.args.get('search', '')
+    try:
+        start, end = parse_period(request.args)
+    except ValueError:
+        return jsonify({'error': 'Intervallo date non valido'}), 400
     
     offset = (page - 1) * per_page
     
@@ -641,9 +623,15 @@ def admin_get_deposits_history():
             params.append(status_filter)
         
         if search:
-            where_conditions.append("(u.email ILIKE %s OR u.nome ILIKE %s OR dr.unique_key ILIKE %s)")
-            search_param = f"%{search}%"
-            params.extend([search_param, search_param, search_param])
+            # Email, nome, chiave, causale e IBAN su indici trigram
+            search_sql, search_params = owner_search_condition(DEPOSIT_SEARCH_COLUMNS, 'dr.user_id', search)
+            where_conditions.append(search_sql)
+            params.extend(search_params)
+        
+        # Intervallo date: solo le partizioni mensili interessate
+        period_sql, period_params = period_conditions('dr.created_at', start, end)
+        where_conditions.extend(period_sql)
+        params.extend(period_params)
         
         where_clause = ""
         if where_conditions:
@@ -672,15 +660,17 @@ def admin_get_deposits_history():
         deposits = cur.fetchall()
         
         # Calcola statistiche
-        stats_query = """
+        stats_where = " AND ".join(period_sql) or "TRUE"
+        stats_query = f"""
             SELECT 
                 status,
                 COUNT(*) as count,
                 SUM(amount) as total_amount
-            FROM deposit_requests
+            FROM deposit_requests dr
+            WHERE {stats_where}
             GROUP BY status
         """
-        cur.execute(stats_query)
+        cur.execute(stats_query, period_params)
         stats = cur.fetchall()
         
         # Calcola paginazione
@@ -701,12 +691,15 @@ def admin_get_deposits_history():
         'stats': stats,
         'filters': {
             'status': status_filter,
-            'search': search
+            'search': search,
+            'from': start.isoformat() if start else None,
+            'to': end.isoformat() if end else None
         }
     })
 
 @deposits_bp.route('/api/admin/approve/<int:request_id>', methods=['POST'])
 @admin_required
+@idempotent
 def admin_approve_deposit(request_id):
     """Admin approva una richiesta di deposito"""
     try:
@@ -715,42 +708,22 @@ def admin_approve_deposit(request_id):
         with get_conn() as conn, conn.cursor() as cur:
             # Garantisce schema coerente
             ensure_deposits_schema(cur)
-            # Verifica richiesta esiste e è pending
-            cur.execute("""
-                SELECT id, user_id, amount, status FROM deposit_requests 
-                WHERE id = %s
-            """, (request_id,))
-            request_detail = cur.fetchone()
-            if not request_detail:
-                return jsonify({'error': 'Richiesta non trovata'}), 404
-            if request_detail['status'] != 'pending':
-                return jsonify({'error': 'Solo le richieste in attesa possono essere approvate'}), 400
-            # Approva richiesta
+            # Passaggio di stato condizionale: solo una approvazione può accreditare
             cur.execute("""
                 UPDATE deposit_requests 
                 SET status = 'completed', approved_at = NOW(), approved_by = %s, admin_notes = %s
-                WHERE id = %s
+                WHERE id = %s AND status = 'pending'
+                RETURNING user_id, amount
             """, (session.get('user_id'), admin_notes, request_id))
-            # Aggiorna portfolio utente
-            cur.execute("""
-                UPDATE user_portfolios 
-                SET free_capital = free_capital + %s, updated_at = NOW()
-                WHERE user_id = %s
-            """, (request_detail['amount'], request_detail['user_id']))
-            # Crea transazione portfolio
-            cur.execute("""
-                INSERT INTO portfolio_transactions 
-                (user_id, type, amount, balance_before, balance_after, description, 
-                 reference_id, reference_type, status)
-                SELECT 
-                    %s, 'deposit', %s, 
-                    (SELECT free_capital + referral_bonus + profits FROM user_portfolios WHERE user_id = %s),
-                    (SELECT free_capital + referral_bonus + profits FROM user_portfolios WHERE user_id = %s),
-                    'Deposito approvato', %s, 'deposit_request', 'completed'
-                FROM user_portfolios WHERE user_id = %s
-            """, (request_detail['user_id'], request_detail['amount'], 
-                  request_detail['user_id'], request_detail['user_id'],
-                  request_id, request_detail['user_id']))
+            request_detail = cur.fetchone()
+            if not request_detail:
+                cur.execute("SELECT 1 FROM deposit_requests WHERE id = %s", (request_id,))
+                if not cur.fetchone():
+                    return jsonify({'error': 'Richiesta non trovata'}), 404
+                return jsonify({'error': 'Solo le richieste in attesa possono essere approvate'}), 400
+            # Accredito relativo e movimento di portafoglio nella stessa istruzione
+            credit_balance(cur, request_detail['user_id'], 'free_capital', request_detail['amount'],
+                           'deposit', 'Deposito approvato', request_id, 'deposit_request')
             conn.commit()
         return jsonify({'success': True, 'message': 'Deposito approvato con successo'})
     except Exception as e:
@@ -759,6 +732,7 @@ def admin_approve_deposit(request_id):
 
 @deposits_bp.route('/api/admin/reject/<int:request_id>', methods=['POST'])
 @admin_required
+@idempotent
 def admin_reject_deposit(request_id):
     """Admin rifiuta una richiesta di deposito"""
     try:
@@ -767,28 +741,64 @@ def admin_reject_deposit(request_id):
         with get_conn() as conn, conn.cursor() as cur:
             # Garantisce schema coerente
             ensure_deposits_schema(cur)
-            # Verifica richiesta esiste e è pending
-            cur.execute("""
-                SELECT id, status FROM deposit_requests 
-                WHERE id = %s
-            """, (request_id,))
-            request_detail = cur.fetchone()
-            if not request_detail:
-                return jsonify({'error': 'Richiesta non trovata'}), 404
-            if request_detail['status'] != 'pending':
-                return jsonify({'error': 'Solo le richieste in attesa possono essere rifiutate'}), 400
-            # Rifiuta richiesta
+            # Rifiuta richiesta (passaggio di stato condizionale)
             cur.execute("""
                 UPDATE deposit_requests 
                 SET status = 'failed', admin_notes = %s
-                WHERE id = %s
+                WHERE id = %s AND status = 'pending'
+                RETURNING id
             """, (admin_notes, request_id))
+            if not cur.fetchone():
+                cur.execute("SELECT 1 FROM deposit_requests WHERE id = %s", (request_id,))
+                if not cur.fetchone():
+                    return jsonify({'error': 'Richiesta non trovata'}), 404
+                return jsonify({'error': 'Solo le richieste in attesa possono essere rifiutate'}), 400
             conn.commit()
         return jsonify({'success': True, 'message': 'Deposito rifiutato'})
     except Exception as e:
         logger.exception("[deposits] admin reject failed: %s", e)
         return jsonify({'error': 'reject_failed', 'debug': str(e)}), 500
 
+@deposits_bp.route('/api/admin/bulk-approve', methods=['POST'])
+@admin_required
+@idempotent
+def admin_bulk_approve_deposits():
+    """Admin approva più richieste di deposito in un'unica transazione"""
+    try:
+        data = request.get_json() or {}
+        ids = parse_batch_ids(data.get('request_ids'))
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            ensure_deposits_schema(cur)
+            results = approve_deposits(cur, ids, session.get('user_id'), data.get('admin_notes', ''))
+            conn.commit()
+        return jsonify({'success': True, **summarize_batch(results)})
+    except Exception as e:
+        logger.exception("[deposits] admin bulk approve failed: %s", e)
+        return jsonify({'error': 'bulk_approve_failed', 'debug': str(e)}), 500
+
+@deposits_bp.route('/api/admin/bulk-reject', methods=['POST'])
+@admin_required
+@idempotent
+def admin_bulk_reject_deposits():
+    """Admin rifiuta più richieste di deposito in un'unica transazione"""
+    try:
+        data = request.get_json() or {}
+        ids = parse_batch_ids(data.get('request_ids'))
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            ensure_deposits_schema(cur)
+            results = reject_deposits(cur, ids, session.get('user_id'), data.get('admin_notes', ''))
+            conn.commit()
+        return jsonify({'success': True, **summarize_batch(results)})
+    except Exception as e:
+        logger.exception("[deposits] admin bulk reject failed: %s", e)
+        return jsonify({'error': 'bulk_reject_failed', 'debug': str(e)}), 500
+
 @deposits_bp.route('/api/admin/delete-all', methods=['DELETE'])
 @admin_required
 def admin_delete_all_deposits():
@@ -993,6 +1003,81 @@ def admin_get_deposits_metrics():
         logger.exception(f"Errore nel recupero metriche depositi: {e}")
         return jsonify({'error': 'Errore interno del server'}), 500
 
+@deposits_bp.route('/api/admin/statements/import', methods=['POST'])
+@admin_required
+@idempotent
+def admin_import_statement():
+    """Admin carica un estratto conto (CSV, CAMT.053) o un export wallet e abbina gli accrediti.
+
+    Form multipart: file, account (IBAN del conto per i CSV banca, opzionale),
+    auto_apply ('true' per approvare subito le righe abbinate per causale e importo)
+    """
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        return jsonify({'error': 'Nessun file caricato'}), 400
+    account = (request.form.get('account') or '').strip() or None
+    auto_apply = request.form.get('auto_apply') == 'true'
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            ensure_deposits_schema(cur)
+            result = import_statement(cur, upload.stream, upload.filename, account, session.get('user_id'))
+            if auto_apply:
+                result['applied'] = apply_lines(cur, result['import_id'], session.get('user_id'))
+            conn.commit()
+        return jsonify({'success': True, **result})
+    except StatementError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.exception("[deposits] statement import failed: %s", e)
+        return jsonify({'error': 'statement_import_failed', 'debug': str(e)}), 500
+
+@deposits_bp.route('/api/admin/statements/<int:import_id>', methods=['GET'])
+@admin_required
+def admin_get_statement(import_id):
+    """Admin: righe di un estratto conto importato con l'esito dell'abbinamento (query status)"""
+    with get_conn() as conn, conn.cursor() as cur:
+        summary, lines = get_import(cur, import_id, request.args.get('status') or None)
+    if not summary:
+        return jsonify({'error': 'Import non trovato'}), 404
+    return jsonify({
+        'import': {**summary, 'created_at': summary['created_at'].isoformat()},
+        'lines': [
+            {
+                **line,
+                'booked_on': line['booked_on'].isoformat() if line['booked_on'] else None,
+                'amount': float(line['amount']),
+                'request_amount': float(line['request_amount']) if line['request_amount'] is not None else None,
+            }
+            for line in lines
+        ]
+    })
+
+@deposits_bp.route('/api/admin/statements/<int:import_id>/apply', methods=['POST'])
+@admin_required
+@idempotent
+def admin_apply_statement(import_id):
+    """Admin approva le richieste abbinate di un estratto conto.
+
+    Body JSON: { line_nos?: [int] } - default tutte le righe abbinate per causale;
+    le righe 'suggested' (solo importo) vanno indicate esplicitamente
+    """
+    data = request.get_json(silent=True) or {}
+    line_nos = data.get('line_nos')
+    if line_nos is not None:
+        try:
+            line_nos = parse_batch_ids(line_nos)
+        except BatchError as e:
+            return jsonify({'error': str(e)}), 400
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            ensure_deposits_schema(cur)
+            result = apply_lines(cur, import_id, session.get('user_id'), line_nos)
+            conn.commit()
+        return jsonify({'success': True, **result})
+    except Exception as e:
+        logger.exception("[deposits] statement apply failed: %s", e)
+        return jsonify({'error': 'statement_apply_failed', 'debug': str(e)}), 500
+
 # Route per pagine admin (senza prefisso)
 
 @deposits_bp.route('/admin/deposits/history', methods=['GET'])
@@ -8,6 +8,10 @@ from decimal import Decimal
 from flask import Blueprint, request, session, jsonify
 from backend.shared.database import get_connection
 from backend.shared.models import TransactionType, TransactionStatus
+from backend.shared.ledger import balances_at, history as ledger_history, SECTIONS as LEDGER_SECTIONS
+from backend.shared.portfolio_snapshots import user_timeline
+from backend.shared.partitioning import parse_period, period_conditions
+from backend.shared.returns import get_returns, serialize as serialize_returns
 
 portfolio_api_bp = Blueprint("portfolio_api", __name__)
 
@@ -163,6 +167,10 @@ def get_portfolio_transactions():
     status = request.args.get('status')
     limit = min(int(request.args.get('limit', 50)), 100)  # Max 100
     offset = int(request.args.get('offset', 0))
+    try:
+        start, end = parse_period(request.args)
+    except ValueError:
+        return jsonify({'error': 'Intervallo date non valido'}), 400
     
     with get_conn() as conn, conn.cursor() as cur:
         # Costruisci query con filtri
@@ -177,6 +185,11 @@ def get_portfolio_transactions():
             where_conditions.append("status = %s")
             params.append(status)
         
+        # Intervallo date: solo le partizioni mensili interessate
+        period_sql, period_params = period_conditions('created_at', start, end)
+        where_conditions.extend(period_sql)
+        params.extend(period_params)
+        
         where_clause = " AND ".join(where_conditions)
         
         # Conta totale transazioni
@@ -399,3 +412,96 @@ def get_current_balance():
         'total_available': float(total_available),
         'total_balance': float(total_balance)
     })
+
+@portfolio_api_bp.route('/api/ledger', methods=['GET'])
+@kyc_verified
+def get_ledger():
+    """Movimenti del ledger, dal più recente. Query: section, limit (max 200), before_id"""
+    uid = session.get("user_id")
+    section = request.args.get('section') or None
+    if section and section not in LEDGER_SECTIONS:
+        return jsonify({'error': 'Sezione non valida'}), 400
+    limit = min(request.args.get('limit', 50, type=int) or 50, 200)
+    before_id = request.args.get('before_id', type=int)
+
+    with get_conn() as conn, conn.cursor() as cur:
+        rows = ledger_history(cur, uid, section, limit, before_id)
+
+    return jsonify({
+        'movements': [{
+            'id': row['id'],
+            'section': row['section'],
+            'amount': float(row['amount']),
+            'balance_after': float(row['balance_after']),
+            'type': row['tx_type'],
+            'description': row['description'],
+            'reference_id': row['reference_id'],
+            'reference_type': row['reference_type'],
+            'created_at': row['created_at'].isoformat()
+        } for row in rows],
+        'next_before_id': rows[-1]['id'] if len(rows) == limit else None
+    })
+
+@portfolio_api_bp.route('/api/balance/at', methods=['GET'])
+@kyc_verified
+def get_balance_at():
+    """Saldi delle 4 sezioni a una data/ora (query at in formato ISO)"""
+    uid = session.get("user_id")
+    try:
+        at = datetime.fromisoformat(request.args['at'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Parametro at mancante o non valido'}), 400
+
+    with get_conn() as conn, conn.cursor() as cur:
+        balances = balances_at(cur, uid, at)
+
+    result = {section: float(balances[section]['balance']) for section in LEDGER_SECTIONS}
+    total_available = result['free_capital'] + result['referral_bonus'] + result['profits']
+    result.update({
+        'at': at.isoformat(),
+        'total_available': total_available,
+        'total_balance': total_available + result['invested_capital']
+    })
+    return jsonify(result)
+
+@portfolio_api_bp.route('/api/history', methods=['GET'])
+@kyc_verified
+def get_portfolio_history():
+    """Andamento giornaliero del portafoglio dagli snapshot (query days, max 3650)"""
+    uid = session.get("user_id")
+    days = min(max(request.args.get('days', 90, type=int) or 90, 1), 3650)
+
+    with get_conn() as conn, conn.cursor() as cur:
+        timeline = user_timeline(cur, uid, days)
+
+    return jsonify({
+        'labels': [day['snapshot_date'].isoformat() for day in timeline],
+        'free_capital': [float(day['free_capital']) for day in timeline],
+        'invested_capital': [float(day['invested_capital']) for day in timeline],
+        'referral_bonus': [float(day['referral_bonus']) for day in timeline],
+        'profits': [float(day['profits']) for day in timeline],
+        'total_balance': [
+            float(day['free_capital'] + day['invested_capital'] + day['referral_bonus'] + day['profits'])
+            for day in timeline
+        ],
+        'invested_by_project': [
+            {project_id: float(amount) for project_id, amount in (day['invested_by_project'] or {}).items()}
+            for day in timeline
+        ]
+    })
+
+
+@portfolio_api_bp.route('/api/returns', methods=['GET'])
+@kyc_verified
+def get_portfolio_returns():
+    """Rendimenti effettivi (XIRR annuo, TWR cumulato, in %) del portafoglio e per progetto"""
+    uid = session.get("user_id")
+
+    with get_conn() as conn, conn.cursor() as cur:
+        overall = get_returns(cur, 'user', user_ids=[uid])
+        positions = get_returns(cur, 'position', user_ids=[uid])
+
+    return jsonify({
+        'portfolio': serialize_returns(overall[0]) if overall else None,
+        'projects': [serialize_returns(row) for row in positions]
+    })
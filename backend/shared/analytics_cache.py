@@ -0,0 +1,293 @@
+"""
+Cache dei risultati analytics condivisa tra i worker
+Stale-while-revalidate + single-flight (in processo e cross-worker via advisory lock PostgreSQL)
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from decimal import Decimal
+from datetime import datetime, date
+
+from psycopg.types.json import Jsonb
+
+logger = logging.getLogger(__name__)
+
+# Finestra in cui il dato è fresco e finestra massima in cui può essere servito stale
+FRESH_TTL = int(os.environ.get("ANALYTICS_CACHE_TTL", "60"))
+STALE_TTL = int(os.environ.get("ANALYTICS_CACHE_STALE_TTL", "600"))
+# Attesa massima sul lock di un altro worker prima di ricalcolare in proprio
+LOCK_WAIT_SECONDS = int(os.environ.get("ANALYTICS_CACHE_LOCK_WAIT", "30"))
+
+_local = {}
+_local_lock = threading.Lock()
+_inflight = {}
+_refreshing = set()
+_table_ready = False
+
+_stats = {
+    'hits': 0,
+    'stale_hits': 0,
+    'misses': 0,
+    'coalesced': 0,
+    'refreshes': 0,
+    'errors': 0,
+}
+
+
+def get_conn():
+    from backend.shared.database import get_connection
+    return get_connection()
+
+
+def _incr(name):
+    with _local_lock:
+        _stats[name] += 1
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Tipo non serializzabile: {type(value).__name__}")
+
+
+def _normalize(payload):
+    """Normalizza il payload in tipi JSON così hit e miss restituiscono la stessa forma"""
+    return json.loads(json.dumps(payload, default=_json_default))
+
+
+def make_key(namespace, **params):
+    """Chiave deterministica da namespace + filtri (range, filtri report)"""
+    parts = [f"{k}={params[k] if params[k] is not None else ''}" for k in sorted(params)]
+    return f"{namespace}|" + "&".join(parts)
+
+
+def _lock_id(key):
+    """Converte la chiave in un bigint firmato per pg_advisory_lock"""
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def ensure_analytics_cache_table(cur):
+    """Crea la tabella analytics_cache se non esiste"""
+    global _table_ready
+    if not _table_ready:
+        from backend.shared.database import run_schema_setup
+        _table_ready = run_schema_setup(cur, _create_analytics_cache_table)[0]
+
+
+def _create_analytics_cache_table(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS analytics_cache (
+            cache_key TEXT PRIMARY KEY,
+            payload JSONB NOT NULL,
+            computed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+
+
+def _read_shared(key):
+    """Legge il payload condiviso, ritorna (payload, età in secondi) o (None, None)"""
+    with get_conn() as conn, conn.cursor() as cur:
+        ensure_analytics_cache_table(cur)
+        cur.execute(
+            """
+            SELECT payload, EXTRACT(EPOCH FROM (NOW() - computed_at)) AS age
+            FROM analytics_cache WHERE cache_key = %s
+            """,
+            (key,),
+        )
+        row = cur.fetchone()
+        conn.commit()
+    if not row:
+        return None, None
+    return row['payload'], float(row['age'])
+
+
+def _write_shared(key, payload):
+    with get_conn() as conn, conn.cursor() as cur:
+        ensure_analytics_cache_table(cur)
+        cur.execute(
+            """
+            INSERT INTO analytics_cache (cache_key, payload, computed_at)
+            VALUES (%s, %s, NOW())
+            ON CONFLICT (cache_key) DO UPDATE
+            SET payload = EXCLUDED.payload, computed_at = EXCLUDED.computed_at
+            """,
+            (key, Jsonb(payload)),
+        )
+        conn.commit()
+
+
+def _store_local(key, payload, age=0.0):
+    with _local_lock:
+        _local[key] = (payload, time.monotonic() - age)
+
+
+class _ComputeFailed(Exception):
+    """Errore sollevato dal calcolo stesso (da propagare, non da ritentare senza cache)"""
+
+
+def _compute(key, compute):
+    try:
+        payload = _normalize(compute())
+    except Exception as e:
+        raise _ComputeFailed(e) from e
+    try:
+        _write_shared(key, payload)
+    except Exception as e:
+        # Il risultato è valido anche se non condiviso
+        logger.warning("[analytics_cache] scrittura cache condivisa fallita per %s: %s", key, e)
+        _incr('errors')
+    _store_local(key, payload)
+    return payload
+
+
+def _compute_locked(key, compute, force=False):
+    """Ricalcola sotto advisory lock: un solo worker calcola, gli altri attendono e rileggono"""
+    lock_id = _lock_id(key)
+    with get_conn() as lock_conn:
+        lock_conn.autocommit = True
+        with lock_conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s) AS locked", (lock_id,))
+            locked = cur.fetchone()['locked']
+            if not locked:
+                # Un altro worker sta calcolando: attendi il suo risultato
+                _incr('coalesced')
+                # SET non accetta parametri lato server: set_config sì
+                cur.execute("SELECT set_config('lock_timeout', %s, false)", (f"{LOCK_WAIT_SECONDS}s",))
+                try:
+                    cur.execute("SELECT pg_advisory_lock(%s)", (lock_id,))
+                    locked = True
+                except Exception as e:
+                    logger.warning("[analytics_cache] attesa lock scaduta per %s: %s", key, e)
+            try:
+                if locked and not force:
+                    # Un altro worker può aver appena ricalcolato: rileggi prima di calcolare
+                    payload, age = _read_shared(key)
+                    if payload is not None and age < FRESH_TTL:
+                        _store_local(key, payload, age)
+                        return payload
+                return _compute(key, compute)
+            finally:
+                if locked:
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (lock_id,))
+
+
+def _single_flight(key, compute, force=False):
+    """Coalesce le richieste concorrenti dello stesso processo sulla stessa chiave"""
+    with _local_lock:
+        flight = _inflight.get(key)
+        leader = flight is None
+        if leader:
+            flight = {'event': threading.Event(), 'value': None, 'error': None}
+            _inflight[key] = flight
+    if not leader:
+        _incr('coalesced')
+        flight['event'].wait()
+        if flight['error'] is not None:
+            raise flight['error']
+        return flight['value']
+    try:
+        try:
+            flight['value'] = _compute_locked(key, compute, force)
+        except _ComputeFailed as e:
+            # Errore del calcolo: non va ripetuto
+            raise e.__cause__
+        except Exception as e:
+            # Solo lock/cache non disponibili: calcola senza condivisione
+            logger.warning("[analytics_cache] cache condivisa non disponibile per %s: %s", key, e)
+            _incr('errors')
+            flight['value'] = _normalize(compute())
+        return flight['value']
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        flight['event'].set()
+        with _local_lock:
+            _inflight.pop(key, None)
+
+
+def _refresh_in_background(key, compute):
+    with _local_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def run():
+        try:
+            _incr('refreshes')
+            _single_flight(key, compute)
+        except Exception as e:
+            logger.warning("[analytics_cache] refresh in background fallito per %s: %s", key, e)
+        finally:
+            with _local_lock:
+                _refreshing.discard(key)
+
+    threading.Thread(target=run, name="analytics-refresh", daemon=True).start()
+
+
+def get_or_compute(key, compute, force=False):
+    """Ritorna il payload in cache per la chiave, ricalcolandolo con stale-while-revalidate"""
+    if not force:
+        with _local_lock:
+            entry = _local.get(key)
+        local_age = time.monotonic() - entry[1] if entry is not None else None
+        # Copia locale assente o non più fresca: un altro worker può aver già aggiornato la riga condivisa
+        if local_age is None or local_age >= FRESH_TTL:
+            try:
+                payload, age = _read_shared(key)
+                if payload is not None and (local_age is None or age < local_age):
+                    _store_local(key, payload, age)
+                    with _local_lock:
+                        entry = _local.get(key)
+            except Exception as e:
+                logger.warning("[analytics_cache] lettura cache condivisa fallita per %s: %s", key, e)
+        if entry is not None:
+            payload, stored_at = entry
+            age = time.monotonic() - stored_at
+            if age < FRESH_TTL:
+                _incr('hits')
+                return payload
+            if age < STALE_TTL:
+                _incr('stale_hits')
+                _refresh_in_background(key, compute)
+                return payload
+    _incr('misses')
+    return _single_flight(key, compute, force)
+
+
+def invalidate(prefix=None):
+    """Svuota la cache locale e condivisa (tutta o per prefisso di chiave)"""
+    with _local_lock:
+        for key in [k for k in _local if prefix is None or k.startswith(prefix)]:
+            _local.pop(key, None)
+    with get_conn() as conn, conn.cursor() as cur:
+        ensure_analytics_cache_table(cur)
+        if prefix is None:
+            cur.execute("DELETE FROM analytics_cache")
+        else:
+            cur.execute("DELETE FROM analytics_cache WHERE cache_key LIKE %s", (prefix + '%',))
+        conn.commit()
+
+
+def get_stats():
+    """Contatori hit/miss/coalesced del processo corrente"""
+    with _local_lock:
+        stats = dict(_stats)
+        stats['entries'] = len(_local)
+        stats['inflight'] = len(_inflight)
+    lookups = stats['hits'] + stats['stale_hits'] + stats['misses']
+    stats['hit_rate'] = round((stats['hits'] + stats['stale_hits']) / lookups * 100, 1) if lookups else 0.0
+    stats['fresh_ttl'] = FRESH_TTL
+    stats['stale_ttl'] = STALE_TTL
+    stats['pid'] = os.getpid()
+    return stats
@@ -0,0 +1,100 @@
+"""
+Movimenti di saldo atomici sul portafoglio
+Ogni movimento è un'unica istruzione condizionale (aggiornamento relativo + movimento in
+portfolio_transactions): nessuna lettura-modifica-scrittura, nessun aggiornamento perso
+"""
+
+import logging
+
+from backend.shared.ledger import ledger_context
+
+logger = logging.getLogger(__name__)
+
+SECTIONS = ('free_capital', 'referral_bonus', 'profits')
+
+# Saldo disponibile registrato in balance_before/balance_after
+AVAILABLE_EXPR = "free_capital + referral_bonus + profits"
+
+
+class InsufficientFundsError(Exception):
+    """Saldo della sezione non sufficiente per il movimento"""
+    def __init__(self, section, amount):
+        super().__init__(f"Saldo insufficiente nella sezione {section}")
+        self.section = section
+        self.amount = amount
+
+
+def _check_section(section):
+    if section not in SECTIONS:
+        raise ValueError(f"Sezione portafoglio non valida: {section}")
+
+
+def debit(cur, user_id, section, amount, tx_type, description,
+          reference_id=None, reference_type=None, to_invested=False):
+    """Scala amount dalla sezione solo se il saldo è sufficiente; con to_invested lo sposta in invested_capital"""
+    _check_section(section)
+    invested = ", invested_capital = invested_capital + %(amount)s" if to_invested else ""
+    # Il trigger del ledger registra il movimento per sezione con questo contesto
+    with ledger_context(cur, tx_type, description, reference_id, reference_type):
+        cur.execute(
+            f"""
+            WITH moved AS (
+                UPDATE user_portfolios
+                SET {section} = {section} - %(amount)s{invested}, updated_at = NOW()
+                WHERE user_id = %(user_id)s AND {section} >= %(amount)s
+                RETURNING user_id, {section} AS section_balance, {AVAILABLE_EXPR} AS balance_after
+            ),
+            ledger AS (
+                INSERT INTO portfolio_transactions
+                    (user_id, type, amount, balance_before, balance_after, description,
+                     reference_id, reference_type, status)
+                SELECT user_id, %(tx_type)s, %(amount)s, balance_after + %(amount)s, balance_after,
+                       %(description)s, %(reference_id)s, %(reference_type)s, 'completed'
+                FROM moved
+                RETURNING id
+            )
+            SELECT m.section_balance, m.balance_after, l.id AS transaction_id
+            FROM moved m CROSS JOIN ledger l
+            """,
+            {'user_id': user_id, 'amount': amount, 'tx_type': tx_type, 'description': description,
+             'reference_id': reference_id, 'reference_type': reference_type},
+        )
+        row = cur.fetchone()
+    if not row:
+        raise InsufficientFundsError(section, amount)
+    return row
+
+
+def credit(cur, user_id, section, amount, tx_type, description,
+           reference_id=None, reference_type=None):
+    """Aggiunge amount alla sezione (crea il portafoglio se manca) registrando il movimento"""
+    _check_section(section)
+    initial = {s: ('%(amount)s' if s == section else '0') for s in SECTIONS}
+    # Il trigger del ledger registra il movimento per sezione con questo contesto
+    with ledger_context(cur, tx_type, description, reference_id, reference_type):
+        cur.execute(
+            f"""
+            WITH moved AS (
+                INSERT INTO user_portfolios (user_id, free_capital, invested_capital, referral_bonus, profits)
+                VALUES (%(user_id)s, {initial['free_capital']}, 0, {initial['referral_bonus']}, {initial['profits']})
+                ON CONFLICT (user_id)
+                DO UPDATE SET {section} = user_portfolios.{section} + EXCLUDED.{section}, updated_at = NOW()
+                RETURNING user_id, {section} AS section_balance, {AVAILABLE_EXPR} AS balance_after
+            ),
+            ledger AS (
+                INSERT INTO portfolio_transactions
+                    (user_id, type, amount, balance_before, balance_after, description,
+                     reference_id, reference_type, status)
+                SELECT user_id, %(tx_type)s, %(amount)s, balance_after - %(amount)s, balance_after,
+                       %(description)s, %(reference_id)s, %(reference_type)s, 'completed'
+                FROM moved
+                RETURNING id
+            )
+            SELECT m.section_balance, m.balance_after, l.id AS transaction_id
+            FROM moved m CROSS JOIN ledger l
+            """,
+            {'user_id': user_id, 'amount': amount, 'tx_type': tx_type, 'description': description,
+             'reference_id': reference_id, 'reference_type': reference_type},
+        )
+        row = cur.fetchone()
+    return row
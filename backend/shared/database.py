@@ -36,6 +36,22 @@ def get_db_connection():
         if conn:
             conn.close()
 
+SCHEMA_LOCK_TIMEOUT = os.environ.get("SCHEMA_LOCK_TIMEOUT", "5s")
+
+def run_schema_setup(cur, setup):
+    """Esegue setup(cursore) (DDL ed eventuale popolamento iniziale) su una connessione propria con commit.
+    Ritorna (committed, risultato): i flag di processo "schema pronto" vanno impostati solo se committed,
+    così un rollback della transazione del chiamante non lascia il flag vero su uno schema mai creato.
+    Se i lock non arrivano entro SCHEMA_LOCK_TIMEOUT (per esempio perché li tiene la transazione
+    stessa del chiamante) il setup gira sul cursore del chiamante e committed è False."""
+    try:
+        with get_connection() as conn, conn.cursor() as own:
+            own.execute("SELECT set_config('lock_timeout', %s, true)", (SCHEMA_LOCK_TIMEOUT,))
+            result = setup(own)
+        return True, result
+    except psycopg.errors.LockNotAvailable:
+        return False, setup(cur)
+
 def test_connection():
     """Testa la connessione al database"""
     try:
@@ -0,0 +1,120 @@
+"""
+Benchmark degli investimenti concorrenti su un singolo progetto
+Confronta l'aggiornamento diretto di projects.funded_amount (legacy) con i contatori
+partizionati di backend/shared/project_funding.py. Crea un progetto temporaneo e lo elimina
+alla fine; il resto della transazione di investimento è simulato con pg_sleep.
+
+Uso: python -m backend.shared.funding_benchmark --workers 32 --investments 50 --hold-ms 5
+"""
+
+import argparse
+import statistics
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from backend.shared.database import get_connection
+from backend.shared.project_funding import FundingError, ensure_funding_shards, get_funding, reserve
+
+LEGACY_SQL = """
+    UPDATE projects SET funded_amount = funded_amount + %s
+    WHERE id = %s AND status = 'active'
+      AND (total_amount IS NULL OR funded_amount + %s <= total_amount)
+"""
+
+
+def _create_project(total_amount):
+    code = f"BENCH-{uuid.uuid4().hex[:8]}"
+    with get_connection() as conn, conn.cursor() as cur:
+        ensure_funding_shards(cur)
+        cur.execute(
+            """
+            INSERT INTO projects (code, name, title, status, total_amount, funded_amount)
+            VALUES (%s, %s, %s, 'active', %s, 0)
+            RETURNING id
+            """,
+            (code, code, code, total_amount),
+        )
+        return cur.fetchone()['id']
+
+
+def _drop_project(project_id):
+    with get_connection() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM projects WHERE id = %s", (project_id,))
+
+
+def _worker(mode, project_id, investments, amount, hold, latencies, rejected, barrier):
+    with get_connection() as conn:
+        barrier.wait()
+        for _ in range(investments):
+            started = time.perf_counter()
+            with conn.transaction(), conn.cursor() as cur:
+                if mode == 'legacy':
+                    cur.execute(LEGACY_SQL, (amount, project_id, amount))
+                    if cur.rowcount == 0:
+                        rejected.append(1)
+                else:
+                    try:
+                        reserve(cur, project_id, amount)
+                    except FundingError:
+                        rejected.append(1)
+                # Resto della transazione di investimento (addebito, statistiche, commit)
+                cur.execute("SELECT pg_sleep(%s)", (hold,))
+            latencies.append(time.perf_counter() - started)
+
+
+def run(mode, workers, investments, amount, hold_ms, total_amount):
+    project_id = _create_project(total_amount)
+    latencies = []
+    rejected = []
+    barrier = threading.Barrier(workers + 1)
+    threads = [
+        threading.Thread(target=_worker, args=(mode, project_id, investments, amount,
+                                               hold_ms / 1000, latencies, rejected, barrier))
+        for _ in range(workers)
+    ]
+    try:
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        with get_connection() as conn, conn.cursor() as cur:
+            funding = get_funding(cur, project_id)
+    finally:
+        _drop_project(project_id)
+
+    latencies.sort()
+    accepted = len(latencies) - len(rejected)
+    expected = Decimal(str(amount)) * accepted
+    return {
+        'mode': mode,
+        'investments': len(latencies),
+        'accepted': accepted,
+        'rejected': len(rejected),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_per_s': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2),
+        'funded_amount': float(funding['funded_amount']),
+        'consistent': Decimal(funding['funded_amount']) == expected,
+        'overfunded': total_amount is not None and Decimal(funding['funded_amount']) > Decimal(str(total_amount)),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark raccolta progetto: legacy vs shard")
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--investments', type=int, default=50, help="investimenti per worker")
+    parser.add_argument('--amount', type=float, default=100)
+    parser.add_argument('--hold-ms', type=float, default=5, help="durata simulata del resto della transazione")
+    parser.add_argument('--total-amount', type=float, default=None,
+                        help="importo totale del progetto (default: illimitato); un valore basso verifica il sovra-finanziamento")
+    args = parser.parse_args()
+
+    for mode in ('legacy', 'sharded'):
+        result = run(mode, args.workers, args.investments, args.amount, args.hold_ms, args.total_amount)
+        print(" ".join(f"{k}={v}" for k, v in result.items()))
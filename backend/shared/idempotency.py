@@ -0,0 +1,206 @@
+"""
+Chiavi di idempotenza per gli endpoint che muovono denaro (tabella idempotency_keys)
+Il client invia l'header Idempotency-Key (o il campo form idempotency_key): la prima richiesta
+esegue la view e salva la risposta, i replay restituiscono la risposta salvata senza rieseguire.
+La riga della chiave resta non committata finché la prima richiesta è in corso, quindi un
+duplicato concorrente attende sull'indice univoco e poi legge la risposta salvata.
+Le risposte in streaming non si possono salvare: se la view indica in Content-Location l'URL da
+cui riscaricare lo stesso contenuto, il replay è un redirect 303 a quell'URL.
+
+Finestra nota: la view usa una propria connessione e fa commit dei movimenti prima che la riga
+della chiave venga completata e committata su questa. Se il processo termina tra i due commit
+(crash, kill del worker, connessione persa) la transazione della chiave viene annullata, la
+chiave torna libera e un retry con la stessa chiave riesegue la view. In quel caso restano a
+proteggere i controlli propri della view (addebiti condizionali, vincoli univoci sui record).
+"""
+
+import hashlib
+import json
+import logging
+import secrets
+from functools import wraps
+
+import psycopg
+from flask import request, session, jsonify, make_response
+
+logger = logging.getLogger(__name__)
+
+HEADER = 'Idempotency-Key'
+FORM_FIELD = 'idempotency_key'
+MAX_KEY_LENGTH = 255
+# Dopo questo intervallo una chiave può essere riutilizzata
+KEY_TTL_HOURS = 24
+# Attesa massima di un duplicato sulla richiesta in corso
+WAIT_TIMEOUT = '30s'
+REPLAYED_HEADERS = ('Content-Type', 'Location')
+
+_keys_ready = False
+
+CLAIM_SQL = """
+    INSERT INTO idempotency_keys (user_id, endpoint, idempotency_key, request_hash, status)
+    VALUES (%(user_id)s, %(endpoint)s, %(key)s, %(request_hash)s, 'processing')
+    ON CONFLICT (user_id, endpoint, idempotency_key) DO UPDATE
+    SET request_hash = EXCLUDED.request_hash, status = 'processing',
+        response_status = NULL, response_body = NULL, response_headers = NULL, response_hash = NULL,
+        created_at = NOW(), completed_at = NULL
+    WHERE idempotency_keys.created_at < NOW() - make_interval(hours => %(ttl)s)
+    RETURNING id
+"""
+
+
+def get_conn():
+    from backend.shared.database import get_connection
+    return get_connection()
+
+
+def ensure_idempotency_table(cur):
+    """Crea la tabella idempotency_keys se non esiste"""
+    global _keys_ready
+    if not _keys_ready:
+        from backend.shared.database import run_schema_setup
+        _keys_ready = run_schema_setup(cur, _create_idempotency_table)[0]
+
+
+def _create_idempotency_table(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            id BIGSERIAL PRIMARY KEY,
+            user_id INT NOT NULL,
+            endpoint TEXT NOT NULL,
+            idempotency_key TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            status TEXT NOT NULL CHECK (status IN ('processing', 'completed', 'failed')),
+            response_status INT,
+            response_body BYTEA,
+            response_headers JSONB,
+            response_hash TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            completed_at TIMESTAMPTZ,
+            UNIQUE (user_id, endpoint, idempotency_key)
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at)")
+
+
+def new_key():
+    """Chiave per i form HTML (campo nascosto idempotency_key)"""
+    return secrets.token_urlsafe(18)
+
+
+def _request_hash():
+    """Impronta della richiesta: la stessa chiave con un corpo diverso viene rifiutata"""
+    digest = hashlib.sha256()
+    digest.update(request.method.encode())
+    digest.update(request.path.encode())
+    digest.update(request.get_data(cache=True, parse_form_data=True))
+    form = sorted((k, v) for k, v in request.form.items(multi=True) if k != FORM_FIELD)
+    files = sorted((k, f.filename or '', _file_digest(f)) for k, f in request.files.items(multi=True))
+    digest.update(json.dumps([form, files]).encode())
+    return digest.hexdigest()
+
+
+def _file_digest(storage):
+    """Impronta del contenuto del file caricato (lo stream viene riportato all'inizio per la view)"""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: storage.stream.read(64 * 1024), b''):
+        digest.update(chunk)
+    storage.stream.seek(0)
+    return digest.hexdigest()
+
+
+def _stored_response(response):
+    """(status, corpo, header) da salvare, oppure None se la risposta non è riproducibile"""
+    if response.is_streamed:
+        location = response.headers.get('Content-Location')
+        if not location or response.status_code >= 400:
+            return None
+        return 303, b'', {'Location': location}
+    body = response.get_data()
+    headers = {name: response.headers[name] for name in REPLAYED_HEADERS if name in response.headers}
+    return response.status_code, body, headers
+
+
+def _replay(row, request_hash):
+    if row['request_hash'] != request_hash:
+        return jsonify({'error': 'Idempotency-Key già usata per una richiesta diversa'}), 422
+    response = make_response(bytes(row['response_body'] or b''), row['response_status'])
+    for name, value in (row['response_headers'] or {}).items():
+        response.headers[name] = value
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(f):
+    """Esegue la view al più una volta per (utente, endpoint, chiave)"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        key = (request.headers.get(HEADER) or request.form.get(FORM_FIELD) or '').strip()
+        if not key:
+            return f(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({'error': 'Idempotency-Key non valida'}), 400
+
+        params = {
+            'user_id': session.get('user_id') or 0,
+            'endpoint': request.endpoint,
+            'key': key,
+            'request_hash': _request_hash(),
+            'ttl': KEY_TTL_HOURS,
+        }
+        conn = get_conn()
+        try:
+            with conn.cursor() as cur:
+                ensure_idempotency_table(cur)
+                conn.commit()
+                cur.execute(f"SET LOCAL lock_timeout = '{WAIT_TIMEOUT}'")
+                try:
+                    cur.execute(CLAIM_SQL, params)
+                except psycopg.errors.LockNotAvailable:
+                    conn.rollback()
+                    return jsonify({'error': 'Richiesta con la stessa Idempotency-Key ancora in elaborazione'}), 409
+                if not cur.fetchone():
+                    cur.execute(
+                        """
+                        SELECT request_hash, status, response_status, response_body, response_headers
+                        FROM idempotency_keys
+                        WHERE user_id = %(user_id)s AND endpoint = %(endpoint)s AND idempotency_key = %(key)s
+                        """,
+                        params,
+                    )
+                    row = cur.fetchone()
+                    conn.commit()
+                    logger.info(f"Replay Idempotency-Key su {params['endpoint']} per utente {params['user_id']}")
+                    return _replay(row, params['request_hash'])
+
+                # Prima richiesta: la riga resta non committata fino al salvataggio della risposta
+                try:
+                    response = make_response(f(*args, **kwargs))
+                except Exception:
+                    conn.rollback()
+                    raise
+                stored = None if response.status_code >= 500 else _stored_response(response)
+                if stored is None:
+                    # Errore del server o streaming non riproducibile: la chiave viene liberata
+                    conn.rollback()
+                    return response
+                status_code, body, headers = stored
+                # La view ha già fatto commit sulla sua connessione: da qui al commit sotto un crash
+                # lascia la chiave libera e un retry rieseguirebbe la view (vedi docstring del modulo)
+                cur.execute(
+                    """
+                    UPDATE idempotency_keys
+                    SET status = %s, response_status = %s, response_body = %s, response_headers = %s::jsonb,
+                        response_hash = %s, completed_at = NOW()
+                    WHERE user_id = %s AND endpoint = %s AND idempotency_key = %s
+                    """,
+                    ('completed' if status_code < 400 else 'failed', status_code, body,
+                     json.dumps(headers), hashlib.sha256(body).hexdigest(),
+                     params['user_id'], params['endpoint'], key),
+                )
+                conn.commit()
+                return response
+        finally:
+            conn.close()
+    return decorated_function
@@ -0,0 +1,110 @@
+"""
+Allocazione di identificatori brevi senza collisioni (chiavi richieste, causali, codici referral)
+Ogni namespace ha una sequence PostgreSQL: il valore di nextval passa per una permutazione
+di Feistel con chiave segreta e viene codificato in base32 Crockford a gruppi di 4 caratteri.
+La permutazione è biiettiva, quindi valori di sequence distinti danno codici distinti:
+nessuna verifica di unicità, nessun retry, costo costante. Il trattino rende i nuovi codici
+disgiunti dai formati generati in precedenza (casuali, senza trattino).
+"""
+
+import hashlib
+import hmac
+import logging
+import secrets
+
+logger = logging.getLogger(__name__)
+
+# Base32 Crockford: niente I, L, O, U (facili da confondere al telefono o in una causale)
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+GROUP = 4
+ROUNDS = 4
+
+# Lunghezza in caratteri (pari: 5 bit per carattere, metà per ramo di Feistel) e prefisso
+NAMESPACES = {
+    'deposit_key': {'length': 8, 'prefix': ''},
+    'withdrawal_key': {'length': 8, 'prefix': ''},
+    'referral_code': {'length': 8, 'prefix': 'REF-'},
+}
+
+_schema_ready = False
+_secrets = {}
+
+
+def get_conn():
+    from backend.shared.database import get_connection
+    return get_connection()
+
+
+def ensure_identifier_schema(cur):
+    """Crea le sequence dei namespace e la tabella delle chiavi di permutazione"""
+    global _schema_ready
+    if not _schema_ready:
+        from backend.shared.database import run_schema_setup
+        _schema_ready = run_schema_setup(cur, _create_identifier_schema)[0]
+
+
+def _create_identifier_schema(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS identifier_keys (
+            namespace TEXT PRIMARY KEY,
+            secret BYTEA NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    for namespace in NAMESPACES:
+        cur.execute(f"CREATE SEQUENCE IF NOT EXISTS identifier_seq_{namespace}")
+
+
+def _secret(namespace):
+    """Chiave del namespace, generata al primo uso e conservata nel database
+    (cambiarla renderebbe possibili collisioni con i codici già emessi).
+    Usa una connessione propria: la chiave resta salvata anche se la transazione del chiamante fallisce"""
+    if namespace not in _secrets:
+        with get_conn() as conn, conn.cursor() as cur:
+            ensure_identifier_schema(cur)
+            cur.execute(
+                """
+                INSERT INTO identifier_keys (namespace, secret) VALUES (%s, %s)
+                ON CONFLICT (namespace) DO NOTHING
+                """,
+                (namespace, secrets.token_bytes(32)),
+            )
+            cur.execute("SELECT secret FROM identifier_keys WHERE namespace = %s", (namespace,))
+            _secrets[namespace] = bytes(cur.fetchone()['secret'])
+    return _secrets[namespace]
+
+
+def permute(secret, value, bits):
+    """Feistel bilanciato su bits bit: biiezione di [0, 2**bits) determinata da secret"""
+    half = bits // 2
+    mask = (1 << half) - 1
+    left, right = value >> half, value & mask
+    for round_no in range(ROUNDS):
+        digest = hmac.new(secret, bytes([round_no]) + right.to_bytes(8, 'big'), hashlib.sha256).digest()
+        left, right = right, left ^ (int.from_bytes(digest[:8], 'big') & mask)
+    return (left << half) | right
+
+
+def encode(value, length):
+    """Base32 Crockford a lunghezza fissa, gruppi separati da trattino"""
+    chars = []
+    for _ in range(length):
+        value, digit = divmod(value, 32)
+        chars.append(ALPHABET[digit])
+    code = ''.join(reversed(chars))
+    return '-'.join(code[i:i + GROUP] for i in range(0, length, GROUP))
+
+
+def allocate(cur, namespace):
+    """Nuovo codice del namespace: nextval + permutazione, sempre univoco"""
+    spec = NAMESPACES[namespace]
+    # Prima la chiave: al primo uso crea anche schema e sequence, già committati
+    secret = _secret(namespace)
+    bits = spec['length'] * 5
+    cur.execute(f"SELECT nextval('identifier_seq_{namespace}') AS value")
+    value = cur.fetchone()['value']
+    if value >= 1 << bits:
+        raise RuntimeError(f"Spazio identificatori esaurito per {namespace}")
+    return spec['prefix'] + encode(permute(secret, value, bits), spec['length'])
@@ -0,0 +1,267 @@
+"""
+Ledger append-only dei portafogli (portfolio_ledger)
+Una riga per movimento e per sezione, con importo con segno e saldo dopo il movimento.
+Le righe sono scritte da un trigger su user_portfolios, quindi nella stessa transazione (e
+sotto lo stesso lock di riga) di ogni aggiornamento del saldo, qualunque sia il chiamante.
+user_portfolios diventa una cache ricostruibile dal ledger (rebuild_portfolios).
+Tipo, descrizione e riferimento del movimento arrivano dal contesto di transazione (ledger_context).
+"""
+
+import json
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+SECTIONS = ('free_capital', 'invested_capital', 'referral_bonus', 'profits')
+
+_ledger_ready = False
+
+CAPTURE_FUNCTION_SQL = """
+    CREATE OR REPLACE FUNCTION portfolio_ledger_capture() RETURNS trigger AS $$
+    DECLARE
+        ctx JSONB;
+        o_free NUMERIC := 0;
+        o_invested NUMERIC := 0;
+        o_bonus NUMERIC := 0;
+        o_profits NUMERIC := 0;
+    BEGIN
+        IF current_setting('cip.ledger_rebuild', true) = 'on' THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP = 'UPDATE' THEN
+            o_free := OLD.free_capital;
+            o_invested := OLD.invested_capital;
+            o_bonus := OLD.referral_bonus;
+            o_profits := OLD.profits;
+        END IF;
+        ctx := NULLIF(current_setting('cip.ledger_context', true), '')::JSONB;
+        INSERT INTO portfolio_ledger
+            (user_id, section, amount, balance_after, tx_type, description, reference_id, reference_type)
+        SELECT NEW.user_id, s.section, s.new_value - s.old_value, s.new_value,
+               COALESCE(ctx->>'tx_type', 'adjustment'), ctx->>'description',
+               (ctx->>'reference_id')::INT, ctx->>'reference_type'
+        FROM (VALUES
+            ('free_capital', COALESCE(o_free, 0), COALESCE(NEW.free_capital, 0)),
+            ('invested_capital', COALESCE(o_invested, 0), COALESCE(NEW.invested_capital, 0)),
+            ('referral_bonus', COALESCE(o_bonus, 0), COALESCE(NEW.referral_bonus, 0)),
+            ('profits', COALESCE(o_profits, 0), COALESCE(NEW.profits, 0))
+        ) AS s(section, old_value, new_value)
+        WHERE s.new_value <> s.old_value;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# Append-only: consentita solo la cancellazione a cascata dalla cancellazione dell'utente
+GUARD_FUNCTION_SQL = """
+    CREATE OR REPLACE FUNCTION portfolio_ledger_guard() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'DELETE' AND pg_trigger_depth() > 1 THEN
+            RETURN OLD;
+        END IF;
+        RAISE EXCEPTION 'portfolio_ledger è append-only';
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# Saldi iniziali per i portafogli esistenti prima del ledger
+OPENING_SQL = """
+    INSERT INTO portfolio_ledger (user_id, section, amount, balance_after, tx_type, description)
+    SELECT up.user_id, s.section, s.value, s.value, 'opening', 'Saldo iniziale'
+    FROM user_portfolios up
+    CROSS JOIN LATERAL (VALUES
+        ('free_capital', up.free_capital),
+        ('invested_capital', up.invested_capital),
+        ('referral_bonus', up.referral_bonus),
+        ('profits', up.profits)
+    ) AS s(section, value)
+    WHERE COALESCE(s.value, 0) <> 0
+      AND NOT EXISTS (
+          SELECT 1 FROM portfolio_ledger l WHERE l.user_id = up.user_id AND l.section = s.section
+      )
+"""
+
+# Somme del ledger per sezione, confrontate con la cache user_portfolios
+TOTALS_SQL = """
+    WITH totals AS (
+        SELECT user_id,
+               COALESCE(SUM(amount) FILTER (WHERE section = 'free_capital'), 0) AS free_capital,
+               COALESCE(SUM(amount) FILTER (WHERE section = 'invested_capital'), 0) AS invested_capital,
+               COALESCE(SUM(amount) FILTER (WHERE section = 'referral_bonus'), 0) AS referral_bonus,
+               COALESCE(SUM(amount) FILTER (WHERE section = 'profits'), 0) AS profits
+        FROM portfolio_ledger
+        WHERE %(ids)s::int[] IS NULL OR user_id = ANY(%(ids)s::int[])
+        GROUP BY user_id
+    )
+"""
+
+
+def ensure_ledger(cur):
+    """Crea ledger e trigger; alla prima installazione registra i saldi esistenti come apertura"""
+    global _ledger_ready
+    if not _ledger_ready:
+        from backend.shared.database import run_schema_setup
+        _ledger_ready = run_schema_setup(cur, _create_ledger)[0]
+
+
+def _create_ledger(cur):
+    cur.execute("SELECT 1 FROM pg_trigger WHERE tgname = 'trg_portfolio_ledger'")
+    if not cur.fetchone():
+        # Blocca le scritture sui portafogli: nessun movimento tra apertura e trigger
+        cur.execute("LOCK TABLE user_portfolios IN SHARE ROW EXCLUSIVE MODE")
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS portfolio_ledger (
+                id BIGSERIAL PRIMARY KEY,
+                user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+                section TEXT NOT NULL CHECK (section IN ('free_capital', 'invested_capital', 'referral_bonus', 'profits')),
+                amount NUMERIC(15,2) NOT NULL,
+                balance_after NUMERIC(15,2) NOT NULL,
+                tx_type TEXT NOT NULL,
+                description TEXT,
+                reference_id INT,
+                reference_type TEXT,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+            )
+            """
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_portfolio_ledger_user_time ON portfolio_ledger(user_id, created_at, id)"
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_portfolio_ledger_user_section_time "
+            "ON portfolio_ledger(user_id, section, created_at, id)"
+        )
+        cur.execute(CAPTURE_FUNCTION_SQL)
+        cur.execute(GUARD_FUNCTION_SQL)
+        cur.execute(OPENING_SQL)
+        logger.info(f"portfolio_ledger: {cur.rowcount} saldi iniziali registrati")
+        cur.execute("DROP TRIGGER IF EXISTS trg_portfolio_ledger_guard ON portfolio_ledger")
+        cur.execute(
+            """
+            CREATE TRIGGER trg_portfolio_ledger_guard
+            BEFORE UPDATE OR DELETE ON portfolio_ledger
+            FOR EACH ROW EXECUTE FUNCTION portfolio_ledger_guard()
+            """
+        )
+        cur.execute(
+            """
+            CREATE TRIGGER trg_portfolio_ledger
+            AFTER INSERT OR UPDATE OF free_capital, invested_capital, referral_bonus, profits ON user_portfolios
+            FOR EACH ROW EXECUTE FUNCTION portfolio_ledger_capture()
+            """
+        )
+
+
+def set_context(cur, tx_type, description=None, reference_id=None, reference_type=None):
+    """Etichetta i movimenti successivi della transazione"""
+    ensure_ledger(cur)
+    context = {'tx_type': tx_type, 'description': description,
+               'reference_id': reference_id, 'reference_type': reference_type}
+    cur.execute("SELECT set_config('cip.ledger_context', %s, true)", (json.dumps(context),))
+
+
+def clear_context(cur):
+    cur.execute("SELECT set_config('cip.ledger_context', '', true)")
+
+
+@contextmanager
+def ledger_context(cur, tx_type, description=None, reference_id=None, reference_type=None):
+    """Contesto dei movimenti per le istruzioni eseguite nel blocco
+    (leggere i risultati dentro il blocco: l'azzeramento usa lo stesso cursore).
+    In caso di errore la transazione è comunque da annullare e il contesto decade con essa"""
+    set_context(cur, tx_type, description, reference_id, reference_type)
+    yield
+    clear_context(cur)
+
+
+def balances_at(cur, user_id, at=None):
+    """Saldi delle quattro sezioni all'istante at (default: ora), una lookup indicizzata per sezione"""
+    cur.execute(
+        """
+        SELECT s.section, COALESCE(l.balance_after, 0) AS balance, l.created_at AS last_movement_at
+        FROM unnest(%s::text[]) AS s(section)
+        LEFT JOIN LATERAL (
+            SELECT balance_after, created_at
+            FROM portfolio_ledger
+            WHERE user_id = %s AND section = s.section AND created_at <= COALESCE(%s, clock_timestamp())
+            ORDER BY created_at DESC, id DESC
+            LIMIT 1
+        ) l ON TRUE
+        """,
+        (list(SECTIONS), user_id, at),
+    )
+    return {row['section']: row for row in cur.fetchall()}
+
+
+def history(cur, user_id, section=None, limit=50, before_id=None):
+    """Movimenti dal più recente, paginati per before_id"""
+    cur.execute(
+        """
+        SELECT id, section, amount, balance_after, tx_type, description,
+               reference_id, reference_type, created_at
+        FROM portfolio_ledger
+        WHERE user_id = %(user_id)s
+          AND (%(section)s::text IS NULL OR section = %(section)s)
+          AND (%(before_id)s::bigint IS NULL OR (created_at, id) < (
+              SELECT created_at, id FROM portfolio_ledger WHERE id = %(before_id)s
+          ))
+        ORDER BY created_at DESC, id DESC
+        LIMIT %(limit)s
+        """,
+        {'user_id': user_id, 'section': section, 'before_id': before_id, 'limit': limit},
+    )
+    return cur.fetchall()
+
+
+def drift(cur, user_ids=None):
+    """Portafogli la cui cache non coincide con le somme del ledger"""
+    cur.execute(
+        TOTALS_SQL + """
+        SELECT up.user_id,
+               up.free_capital, t.free_capital AS ledger_free_capital,
+               up.invested_capital, t.invested_capital AS ledger_invested_capital,
+               up.referral_bonus, t.referral_bonus AS ledger_referral_bonus,
+               up.profits, t.profits AS ledger_profits
+        FROM user_portfolios up
+        LEFT JOIN totals t ON t.user_id = up.user_id
+        WHERE (%(ids)s::int[] IS NULL OR up.user_id = ANY(%(ids)s::int[]))
+          AND (up.free_capital, up.invested_capital, up.referral_bonus, up.profits)
+              IS DISTINCT FROM (COALESCE(t.free_capital, 0), COALESCE(t.invested_capital, 0),
+                                COALESCE(t.referral_bonus, 0), COALESCE(t.profits, 0))
+        ORDER BY up.user_id
+        """,
+        {'ids': user_ids},
+    )
+    return cur.fetchall()
+
+
+def rebuild_portfolios(cur, user_ids=None):
+    """Riallinea user_portfolios alle somme del ledger; ritorna gli utenti corretti"""
+    cur.execute("SELECT set_config('cip.ledger_rebuild', 'on', true)")
+    try:
+        cur.execute(
+            TOTALS_SQL + """
+            UPDATE user_portfolios up
+            SET free_capital = COALESCE(t.free_capital, 0),
+                invested_capital = COALESCE(t.invested_capital, 0),
+                referral_bonus = COALESCE(t.referral_bonus, 0),
+                profits = COALESCE(t.profits, 0),
+                updated_at = NOW()
+            FROM user_portfolios src
+            LEFT JOIN totals t ON t.user_id = src.user_id
+            WHERE up.user_id = src.user_id
+              AND (%(ids)s::int[] IS NULL OR up.user_id = ANY(%(ids)s::int[]))
+              AND (up.free_capital, up.invested_capital, up.referral_bonus, up.profits)
+                  IS DISTINCT FROM (COALESCE(t.free_capital, 0), COALESCE(t.invested_capital, 0),
+                                    COALESCE(t.referral_bonus, 0), COALESCE(t.profits, 0))
+            RETURNING up.user_id
+            """,
+            {'ids': user_ids},
+        )
+        fixed = [row['user_id'] for row in cur.fetchall()]
+    finally:
+        cur.execute("SELECT set_config('cip.ledger_rebuild', 'off', true)")
+    logger.info(f"user_portfolios ricostruita dal ledger: {len(fixed)} portafogli corretti")
+    return fixed
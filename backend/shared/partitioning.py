@@ -0,0 +1,332 @@
+"""
+Partizionamento mensile per created_at delle tabelle storiche che crescono soltanto
+(portfolio_transactions, deposit_requests, withdrawal_requests)
+Le partizioni dei mesi futuri sono create in anticipo (avvio app e job notturno), gli indici
+sono definiti sulla tabella madre e quindi presenti su ogni partizione. Le partizioni vecchie
+si staccano e si spostano nello schema archive (fuori dalle query, esportabili con pg_dump -n archive).
+Il PK diventa (id, created_at): un vincolo univoco su una tabella partizionata deve contenere la
+chiave di partizione, quindi unique_key e payment_reference restano univoci per costruzione
+(servizio identificatori) e non più per indice.
+
+Uso:
+  python -m backend.shared.partitioning migrate           # conversione una tantum delle tabelle esistenti
+  python -m backend.shared.partitioning maintain          # crea le partizioni dei prossimi mesi
+  python -m backend.shared.partitioning archive --older-than 36
+"""
+
+import logging
+from datetime import date
+
+logger = logging.getLogger(__name__)
+
+PARTITIONED_TABLES = ('portfolio_transactions', 'deposit_requests', 'withdrawal_requests')
+MONTHS_AHEAD = 3
+ARCHIVE_SCHEMA = 'archive'
+# Attesa massima sul lock della tabella madre per creare/staccare partizioni
+LOCK_TIMEOUT = '5s'
+
+# Indici per le query recenti: (suffisso, colonne), creati sulla tabella madre
+INDEXES = {
+    'portfolio_transactions': [
+        ('user_created', 'user_id, created_at DESC'),
+        ('created', 'created_at DESC'),
+        ('type_created', 'type, created_at DESC'),
+        ('reference', 'reference_type, reference_id'),
+    ],
+    'deposit_requests': [
+        ('user_created', 'user_id, created_at DESC'),
+        ('status_created', 'status, created_at DESC'),
+        ('created', 'created_at DESC'),
+        ('unique_key', 'unique_key'),
+        ('payment_reference', 'payment_reference'),
+    ],
+    'withdrawal_requests': [
+        ('user_created', 'user_id, created_at DESC'),
+        ('status_created', 'status, created_at DESC'),
+        ('created', 'created_at DESC'),
+        ('unique_key', 'unique_key'),
+    ],
+}
+
+
+def get_conn():
+    from backend.shared.database import get_connection
+    return get_connection()
+
+
+def _add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month:%Y%m}"
+
+
+def parse_period(args):
+    """Intervallo from/to (AAAA-MM-GG, estremi inclusi) dai parametri della richiesta; ValueError se non valido"""
+    start = date.fromisoformat(args['from']) if args.get('from') else None
+    end = date.fromisoformat(args['to']) if args.get('to') else None
+    if start and end and start > end:
+        raise ValueError("Intervallo date non valido")
+    return start, end
+
+
+def period_conditions(column, start, end):
+    """Condizioni su created_at che permettono di escludere le partizioni fuori intervallo"""
+    conditions, params = [], []
+    if start:
+        conditions.append(f"{column} >= %s")
+        params.append(start)
+    if end:
+        conditions.append(f"{column} < %s::date + 1")
+        params.append(end)
+    return conditions, params
+
+
+def is_partitioned(cur, table):
+    cur.execute(
+        """
+        SELECT EXISTS (
+            SELECT 1 FROM pg_partitioned_table pt
+            JOIN pg_class c ON c.oid = pt.partrelid
+            WHERE c.relname = %s AND c.relnamespace = 'public'::regnamespace
+        ) AS partitioned
+        """,
+        (table,),
+    )
+    return cur.fetchone()['partitioned']
+
+
+def list_partitions(cur, table):
+    """Partizioni mensili attaccate alla tabella, dalla più vecchia, con numero stimato di righe"""
+    cur.execute(
+        """
+        SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound,
+               c.reltuples::bigint AS estimated_rows
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        ORDER BY c.relname
+        """,
+        (table,),
+    )
+    return cur.fetchall()
+
+
+def _create_month(cur, table, month):
+    """Crea la partizione del mese; le righe finite nella partizione di default vengono spostate"""
+    name = partition_name(table, month)
+    start, end = month.isoformat(), _add_months(month, 1).isoformat()
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL AS found", (name,))
+    if cur.fetchone()['found']:
+        return False
+    cur.execute(
+        f"SELECT EXISTS (SELECT 1 FROM {table}_default WHERE created_at >= %s AND created_at < %s) AS found",
+        (start, end),
+    )
+    if not cur.fetchone()['found']:
+        cur.execute(f"CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM ('{start}') TO ('{end}')")
+        return True
+    # Righe del mese nella default: si spostano in una tabella che poi viene attaccata
+    cur.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    cur.execute(
+        f"""
+        WITH moved AS (
+            DELETE FROM {table}_default WHERE created_at >= %s AND created_at < %s RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+        """,
+        (start, end),
+    )
+    logger.warning(f"{table}: {cur.rowcount} righe spostate dalla partizione di default in {name}")
+    cur.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM ('{start}') TO ('{end}')")
+    return True
+
+
+def ensure_partitions(cur, months_ahead=MONTHS_AHEAD):
+    """Crea le partizioni dal mese corrente a months_ahead mesi avanti; ritorna le partizioni create"""
+    current = date.today().replace(day=1)
+    created = []
+    cur.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(cur, table):
+            continue
+        for n in range(months_ahead + 1):
+            month = _add_months(current, n)
+            if _create_month(cur, table, month):
+                created.append(partition_name(table, month))
+    if created:
+        logger.info(f"Partizioni create: {', '.join(created)}")
+    return created
+
+
+def _legacy_name(name):
+    return f"{name[:56]}_legacy"
+
+
+def migrate_table(cur, table, months_ahead=MONTHS_AHEAD):
+    """Converte una tabella esistente in tabella partizionata per mese.
+    La tabella originale resta come <tabella>_legacy per la verifica e va eliminata a mano"""
+    if is_partitioned(cur, table):
+        return None
+    cur.execute(f"LOCK TABLE {table} IN ACCESS EXCLUSIVE MODE")
+
+    # Oggetti da ricreare sulla nuova tabella: viste dipendenti, chiavi esterne, indici, sequence
+    cur.execute(
+        """
+        SELECT DISTINCT v.oid::regclass::text AS name, pg_get_viewdef(v.oid) AS definition
+        FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        JOIN pg_class v ON v.oid = r.ev_class
+        WHERE d.refobjid = %s::regclass AND v.relkind = 'v'
+        """,
+        (table,),
+    )
+    views = cur.fetchall()
+    cur.execute(
+        """
+        SELECT conname, pg_get_constraintdef(oid) AS definition
+        FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'
+        """,
+        (table,),
+    )
+    foreign_keys = cur.fetchall()
+    cur.execute(
+        """
+        SELECT c.relname AS name, pg_get_indexdef(i.indexrelid) AS definition, i.indisprimary AS is_primary
+        FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE i.indrelid = %s::regclass
+        """,
+        (table,),
+    )
+    indexes = cur.fetchall()
+    cur.execute("SELECT pg_get_serial_sequence(%s, 'id') AS seq", (table,))
+    sequence = cur.fetchone()['seq']
+    cur.execute(
+        """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = %s
+        ORDER BY ordinal_position
+        """,
+        (table,),
+    )
+    columns = [row['column_name'] for row in cur.fetchall()]
+    cur.execute(
+        f"SELECT date_trunc('month', MIN(created_at))::date AS first_month FROM {table}"
+    )
+    first_month = cur.fetchone()['first_month']
+
+    legacy = f"{table}_legacy"
+    cur.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+    for index in indexes:
+        cur.execute(f"ALTER INDEX {index['name']} RENAME TO {_legacy_name(index['name'])}")
+
+    cur.execute(
+        f"""
+        CREATE TABLE {table} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE INCLUDING COMMENTS)
+        PARTITION BY RANGE (created_at)
+        """
+    )
+    cur.execute(f"ALTER TABLE {table} ALTER COLUMN created_at SET NOT NULL")
+    cur.execute(f"ALTER TABLE {table} ADD PRIMARY KEY (id, created_at)")
+    if sequence:
+        cur.execute(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id")
+    cur.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+
+    current = date.today().replace(day=1)
+    month = min(first_month or current, current)
+    while month <= _add_months(current, months_ahead):
+        _create_month(cur, table, month)
+        month = _add_months(month, 1)
+
+    # Le date mancanti finiscono in coda alla partizione di default
+    select_list = ", ".join(
+        "COALESCE(created_at, '-infinity')" if column == 'created_at' else column for column in columns
+    )
+    cur.execute(f"INSERT INTO {table} ({', '.join(columns)}) SELECT {select_list} FROM {legacy}")
+    copied = cur.rowcount
+
+    for fk in foreign_keys:
+        cur.execute(f"ALTER TABLE {table} ADD CONSTRAINT {fk['conname']} {fk['definition']}")
+    for index in indexes:
+        if index['is_primary']:
+            continue
+        # Univocità non applicabile senza created_at: l'indice resta per le ricerche
+        cur.execute(index['definition'].replace('CREATE UNIQUE INDEX', 'CREATE INDEX', 1))
+    for suffix, index_columns in INDEXES[table]:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{suffix} ON {table} ({index_columns})")
+    for view in views:
+        cur.execute(f"CREATE OR REPLACE VIEW {view['name']} AS {view['definition']}")
+    cur.execute(f"ANALYZE {table}")
+
+    logger.info(f"{table} partizionata per mese: {copied} righe copiate, originale in {legacy}")
+    return {'table': table, 'rows': copied, 'legacy_table': legacy, 'views': [v['name'] for v in views]}
+
+
+def migrate_all(months_ahead=MONTHS_AHEAD):
+    """Converte tutte le tabelle storiche, una transazione per tabella"""
+    results = []
+    for table in PARTITIONED_TABLES:
+        with get_conn() as conn, conn.cursor() as cur:
+            result = migrate_table(cur, table, months_ahead)
+        if result:
+            results.append(result)
+    return results
+
+
+def archive_partitions(cur, older_than_months):
+    """Stacca le partizioni mensili terminate da più di older_than_months mesi e le sposta nello
+    schema archive; ritorna i nomi delle partizioni archiviate"""
+    cutoff = _add_months(date.today().replace(day=1), -older_than_months)
+    cur.execute(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}")
+    cur.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+    archived = []
+    for table in PARTITIONED_TABLES:
+        if not is_partitioned(cur, table):
+            continue
+        for partition in list_partitions(cur, table):
+            name = partition['name']
+            suffix = name[len(table) + 2:]
+            if not name.startswith(f"{table}_p") or not suffix.isdigit():
+                continue
+            month = date(int(suffix[:4]), int(suffix[4:]), 1)
+            if _add_months(month, 1) > cutoff:
+                continue
+            cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+            cur.execute(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}")
+            archived.append(f"{ARCHIVE_SCHEMA}.{name}")
+    if archived:
+        logger.info(f"Partizioni archiviate: {', '.join(archived)}")
+    return archived
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Partizionamento mensile delle tabelle storiche")
+    parser.add_argument('command', choices=('migrate', 'maintain', 'archive', 'list'))
+    parser.add_argument('--months-ahead', type=int, default=MONTHS_AHEAD)
+    parser.add_argument('--older-than', type=int, default=None, help="mesi (solo archive)")
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        for result in migrate_all(args.months_ahead):
+            print(f"{result['table']}: {result['rows']} righe, originale in {result['legacy_table']}")
+    elif args.command == 'archive':
+        if not args.older_than or args.older_than < 1:
+            parser.error("archive richiede --older-than (mesi, almeno 1)")
+        with get_conn() as conn, conn.cursor() as cur:
+            for name in archive_partitions(cur, args.older_than):
+                print(name)
+    elif args.command == 'list':
+        with get_conn() as conn, conn.cursor() as cur:
+            for table in PARTITIONED_TABLES:
+                if is_partitioned(cur, table):
+                    for partition in list_partitions(cur, table):
+                        print(f"{partition['name']} {partition['bound']} ~{partition['estimated_rows']} righe")
+    else:
+        with get_conn() as conn, conn.cursor() as cur:
+            for name in ensure_partitions(cur, args.months_ahead):
+                print(name)
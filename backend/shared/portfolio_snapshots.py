@@ -0,0 +1,338 @@
+"""
+Snapshot giornalieri dei portafogli (portfolio_snapshots) e della piattaforma (platform_snapshots)
+Una riga per utente e per giorno con i saldi delle 4 sezioni a fine giornata e il capitale
+investito per progetto, più una riga aggregata per giorno. I grafici leggono N righe invece
+di ricostruire lo storico a ogni richiesta.
+Il giorno D si calcola dal ledger: snapshot di D-1 più i movimenti di D, oppure (primo giorno
+o buco nello storico) ultimo saldo di ogni sezione prima della mezzanotte. Rieseguire un
+giorno lo sostituisce, quindi il job è idempotente e il backfill è lo stesso job su un intervallo.
+
+Uso (cron notturno): python -m backend.shared.portfolio_snapshots [--from AAAA-MM-GG] [--to AAAA-MM-GG]
+"""
+
+import logging
+from datetime import date, timedelta
+
+from backend.shared.ledger import ensure_ledger
+
+logger = logging.getLogger(__name__)
+
+# Lock advisory del job: un solo worker/cron alla volta
+JOB_LOCK_ID = 4307001
+MAX_RANGE_DAYS = 3660
+
+_snapshots_ready = False
+
+# Saldi a fine giornata dall'ultimo movimento di ogni sezione (primo giorno o storico mancante)
+FULL_BALANCES_SQL = """
+    balances AS (
+        SELECT user_id,
+               COALESCE(SUM(balance_after) FILTER (WHERE section = 'free_capital'), 0) AS free_capital,
+               COALESCE(SUM(balance_after) FILTER (WHERE section = 'invested_capital'), 0) AS invested_capital,
+               COALESCE(SUM(balance_after) FILTER (WHERE section = 'referral_bonus'), 0) AS referral_bonus,
+               COALESCE(SUM(balance_after) FILTER (WHERE section = 'profits'), 0) AS profits
+        FROM (
+            SELECT DISTINCT ON (user_id, section) user_id, section, balance_after
+            FROM portfolio_ledger
+            WHERE created_at < %(cutoff)s
+            ORDER BY user_id, section, created_at DESC, id DESC
+        ) last
+        GROUP BY user_id
+    )
+"""
+
+# Snapshot del giorno precedente più i movimenti del giorno
+INCREMENTAL_BALANCES_SQL = """
+    moved AS (
+        SELECT user_id,
+               COALESCE(SUM(amount) FILTER (WHERE section = 'free_capital'), 0) AS free_capital,
+               COALESCE(SUM(amount) FILTER (WHERE section = 'invested_capital'), 0) AS invested_capital,
+               COALESCE(SUM(amount) FILTER (WHERE section = 'referral_bonus'), 0) AS referral_bonus,
+               COALESCE(SUM(amount) FILTER (WHERE section = 'profits'), 0) AS profits
+        FROM portfolio_ledger
+        WHERE created_at >= %(start)s AND created_at < %(cutoff)s
+        GROUP BY user_id
+    ),
+    balances AS (
+        SELECT COALESCE(s.user_id, m.user_id) AS user_id,
+               COALESCE(s.free_capital, 0) + COALESCE(m.free_capital, 0) AS free_capital,
+               COALESCE(s.invested_capital, 0) + COALESCE(m.invested_capital, 0) AS invested_capital,
+               COALESCE(s.referral_bonus, 0) + COALESCE(m.referral_bonus, 0) AS referral_bonus,
+               COALESCE(s.profits, 0) + COALESCE(m.profits, 0) AS profits
+        FROM (SELECT * FROM portfolio_snapshots WHERE snapshot_date = %(day)s::date - 1) s
+        FULL JOIN moved m ON m.user_id = s.user_id
+    )
+"""
+
+# Investimenti in corso a fine giornata, per utente e progetto
+INVESTED_SQL = """
+    invested AS (
+        SELECT user_id, jsonb_object_agg(project_id::text, amount) AS by_project
+        FROM (
+            SELECT user_id, project_id, SUM(amount) AS amount
+            FROM investments
+            WHERE created_at < %(cutoff)s
+              AND (status = 'active' OR (status IN ('completed', 'cancelled') AND completed_at >= %(cutoff)s))
+            GROUP BY user_id, project_id
+        ) p
+        GROUP BY user_id
+    )
+"""
+
+USER_SNAPSHOT_SQL = """
+    INSERT INTO portfolio_snapshots
+        (user_id, snapshot_date, free_capital, invested_capital, referral_bonus, profits, invested_by_project)
+    SELECT COALESCE(b.user_id, i.user_id), %(day)s,
+           COALESCE(b.free_capital, 0), COALESCE(b.invested_capital, 0),
+           COALESCE(b.referral_bonus, 0), COALESCE(b.profits, 0),
+           COALESCE(i.by_project, '{}'::jsonb)
+    FROM balances b
+    FULL JOIN invested i ON i.user_id = b.user_id
+    WHERE i.user_id IS NOT NULL
+       OR (b.free_capital, b.invested_capital, b.referral_bonus, b.profits) <> (0, 0, 0, 0)
+"""
+
+PLATFORM_SNAPSHOT_SQL = """
+    WITH day_snapshots AS (
+        SELECT * FROM portfolio_snapshots WHERE snapshot_date = %(day)s
+    ),
+    by_project AS (
+        SELECT COALESCE(jsonb_object_agg(project_id, amount), '{}'::jsonb) AS invested_by_project
+        FROM (
+            SELECT e.key AS project_id, SUM(e.value::numeric) AS amount
+            FROM day_snapshots s, jsonb_each_text(s.invested_by_project) e
+            GROUP BY e.key
+        ) p
+    ),
+    flows AS (
+        SELECT COALESCE(SUM(amount) FILTER (WHERE tx_type = 'deposit'), 0) AS deposits,
+               COALESCE(-SUM(amount) FILTER (WHERE tx_type = 'withdrawal'), 0) AS withdrawals
+        FROM portfolio_ledger
+        WHERE created_at >= %(start)s AND created_at < %(cutoff)s
+    )
+    INSERT INTO platform_snapshots
+        (snapshot_date, free_capital, invested_capital, referral_bonus, profits,
+         users_count, investors_count, deposits, withdrawals, invested_by_project, computed_at)
+    SELECT %(day)s,
+           COALESCE(SUM(s.free_capital), 0), COALESCE(SUM(s.invested_capital), 0),
+           COALESCE(SUM(s.referral_bonus), 0), COALESCE(SUM(s.profits), 0),
+           COUNT(s.user_id), COUNT(s.user_id) FILTER (WHERE s.invested_by_project <> '{}'::jsonb),
+           f.deposits, f.withdrawals, bp.invested_by_project, NOW()
+    FROM flows f
+    CROSS JOIN by_project bp
+    LEFT JOIN day_snapshots s ON TRUE
+    GROUP BY f.deposits, f.withdrawals, bp.invested_by_project
+    ON CONFLICT (snapshot_date) DO UPDATE SET
+        free_capital = EXCLUDED.free_capital,
+        invested_capital = EXCLUDED.invested_capital,
+        referral_bonus = EXCLUDED.referral_bonus,
+        profits = EXCLUDED.profits,
+        users_count = EXCLUDED.users_count,
+        investors_count = EXCLUDED.investors_count,
+        deposits = EXCLUDED.deposits,
+        withdrawals = EXCLUDED.withdrawals,
+        invested_by_project = EXCLUDED.invested_by_project,
+        computed_at = EXCLUDED.computed_at
+    RETURNING users_count
+"""
+
+
+def get_conn():
+    from backend.shared.database import get_connection
+    return get_connection()
+
+
+def ensure_snapshot_schema(cur):
+    """Crea le tabelle degli snapshot (e il ledger da cui sono calcolati)"""
+    global _snapshots_ready
+    if not _snapshots_ready:
+        from backend.shared.database import run_schema_setup
+        _snapshots_ready = run_schema_setup(cur, _create_snapshot_schema)[0]
+
+
+def _create_snapshot_schema(cur):
+    ensure_ledger(cur)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS portfolio_snapshots (
+            user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            snapshot_date DATE NOT NULL,
+            free_capital NUMERIC(15,2) NOT NULL DEFAULT 0,
+            invested_capital NUMERIC(15,2) NOT NULL DEFAULT 0,
+            referral_bonus NUMERIC(15,2) NOT NULL DEFAULT 0,
+            profits NUMERIC(15,2) NOT NULL DEFAULT 0,
+            invested_by_project JSONB NOT NULL DEFAULT '{}'::jsonb,
+            PRIMARY KEY (user_id, snapshot_date)
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_portfolio_snapshots_date ON portfolio_snapshots(snapshot_date)")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS platform_snapshots (
+            snapshot_date DATE PRIMARY KEY,
+            free_capital NUMERIC(15,2) NOT NULL DEFAULT 0,
+            invested_capital NUMERIC(15,2) NOT NULL DEFAULT 0,
+            referral_bonus NUMERIC(15,2) NOT NULL DEFAULT 0,
+            profits NUMERIC(15,2) NOT NULL DEFAULT 0,
+            users_count INT NOT NULL DEFAULT 0,
+            investors_count INT NOT NULL DEFAULT 0,
+            deposits NUMERIC(15,2) NOT NULL DEFAULT 0,
+            withdrawals NUMERIC(15,2) NOT NULL DEFAULT 0,
+            invested_by_project JSONB NOT NULL DEFAULT '{}'::jsonb,
+            computed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    # Movimenti di un giorno per tutti gli utenti (calcolo incrementale)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_portfolio_ledger_created_at ON portfolio_ledger(created_at)")
+
+
+def snapshot_day(cur, day):
+    """Scrive (o riscrive) gli snapshot del giorno; ritorna il numero di utenti"""
+    ensure_snapshot_schema(cur)
+    cur.execute(
+        "SELECT %(day)s::date::timestamptz AS start, (%(day)s::date + 1)::timestamptz AS cutoff, "
+        "EXISTS (SELECT 1 FROM platform_snapshots WHERE snapshot_date = %(day)s::date - 1) AS has_previous",
+        {'day': day},
+    )
+    window = cur.fetchone()
+    params = {'day': day, 'start': window['start'], 'cutoff': window['cutoff']}
+    balances_sql = INCREMENTAL_BALANCES_SQL if window['has_previous'] else FULL_BALANCES_SQL
+
+    cur.execute("DELETE FROM portfolio_snapshots WHERE snapshot_date = %s", (day,))
+    cur.execute("WITH " + balances_sql + "," + INVESTED_SQL + USER_SNAPSHOT_SQL, params)
+    cur.execute(PLATFORM_SNAPSHOT_SQL, params)
+    return cur.fetchone()['users_count']
+
+
+def pending_range(cur, until=None):
+    """Giorni ancora da calcolare: dal giorno dopo l'ultimo snapshot (o dal primo movimento) a until"""
+    ensure_snapshot_schema(cur)
+    cur.execute(
+        """
+        SELECT COALESCE(
+            (SELECT MAX(snapshot_date) + 1 FROM platform_snapshots),
+            (SELECT MIN(created_at)::date FROM portfolio_ledger)
+        ) AS first_day, CURRENT_DATE - 1 AS yesterday
+        """
+    )
+    row = cur.fetchone()
+    return row['first_day'], until or row['yesterday']
+
+
+def run(start=None, end=None):
+    """Calcola gli snapshot da start a end (default: i giorni mancanti fino a ieri), un commit per giorno.
+    Ritorna i giorni calcolati, oppure None se un altro processo sta già eseguendo il job"""
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(%s) AS locked", (JOB_LOCK_ID,))
+        if not cur.fetchone()['locked']:
+            logger.info("Snapshot portafogli già in esecuzione in un altro processo")
+            return None
+        try:
+            first_day, last_day = pending_range(cur, end)
+            conn.commit()
+            day = start or first_day
+            if day is None or day > last_day:
+                return []
+            if (last_day - day).days > MAX_RANGE_DAYS:
+                raise ValueError(f"Intervallo troppo ampio (massimo {MAX_RANGE_DAYS} giorni)")
+            done = []
+            while day <= last_day:
+                users = snapshot_day(cur, day)
+                conn.commit()
+                done.append({'date': day.isoformat(), 'users': users})
+                day += timedelta(days=1)
+            logger.info(f"Snapshot portafogli calcolati: {len(done)} giorni")
+            return done
+        finally:
+            # Il lock è di sessione: va rilasciato anche dopo un errore
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s)", (JOB_LOCK_ID,))
+            conn.commit()
+
+
+def _live_platform(cur):
+    cur.execute(
+        """
+        SELECT CURRENT_DATE AS snapshot_date,
+               COALESCE(SUM(free_capital), 0) AS free_capital,
+               COALESCE(SUM(invested_capital), 0) AS invested_capital,
+               COALESCE(SUM(referral_bonus), 0) AS referral_bonus,
+               COALESCE(SUM(profits), 0) AS profits,
+               COUNT(*) AS users_count
+        FROM user_portfolios
+        """
+    )
+    return cur.fetchone()
+
+
+def platform_timeline(cur, days=30):
+    """Serie giornaliera della piattaforma: snapshot degli ultimi giorni più il valore di oggi"""
+    ensure_snapshot_schema(cur)
+    cur.execute(
+        """
+        SELECT snapshot_date, free_capital, invested_capital, referral_bonus, profits,
+               users_count, investors_count, deposits, withdrawals
+        FROM platform_snapshots
+        WHERE snapshot_date >= CURRENT_DATE - %s AND snapshot_date < CURRENT_DATE
+        ORDER BY snapshot_date
+        """,
+        (days,),
+    )
+    return cur.fetchall() + [_live_platform(cur)]
+
+
+def user_timeline(cur, user_id, days=90):
+    """Serie giornaliera di un utente: snapshot degli ultimi giorni più il saldo attuale"""
+    ensure_snapshot_schema(cur)
+    cur.execute(
+        """
+        SELECT snapshot_date, free_capital, invested_capital, referral_bonus, profits, invested_by_project
+        FROM portfolio_snapshots
+        WHERE user_id = %s AND snapshot_date >= CURRENT_DATE - %s AND snapshot_date < CURRENT_DATE
+        ORDER BY snapshot_date
+        """,
+        (user_id, days),
+    )
+    rows = cur.fetchall()
+    cur.execute(
+        """
+        SELECT CURRENT_DATE AS snapshot_date,
+               COALESCE(up.free_capital, 0) AS free_capital,
+               COALESCE(up.invested_capital, 0) AS invested_capital,
+               COALESCE(up.referral_bonus, 0) AS referral_bonus,
+               COALESCE(up.profits, 0) AS profits,
+               COALESCE((
+                   SELECT jsonb_object_agg(project_id::text, amount)
+                   FROM (
+                       SELECT project_id, SUM(amount) AS amount FROM investments
+                       WHERE user_id = u.id AND status = 'active'
+                       GROUP BY project_id
+                   ) p
+               ), '{}'::jsonb) AS invested_by_project
+        FROM (SELECT %s AS id) u
+        LEFT JOIN user_portfolios up ON up.user_id = u.id
+        """,
+        (user_id,),
+    )
+    return rows + [cur.fetchone()]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Snapshot giornalieri dei portafogli")
+    parser.add_argument('--from', dest='start', type=date.fromisoformat, default=None,
+                        help="primo giorno da (ri)calcolare (default: giorno dopo l'ultimo snapshot)")
+    parser.add_argument('--to', dest='end', type=date.fromisoformat, default=None,
+                        help="ultimo giorno (default: ieri)")
+    args = parser.parse_args()
+
+    result = run(args.start, args.end)
+    if result is None:
+        print("Job già in esecuzione")
+    else:
+        for item in result:
+            print(f"{item['date']} utenti={item['users']}")
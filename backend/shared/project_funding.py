@@ -0,0 +1,186 @@
+"""
+Raccolta dei progetti su contatori partizionati (project_funding_shards)
+Ogni investimento incrementa una sola riga shard scelta a caso invece di projects.funded_amount,
+così gli investitori dello stesso progetto non si serializzano sul lock della riga progetto.
+Totale raccolto = projects.funded_amount (base consolidata) + somma degli shard.
+Il controllo di sovra-finanziamento resta esatto: ogni shard ha una capacità e la somma delle
+capacità non supera total_amount - funded_amount; quando uno shard è pieno si passa dal
+percorso lento sotto lock del progetto, che consolida gli shard e ridistribuisce la capacità.
+"""
+
+import logging
+from decimal import Decimal, ROUND_DOWN
+
+logger = logging.getLogger(__name__)
+
+SHARDS = 16
+
+_shards_ready = False
+
+# Totale raccolto per una query su projects con alias p
+FUNDED_SQL = """(p.funded_amount + COALESCE(
+    (SELECT SUM(fs.amount) FROM project_funding_shards fs WHERE fs.project_id = p.id), 0))"""
+
+# Incremento di uno shard con capacità sufficiente; {skip} = SKIP LOCKED al primo tentativo
+RESERVE_SQL = """
+    UPDATE project_funding_shards s
+    SET amount = s.amount + %(amount)s
+    WHERE (s.project_id, s.shard) = (
+        SELECT c.project_id, c.shard
+        FROM project_funding_shards c
+        JOIN projects p ON p.id = c.project_id AND p.status = 'active'
+        WHERE c.project_id = %(project_id)s
+          AND (c.capacity IS NULL OR c.amount + %(amount)s <= c.capacity)
+        ORDER BY random()
+        LIMIT 1
+        FOR UPDATE OF c {skip}
+    )
+    AND (s.capacity IS NULL OR s.amount + %(amount)s <= s.capacity)
+    RETURNING s.shard
+"""
+
+
+class FundingError(Exception):
+    """Investimento non accettabile dal progetto (non attivo o oltre l'importo totale)"""
+    def __init__(self, message, remaining=None):
+        super().__init__(message)
+        self.remaining = remaining
+
+
+def ensure_funding_shards(cur):
+    """Crea la tabella project_funding_shards se non esiste"""
+    global _shards_ready
+    if not _shards_ready:
+        from backend.shared.database import run_schema_setup
+        _shards_ready = run_schema_setup(cur, _create_funding_shards)[0]
+
+
+def _create_funding_shards(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS project_funding_shards (
+            project_id INT NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+            shard SMALLINT NOT NULL,
+            amount NUMERIC(14,2) NOT NULL DEFAULT 0 CHECK (amount >= 0),
+            capacity NUMERIC(14,2),
+            PRIMARY KEY (project_id, shard)
+        )
+        """
+    )
+
+
+def _lock(cur, project_id):
+    # NO KEY UPDATE: compatibile con i lock KEY SHARE delle FK da investments
+    cur.execute(
+        """
+        SELECT id, status, total_amount, funded_amount
+        FROM projects
+        WHERE id = %s
+        FOR NO KEY UPDATE
+        """,
+        (project_id,),
+    )
+    return cur.fetchone()
+
+
+def _fold_locked(cur, project_id):
+    """Consolida gli shard nella base del progetto (lock del progetto già acquisito)"""
+    cur.execute(
+        """
+        WITH folded AS (
+            DELETE FROM project_funding_shards
+            WHERE project_id = %s
+            RETURNING amount
+        )
+        UPDATE projects
+        SET funded_amount = funded_amount + (SELECT COALESCE(SUM(amount), 0) FROM folded)
+        WHERE id = %s
+        RETURNING funded_amount
+        """,
+        (project_id, project_id),
+    )
+    return Decimal(cur.fetchone()['funded_amount'])
+
+
+def _reshard(cur, project_id, total_amount, funded):
+    """Ricrea gli shard dividendo la capacità residua (arrotondata per difetto al centesimo)"""
+    if total_amount and Decimal(total_amount) > 0:
+        capacity = ((Decimal(total_amount) - funded) / SHARDS).quantize(Decimal('0.01'), rounding=ROUND_DOWN)
+        if capacity <= 0:
+            # Capacità residua minima: gli ultimi investimenti passano dal percorso lento
+            return
+    else:
+        capacity = None
+    cur.execute(
+        """
+        INSERT INTO project_funding_shards (project_id, shard, amount, capacity)
+        SELECT %s, g, 0, %s FROM generate_series(0, %s - 1) AS g
+        """,
+        (project_id, capacity, SHARDS),
+    )
+
+
+def reserve(cur, project_id, amount):
+    """Aggiunge amount alla raccolta del progetto nella transazione del chiamante"""
+    ensure_funding_shards(cur)
+    params = {'project_id': project_id, 'amount': amount}
+    for skip in ('SKIP LOCKED', ''):
+        cur.execute(RESERVE_SQL.format(skip=skip), params)
+        if cur.fetchone():
+            return
+
+    # Percorso lento: shard assenti o pieni
+    project = _lock(cur, project_id)
+    if not project or project['status'] != 'active':
+        raise FundingError("Il progetto non è più disponibile")
+    funded = _fold_locked(cur, project_id)
+    total_amount = project['total_amount']
+    if total_amount and Decimal(total_amount) > 0:
+        remaining = Decimal(total_amount) - funded
+        if Decimal(str(amount)) > remaining:
+            raise FundingError(f"Importo troppo alto. Capacità rimanente: €{max(remaining, 0):.2f}",
+                               max(remaining, Decimal('0')))
+    cur.execute(
+        "UPDATE projects SET funded_amount = funded_amount + %s WHERE id = %s RETURNING funded_amount",
+        (amount, project_id),
+    )
+    _reshard(cur, project_id, total_amount, Decimal(cur.fetchone()['funded_amount']))
+
+
+def fold(cur, project_id):
+    """Consolida gli shard in projects.funded_amount e ritorna il totale raccolto"""
+    ensure_funding_shards(cur)
+    if not _lock(cur, project_id):
+        return None
+    return _fold_locked(cur, project_id)
+
+
+def adjust(cur, project_id, delta):
+    """Rettifica admin della raccolta (senza limite di capacità) ridistribuendo gli shard"""
+    ensure_funding_shards(cur)
+    project = _lock(cur, project_id)
+    if not project:
+        return None
+    _fold_locked(cur, project_id)
+    cur.execute(
+        "UPDATE projects SET funded_amount = funded_amount + %s WHERE id = %s RETURNING funded_amount",
+        (delta, project_id),
+    )
+    funded = Decimal(cur.fetchone()['funded_amount'])
+    if project['status'] == 'active':
+        _reshard(cur, project_id, project['total_amount'], funded)
+    return funded
+
+
+def get_funding(cur, project_id):
+    """Importo totale e raccolto (base + shard) del progetto"""
+    ensure_funding_shards(cur)
+    cur.execute(
+        f"""
+        SELECT p.total_amount, {FUNDED_SQL} AS funded_amount, p.status
+        FROM projects p
+        WHERE p.id = %s
+        """,
+        (project_id,),
+    )
+    return cur.fetchone()
@@ -0,0 +1,286 @@
+"""
+Riconciliazione dei saldi: user_portfolios confrontata con i saldi attesi dai documenti
+Saldo atteso per sezione = saldo di apertura del ledger + depositi completati, prelievi approvati,
+investimenti (capitale investito dal documento, addebito sulla sezione di provenienza dal ledger),
+chiusure per vendita o rimborso, profitti e perdite (movimenti roi del ledger),
+bonus referral pagati, rettifiche e trasferimenti manuali registrati nel ledger.
+Tutto è calcolato in un'unica istruzione set-based; le differenze aperte stanno in
+reconciliation_discrepancies (una riga per utente e sezione) e spariscono quando si risolvono.
+Il run incrementale ricontrolla solo gli utenti toccati dall'inizio dell'ultimo run completato.
+
+Uso (job notturno): python -m backend.shared.reconciliation [--full]
+"""
+
+import logging
+
+from backend.shared.ledger import ensure_ledger
+
+logger = logging.getLogger(__name__)
+
+# Differenze sotto il centesimo sono arrotondamenti
+TOLERANCE = '0.01'
+JOB_LOCK_ID = 4507001
+
+_reconciliation_ready = False
+
+# Utenti con movimenti o documenti modificati dopo %(since)s
+TOUCHED_SQL = """
+    SELECT user_id FROM portfolio_ledger WHERE created_at >= %(since)s
+    UNION SELECT user_id FROM user_portfolios WHERE updated_at >= %(since)s
+    UNION SELECT user_id FROM deposit_requests WHERE approved_at >= %(since)s
+    UNION SELECT user_id FROM withdrawal_requests WHERE approved_at >= %(since)s
+    UNION SELECT user_id FROM investments WHERE created_at >= %(since)s OR completed_at >= %(since)s
+    UNION SELECT user_id FROM portfolio_transactions WHERE created_at >= %(since)s
+    UNION SELECT receiver_user_id FROM referral_bonuses WHERE paid_at >= %(since)s
+"""
+
+# Filtro utenti di ogni ramo (NULL = tutti)
+_USERS = "(%(ids)s::int[] IS NULL OR {column} = ANY(%(ids)s::int[]))"
+
+RECONCILE_SQL = f"""
+    WITH flows (user_id, section, amount) AS (
+        -- Saldi all'installazione del ledger: i documenti precedenti sono già compresi
+        SELECT user_id, section, amount FROM portfolio_ledger
+        WHERE tx_type = 'opening' AND {_USERS.format(column='user_id')}
+        UNION ALL
+        SELECT user_id, 'free_capital', amount FROM deposit_requests
+        WHERE status = 'completed' AND approved_at >= %(t0)s AND {_USERS.format(column='user_id')}
+        UNION ALL
+        SELECT user_id, COALESCE(source_section, 'free_capital'), -amount FROM withdrawal_requests
+        WHERE status = 'approved' AND approved_at >= %(t0)s AND {_USERS.format(column='user_id')}
+        UNION ALL
+        -- Investimento: capitale investito dal documento (le modifiche admin cambiano solo questo)
+        SELECT user_id, 'invested_capital', amount FROM investments
+        WHERE status IN ('active', 'completed', 'cancelled') AND created_at >= %(t0)s
+          AND {_USERS.format(column='user_id')}
+        UNION ALL
+        -- ... e addebito effettivo sulla sezione di provenienza, dai movimenti dell'investimento
+        SELECT user_id, section, amount FROM portfolio_ledger
+        WHERE tx_type = 'investment' AND reference_type = 'investment' AND section <> 'invested_capital'
+          AND created_at >= %(t0)s AND {_USERS.format(column='user_id')}
+        UNION ALL
+        -- Vendita o rimborso: il capitale investito torna libero
+        SELECT i.user_id, v.section, v.amount
+        FROM investments i
+        CROSS JOIN LATERAL (VALUES ('invested_capital', -i.amount), ('free_capital', i.amount)) AS v(section, amount)
+        WHERE i.status IN ('completed', 'cancelled') AND i.completed_at >= %(t0)s
+          AND {_USERS.format(column='i.user_id')}
+        UNION ALL
+        -- Profitti e perdite (rendimenti periodici e vendite, anche in perdita)
+        SELECT user_id, section, amount FROM portfolio_ledger
+        WHERE tx_type = 'roi' AND section = 'profits' AND created_at >= %(t0)s
+          AND {_USERS.format(column='user_id')}
+        UNION ALL
+        SELECT receiver_user_id, 'referral_bonus', amount FROM referral_bonuses
+        WHERE status = 'paid' AND paid_at >= %(t0)s AND {_USERS.format(column='receiver_user_id')}
+        UNION ALL
+        -- Movimenti senza documento proprio (le modifiche di un investimento sono già nel documento)
+        SELECT user_id, section, amount FROM portfolio_ledger
+        WHERE tx_type IN ('adjustment', 'transfer') AND created_at >= %(t0)s
+          AND reference_type IS DISTINCT FROM 'investment' AND {_USERS.format(column='user_id')}
+    ),
+    expected AS (
+        SELECT user_id, section, SUM(amount) AS amount FROM flows GROUP BY user_id, section
+    ),
+    actual AS (
+        SELECT up.user_id, v.section, COALESCE(v.amount, 0) AS amount
+        FROM user_portfolios up
+        CROSS JOIN LATERAL (VALUES
+            ('free_capital', up.free_capital),
+            ('invested_capital', up.invested_capital),
+            ('referral_bonus', up.referral_bonus),
+            ('profits', up.profits)
+        ) AS v(section, amount)
+        WHERE {_USERS.format(column='up.user_id')}
+    ),
+    compared AS (
+        SELECT COALESCE(a.user_id, e.user_id) AS user_id, COALESCE(a.section, e.section) AS section,
+               COALESCE(e.amount, 0) AS expected, COALESCE(a.amount, 0) AS actual
+        FROM actual a
+        FULL JOIN expected e ON e.user_id = a.user_id AND e.section = a.section
+        WHERE EXISTS (SELECT 1 FROM users u WHERE u.id = COALESCE(a.user_id, e.user_id))
+    ),
+    recorded AS (
+        INSERT INTO reconciliation_discrepancies
+            (user_id, section, expected, actual, difference, first_run_id, last_run_id)
+        SELECT user_id, section, expected, actual, actual - expected, %(run_id)s, %(run_id)s
+        FROM compared
+        WHERE ABS(actual - expected) >= {TOLERANCE}
+        ON CONFLICT (user_id, section) DO UPDATE SET
+            expected = EXCLUDED.expected,
+            actual = EXCLUDED.actual,
+            difference = EXCLUDED.difference,
+            last_run_id = EXCLUDED.last_run_id,
+            last_seen_at = NOW()
+        RETURNING difference
+    )
+    SELECT (SELECT COUNT(DISTINCT user_id) FROM compared) AS users_checked,
+           (SELECT COUNT(*) FROM recorded) AS discrepancies,
+           (SELECT COALESCE(SUM(ABS(difference)), 0) FROM recorded) AS total_difference
+"""
+
+
+def get_conn():
+    from backend.shared.database import get_connection
+    return get_connection()
+
+
+def ensure_reconciliation_schema(cur):
+    """Crea le tabelle dei run e delle differenze aperte"""
+    global _reconciliation_ready
+    if not _reconciliation_ready:
+        from backend.shared.database import run_schema_setup
+        _reconciliation_ready = run_schema_setup(cur, _create_reconciliation_schema)[0]
+
+
+def _create_reconciliation_schema(cur):
+    ensure_ledger(cur)
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS reconciliation_runs (
+            id SERIAL PRIMARY KEY,
+            mode TEXT NOT NULL CHECK (mode IN ('full', 'incremental')),
+            status TEXT NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'completed', 'failed')),
+            since TIMESTAMPTZ,
+            users_checked INT NOT NULL DEFAULT 0,
+            discrepancies INT NOT NULL DEFAULT 0,
+            resolved INT NOT NULL DEFAULT 0,
+            total_difference NUMERIC(15,2) NOT NULL DEFAULT 0,
+            created_by INT,
+            started_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            completed_at TIMESTAMPTZ
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS reconciliation_discrepancies (
+            user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            section TEXT NOT NULL,
+            expected NUMERIC(15,2) NOT NULL,
+            actual NUMERIC(15,2) NOT NULL,
+            difference NUMERIC(15,2) NOT NULL,
+            first_run_id INT NOT NULL,
+            last_run_id INT NOT NULL,
+            first_seen_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            last_seen_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (user_id, section)
+        )
+        """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_reconciliation_discrepancies_difference "
+        "ON reconciliation_discrepancies (ABS(difference) DESC)"
+    )
+
+
+def _ledger_start(cur):
+    """Installazione del ledger: i documenti precedenti sono compresi nei saldi di apertura"""
+    cur.execute("SELECT MIN(created_at) AS t0 FROM portfolio_ledger")
+    return cur.fetchone()['t0'] or '-infinity'
+
+
+def reconcile(cur, full=False, admin_id=None):
+    """Esegue un run nella transazione del chiamante; ritorna il riepilogo, None se un altro run è in corso"""
+    ensure_reconciliation_schema(cur)
+    cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (JOB_LOCK_ID,))
+    if not cur.fetchone()['locked']:
+        return None
+
+    since = None
+    if not full:
+        cur.execute("SELECT MAX(started_at) AS since FROM reconciliation_runs WHERE status = 'completed'")
+        since = cur.fetchone()['since']
+    mode = 'incremental' if since else 'full'
+    cur.execute(
+        "INSERT INTO reconciliation_runs (mode, since, created_by) VALUES (%s, %s, %s) RETURNING id, started_at",
+        (mode, since, admin_id),
+    )
+    run = cur.fetchone()
+
+    user_ids = None
+    if since:
+        cur.execute(TOUCHED_SQL, {'since': since})
+        user_ids = [row['user_id'] for row in cur.fetchall()]
+
+    result = {'users_checked': 0, 'discrepancies': 0, 'total_difference': 0}
+    if user_ids is None or user_ids:
+        cur.execute(RECONCILE_SQL, {'ids': user_ids, 't0': _ledger_start(cur), 'run_id': run['id']})
+        result = cur.fetchone()
+
+    # Differenze non più presenti negli utenti controllati: risolte
+    cur.execute(
+        """
+        DELETE FROM reconciliation_discrepancies
+        WHERE last_run_id <> %(run_id)s AND (%(ids)s::int[] IS NULL OR user_id = ANY(%(ids)s::int[]))
+        """,
+        {'run_id': run['id'], 'ids': user_ids},
+    )
+    resolved = cur.rowcount
+    cur.execute(
+        """
+        UPDATE reconciliation_runs
+        SET status = 'completed', users_checked = %s, discrepancies = %s, resolved = %s,
+            total_difference = %s, completed_at = NOW()
+        WHERE id = %s
+        """,
+        (result['users_checked'], result['discrepancies'], resolved, result['total_difference'], run['id']),
+    )
+    logger.info(
+        f"Riconciliazione {mode} #{run['id']}: {result['users_checked']} utenti, "
+        f"{result['discrepancies']} differenze, {resolved} risolte"
+    )
+    return {
+        'run_id': run['id'],
+        'mode': mode,
+        'since': since.isoformat() if since else None,
+        'users_checked': result['users_checked'],
+        'discrepancies': result['discrepancies'],
+        'resolved': resolved,
+        'total_difference': float(result['total_difference']),
+    }
+
+
+def run(full=False, admin_id=None):
+    """Run in una transazione propria"""
+    with get_conn() as conn, conn.cursor() as cur:
+        return reconcile(cur, full, admin_id)
+
+
+def list_discrepancies(cur, limit=100, offset=0, section=None):
+    """Differenze aperte, dalla più grande"""
+    ensure_reconciliation_schema(cur)
+    cur.execute(
+        """
+        SELECT d.user_id, u.nome, u.cognome, u.email, d.section, d.expected, d.actual, d.difference,
+               d.first_seen_at, d.last_seen_at, COUNT(*) OVER () AS total
+        FROM reconciliation_discrepancies d
+        JOIN users u ON u.id = d.user_id
+        WHERE %(section)s::text IS NULL OR d.section = %(section)s
+        ORDER BY ABS(d.difference) DESC, d.user_id, d.section
+        LIMIT %(limit)s OFFSET %(offset)s
+        """,
+        {'section': section, 'limit': limit, 'offset': offset},
+    )
+    return cur.fetchall()
+
+
+def recent_runs(cur, limit=10):
+    ensure_reconciliation_schema(cur)
+    cur.execute("SELECT * FROM reconciliation_runs ORDER BY id DESC LIMIT %s", (limit,))
+    return cur.fetchall()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Riconciliazione saldi portafogli")
+    parser.add_argument('--full', action='store_true', help="controlla tutti gli utenti")
+    args = parser.parse_args()
+
+    summary = run(args.full)
+    if summary is None:
+        print("Riconciliazione già in esecuzione")
+    else:
+        print(" ".join(f"{k}={v}" for k, v in summary.items()))
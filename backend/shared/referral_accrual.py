@@ -0,0 +1,359 @@
+"""
+Maturazione e pagamento dei bonus referral per periodo (mese)
+Le vendite registrano i bonus trattenuti già alla liquidazione (settlement.settle_sale), con referrer
+e aliquota di quel momento; la maturazione qui copre solo gli investimenti completati senza bonus registrati.
+Calcolo set-based: pochi INSERT ... SELECT su referral_bonuses, accredito in un unico UPSERT
+Idempotente per (mese, investimento, destinatario, tipo bonus) grazie all'indice univoco
+"""
+
+import hashlib
+import logging
+import threading
+from datetime import date
+from decimal import Decimal
+
+from backend.shared.ledger import ledger_context
+
+logger = logging.getLogger(__name__)
+
+# Regole bonus sul profitto lordo dell'investimento (Decimal: calcoli in numeric lato SQL)
+REFERRER_RATE = Decimal('0.03')
+VIP_REFERRER_RATE = Decimal('0.05')
+PLATFORM_RATE = Decimal('0.02')
+# Destinatario della quota piattaforma (senza referrer o con referrer non VIP)
+PLATFORM_USER_ID = 2
+# Tempo concesso a un run appena creato per prendere il lock del mese
+RUN_START_GRACE = '1 minute'
+
+_schema_ready = False
+
+# Bonus spettanti per gli investimenti completati nel mese (profitto > 0) senza bonus già registrati
+CANDIDATES_SQL = """
+    WITH profits AS (
+        SELECT i.id AS investment_id, i.user_id AS source_user_id,
+               COALESCE(i.profit_earned, 0) AS profit,
+               r.id AS referrer_id, COALESCE(r.is_vip, FALSE) AS referrer_vip,
+               CASE WHEN COALESCE(r.is_vip, FALSE) THEN %(vip_rate)s ELSE %(rate)s END AS referrer_rate
+        FROM investments i
+        JOIN users u ON u.id = i.user_id
+        LEFT JOIN users r ON r.id = u.referred_by AND r.id != u.id
+        WHERE i.status = 'completed'
+          AND i.completed_at >= %(start)s AND i.completed_at < %(end)s
+          AND COALESCE(i.profit_earned, 0) > 0
+          AND NOT EXISTS (
+              SELECT 1 FROM referral_bonuses rb
+              WHERE rb.investment_id = i.id AND rb.bonus_type IN ('referral', 'platform')
+          )
+    )
+    SELECT referrer_id AS receiver_user_id, source_user_id, investment_id, 'referral' AS bonus_type,
+           referrer_rate AS rate, ROUND(profit * referrer_rate, 2) AS amount
+    FROM profits
+    WHERE referrer_id IS NOT NULL
+    UNION ALL
+    SELECT %(platform_user)s, source_user_id, investment_id, 'platform',
+           %(platform_rate)s, ROUND(profit * %(platform_rate)s, 2)
+    FROM profits
+    WHERE NOT referrer_vip
+"""
+
+
+def get_conn():
+    from backend.shared.database import get_connection
+    return get_connection()
+
+
+def ensure_referral_accrual_schema(cur):
+    """Tipo bonus e indice di idempotenza su referral_bonuses, tabella referral_runs"""
+    global _schema_ready
+    if not _schema_ready:
+        from backend.shared.database import run_schema_setup
+        _schema_ready = run_schema_setup(cur, _create_referral_accrual_schema)[0]
+
+
+def _create_referral_accrual_schema(cur):
+    cur.execute("ALTER TABLE referral_bonuses ADD COLUMN IF NOT EXISTS bonus_type TEXT NOT NULL DEFAULT 'referral'")
+    cur.execute("ALTER TABLE referral_bonuses ADD COLUMN IF NOT EXISTS rate NUMERIC(6,4)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_referral_bonuses_investment ON referral_bonuses(investment_id)")
+    cur.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_referral_bonuses_period_investment
+        ON referral_bonuses(month_ref, investment_id, receiver_user_id, bonus_type)
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS referral_runs (
+            id SERIAL PRIMARY KEY,
+            month_ref DATE NOT NULL,
+            pay BOOLEAN NOT NULL DEFAULT TRUE,
+            status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued','running','completed','failed')),
+            accrued_count INT,
+            accrued_amount NUMERIC(15,2),
+            paid_count INT,
+            paid_amount NUMERIC(15,2),
+            error TEXT,
+            created_by INT REFERENCES users(id) ON DELETE SET NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            completed_at TIMESTAMPTZ
+        )
+        """
+    )
+
+
+def parse_month(value):
+    """'YYYY-MM' (o data ISO) -> primo giorno del mese; default mese precedente"""
+    if not value:
+        today = date.today()
+        return date(today.year - 1, 12, 1) if today.month == 1 else date(today.year, today.month - 1, 1)
+    year, month = str(value)[:7].split('-')
+    return date(int(year), int(month), 1)
+
+
+def _period_params(month_ref):
+    end = date(month_ref.year + 1, 1, 1) if month_ref.month == 12 else date(month_ref.year, month_ref.month + 1, 1)
+    return {
+        'start': month_ref,
+        'end': end,
+        'month_ref': month_ref,
+        'rate': REFERRER_RATE,
+        'vip_rate': VIP_REFERRER_RATE,
+        'platform_rate': PLATFORM_RATE,
+        'platform_user': PLATFORM_USER_ID,
+    }
+
+
+def preview_period(cur, month_ref):
+    """Dry-run: bonus da maturare (non ancora registrati) e già maturati/pagati nel mese"""
+    ensure_referral_accrual_schema(cur)
+    cur.execute(
+        f"""
+        SELECT c.bonus_type,
+               COUNT(*) AS bonuses,
+               COUNT(DISTINCT c.receiver_user_id) AS receivers,
+               COALESCE(SUM(c.amount), 0) AS amount
+        FROM ({CANDIDATES_SQL}) c
+        WHERE NOT EXISTS (
+            SELECT 1 FROM referral_bonuses rb
+            WHERE rb.month_ref = %(month_ref)s AND rb.investment_id = c.investment_id
+              AND rb.receiver_user_id = c.receiver_user_id AND rb.bonus_type = c.bonus_type
+        )
+        GROUP BY c.bonus_type
+        ORDER BY c.bonus_type
+        """,
+        _period_params(month_ref),
+    )
+    pending = cur.fetchall()
+    cur.execute(
+        """
+        SELECT status, COUNT(*) AS bonuses, COALESCE(SUM(amount), 0) AS amount
+        FROM referral_bonuses
+        WHERE month_ref = %s AND investment_id IS NOT NULL
+        GROUP BY status
+        """,
+        (month_ref,),
+    )
+    existing = {row['status']: row for row in cur.fetchall()}
+    return {
+        'month_ref': month_ref.isoformat(),
+        'to_accrue': [
+            {'bonus_type': row['bonus_type'], 'bonuses': row['bonuses'],
+             'receivers': row['receivers'], 'amount': float(row['amount'])}
+            for row in pending
+        ],
+        'to_accrue_amount': float(sum(row['amount'] for row in pending)),
+        'accrued_amount': float(existing['accrued']['amount']) if 'accrued' in existing else 0.0,
+        'paid_amount': float(existing['paid']['amount']) if 'paid' in existing else 0.0,
+    }
+
+
+def accrue_period(cur, month_ref):
+    """Registra i bonus del mese in referral_bonuses (le righe già presenti vengono saltate)"""
+    ensure_referral_accrual_schema(cur)
+    cur.execute(
+        f"""
+        WITH inserted AS (
+            INSERT INTO referral_bonuses
+                (receiver_user_id, source_user_id, investment_id, level, amount, month_ref, status, bonus_type, rate)
+            SELECT c.receiver_user_id, c.source_user_id, c.investment_id, 1, c.amount,
+                   %(month_ref)s, 'accrued', c.bonus_type, c.rate
+            FROM ({CANDIDATES_SQL}) c
+            ON CONFLICT (month_ref, investment_id, receiver_user_id, bonus_type) DO NOTHING
+            RETURNING amount
+        )
+        SELECT COUNT(*) AS bonuses, COALESCE(SUM(amount), 0) AS amount FROM inserted
+        """,
+        _period_params(month_ref),
+    )
+    row = cur.fetchone()
+    return row['bonuses'], float(row['amount'])
+
+
+def pay_period(cur, month_ref):
+    """Paga i bonus maturati del mese: un UPSERT su user_portfolios e un movimento per destinatario"""
+    ensure_referral_accrual_schema(cur)
+    with ledger_context(cur, 'referral', f"Bonus referral {month_ref:%m/%Y}", reference_type='referral_bonus'):
+        cur.execute(
+            """
+            WITH paid AS (
+                UPDATE referral_bonuses
+                SET status = 'paid', paid_at = NOW()
+                WHERE month_ref = %(month_ref)s AND status = 'accrued'
+                RETURNING receiver_user_id, amount
+            ),
+            totals AS (
+                SELECT receiver_user_id AS user_id, SUM(amount) AS amount, COUNT(*) AS bonuses
+                FROM paid
+                GROUP BY receiver_user_id
+                HAVING SUM(amount) > 0
+            ),
+            credited AS (
+                INSERT INTO user_portfolios (user_id, free_capital, invested_capital, profits, referral_bonus)
+                SELECT user_id, 0, 0, 0, amount FROM totals
+                ON CONFLICT (user_id)
+                DO UPDATE SET referral_bonus = user_portfolios.referral_bonus + EXCLUDED.referral_bonus
+                RETURNING user_id, referral_bonus
+            ),
+            movements AS (
+                INSERT INTO portfolio_transactions
+                    (user_id, type, amount, balance_before, balance_after, description, reference_type, status)
+                SELECT t.user_id, 'referral', t.amount, c.referral_bonus - t.amount, c.referral_bonus,
+                       'Bonus referral ' || to_char(%(month_ref)s::date, 'MM/YYYY'), 'referral_bonus', 'completed'
+                FROM totals t
+                JOIN credited c ON c.user_id = t.user_id
+            )
+            SELECT user_id, amount, bonuses FROM totals
+            """,
+            {'month_ref': month_ref},
+        )
+        rows = cur.fetchall()
+    return [row['user_id'] for row in rows], sum(row['bonuses'] for row in rows), float(sum(row['amount'] for row in rows))
+
+
+def _lock_id(month_ref):
+    digest = hashlib.sha1(f"referral_run|{month_ref.isoformat()}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def run_period(cur, month_ref, pay=True):
+    """Maturazione (e pagamento) del mese nella transazione del chiamante, un run per mese alla volta"""
+    from backend.shared.referral_stats import refresh_referral_stats
+
+    ensure_referral_accrual_schema(cur)
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (_lock_id(month_ref),))
+    accrued_count, accrued_amount = accrue_period(cur, month_ref)
+    result = {
+        'month_ref': month_ref.isoformat(),
+        'accrued_count': accrued_count,
+        'accrued_amount': accrued_amount,
+        'paid_count': 0,
+        'paid_amount': 0.0,
+    }
+    if pay:
+        receivers, paid_count, paid_amount = pay_period(cur, month_ref)
+        result['paid_count'] = paid_count
+        result['paid_amount'] = paid_amount
+        # bonus_earned dei destinatari (invitees_bonus dei referrer segue il trigger sui portafogli)
+        refresh_referral_stats(cur, receivers)
+    return result
+
+
+def enqueue_run(month_ref, pay, admin_id):
+    """Registra il run e lo esegue in un thread separato dal worker web"""
+    with get_conn() as conn, conn.cursor() as cur:
+        ensure_referral_accrual_schema(cur)
+        cur.execute(
+            """
+            INSERT INTO referral_runs (month_ref, pay, created_by)
+            VALUES (%s, %s, %s)
+            RETURNING id
+            """,
+            (month_ref, pay, admin_id),
+        )
+        run_id = cur.fetchone()['id']
+        conn.commit()
+
+    threading.Thread(
+        target=_execute_run,
+        args=(run_id, month_ref, pay),
+        name=f"referral-run-{run_id}",
+        daemon=True,
+    ).start()
+    return run_id
+
+
+def _execute_run(run_id, month_ref, pay):
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE referral_runs SET status = 'running' WHERE id = %s AND status = 'queued'", (run_id,))
+        started = cur.rowcount
+        conn.commit()
+    if not started:
+        logger.warning(f"Run bonus referral {run_id} non più in coda, esecuzione annullata")
+        return
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            result = run_period(cur, month_ref, pay)
+            cur.execute(
+                """
+                UPDATE referral_runs
+                SET status = 'completed', accrued_count = %s, accrued_amount = %s,
+                    paid_count = %s, paid_amount = %s, completed_at = NOW()
+                WHERE id = %s
+                """,
+                (result['accrued_count'], result['accrued_amount'],
+                 result['paid_count'], result['paid_amount'], run_id),
+            )
+            conn.commit()
+    except Exception as e:
+        logger.exception(f"Errore nel run bonus referral {run_id}: {e}")
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute(
+                "UPDATE referral_runs SET status = 'failed', error = %s, completed_at = NOW() WHERE id = %s",
+                (str(e), run_id),
+            )
+            conn.commit()
+        return
+    logger.info(f"Run bonus referral {run_id} ({month_ref}): {result}")
+
+
+def fail_stale_runs(cur):
+    """Segna come falliti i run in coda/in esecuzione il cui worker è terminato.
+    Un run vivo tiene il lock del mese per tutta la transazione; se il lock è libero il
+    thread è morto e la sua transazione è stata annullata, quindi nulla è stato registrato"""
+    ensure_referral_accrual_schema(cur)
+    cur.execute(
+        f"""
+        SELECT id, month_ref FROM referral_runs
+        WHERE status IN ('queued', 'running') AND created_at < NOW() - INTERVAL '{RUN_START_GRACE}'
+        """
+    )
+    failed = []
+    for run in cur.fetchall():
+        lock_id = _lock_id(run['month_ref'])
+        cur.execute("SELECT pg_try_advisory_lock(%s) AS locked", (lock_id,))
+        if not cur.fetchone()['locked']:
+            continue
+        try:
+            cur.execute(
+                """
+                UPDATE referral_runs
+                SET status = 'failed', error = 'Run interrotto (riavvio del worker)', completed_at = NOW()
+                WHERE id = %s AND status IN ('queued', 'running')
+                """,
+                (run['id'],),
+            )
+            if cur.rowcount:
+                failed.append(run['id'])
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (lock_id,))
+    if failed:
+        logger.warning(f"Run bonus referral interrotti segnati come falliti: {failed}")
+    return failed
+
+
+def get_run(run_id):
+    with get_conn() as conn, conn.cursor() as cur:
+        fail_stale_runs(cur)
+        cur.execute("SELECT * FROM referral_runs WHERE id = %s", (run_id,))
+        run = cur.fetchone()
+        conn.commit()
+    return run
@@ -0,0 +1,224 @@
+"""
+Statistiche referral precalcolate per utente (user_referral_stats)
+Le funzioni lavorano sul cursore del chiamante, nella stessa transazione dell'evento.
+I volumi degli invitati (investito, profitti, bonus) seguono user_portfolios con un trigger:
+ogni scrittura sul portafoglio applica la differenza alla sola riga del referrer diretto,
+qualunque sia il percorso (investimenti, prelievi, trasferimenti, rettifiche admin, liquidazioni).
+La rete (invitati, dimensione) cambia con un delta alla registrazione e con un ricalcolo
+degli antenati sugli spostamenti e le cancellazioni.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_stats_ready = False
+
+# Differenza del portafoglio di un invitato sui totali del suo referrer diretto.
+# Il referrer senza riga di statistiche viene calcolato per intero alla prima lettura.
+INVITEE_DELTA_FUNCTION_SQL = """
+    CREATE OR REPLACE FUNCTION referral_stats_invitee_delta() RETURNS trigger AS $$
+    DECLARE
+        uid INT;
+        d_invested NUMERIC := 0;
+        d_profits NUMERIC := 0;
+        d_bonus NUMERIC := 0;
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            uid := OLD.user_id;
+            d_invested := -COALESCE(OLD.invested_capital, 0);
+            d_profits := -COALESCE(OLD.profits, 0);
+            d_bonus := -COALESCE(OLD.referral_bonus, 0);
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            uid := NEW.user_id;
+            d_invested := d_invested + COALESCE(NEW.invested_capital, 0);
+            d_profits := d_profits + COALESCE(NEW.profits, 0);
+            d_bonus := d_bonus + COALESCE(NEW.referral_bonus, 0);
+        END IF;
+        IF d_invested <> 0 OR d_profits <> 0 OR d_bonus <> 0 THEN
+            UPDATE user_referral_stats rs
+            SET invitees_invested = rs.invitees_invested + d_invested,
+                invitees_profits = rs.invitees_profits + d_profits,
+                invitees_bonus = rs.invitees_bonus + d_bonus,
+                updated_at = NOW()
+            FROM users u
+            WHERE u.id = uid AND rs.user_id = u.referred_by AND u.referred_by != u.id;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+
+# Ricalcolo set-based per un insieme di utenti (NULL = tutti)
+REFRESH_SQL = """
+    WITH targets AS (
+        SELECT id FROM users
+        WHERE %(ids)s::int[] IS NULL OR id = ANY(%(ids)s::int[])
+    ),
+    invitees AS (
+        SELECT
+            i.referred_by AS user_id,
+            COUNT(*) AS invited_count,
+            COALESCE(SUM(ip.invested_capital), 0) AS invitees_invested,
+            COALESCE(SUM(ip.profits), 0) AS invitees_profits,
+            COALESCE(SUM(ip.referral_bonus), 0) AS invitees_bonus
+        FROM users i
+        JOIN targets t ON t.id = i.referred_by
+        LEFT JOIN user_portfolios ip ON ip.user_id = i.id
+        WHERE i.id != i.referred_by
+        GROUP BY i.referred_by
+    ),
+    bonuses AS (
+        SELECT rb.receiver_user_id AS user_id, COALESCE(SUM(rb.amount), 0) AS bonus_earned
+        FROM referral_bonuses rb
+        JOIN targets t ON t.id = rb.receiver_user_id
+        WHERE rb.status != 'cancelled'
+        GROUP BY rb.receiver_user_id
+    ),
+    network AS (
+        SELECT rc.ancestor_id AS user_id, COUNT(*) AS network_size
+        FROM referral_closure rc
+        JOIN targets t ON t.id = rc.ancestor_id
+        WHERE rc.depth > 0
+        GROUP BY rc.ancestor_id
+    )
+    INSERT INTO user_referral_stats (
+        user_id, invited_count, network_size,
+        invitees_invested, invitees_profits, invitees_bonus, bonus_earned, updated_at
+    )
+    SELECT
+        t.id,
+        COALESCE(inv.invited_count, 0),
+        COALESCE(net.network_size, 0),
+        COALESCE(inv.invitees_invested, 0),
+        COALESCE(inv.invitees_profits, 0),
+        COALESCE(inv.invitees_bonus, 0),
+        COALESCE(b.bonus_earned, 0),
+        NOW()
+    FROM targets t
+    LEFT JOIN invitees inv ON inv.user_id = t.id
+    LEFT JOIN bonuses b ON b.user_id = t.id
+    LEFT JOIN network net ON net.user_id = t.id
+    ON CONFLICT (user_id) DO UPDATE SET
+        invited_count = EXCLUDED.invited_count,
+        network_size = EXCLUDED.network_size,
+        invitees_invested = EXCLUDED.invitees_invested,
+        invitees_profits = EXCLUDED.invitees_profits,
+        invitees_bonus = EXCLUDED.invitees_bonus,
+        bonus_earned = EXCLUDED.bonus_earned,
+        updated_at = EXCLUDED.updated_at
+"""
+
+
+def ensure_referral_stats_table(cur):
+    """Crea la tabella user_referral_stats e il trigger sui portafogli, con ricalcolo completo all'installazione"""
+    global _stats_ready
+    if not _stats_ready:
+        from backend.shared.database import run_schema_setup
+        _stats_ready = run_schema_setup(cur, _create_referral_stats_table)[0]
+
+
+def _create_referral_stats_table(cur):
+    from backend.shared.referral_tree import ensure_referral_closure
+    ensure_referral_closure(cur)
+    cur.execute("SELECT 1 FROM pg_trigger WHERE tgname = 'trg_referral_stats_invitees'")
+    if cur.fetchone():
+        return
+    # Blocca le scritture sui portafogli: nessun movimento tra ricalcolo e trigger
+    cur.execute("LOCK TABLE user_portfolios IN SHARE ROW EXCLUSIVE MODE")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_referral_stats (
+            user_id INT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+            invited_count INT NOT NULL DEFAULT 0,
+            network_size INT NOT NULL DEFAULT 0,
+            invitees_invested NUMERIC(15,2) NOT NULL DEFAULT 0,
+            invitees_profits NUMERIC(15,2) NOT NULL DEFAULT 0,
+            invitees_bonus NUMERIC(15,2) NOT NULL DEFAULT 0,
+            bonus_earned NUMERIC(15,2) NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    rebuild_referral_stats(cur)
+    cur.execute(INVITEE_DELTA_FUNCTION_SQL)
+    cur.execute(
+        """
+        CREATE TRIGGER trg_referral_stats_invitees
+        AFTER INSERT OR DELETE OR UPDATE OF invested_capital, profits, referral_bonus ON user_portfolios
+        FOR EACH ROW EXECUTE FUNCTION referral_stats_invitee_delta()
+        """
+    )
+
+
+def rebuild_referral_stats(cur):
+    """Ricalcola le statistiche di tutti gli utenti"""
+    cur.execute(REFRESH_SQL, {'ids': None})
+    logger.info(f"user_referral_stats ricostruita: {cur.rowcount} utenti")
+    return cur.rowcount
+
+
+def refresh_referral_stats(cur, user_ids):
+    """Ricalcola le statistiche degli utenti indicati (referrer o destinatari di bonus)"""
+    ids = sorted({int(uid) for uid in user_ids if uid is not None})
+    if not ids:
+        return 0
+    ensure_referral_stats_table(cur)
+    cur.execute(REFRESH_SQL, {'ids': ids})
+    return cur.rowcount
+
+
+def get_referral_ancestors(cur, user_ids):
+    """Antenati nella rete referral degli utenti indicati (da leggere prima di spostamenti/eliminazioni)"""
+    ids = sorted({int(uid) for uid in user_ids if uid is not None})
+    if not ids:
+        return []
+    ensure_referral_stats_table(cur)
+    cur.execute(
+        """
+        SELECT DISTINCT ancestor_id FROM referral_closure
+        WHERE descendant_id = ANY(%s) AND depth > 0
+        """,
+        (ids,),
+    )
+    return [row['ancestor_id'] for row in cur.fetchall()]
+
+
+def refresh_referrer_stats(cur, invitee_ids):
+    """Ricalcola le statistiche dei referrer e degli antenati degli utenti indicati"""
+    # Referrer diretti (volumi degli invitati) e antenati (dimensione rete)
+    return refresh_referral_stats(cur, get_referral_ancestors(cur, invitee_ids))
+
+
+def add_network_member(cur, user_id):
+    """Nuovo utente (già nella closure): +1 sulla rete degli antenati e sugli invitati del referrer diretto"""
+    ensure_referral_stats_table(cur)
+    cur.execute(
+        """
+        UPDATE user_referral_stats rs
+        SET network_size = rs.network_size + 1,
+            invited_count = rs.invited_count + (rc.depth = 1)::int,
+            updated_at = NOW()
+        FROM referral_closure rc
+        WHERE rc.descendant_id = %s AND rc.depth > 0 AND rs.user_id = rc.ancestor_id
+        RETURNING rs.user_id
+        """,
+        (user_id,),
+    )
+    updated = {row['user_id'] for row in cur.fetchall()}
+    # Antenati senza riga di statistiche: calcolo completo
+    missing = [uid for uid in get_referral_ancestors(cur, [user_id]) if uid not in updated]
+    return refresh_referral_stats(cur, missing) + len(updated)
+
+
+def get_user_referral_stats(cur, user_id):
+    """Riga di statistiche di un utente (lookup su chiave primaria)"""
+    ensure_referral_stats_table(cur)
+    cur.execute("SELECT * FROM user_referral_stats WHERE user_id = %s", (user_id,))
+    row = cur.fetchone()
+    if row is None:
+        refresh_referral_stats(cur, [user_id])
+        cur.execute("SELECT * FROM user_referral_stats WHERE user_id = %s", (user_id,))
+        row = cur.fetchone()
+    return row
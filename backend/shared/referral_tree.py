@@ -0,0 +1,200 @@
+"""
+Albero referral materializzato (closure table)
+Ogni coppia (antenato, discendente) della rete con la distanza in livelli
+Le funzioni lavorano sul cursore del chiamante: stesse transazioni di users.referred_by
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Limite di profondità per il backfill ricorsivo (protegge da cicli nei dati storici)
+MAX_BACKFILL_DEPTH = 100
+
+_closure_ready = False
+
+
+class ReferralTreeError(Exception):
+    """Spostamento non valido nell'albero referral"""
+    pass
+
+
+def ensure_referral_closure(cur):
+    """Crea la tabella referral_closure e la popola da users.referred_by se vuota"""
+    global _closure_ready
+    if not _closure_ready:
+        from backend.shared.database import run_schema_setup
+        _closure_ready = run_schema_setup(cur, _create_referral_closure)[0]
+
+
+def _create_referral_closure(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS referral_closure (
+            ancestor_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            descendant_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            depth INT NOT NULL CHECK (depth >= 0),
+            PRIMARY KEY (ancestor_id, descendant_id)
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_referral_closure_descendant ON referral_closure(descendant_id, depth)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_referral_closure_ancestor_depth ON referral_closure(ancestor_id, depth)")
+    cur.execute("SELECT EXISTS (SELECT 1 FROM referral_closure) AS populated")
+    if not cur.fetchone()['populated']:
+        rebuild_referral_closure(cur)
+
+
+def rebuild_referral_closure(cur):
+    """Ricostruisce l'intera closure table da users.referred_by"""
+    cur.execute("DELETE FROM referral_closure")
+    cur.execute(
+        """
+        INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE tree AS (
+            SELECT id AS ancestor_id, id AS descendant_id, 0 AS depth FROM users
+            UNION ALL
+            SELECT t.ancestor_id, u.id, t.depth + 1
+            FROM tree t
+            JOIN users u ON u.referred_by = t.descendant_id
+            WHERE t.depth < %s
+        )
+        SELECT ancestor_id, descendant_id, MIN(depth) FROM tree
+        GROUP BY ancestor_id, descendant_id
+        """,
+        (MAX_BACKFILL_DEPTH,),
+    )
+    count = cur.rowcount
+    logger.info(f"referral_closure ricostruita: {count} relazioni")
+    return count
+
+
+def closure_add_user(cur, user_id, referrer_id=None):
+    """Inserisce un nuovo utente come foglia sotto il referrer"""
+    ensure_referral_closure(cur)
+    cur.execute(
+        """
+        INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+        SELECT %s, %s, 0
+        UNION ALL
+        SELECT ancestor_id, %s, depth + 1
+        FROM referral_closure
+        WHERE descendant_id = %s
+        ON CONFLICT (ancestor_id, descendant_id) DO NOTHING
+        """,
+        (user_id, user_id, user_id, referrer_id),
+    )
+
+
+def closure_move_subtree(cur, user_id, new_referrer_id=None):
+    """Sposta l'utente e tutta la sua rete sotto un nuovo referrer (o alla radice)"""
+    ensure_referral_closure(cur)
+    if new_referrer_id is not None:
+        cur.execute(
+            "SELECT 1 FROM referral_closure WHERE ancestor_id = %s AND descendant_id = %s",
+            (user_id, new_referrer_id),
+        )
+        if cur.fetchone():
+            raise ReferralTreeError("Il nuovo referrer fa parte della rete dell'utente")
+
+    # Scollega il sottoalbero dai vecchi antenati
+    cur.execute(
+        """
+        DELETE FROM referral_closure rc
+        USING referral_closure sub
+        WHERE sub.ancestor_id = %s
+          AND rc.descendant_id = sub.descendant_id
+          AND rc.ancestor_id NOT IN (
+              SELECT descendant_id FROM referral_closure WHERE ancestor_id = %s
+          )
+        """,
+        (user_id, user_id),
+    )
+
+    if new_referrer_id is None:
+        return
+
+    # Collega il sottoalbero ai nuovi antenati
+    cur.execute(
+        """
+        INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+        SELECT sup.ancestor_id, sub.descendant_id, sup.depth + sub.depth + 1
+        FROM referral_closure sup
+        CROSS JOIN referral_closure sub
+        WHERE sup.descendant_id = %s AND sub.ancestor_id = %s
+        """,
+        (new_referrer_id, user_id),
+    )
+
+
+def closure_remove_user(cur, user_id):
+    """Rimuove un utente: i suoi invitati salgono di un livello sotto il suo referrer"""
+    ensure_referral_closure(cur)
+    # I percorsi che passavano per l'utente si accorciano di un livello
+    cur.execute(
+        """
+        UPDATE referral_closure rc
+        SET depth = rc.depth - 1
+        FROM referral_closure up, referral_closure down
+        WHERE up.descendant_id = %s AND up.depth > 0
+          AND down.ancestor_id = %s AND down.depth > 0
+          AND rc.ancestor_id = up.ancestor_id
+          AND rc.descendant_id = down.descendant_id
+        """,
+        (user_id, user_id),
+    )
+    cur.execute(
+        "DELETE FROM referral_closure WHERE ancestor_id = %s OR descendant_id = %s",
+        (user_id, user_id),
+    )
+
+
+def get_downline(cur, user_id, max_depth=None):
+    """Rete sotto l'utente con livello, fino a max_depth livelli"""
+    ensure_referral_closure(cur)
+    params = [user_id]
+    depth_filter = ""
+    if max_depth:
+        depth_filter = "AND rc.depth <= %s"
+        params.append(max_depth)
+    cur.execute(
+        f"""
+        SELECT u.id, u.nome, u.cognome, u.email, u.referred_by, rc.depth,
+               COALESCE(up.invested_capital, 0) AS invested_capital
+        FROM referral_closure rc
+        JOIN users u ON u.id = rc.descendant_id
+        LEFT JOIN user_portfolios up ON up.user_id = u.id
+        WHERE rc.ancestor_id = %s AND rc.depth > 0 {depth_filter}
+        ORDER BY rc.depth, u.id
+        """,
+        params,
+    )
+    return cur.fetchall()
+
+
+def get_network_summary(cur, user_id):
+    """Dimensione della rete e volume investito dalla rete, per livello"""
+    ensure_referral_closure(cur)
+    cur.execute(
+        """
+        SELECT rc.depth,
+               COUNT(*) AS users_count,
+               COALESCE(SUM(up.invested_capital), 0) AS invested_volume
+        FROM referral_closure rc
+        LEFT JOIN user_portfolios up ON up.user_id = rc.descendant_id
+        WHERE rc.ancestor_id = %s AND rc.depth > 0
+        GROUP BY rc.depth
+        ORDER BY rc.depth
+        """,
+        (user_id,),
+    )
+    levels = cur.fetchall()
+    return {
+        'network_size': sum(level['users_count'] for level in levels),
+        'network_volume': float(sum(level['invested_volume'] for level in levels)),
+        'levels': [
+            {'depth': level['depth'], 'users_count': level['users_count'],
+             'invested_volume': float(level['invested_volume'])}
+            for level in levels
+        ],
+    }
@@ -0,0 +1,222 @@
+"""
+Approvazione e rifiuto massivo di depositi e prelievi
+Le richieste selezionate vengono bloccate con FOR UPDATE SKIP LOCKED e regolate con
+istruzioni set-based nella transazione del chiamante; esito per ogni richiesta
+"""
+
+import logging
+
+from backend.shared.ledger import ledger_context
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH = 1000
+
+DEPOSIT_APPROVE_SQL = """
+    WITH locked AS (
+        SELECT id, user_id, amount
+        FROM deposit_requests
+        WHERE id = ANY(%(ids)s) AND status = 'pending'
+        ORDER BY id
+        FOR UPDATE SKIP LOCKED
+    ),
+    approved AS (
+        UPDATE deposit_requests dr
+        SET status = 'completed', approved_at = NOW(), approved_by = %(admin_id)s, admin_notes = %(notes)s
+        FROM locked l
+        WHERE dr.id = l.id
+        RETURNING dr.id, dr.user_id, dr.amount
+    ),
+    per_user AS (
+        SELECT user_id, SUM(amount) AS total FROM approved GROUP BY user_id
+    ),
+    credited AS (
+        INSERT INTO user_portfolios (user_id, free_capital, invested_capital, referral_bonus, profits)
+        SELECT user_id, total, 0, 0, 0 FROM per_user
+        ON CONFLICT (user_id)
+        DO UPDATE SET free_capital = user_portfolios.free_capital + EXCLUDED.free_capital, updated_at = NOW()
+        RETURNING user_id, free_capital + referral_bonus + profits AS balance_after
+    ),
+    ledger AS (
+        INSERT INTO portfolio_transactions
+            (user_id, type, amount, balance_before, balance_after, description,
+             reference_id, reference_type, status)
+        SELECT a.user_id, 'deposit', a.amount,
+               c.balance_after - p.total + a.running - a.amount,
+               c.balance_after - p.total + a.running,
+               'Deposito approvato', a.id, 'deposit_request', 'completed'
+        FROM (
+            SELECT id, user_id, amount,
+                   SUM(amount) OVER (PARTITION BY user_id ORDER BY id) AS running
+            FROM approved
+        ) a
+        JOIN per_user p ON p.user_id = a.user_id
+        JOIN credited c ON c.user_id = a.user_id
+    )
+    SELECT id FROM approved
+"""
+
+DEPOSIT_REJECT_SQL = """
+    WITH locked AS (
+        SELECT id FROM deposit_requests
+        WHERE id = ANY(%(ids)s) AND status = 'pending'
+        ORDER BY id
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE deposit_requests dr
+    SET status = 'failed', admin_notes = %(notes)s
+    FROM locked l
+    WHERE dr.id = l.id
+    RETURNING dr.id
+"""
+
+# Il saldo viene scalato solo se copre tutti i prelievi del lotto dell'utente per ogni sezione
+WITHDRAWAL_APPROVE_SQL = """
+    WITH locked AS (
+        SELECT id, user_id, amount, COALESCE(source_section, 'free_capital') AS source_section
+        FROM withdrawal_requests
+        WHERE id = ANY(%(ids)s) AND status = 'pending'
+        ORDER BY id
+        FOR UPDATE SKIP LOCKED
+    ),
+    per_user AS (
+        SELECT user_id,
+               SUM(amount) AS total,
+               COALESCE(SUM(amount) FILTER (WHERE source_section = 'free_capital'), 0) AS free_capital,
+               COALESCE(SUM(amount) FILTER (WHERE source_section = 'referral_bonus'), 0) AS referral_bonus,
+               COALESCE(SUM(amount) FILTER (WHERE source_section = 'profits'), 0) AS profits
+        FROM locked
+        GROUP BY user_id
+    ),
+    debited AS (
+        UPDATE user_portfolios up
+        SET free_capital = up.free_capital - p.free_capital,
+            referral_bonus = up.referral_bonus - p.referral_bonus,
+            profits = up.profits - p.profits,
+            updated_at = NOW()
+        FROM per_user p
+        WHERE up.user_id = p.user_id
+          AND up.free_capital >= p.free_capital
+          AND up.referral_bonus >= p.referral_bonus
+          AND up.profits >= p.profits
+        RETURNING up.user_id, up.free_capital + up.referral_bonus + up.profits AS balance_after
+    ),
+    approved AS (
+        UPDATE withdrawal_requests wr
+        SET status = 'approved', approved_at = NOW(), approved_by = %(admin_id)s, updated_at = NOW()
+        FROM locked l
+        JOIN debited d ON d.user_id = l.user_id
+        WHERE wr.id = l.id
+        RETURNING wr.id, wr.user_id, wr.amount
+    ),
+    ledger AS (
+        INSERT INTO portfolio_transactions
+            (user_id, type, amount, balance_before, balance_after, description,
+             reference_id, reference_type, status)
+        SELECT a.user_id, 'withdrawal', a.amount,
+               d.balance_after + p.total - a.running + a.amount,
+               d.balance_after + p.total - a.running,
+               'Prelievo approvato da admin', a.id, 'withdrawal_request', 'completed'
+        FROM (
+            SELECT id, user_id, amount,
+                   SUM(amount) OVER (PARTITION BY user_id ORDER BY id) AS running
+            FROM approved
+        ) a
+        JOIN per_user p ON p.user_id = a.user_id
+        JOIN debited d ON d.user_id = a.user_id
+    )
+    SELECT l.id, d.user_id IS NOT NULL AS approved
+    FROM locked l
+    LEFT JOIN debited d ON d.user_id = l.user_id
+"""
+
+WITHDRAWAL_REJECT_SQL = """
+    WITH locked AS (
+        SELECT id FROM withdrawal_requests
+        WHERE id = ANY(%(ids)s) AND status = 'pending'
+        ORDER BY id
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE withdrawal_requests wr
+    SET status = 'cancelled', admin_notes = %(notes)s, approved_at = NOW(), approved_by = %(admin_id)s
+    FROM locked l
+    WHERE wr.id = l.id
+    RETURNING wr.id
+"""
+
+TABLES = {'deposit': 'deposit_requests', 'withdrawal': 'withdrawal_requests'}
+
+
+class BatchError(Exception):
+    """Lotto di richieste non valido"""
+    pass
+
+
+def parse_ids(values):
+    """Lista di ID univoci, al massimo MAX_BATCH"""
+    if not isinstance(values, list) or not values:
+        raise BatchError("Lista ID richieste mancante")
+    try:
+        ids = list(dict.fromkeys(int(v) for v in values))
+    except (TypeError, ValueError):
+        raise BatchError("ID richieste non validi")
+    if len(ids) > MAX_BATCH:
+        raise BatchError(f"Massimo {MAX_BATCH} richieste per lotto")
+    return ids
+
+
+def _unprocessed_results(cur, kind, ids):
+    """Motivo per le richieste non regolate: inesistenti, già processate o in lavorazione altrove"""
+    if not ids:
+        return []
+    cur.execute(f"SELECT id, status FROM {TABLES[kind]} WHERE id = ANY(%s)", (ids,))
+    statuses = {row['id']: row['status'] for row in cur.fetchall()}
+    results = []
+    for request_id in ids:
+        status = statuses.get(request_id)
+        if status is None:
+            results.append({'id': request_id, 'status': 'error', 'error': 'Richiesta non trovata'})
+        elif status == 'pending':
+            results.append({'id': request_id, 'status': 'skipped', 'error': 'Richiesta in lavorazione da un altro admin'})
+        else:
+            results.append({'id': request_id, 'status': 'error', 'error': f'Richiesta già processata ({status})'})
+    return results
+
+
+def _run(cur, kind, sql, ids, admin_id, notes, done_status, description=None):
+    # Contesto dei movimenti registrati dal trigger del ledger
+    with ledger_context(cur, kind, description, reference_type=f"{kind}_request"):
+        cur.execute(sql, {'ids': ids, 'admin_id': admin_id, 'notes': notes})
+        rows = cur.fetchall()
+    done = {row['id'] for row in rows if row.get('approved', True)}
+    insufficient = {row['id'] for row in rows if not row.get('approved', True)}
+    results = [{'id': request_id, 'status': done_status} for request_id in ids if request_id in done]
+    results += [{'id': request_id, 'status': 'error', 'error': 'Saldo insufficiente'}
+                for request_id in ids if request_id in insufficient]
+    results += _unprocessed_results(cur, kind, [i for i in ids if i not in done and i not in insufficient])
+    order = {request_id: n for n, request_id in enumerate(ids)}
+    results.sort(key=lambda r: order[r['id']])
+    logger.info(f"Lotto {kind} {done_status}: {len(done)}/{len(ids)} richieste da admin {admin_id}")
+    return results
+
+
+def approve_deposits(cur, ids, admin_id, notes=''):
+    return _run(cur, 'deposit', DEPOSIT_APPROVE_SQL, ids, admin_id, notes, 'approved', 'Deposito approvato')
+
+
+def reject_deposits(cur, ids, admin_id, notes=''):
+    return _run(cur, 'deposit', DEPOSIT_REJECT_SQL, ids, admin_id, notes, 'rejected')
+
+
+def approve_withdrawals(cur, ids, admin_id, notes=''):
+    return _run(cur, 'withdrawal', WITHDRAWAL_APPROVE_SQL, ids, admin_id, notes, 'approved',
+                'Prelievo approvato da admin')
+
+
+def reject_withdrawals(cur, ids, admin_id, notes='Rifiutato da admin'):
+    return _run(cur, 'withdrawal', WITHDRAWAL_REJECT_SQL, ids, admin_id, notes, 'rejected')
+
+
+def summarize(results):
+    processed = sum(1 for r in results if r['status'] in ('approved', 'rejected'))
+    return {'processed': processed, 'failed': len(results) - processed, 'results': results}
@@ -0,0 +1,176 @@
+"""
+Scadenza delle richieste in attesa abbandonate (deposit_requests, withdrawal_requests)
+Le richieste 'pending' più vecchie del TTL passano a 'cancelled' a blocchi di BATCH_SIZE:
+ogni blocco è un'unica istruzione (SELECT ... FOR UPDATE SKIP LOCKED, UPDATE, INSERT nel log)
+con commit proprio, così le code restano piccole senza bloccare le approvazioni in corso.
+Ogni richiesta scaduta resta tracciata in request_expirations.
+I prelievi in attesa non hanno ancora addebitato il saldo: annullarli non muove fondi.
+
+Uso:
+  python -m backend.shared.request_expiry [--deposit-days N] [--withdrawal-days N] [--dry-run]
+"""
+
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+DEPOSIT_TTL_DAYS = int(os.environ.get("DEPOSIT_REQUEST_TTL_DAYS", "7"))
+WITHDRAWAL_TTL_DAYS = int(os.environ.get("WITHDRAWAL_REQUEST_TTL_DAYS", "30"))
+BATCH_SIZE = int(os.environ.get("REQUEST_EXPIRY_BATCH_SIZE", "1000"))
+JOB_LOCK_ID = 5007001
+
+# Tabella per tipo di richiesta
+REQUEST_TABLES = {
+    'deposit': 'deposit_requests',
+    'withdrawal': 'withdrawal_requests',
+}
+
+_expiry_schema_ready = False
+
+# Un blocco: (id, created_at) per sfruttare il PK e le partizioni mensili
+EXPIRE_SQL = """
+    WITH picked AS (
+        SELECT id, created_at
+        FROM {table}
+        WHERE status = 'pending' AND created_at < NOW() - %(ttl_days)s * INTERVAL '1 day'
+        ORDER BY created_at
+        LIMIT %(batch_size)s
+        FOR UPDATE SKIP LOCKED
+    ),
+    expired AS (
+        UPDATE {table} r
+        SET status = 'cancelled',
+            admin_notes = %(note)s{extra_set}
+        FROM picked
+        WHERE r.id = picked.id AND r.created_at = picked.created_at AND r.status = 'pending'
+        RETURNING r.id, r.user_id, r.amount, r.created_at
+    )
+    INSERT INTO request_expirations (request_type, request_id, user_id, amount, requested_at, ttl_days)
+    SELECT %(request_type)s, id, user_id, amount, created_at, %(ttl_days)s
+    FROM expired
+"""
+
+
+def get_conn():
+    from backend.shared.database import get_connection
+    return get_connection()
+
+
+def ensure_expiry_schema(cur):
+    """Log delle richieste scadute"""
+    global _expiry_schema_ready
+    if not _expiry_schema_ready:
+        from backend.shared.database import run_schema_setup
+        _expiry_schema_ready = run_schema_setup(cur, _create_expiry_schema)[0]
+
+
+def _create_expiry_schema(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS request_expirations (
+            id BIGSERIAL PRIMARY KEY,
+            request_type TEXT NOT NULL CHECK (request_type IN ('deposit', 'withdrawal')),
+            request_id INT NOT NULL,
+            user_id INT NOT NULL,
+            amount NUMERIC(15,2) NOT NULL,
+            requested_at TIMESTAMPTZ NOT NULL,
+            ttl_days INT NOT NULL,
+            expired_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_request_expirations_request ON request_expirations(request_type, request_id)"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_request_expirations_user ON request_expirations(user_id, expired_at DESC)")
+
+
+def count_expired(cur, request_type, ttl_days):
+    """Richieste in attesa oltre il TTL (anteprima, nessuna modifica)"""
+    cur.execute(
+        f"""
+        SELECT COUNT(*) AS requests, COALESCE(SUM(amount), 0) AS amount
+        FROM {REQUEST_TABLES[request_type]}
+        WHERE status = 'pending' AND created_at < NOW() - %s * INTERVAL '1 day'
+        """,
+        (ttl_days,),
+    )
+    return cur.fetchone()
+
+
+def expire_batch(cur, request_type, ttl_days, batch_size=BATCH_SIZE):
+    """Annulla un blocco di richieste scadute nella transazione del chiamante; ritorna quante"""
+    ensure_expiry_schema(cur)
+    # I prelievi hanno updated_at, i depositi no
+    extra_set = ", updated_at = NOW()" if request_type == 'withdrawal' else ""
+    cur.execute(
+        EXPIRE_SQL.format(table=REQUEST_TABLES[request_type], extra_set=extra_set),
+        {
+            'request_type': request_type,
+            'ttl_days': ttl_days,
+            'batch_size': batch_size,
+            'note': f"Scaduta automaticamente: in attesa da oltre {ttl_days} giorni",
+        },
+    )
+    return cur.rowcount
+
+
+def sweep(cur, conn, request_type, ttl_days, batch_size=BATCH_SIZE):
+    """Blocchi successivi con commit fino a esaurimento delle richieste scadute"""
+    total = 0
+    while True:
+        expired = expire_batch(cur, request_type, ttl_days, batch_size)
+        conn.commit()
+        total += expired
+        if expired < batch_size:
+            return total
+
+
+def run(deposit_days=DEPOSIT_TTL_DAYS, withdrawal_days=WITHDRAWAL_TTL_DAYS, dry_run=False, batch_size=BATCH_SIZE):
+    """Scadenza di depositi e prelievi abbandonati.
+    Ritorna le richieste annullate per tipo, oppure None se il job è già in esecuzione altrove"""
+    ttl = {'deposit': deposit_days, 'withdrawal': withdrawal_days}
+    with get_conn() as conn, conn.cursor() as cur:
+        if dry_run:
+            return {
+                request_type: {**count_expired(cur, request_type, days), 'ttl_days': days}
+                for request_type, days in ttl.items()
+            }
+        cur.execute("SELECT pg_try_advisory_lock(%s) AS locked", (JOB_LOCK_ID,))
+        if not cur.fetchone()['locked']:
+            logger.info("Scadenza richieste già in esecuzione in un altro processo")
+            return None
+        try:
+            result = {
+                request_type: sweep(cur, conn, request_type, days, batch_size)
+                for request_type, days in ttl.items()
+            }
+            logger.info(f"Richieste scadute annullate: {result['deposit']} depositi "
+                        f"(> {deposit_days} giorni), {result['withdrawal']} prelievi (> {withdrawal_days} giorni)")
+            return result
+        finally:
+            # Il lock è di sessione: va rilasciato anche dopo un errore
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s)", (JOB_LOCK_ID,))
+            conn.commit()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Scadenza delle richieste di deposito e prelievo abbandonate")
+    parser.add_argument('--deposit-days', type=int, default=DEPOSIT_TTL_DAYS, help="TTL dei depositi in attesa")
+    parser.add_argument('--withdrawal-days', type=int, default=WITHDRAWAL_TTL_DAYS, help="TTL dei prelievi in attesa")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--dry-run', action='store_true', help="conta le richieste scadute senza annullarle")
+    args = parser.parse_args()
+    if min(args.deposit_days, args.withdrawal_days) < 1 or args.batch_size < 1:
+        parser.error("TTL e dimensione del blocco devono essere positivi")
+
+    result = run(args.deposit_days, args.withdrawal_days, args.dry_run, args.batch_size)
+    if result is None:
+        print("Scadenza richieste già in esecuzione")
+    else:
+        print(" ".join(f"{k}={v}" for k, v in result.items()))
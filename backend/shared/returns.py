@@ -0,0 +1,275 @@
+"""
+Rendimenti effettivi degli investimenti: XIRR (money-weighted) e TWR (time-weighted)
+Flussi di cassa dal punto di vista dell'investitore: investimento (uscita), rendimenti
+periodici (investment_yields), profitto e capitale restituiti alla vendita o al rimborso.
+Le posizioni aperte sono valorizzate al capitale residuo alla data di calcolo.
+Il calcolo è vettoriale (NumPy): tutti i gruppi di un ambito sono risolti insieme con Newton
+su array piatti e np.bincount. I risultati restano in investment_returns finché non arrivano
+nuovi flussi (firma: numero, ultimo istante e somma dei flussi) o, per le posizioni aperte,
+fino al giorno successivo.
+"""
+
+import logging
+import math
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Ambiti: per utente (tutti i progetti), per progetto (tutti gli investitori), per posizione
+SCOPES = ('user', 'project', 'position')
+
+SECONDS_PER_YEAR = 365 * 86400
+MAX_ITERATIONS = 50
+TOLERANCE = 1e-9
+INITIAL_RATE = 0.1
+MIN_RATE = -0.9999
+
+_returns_ready = False
+
+_FILTER = """
+    i.status IN ('active', 'completed', 'cancelled')
+    AND (%(user_ids)s::int[] IS NULL OR i.user_id = ANY(%(user_ids)s::int[]))
+    AND (%(project_ids)s::int[] IS NULL OR i.project_id = ANY(%(project_ids)s::int[]))
+"""
+
+# seq ordina i flussi nello stesso istante: profitto prima della restituzione del capitale
+FLOWS_SQL = f"""
+    SELECT CASE WHEN %(scope)s = 'project' THEN 0 ELSE user_id END AS key_user,
+           CASE WHEN %(scope)s = 'user' THEN 0 ELSE project_id END AS key_project,
+           flow_at, seq, cash, principal, income
+    FROM (
+        SELECT i.user_id, i.project_id, i.created_at AS flow_at, 0 AS seq,
+               -i.amount AS cash, i.amount AS principal, 0 AS income
+        FROM investments i
+        WHERE {_FILTER}
+        UNION ALL
+        SELECT i.user_id, i.project_id, (y.period_end + 1)::timestamptz, 1, y.amount, 0, y.amount
+        FROM investment_yields y
+        JOIN investments i ON i.id = y.investment_id
+        WHERE {_FILTER}
+        UNION ALL
+        SELECT i.user_id, i.project_id, i.completed_at, 1, p.profit, 0, p.profit
+        FROM investments i
+        CROSS JOIN LATERAL (SELECT CASE WHEN COALESCE(i.total_return, 0) > 0 THEN i.total_return - i.amount
+                                        ELSE COALESCE(i.profit_earned, 0) END AS profit) p
+        WHERE i.status = 'completed' AND i.completed_at IS NOT NULL AND p.profit <> 0 AND {_FILTER}
+        UNION ALL
+        SELECT i.user_id, i.project_id, i.completed_at, 2, i.amount, -i.amount, 0
+        FROM investments i
+        WHERE i.status IN ('completed', 'cancelled') AND i.completed_at IS NOT NULL AND {_FILTER}
+    ) flows
+"""
+
+# Gruppi senza risultato o con firma dei flussi cambiata
+STALE_SQL = f"""
+    WITH signatures AS (
+        SELECT key_user, key_project, COUNT(*) AS flows_count,
+               MAX(flow_at) AS last_flow_at, SUM(cash) AS net_cash
+        FROM ({FLOWS_SQL}) f
+        GROUP BY key_user, key_project
+    )
+    SELECT s.key_user, s.key_project
+    FROM signatures s
+    LEFT JOIN investment_returns r
+           ON r.scope = %(scope)s AND r.user_id = s.key_user AND r.project_id = s.key_project
+    WHERE r.scope IS NULL
+       OR (r.flows_count, r.last_flow_at, r.net_cash)
+          IS DISTINCT FROM (s.flows_count, s.last_flow_at, s.net_cash)
+       OR (r.open_capital > 0 AND r.computed_at < CURRENT_DATE)
+"""
+
+UPSERT_SQL = """
+    INSERT INTO investment_returns
+        (scope, user_id, project_id, xirr, twr, invested, returned, open_capital,
+         flows_count, last_flow_at, net_cash, computed_at)
+    SELECT %(scope)s, r.*, NOW()
+    FROM unnest(%(user_id)s::int[], %(project_id)s::int[], %(xirr)s::numeric[], %(twr)s::numeric[],
+                %(invested)s::numeric[], %(returned)s::numeric[], %(open_capital)s::numeric[],
+                %(flows_count)s::int[], %(last_flow_at)s::timestamptz[], %(net_cash)s::numeric[]) AS r
+    ON CONFLICT (scope, user_id, project_id) DO UPDATE SET
+        xirr = EXCLUDED.xirr,
+        twr = EXCLUDED.twr,
+        invested = EXCLUDED.invested,
+        returned = EXCLUDED.returned,
+        open_capital = EXCLUDED.open_capital,
+        flows_count = EXCLUDED.flows_count,
+        last_flow_at = EXCLUDED.last_flow_at,
+        net_cash = EXCLUDED.net_cash,
+        computed_at = EXCLUDED.computed_at
+"""
+
+
+def ensure_returns_table(cur):
+    """Cache dei rendimenti per ambito (user_id / project_id = 0 quando non pertinenti)"""
+    global _returns_ready
+    if not _returns_ready:
+        from backend.shared.database import run_schema_setup
+        _returns_ready = run_schema_setup(cur, _create_returns_table)[0]
+
+
+def _create_returns_table(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS investment_returns (
+            scope TEXT NOT NULL CHECK (scope IN ('user', 'project', 'position')),
+            user_id INT NOT NULL DEFAULT 0,
+            project_id INT NOT NULL DEFAULT 0,
+            xirr NUMERIC(14,6),
+            twr NUMERIC(14,6),
+            invested NUMERIC(15,2) NOT NULL DEFAULT 0,
+            returned NUMERIC(15,2) NOT NULL DEFAULT 0,
+            open_capital NUMERIC(15,2) NOT NULL DEFAULT 0,
+            flows_count INT NOT NULL DEFAULT 0,
+            last_flow_at TIMESTAMPTZ,
+            net_cash NUMERIC(15,2) NOT NULL DEFAULT 0,
+            computed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (scope, user_id, project_id)
+        )
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_investment_returns_project ON investment_returns(scope, project_id)")
+
+
+def compute(rows, now=None):
+    """XIRR e TWR di tutti i gruppi dei flussi (ordinati per gruppo, istante, seq)"""
+    import numpy as np
+
+    if not rows:
+        return []
+    now = now or datetime.now(timezone.utc)
+    n = len(rows)
+    key_user = np.fromiter((row['key_user'] for row in rows), dtype=np.int64, count=n)
+    key_project = np.fromiter((row['key_project'] for row in rows), dtype=np.int64, count=n)
+    times = np.fromiter((row['flow_at'].timestamp() for row in rows), dtype=np.float64, count=n)
+    cash = np.fromiter((float(row['cash']) for row in rows), dtype=np.float64, count=n)
+    principal = np.fromiter((float(row['principal']) for row in rows), dtype=np.float64, count=n)
+    income = np.fromiter((float(row['income']) for row in rows), dtype=np.float64, count=n)
+
+    # Indice di gruppo per ogni flusso
+    first = np.ones(n, dtype=bool)
+    first[1:] = (key_user[1:] != key_user[:-1]) | (key_project[1:] != key_project[:-1])
+    starts = np.flatnonzero(first)
+    ends = np.append(starts[1:], n) - 1
+    group = np.cumsum(first) - 1
+    groups = starts.size
+
+    # Capitale investito prima di ogni flusso e residuo a fine gruppo
+    running = np.cumsum(principal)
+    outstanding = running - principal - (running[starts] - principal[starts])[group]
+    open_capital = np.bincount(group, weights=principal, minlength=groups)
+    open_capital[np.abs(open_capital) < 0.005] = 0.0
+
+    # TWR: prodotto dei fattori (1 + reddito / capitale investito) dei sotto-periodi
+    growth = np.zeros(n)
+    earning = (income != 0) & (outstanding > 0)
+    growth[earning] = np.log(np.maximum(1 + income[earning] / outstanding[earning], 1e-12))
+    twr = np.expm1(np.bincount(group, weights=growth, minlength=groups))
+
+    # XIRR: flussi più il valore residuo delle posizioni aperte alla data di calcolo
+    open_groups = np.flatnonzero(open_capital > 0)
+    x_group = np.concatenate([group, open_groups])
+    x_cash = np.concatenate([cash, open_capital[open_groups]])
+    x_years = (np.concatenate([times, np.full(open_groups.size, now.timestamp())])
+               - times[starts][x_group]) / SECONDS_PER_YEAR
+    span = np.zeros(groups)
+    np.maximum.at(span, x_group, x_years)
+    inflows = np.bincount(x_group, weights=(x_cash > 0), minlength=groups)
+    outflows = np.bincount(x_group, weights=(x_cash < 0), minlength=groups)
+    solvable = (inflows > 0) & (outflows > 0) & (span > 0)
+
+    rate = np.full(groups, INITIAL_RATE)
+    converged = np.zeros(groups, dtype=bool)
+    pending = solvable.copy()
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        for _ in range(MAX_ITERATIONS):
+            base = 1 + rate[x_group]
+            discounted = x_cash * base ** -x_years
+            value = np.bincount(x_group, weights=discounted, minlength=groups)
+            slope = np.bincount(x_group, weights=-x_years * discounted / base, minlength=groups)
+            step = value / slope
+            pending &= np.isfinite(step)
+            new_rate = np.where(pending, np.maximum(rate - step, MIN_RATE), rate)
+            converged |= pending & (np.abs(new_rate - rate) < TOLERANCE)
+            pending &= ~converged
+            rate = new_rate
+            if not pending.any():
+                break
+    xirr = np.where(converged & np.isfinite(rate), rate, np.nan)
+
+    invested = np.bincount(group, weights=np.where(cash < 0, -cash, 0.0), minlength=groups)
+    returned = np.bincount(group, weights=np.where(cash > 0, cash, 0.0), minlength=groups)
+    net_cash = np.bincount(group, weights=cash, minlength=groups)
+    counts = np.bincount(group, minlength=groups)
+
+    return [
+        {
+            'user_id': int(key_user[starts[g]]),
+            'project_id': int(key_project[starts[g]]),
+            'xirr': None if math.isnan(xirr[g]) else round(float(xirr[g]), 6) + 0.0,
+            'twr': round(float(twr[g]), 6),
+            'invested': round(float(invested[g]), 2),
+            'returned': round(float(returned[g]), 2),
+            'open_capital': round(float(open_capital[g]), 2),
+            'flows_count': int(counts[g]),
+            'last_flow_at': rows[ends[g]]['flow_at'],
+            'net_cash': round(float(net_cash[g]), 2),
+        }
+        for g in range(groups)
+    ]
+
+
+def refresh(cur, scope, user_ids=None, project_ids=None):
+    """Ricalcola i gruppi dell'ambito con flussi nuovi; ritorna il numero di gruppi aggiornati"""
+    if scope not in SCOPES:
+        raise ValueError(f"Ambito non valido: {scope}")
+    ensure_returns_table(cur)
+    params = {'scope': scope, 'user_ids': user_ids, 'project_ids': project_ids}
+    cur.execute(STALE_SQL, params)
+    stale = cur.fetchall()
+    if not stale:
+        return 0
+
+    # Solo i flussi dei gruppi da ricalcolare
+    if scope != 'project':
+        params['user_ids'] = sorted({row['key_user'] for row in stale})
+    if scope != 'user':
+        params['project_ids'] = sorted({row['key_project'] for row in stale})
+    cur.execute(FLOWS_SQL + " ORDER BY key_user, key_project, flow_at, seq", params)
+    results = compute(cur.fetchall())
+    if results:
+        columns = ('user_id', 'project_id', 'xirr', 'twr', 'invested', 'returned',
+                   'open_capital', 'flows_count', 'last_flow_at', 'net_cash')
+        cur.execute(UPSERT_SQL, {'scope': scope, **{c: [row[c] for row in results] for c in columns}})
+    logger.info(f"Rendimenti {scope}: {len(results)} gruppi ricalcolati")
+    return len(results)
+
+
+def get_returns(cur, scope, user_ids=None, project_ids=None):
+    """Rendimenti dell'ambito dalla cache, aggiornata prima per i gruppi con flussi nuovi"""
+    refresh(cur, scope, user_ids, project_ids)
+    cur.execute(
+        """
+        SELECT user_id, project_id, xirr, twr, invested, returned, open_capital, last_flow_at, computed_at
+        FROM investment_returns
+        WHERE scope = %(scope)s
+          AND (%(user_ids)s::int[] IS NULL OR user_id = ANY(%(user_ids)s::int[]))
+          AND (%(project_ids)s::int[] IS NULL OR project_id = ANY(%(project_ids)s::int[]))
+        ORDER BY user_id, project_id
+        """,
+        {'scope': scope, 'user_ids': user_ids, 'project_ids': project_ids},
+    )
+    return cur.fetchall()
+
+
+def serialize(row):
+    """Riga di investment_returns per le risposte JSON (rendimenti in percentuale)"""
+    return {
+        'user_id': row['user_id'] or None,
+        'project_id': row['project_id'] or None,
+        'xirr': round(float(row['xirr']) * 100, 2) if row['xirr'] is not None else None,
+        'twr': round(float(row['twr']) * 100, 2) if row['twr'] is not None else None,
+        'invested': float(row['invested']),
+        'returned': float(row['returned']),
+        'open_capital': float(row['open_capital']),
+        'last_flow_at': row['last_flow_at'].isoformat() if row['last_flow_at'] else None,
+    }
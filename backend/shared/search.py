@@ -0,0 +1,146 @@
+"""
+Ricerca testuale admin su indici trigram (pg_trgm)
+Substring (ILIKE) e fuzzy (operatore %) usano gli indici GIN gin_trgm_ops
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+SEARCH_LIMIT_DEFAULT = 20
+SEARCH_LIMIT_MAX = 100
+
+# Colonne indicizzate per ambito di ricerca (vedi config/database/add_trigram_search_indexes.sql)
+USER_SEARCH_COLUMNS = ['u.nome', 'u.cognome', 'u.email', 'u.telefono', 'u.nome_telegram']
+DEPOSIT_SEARCH_COLUMNS = ['dr.payment_reference', 'dr.iban', 'dr.unique_key']
+WITHDRAWAL_SEARCH_COLUMNS = ['wr.unique_key', "(wr.bank_details->>'iban')", 'wr.wallet_address']
+# Dati dell'utente proprietario: cercati su users e non attraverso la JOIN (vedi owner_search_condition)
+OWNER_SEARCH_COLUMNS = ['email', 'nome']
+
+_trigram_available = None
+
+
+def trigram_available(cur):
+    """Verifica (una volta per processo) che l'estensione pg_trgm sia installata"""
+    global _trigram_available
+    if _trigram_available is None:
+        cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') AS available")
+        _trigram_available = bool(cur.fetchone()['available'])
+        if not _trigram_available:
+            logger.warning("pg_trgm non installata: ricerca admin senza indici trigram")
+    return _trigram_available
+
+
+def escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_condition(columns, term, fuzzy=False):
+    """Condizione SQL e parametri: match per sottostringa (e per similarità se fuzzy) su ogni colonna"""
+    term = term.strip()
+    pattern = f"%{escape_like(term)}%"
+    fuzzy = fuzzy and len(term) >= 3
+    parts = []
+    params = []
+    for column in columns:
+        parts.append(f"{column} ILIKE %s")
+        params.append(pattern)
+        if fuzzy:
+            parts.append(f"{column} %% %s")
+            params.append(term)
+    return "(" + " OR ".join(parts) + ")", params
+
+
+def owner_search_condition(columns, owner_column, term, fuzzy=False):
+    """Come search_condition sulle colonne della tabella, più i dati dell'utente proprietario.
+    Un OR tra colonne di tabelle diverse della JOIN non può usare gli indici trigram:
+    gli utenti corrispondenti sono risolti prima (ARRAY(...) diventa un initplan) e
+    owner_column = ANY(...) resta un ramo indicizzato del BitmapOr sulla tabella."""
+    own_sql, own_params = search_condition(columns, term, fuzzy)
+    owner_sql, owner_params = search_condition(OWNER_SEARCH_COLUMNS, term, fuzzy)
+    return (
+        f"({own_sql} OR {owner_column} = ANY(ARRAY(SELECT id FROM users WHERE {owner_sql})))",
+        own_params + owner_params,
+    )
+
+
+def rank_expression(cur, columns, term):
+    """Espressione di ranking: similarità massima tra le colonne (0 senza pg_trgm)"""
+    term = term.strip()
+    if not trigram_available(cur):
+        return "0", []
+    expr = "GREATEST(" + ", ".join(f"similarity(COALESCE({c}, ''), %s)" for c in columns) + ")"
+    return expr, [term] * len(columns)
+
+
+def clamp_limit(limit):
+    if not limit:
+        return SEARCH_LIMIT_DEFAULT
+    return min(max(int(limit), 1), SEARCH_LIMIT_MAX)
+
+
+def search_users(cur, term, limit=None):
+    """Utenti ordinati per similarità con il termine cercato"""
+    where, where_params = search_condition(USER_SEARCH_COLUMNS, term, fuzzy=trigram_available(cur))
+    rank, rank_params = rank_expression(cur, USER_SEARCH_COLUMNS, term)
+    cur.execute(
+        f"""
+        SELECT u.id, u.nome, u.cognome, u.email, u.telefono, u.nome_telegram,
+               u.role, u.kyc_status, u.created_at, {rank} AS score
+        FROM users u
+        WHERE {where}
+        ORDER BY score DESC, u.id DESC
+        LIMIT %s
+        """,
+        rank_params + where_params + [clamp_limit(limit)],
+    )
+    return cur.fetchall()
+
+
+def search_deposits(cur, term, limit=None):
+    """Depositi per causale, IBAN, chiave univoca o dati utente, ordinati per similarità"""
+    where, where_params = owner_search_condition(DEPOSIT_SEARCH_COLUMNS, 'dr.user_id', term,
+                                                 fuzzy=trigram_available(cur))
+    rank, rank_params = rank_expression(cur, DEPOSIT_SEARCH_COLUMNS + ['u.email', 'u.nome'], term)
+    cur.execute(
+        f"""
+        SELECT dr.id, dr.user_id, dr.amount, dr.method, dr.iban, dr.unique_key,
+               dr.payment_reference, dr.status, dr.created_at,
+               u.nome, u.email, {rank} AS score
+        FROM deposit_requests dr
+        JOIN users u ON u.id = dr.user_id
+        WHERE {where}
+        ORDER BY score DESC, dr.created_at DESC
+        LIMIT %s
+        """,
+        rank_params + where_params + [clamp_limit(limit)],
+    )
+    return cur.fetchall()
+
+
+def search_withdrawals(cur, term, limit=None):
+    """Prelievi per chiave univoca, IBAN, wallet o dati utente, ordinati per similarità"""
+    where, where_params = owner_search_condition(WITHDRAWAL_SEARCH_COLUMNS, 'wr.user_id', term,
+                                                 fuzzy=trigram_available(cur))
+    rank, rank_params = rank_expression(cur, WITHDRAWAL_SEARCH_COLUMNS + ['u.email', 'u.nome'], term)
+    cur.execute(
+        f"""
+        SELECT wr.id, wr.user_id, wr.amount, wr.method, wr.unique_key, wr.wallet_address,
+               wr.bank_details->>'iban' AS iban, wr.status, wr.created_at,
+               u.nome, u.email, {rank} AS score
+        FROM withdrawal_requests wr
+        JOIN users u ON u.id = wr.user_id
+        WHERE {where}
+        ORDER BY score DESC, wr.created_at DESC
+        LIMIT %s
+        """,
+        rank_params + where_params + [clamp_limit(limit)],
+    )
+    return cur.fetchall()
+
+
+SEARCH_SCOPES = {
+    'users': search_users,
+    'deposits': search_deposits,
+    'withdrawals': search_withdrawals,
+}
@@ -0,0 +1,336 @@
+"""
+Distinte SEPA (pain.001.001.03) per i prelievi bancari approvati
+Una distinta raccoglie in un'unica transazione tutti i prelievi approvati e non ancora
+esportati (FOR UPDATE SKIP LOCKED), con IBAN/BIC validati da validate_bank_details:
+i dati di pagamento sono copiati in payout_batch_items e il prelievo punta alla distinta.
+Il file XML è generato in streaming dalle righe salvate, quindi si può riscaricare identico;
+annullare la distinta rende i prelievi di nuovo esportabili.
+"""
+
+import logging
+import re
+import unicodedata
+from datetime import date, timezone
+from decimal import Decimal
+from xml.sax.saxutils import escape, quoteattr
+
+from backend.shared.validators import ValidationError, validate_bank_details
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH = 5000
+NAMESPACE = 'urn:iso:std:iso:20022:tech:xsd:pain.001.001.03'
+JOB_LOCK_ID = 4907001
+
+# Caratteri ammessi nei testi SEPA (set latino di base), lunghezza massima dei nomi
+SEPA_TEXT = re.compile(r"[^A-Za-z0-9/\-?:().,'+ ]")
+MAX_NAME = 70
+MAX_REMITTANCE = 140
+
+_payout_schema_ready = False
+
+# Prelievi bancari approvati non ancora in una distinta attiva
+ELIGIBLE_SQL = """
+    SELECT wr.id, wr.amount, wr.bank_details, wr.unique_key
+    FROM withdrawal_requests wr
+    WHERE wr.status = 'approved' AND wr.method = 'bank' AND wr.payout_batch_id IS NULL
+    ORDER BY wr.id
+"""
+
+
+class PayoutError(Exception):
+    """Distinta non generabile o non modificabile"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def ensure_payout_schema(cur):
+    """Distinte, righe di pagamento e collegamento dei prelievi alla distinta"""
+    global _payout_schema_ready
+    if not _payout_schema_ready:
+        from backend.shared.database import run_schema_setup
+        _payout_schema_ready = run_schema_setup(cur, _create_payout_schema)[0]
+
+
+def _create_payout_schema(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS payout_batches (
+            id SERIAL PRIMARY KEY,
+            message_id TEXT NOT NULL UNIQUE,
+            status TEXT NOT NULL DEFAULT 'exported' CHECK (status IN ('exported', 'cancelled')),
+            execution_date DATE NOT NULL,
+            debtor_name TEXT NOT NULL,
+            debtor_iban TEXT NOT NULL,
+            debtor_bic TEXT,
+            transactions INT NOT NULL,
+            control_sum NUMERIC(15,2) NOT NULL,
+            created_by INT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            cancelled_by INT,
+            cancelled_at TIMESTAMPTZ
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS payout_batch_items (
+            batch_id INT NOT NULL REFERENCES payout_batches(id) ON DELETE CASCADE,
+            withdrawal_id INT NOT NULL,
+            end_to_end_id TEXT NOT NULL,
+            amount NUMERIC(15,2) NOT NULL,
+            creditor_name TEXT NOT NULL,
+            creditor_iban TEXT NOT NULL,
+            creditor_bic TEXT,
+            remittance TEXT NOT NULL,
+            PRIMARY KEY (batch_id, withdrawal_id)
+        )
+        """
+    )
+    cur.execute("ALTER TABLE withdrawal_requests ADD COLUMN IF NOT EXISTS payout_batch_id INT")
+    cur.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_withdrawal_requests_payout_pending
+        ON withdrawal_requests(id) WHERE status = 'approved' AND method = 'bank' AND payout_batch_id IS NULL
+        """
+    )
+
+
+def sepa_text(value, length):
+    """Testo nel set di caratteri SEPA (accenti rimossi, altri simboli sostituiti da spazio)"""
+    ascii_text = unicodedata.normalize('NFKD', value or '').encode('ascii', 'ignore').decode('ascii')
+    return re.sub(r'\s+', ' ', SEPA_TEXT.sub(' ', ascii_text)).strip()[:length]
+
+
+def _debtor(cur):
+    """Conto di addebito: configurazione bancaria attiva della piattaforma"""
+    cur.execute(
+        """
+        SELECT iban, bic_swift, account_holder, bank_name
+        FROM bank_configurations
+        WHERE is_active = true
+        ORDER BY created_at DESC
+        LIMIT 1
+        """
+    )
+    config = cur.fetchone()
+    if not config:
+        raise PayoutError("Nessun conto bancario attivo configurato")
+    try:
+        details = validate_bank_details({**config, 'bic': config['bic_swift']})
+    except ValidationError as e:
+        raise PayoutError(f"Conto di addebito non valido: {e}")
+    return sepa_text(config['account_holder'], MAX_NAME), details['iban'], details['bic'] or None
+
+
+def pending_withdrawals(cur):
+    """Anteprima: prelievi esportabili e prelievi esclusi per dati bancari non validi"""
+    ensure_payout_schema(cur)
+    cur.execute(ELIGIBLE_SQL)
+    valid, invalid = _validate(cur.fetchall())
+    return {
+        'withdrawals': len(valid),
+        'control_sum': float(sum(item['amount'] for item in valid)),
+        'invalid': invalid,
+    }
+
+
+def _validate(rows):
+    valid, invalid = [], []
+    for row in rows:
+        details = row['bank_details'] or {}
+        try:
+            details = validate_bank_details(details)
+            name = sepa_text(details['account_holder'], MAX_NAME)
+            if not name:
+                raise ValidationError("Intestatario non valido")
+        except ValidationError as e:
+            invalid.append({'id': row['id'], 'error': str(e)})
+            continue
+        valid.append({
+            'withdrawal_id': row['id'],
+            'end_to_end_id': f"CIP-WD-{row['id']}",
+            'amount': Decimal(row['amount']),
+            'creditor_name': name,
+            'creditor_iban': details['iban'],
+            'creditor_bic': details['bic'] or None,
+            'remittance': sepa_text(f"Prelievo CIP {row['unique_key'] or row['id']}", MAX_REMITTANCE),
+        })
+    return valid, invalid
+
+
+def create_batch(cur, admin_id, execution_date=None, limit=MAX_BATCH):
+    """Blocca i prelievi esportabili e registra la distinta nella transazione del chiamante"""
+    ensure_payout_schema(cur)
+    execution_date = execution_date or date.today()
+    if execution_date < date.today():
+        raise PayoutError("La data di esecuzione non può essere nel passato")
+    debtor_name, debtor_iban, debtor_bic = _debtor(cur)
+
+    # Una distinta alla volta; i prelievi in lavorazione altrove vengono saltati
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (JOB_LOCK_ID,))
+    cur.execute(ELIGIBLE_SQL + " LIMIT %s FOR UPDATE SKIP LOCKED", (limit,))
+    valid, invalid = _validate(cur.fetchall())
+    if not valid:
+        raise PayoutError("Nessun prelievo bancario approvato da pagare", 404)
+
+    control_sum = sum(item['amount'] for item in valid)
+    cur.execute("SELECT nextval(pg_get_serial_sequence('payout_batches', 'id')) AS id")
+    batch_id = cur.fetchone()['id']
+    # MsgId univoco, max 35 caratteri
+    message_id = f"CIP-PAY-{date.today():%Y%m%d}-{batch_id}"
+    cur.execute(
+        """
+        INSERT INTO payout_batches
+            (id, message_id, execution_date, debtor_name, debtor_iban, debtor_bic, transactions, control_sum, created_by)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING id, message_id
+        """,
+        (batch_id, message_id, execution_date, debtor_name, debtor_iban, debtor_bic, len(valid), control_sum, admin_id),
+    )
+    batch = cur.fetchone()
+    columns = ('withdrawal_id', 'end_to_end_id', 'amount', 'creditor_name', 'creditor_iban', 'creditor_bic', 'remittance')
+    cur.execute(
+        """
+        WITH items AS (
+            INSERT INTO payout_batch_items
+                (batch_id, withdrawal_id, end_to_end_id, amount, creditor_name, creditor_iban, creditor_bic, remittance)
+            SELECT %(batch_id)s, i.*
+            FROM unnest(%(withdrawal_id)s::int[], %(end_to_end_id)s::text[], %(amount)s::numeric[],
+                        %(creditor_name)s::text[], %(creditor_iban)s::text[], %(creditor_bic)s::text[],
+                        %(remittance)s::text[]) AS i
+            RETURNING withdrawal_id
+        )
+        UPDATE withdrawal_requests wr
+        SET payout_batch_id = %(batch_id)s, updated_at = NOW()
+        FROM items
+        WHERE wr.id = items.withdrawal_id
+        """,
+        {'batch_id': batch['id'], **{c: [item[c] for item in valid] for c in columns}},
+    )
+    logger.info(f"Distinta SEPA {batch['message_id']}: {len(valid)} prelievi, {control_sum} EUR, {len(invalid)} esclusi")
+    return {
+        'batch_id': batch['id'],
+        'message_id': batch['message_id'],
+        'withdrawals': len(valid),
+        'control_sum': float(control_sum),
+        'invalid': invalid,
+    }
+
+
+def cancel_batch(cur, batch_id, admin_id):
+    """Annulla la distinta: i suoi prelievi tornano esportabili in una nuova distinta"""
+    ensure_payout_schema(cur)
+    cur.execute(
+        """
+        UPDATE payout_batches
+        SET status = 'cancelled', cancelled_by = %s, cancelled_at = NOW()
+        WHERE id = %s AND status = 'exported'
+        RETURNING id
+        """,
+        (admin_id, batch_id),
+    )
+    if not cur.fetchone():
+        cur.execute("SELECT status FROM payout_batches WHERE id = %s", (batch_id,))
+        row = cur.fetchone()
+        if not row:
+            raise PayoutError("Distinta non trovata", 404)
+        raise PayoutError(f"Distinta già {row['status']}")
+    cur.execute("UPDATE withdrawal_requests SET payout_batch_id = NULL, updated_at = NOW() WHERE payout_batch_id = %s",
+                (batch_id,))
+    released = cur.rowcount
+    logger.info(f"Distinta SEPA {batch_id} annullata da admin {admin_id}: {released} prelievi di nuovo esportabili")
+    return {'batch_id': batch_id, 'released': released}
+
+
+def list_batches(cur, limit=50):
+    """Ultime distinte; downloadable è falso per le annullate (il file non va più inviato alla banca)"""
+    ensure_payout_schema(cur)
+    cur.execute(
+        "SELECT *, status = 'exported' AS downloadable FROM payout_batches ORDER BY id DESC LIMIT %s",
+        (limit,),
+    )
+    return cur.fetchall()
+
+
+def get_batch(cur, batch_id):
+    ensure_payout_schema(cur)
+    cur.execute("SELECT * FROM payout_batches WHERE id = %s", (batch_id,))
+    return cur.fetchone()
+
+
+def _element(tag, value, attrs=''):
+    return f"<{tag}{attrs}>{escape(str(value))}</{tag}>"
+
+
+def _agent(tag, bic):
+    """Banca: BIC se noto, altrimenti NOTPROVIDED (SEPA solo IBAN)"""
+    inner = _element('BIC', bic) if bic else '<Othr><Id>NOTPROVIDED</Id></Othr>'
+    return f"<{tag}><FinInstnId>{inner}</FinInstnId></{tag}>"
+
+
+def xml_header(batch):
+    """Testata del documento e dati di addebito (PmtInf aperto)"""
+    created = batch['created_at'].astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    control_sum = f"{batch['control_sum']:.2f}"
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<Document xmlns="{NAMESPACE}"><CstmrCdtTrfInitn>'
+        '<GrpHdr>'
+        f"{_element('MsgId', batch['message_id'])}{_element('CreDtTm', created)}"
+        f"{_element('NbOfTxs', batch['transactions'])}{_element('CtrlSum', control_sum)}"
+        f"<InitgPty>{_element('Nm', batch['debtor_name'])}</InitgPty>"
+        '</GrpHdr>'
+        '<PmtInf>'
+        f"{_element('PmtInfId', batch['message_id'])}<PmtMtd>TRF</PmtMtd><BtchBookg>true</BtchBookg>"
+        f"{_element('NbOfTxs', batch['transactions'])}{_element('CtrlSum', control_sum)}"
+        '<PmtTpInf><SvcLvl><Cd>SEPA</Cd></SvcLvl></PmtTpInf>'
+        f"{_element('ReqdExctnDt', batch['execution_date'].isoformat())}"
+        f"<Dbtr>{_element('Nm', batch['debtor_name'])}</Dbtr>"
+        f"<DbtrAcct><Id>{_element('IBAN', batch['debtor_iban'])}</Id></DbtrAcct>"
+        f"{_agent('DbtrAgt', batch['debtor_bic'])}"
+        '<ChrgBr>SLEV</ChrgBr>\n'
+    )
+
+
+def xml_transaction(item):
+    return (
+        '<CdtTrfTxInf>'
+        f"<PmtId>{_element('EndToEndId', item['end_to_end_id'])}</PmtId>"
+        f"<Amt>{_element('InstdAmt', format(item['amount'], '.2f'), ' Ccy=' + quoteattr('EUR'))}</Amt>"
+        f"{_agent('CdtrAgt', item['creditor_bic']) if item['creditor_bic'] else ''}"
+        f"<Cdtr>{_element('Nm', item['creditor_name'])}</Cdtr>"
+        f"<CdtrAcct><Id>{_element('IBAN', item['creditor_iban'])}</Id></CdtrAcct>"
+        f"<RmtInf>{_element('Ustrd', item['remittance'])}</RmtInf>"
+        '</CdtTrfTxInf>\n'
+    )
+
+
+XML_FOOTER = '</PmtInf></CstmrCdtTrfInitn></Document>\n'
+
+
+def filename(batch):
+    return f"{batch['message_id']}.xml"
+
+
+def stream_batch(batch, itersize=2000):
+    """XML della distinta in streaming dalle righe salvate (cursore server-side, memoria costante)"""
+    yield xml_header(batch)
+    from backend.shared.database import get_connection
+
+    with get_connection() as conn:
+        with conn.cursor(name=f"payout_batch_{batch['id']}") as cur:
+            cur.itersize = itersize
+            cur.execute(
+                "SELECT * FROM payout_batch_items WHERE batch_id = %s ORDER BY withdrawal_id",
+                (batch['id'],),
+            )
+            chunk = []
+            for item in cur:
+                chunk.append(xml_transaction(item))
+                if len(chunk) >= 500:
+                    yield ''.join(chunk)
+                    chunk = []
+            yield ''.join(chunk)
+    yield XML_FOOTER
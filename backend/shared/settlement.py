@@ -0,0 +1,294 @@
+"""
+Liquidazione set-based dei progetti: vendita (profitti) e annullamento (rimborsi)
+Tutti gli investitori vengono regolati con poche istruzioni nella transazione del chiamante:
+o il progetto è liquidato per intero o non cambia nulla
+"""
+
+import logging
+from decimal import Decimal
+
+from backend.shared.ledger import ledger_context
+from backend.shared.project_funding import fold
+from backend.shared.referral_accrual import (
+    REFERRER_RATE, VIP_REFERRER_RATE, PLATFORM_RATE, PLATFORM_USER_ID, ensure_referral_accrual_schema,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class SettlementError(Exception):
+    """Progetto non liquidabile nello stato attuale"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+# Quote per investimento: profitto proporzionale, bonus referrer e piattaforma, trattenuta, profitto netto.
+# I bonus sono arrotondati uno per uno e la trattenuta è la loro somma: quanto si trattiene è quanto si paga.
+SALE_SHARES_SQL = """
+    WITH base AS (
+        SELECT i.id AS investment_id, i.user_id, i.amount,
+               i.amount / %(total_invested)s::numeric * %(total_profit)s::numeric AS profit_share,
+               r.id AS referrer_id, COALESCE(r.is_vip, FALSE) AS referrer_vip,
+               CASE WHEN COALESCE(r.is_vip, FALSE) THEN %(vip_rate)s::numeric ELSE %(rate)s::numeric END AS referrer_rate
+        FROM investments i
+        JOIN users u ON u.id = i.user_id
+        LEFT JOIN users r ON r.id = u.referred_by AND r.id != u.id
+        WHERE i.project_id = %(project_id)s AND i.status = 'active' AND i.amount > 0
+    ),
+    bonuses AS (
+        SELECT investment_id, user_id, amount, referrer_id, referrer_rate,
+               ROUND(profit_share, 2) AS profit_share,
+               CASE WHEN profit_share > 0 AND referrer_id IS NOT NULL
+                    THEN ROUND(profit_share * referrer_rate, 2) ELSE 0 END AS referrer_bonus,
+               CASE WHEN profit_share > 0 AND NOT referrer_vip
+                    THEN ROUND(profit_share * %(platform_rate)s::numeric, 2) ELSE 0 END AS platform_bonus
+        FROM base
+    ),
+    shares AS (
+        SELECT *, referrer_bonus + platform_bonus AS referral_withheld
+        FROM bonuses
+    )
+"""
+
+
+def _lock_project(cur, project_id):
+    """Lock del progetto con la raccolta consolidata (shard ripiegati in funded_amount)"""
+    cur.execute(
+        """
+        SELECT id, name, status, COALESCE(funded_amount, 0) AS funded_amount
+        FROM projects
+        WHERE id = %s
+        FOR UPDATE
+        """,
+        (project_id,),
+    )
+    project = cur.fetchone()
+    if not project:
+        raise SettlementError("Progetto non trovato", 404)
+    project['funded_amount'] = fold(cur, project_id)
+    return project
+
+
+def _sale_params(cur, project, sale_price):
+    """Totale investito (funded_amount, fallback somma investimenti attivi) e profitto totale, in Decimal"""
+    total_invested = Decimal(project['funded_amount'] or 0)
+    if total_invested <= 0:
+        cur.execute(
+            """
+            SELECT COALESCE(SUM(amount), 0) AS total
+            FROM investments
+            WHERE project_id = %s AND status = 'active'
+            """,
+            (project['id'],),
+        )
+        total_invested = Decimal(cur.fetchone()['total'])
+    if total_invested <= 0:
+        raise SettlementError("Nessun investimento registrato per il progetto")
+    total_profit = Decimal(str(sale_price)) - total_invested
+    return {
+        'project_id': project['id'],
+        'total_invested': total_invested,
+        'total_profit': total_profit,
+        'rate': REFERRER_RATE,
+        'vip_rate': VIP_REFERRER_RATE,
+        'platform_rate': PLATFORM_RATE,
+        'platform_user': PLATFORM_USER_ID,
+    }
+
+
+def preview_sale(cur, project_id, sale_price):
+    """Dry-run della vendita: importi per investitore senza modificare nulla"""
+    project = _lock_project(cur, project_id)
+    if project['status'] != 'completed':
+        raise SettlementError("Il progetto deve essere in stato 'completed'")
+    params = _sale_params(cur, project, sale_price)
+    cur.execute(
+        SALE_SHARES_SQL + """
+        SELECT s.investment_id, s.user_id, u.email, s.amount, s.profit_share, s.referral_withheld,
+               s.profit_share - s.referral_withheld AS net_profit,
+               s.amount + s.profit_share - s.referral_withheld AS payout
+        FROM shares s
+        JOIN users u ON u.id = s.user_id
+        ORDER BY s.investment_id
+        """,
+        params,
+    )
+    rows = cur.fetchall()
+    return {
+        'project_id': project_id,
+        'sale_price': float(sale_price),
+        'total_invested': float(params['total_invested']),
+        'total_profit': float(params['total_profit']),
+        'profit_percentage': float(params['total_profit'] / params['total_invested'] * 100),
+        'investments': [
+            {k: (float(v) if k in ('amount', 'profit_share', 'referral_withheld', 'net_profit', 'payout') else v)
+             for k, v in row.items()}
+            for row in rows
+        ],
+        'total_referral_withheld': float(sum(row['referral_withheld'] for row in rows)),
+        'total_payout': float(sum(row['payout'] for row in rows)),
+    }
+
+
+def settle_sale(cur, project_id, sale_price):
+    """Vende il progetto: restituisce il capitale e accredita i profitti netti a tutti gli investitori"""
+    project = _lock_project(cur, project_id)
+    if project['status'] != 'completed':
+        raise SettlementError("Il progetto deve essere in stato 'completed'")
+    params = _sale_params(cur, project, sale_price)
+    profit_percentage = params['total_profit'] / params['total_invested'] * 100
+    ensure_referral_accrual_schema(cur)
+
+    with ledger_context(cur, 'roi', f"Vendita progetto {project['name'] or project_id}", project_id, 'project'):
+        cur.execute(
+            SALE_SHARES_SQL + """,
+            settled AS (
+                UPDATE investments i
+                SET status = 'completed', completed_at = NOW(),
+                    profit_earned = GREATEST(s.profit_share, 0),
+                    total_return = GREATEST(s.amount + s.profit_share, 0)
+                FROM shares s
+                WHERE i.id = s.investment_id
+                RETURNING s.user_id, s.amount, s.profit_share - s.referral_withheld AS net_profit
+            ),
+            -- Bonus trattenuti registrati ora, con referrer e aliquota della vendita: li paga il run mensile
+            withheld_bonuses AS (
+                INSERT INTO referral_bonuses
+                    (receiver_user_id, source_user_id, investment_id, level, amount, month_ref, status, bonus_type, rate)
+                SELECT referrer_id, user_id, investment_id, 1, referrer_bonus,
+                       DATE_TRUNC('month', NOW())::date, 'accrued', 'referral', referrer_rate
+                FROM shares
+                WHERE referrer_bonus > 0
+                UNION ALL
+                SELECT %(platform_user)s, user_id, investment_id, 1, platform_bonus,
+                       DATE_TRUNC('month', NOW())::date, 'accrued', 'platform', %(platform_rate)s
+                FROM shares
+                WHERE platform_bonus > 0
+                ON CONFLICT (month_ref, investment_id, receiver_user_id, bonus_type) DO NOTHING
+            ),
+            per_user AS (
+                SELECT user_id, SUM(amount) AS capital, SUM(net_profit) AS net_profit
+                FROM settled
+                GROUP BY user_id
+            ),
+            credited AS (
+                INSERT INTO user_portfolios (user_id, free_capital, invested_capital, referral_bonus, profits)
+                SELECT user_id, capital, -capital, 0, net_profit FROM per_user
+                ON CONFLICT (user_id)
+                DO UPDATE SET
+                    profits = user_portfolios.profits + EXCLUDED.profits,
+                    free_capital = user_portfolios.free_capital + EXCLUDED.free_capital,
+                    invested_capital = user_portfolios.invested_capital + EXCLUDED.invested_capital
+                RETURNING user_id, profits
+            ),
+            movements AS (
+                INSERT INTO portfolio_transactions
+                    (user_id, type, amount, balance_before, balance_after, description,
+                     reference_id, reference_type, status)
+                SELECT p.user_id, 'roi', p.net_profit, c.profits - p.net_profit, c.profits,
+                       'Profitto vendita progetto ' || %(project_name)s, %(project_id)s, 'project', 'completed'
+                FROM per_user p
+                JOIN credited c ON c.user_id = p.user_id
+                WHERE p.net_profit > 0
+            )
+            SELECT user_id, capital, net_profit FROM per_user
+            """,
+            {**params, 'project_name': project['name'] or str(project_id)},
+        )
+        investors = cur.fetchall()
+
+    cur.execute(
+        """
+        UPDATE projects
+        SET status = 'sold', sale_price = %s, sold_at = NOW(), profit_percentage = %s
+        WHERE id = %s
+        """,
+        (Decimal(str(sale_price)), round(profit_percentage, 3), project_id),
+    )
+
+    logger.info(f"Progetto {project_id} venduto: {len(investors)} investitori liquidati")
+    return {
+        'total_profit': float(params['total_profit']),
+        'profit_percentage': float(profit_percentage),
+        'investors': len(investors),
+        'capital_returned': float(sum(row['capital'] for row in investors)),
+        'net_profit_distributed': float(sum(row['net_profit'] for row in investors)),
+    }
+
+
+def preview_refunds(cur, project_id):
+    """Dry-run dei rimborsi: capitale da restituire per investitore"""
+    _lock_project(cur, project_id)
+    cur.execute(
+        """
+        SELECT i.user_id, u.email, COUNT(*) AS investments, SUM(i.amount) AS refund
+        FROM investments i
+        JOIN users u ON u.id = i.user_id
+        WHERE i.project_id = %s AND i.status = 'active'
+        GROUP BY i.user_id, u.email
+        ORDER BY i.user_id
+        """,
+        (project_id,),
+    )
+    rows = cur.fetchall()
+    return {
+        'project_id': project_id,
+        'investors': [
+            {'user_id': row['user_id'], 'email': row['email'],
+             'investments': row['investments'], 'refund': float(row['refund'])}
+            for row in rows
+        ],
+        'refunded_investments': sum(row['investments'] for row in rows),
+        'total_refunded': float(sum(row['refund'] for row in rows)),
+    }
+
+
+def refund_investments(cur, project_id, new_status='cancelled'):
+    """Rimborsa in free_capital tutti gli investimenti attivi del progetto in un'unica istruzione"""
+    with ledger_context(cur, 'refund', 'Rimborso investimenti progetto', project_id, 'project'):
+        cur.execute(
+            """
+            WITH refunded AS (
+                UPDATE investments
+                SET status = %s, completed_at = NOW()
+                WHERE project_id = %s AND status = 'active'
+                RETURNING user_id, amount
+            ),
+            per_user AS (
+                SELECT user_id, SUM(amount) AS refund, COUNT(*) AS investments
+                FROM refunded
+                GROUP BY user_id
+            ),
+            credited AS (
+                INSERT INTO user_portfolios (user_id, free_capital, invested_capital, profits, referral_bonus)
+                SELECT user_id, refund, -refund, 0, 0 FROM per_user
+                ON CONFLICT (user_id)
+                DO UPDATE SET
+                    free_capital = user_portfolios.free_capital + EXCLUDED.free_capital,
+                    invested_capital = user_portfolios.invested_capital + EXCLUDED.invested_capital
+                RETURNING user_id
+            )
+            SELECT p.user_id, p.refund, p.investments
+            FROM per_user p
+            JOIN credited c ON c.user_id = p.user_id
+            """,
+            (new_status, project_id),
+        )
+        rows = cur.fetchall()
+    return {
+        'refunded_investments': sum(row['investments'] for row in rows),
+        'total_refunded': float(sum(row['refund'] for row in rows)),
+        'investors': len(rows),
+    }
+
+
+def settle_cancellation(cur, project_id):
+    """Annulla un progetto attivo rimborsando tutti gli investitori"""
+    project = _lock_project(cur, project_id)
+    if project['status'] != 'active':
+        raise SettlementError("Progetto non trovato o non attivo", 404)
+    result = refund_investments(cur, project_id)
+    cur.execute("UPDATE projects SET status = 'cancelled' WHERE id = %s", (project_id,))
+    logger.info(f"Progetto {project_id} annullato: {result['refunded_investments']} investimenti rimborsati")
+    return result
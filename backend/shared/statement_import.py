@@ -0,0 +1,473 @@
+"""
+Import di estratti conto (CSV banca, CAMT.053 XML) ed export di transazioni wallet crypto
+Il file viene letto in streaming (csv.reader / iterparse) e caricato con COPY in una tabella
+temporanea; un'unica istruzione abbina tutte le righe alle richieste di deposito per causale
+(chiave univoca della richiesta), importo e conto di accredito e salva l'esito in
+bank_statement_lines. Le righe abbinate si approvano con il percorso massivo di
+request_batches (accredito set-based), subito o dopo revisione.
+"""
+
+import csv
+import io
+import logging
+import re
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+from backend.shared.request_batches import approve_deposits, summarize
+
+logger = logging.getLogger(__name__)
+
+SOURCES = ('csv', 'camt053', 'crypto')
+MAX_LINES = 50000
+MAX_TOKENS = 50
+MAX_TEXT = 500
+CENT = Decimal('0.01')
+
+_statement_schema_ready = False
+
+# Intestazioni riconosciute (minuscole) per i CSV delle banche e degli explorer
+BANK_COLUMNS = {
+    'booked_on': ('data contabile', 'data operazione', 'data', 'data valuta', 'booking date', 'date', 'value date'),
+    'amount': ('importo', 'entrate', 'accrediti', 'avere', 'amount', 'credit'),
+    'debit': ('uscite', 'addebiti', 'dare', 'debit'),
+    'description': ('causale', 'descrizione', 'descrizione operazione', 'dettagli', 'description',
+                    'remittance information'),
+    'counterparty_iban': ('iban ordinante', 'iban controparte', 'iban', 'counterparty iban'),
+    'counterparty_name': ('ordinante', 'controparte', 'counterparty', 'name'),
+    'external_id': ('id operazione', 'id transazione', 'transaction id', 'id'),
+    'currency': ('divisa', 'currency'),
+}
+CRYPTO_COLUMNS = {
+    'external_id': ('transaction hash', 'txhash', 'hash'),
+    'booked_on': ('datetime (utc)', 'datetime', 'date'),
+    'timestamp': ('unixtimestamp', 'timestamp'),
+    'counterparty_iban': ('from',),
+    'account': ('to',),
+    'amount': ('tokenvalue', 'value', 'quantity', 'amount'),
+    'currency': ('tokensymbol', 'token symbol', 'symbol'),
+}
+
+DATE_FORMATS = ('%d/%m/%Y', '%d/%m/%y', '%d-%m-%Y', '%d.%m.%Y', '%Y-%m-%d', '%Y-%m-%d %H:%M:%S',
+                '%Y/%m/%d %H:%M:%S', '%m/%d/%Y %I:%M:%S %p')
+
+# Chiavi richiesta (gruppi da 4 caratteri base32) anche con spazio o senza trattino,
+# sovrapposte: "ABCD EFGH JKMN" contiene sia ABCD-EFGH sia EFGH-JKMN
+KEY_PATTERN = re.compile(r'(?=(?<![0-9A-Z])([0-9A-Z]{4})[\s-]?([0-9A-Z]{4})(?![0-9A-Z]))')
+# Chiavi di formato precedente: parole alfanumeriche lunghe
+WORD_PATTERN = re.compile(r'[0-9A-Za-z][0-9A-Za-z_-]{5,39}')
+
+COPY_COLUMNS = ('line_no', 'booked_on', 'amount', 'currency', 'account', 'counterparty_iban',
+                'counterparty_name', 'description', 'external_id', 'tokens')
+
+# Un'unica istruzione: abbinamento per causale, poi per importo (candidato unico),
+# una sola riga per richiesta (le altre sono duplicati)
+MATCH_SQL = """
+    WITH by_reference AS (
+        SELECT DISTINCT ON (l.line_no) l.line_no, dr.id AS request_id, dr.status, dr.amount, dr.iban
+        FROM tmp_statement_lines l
+        JOIN deposit_requests dr ON dr.unique_key = ANY(l.tokens)
+        ORDER BY l.line_no, dr.status = 'pending' DESC, dr.id
+    ),
+    by_amount AS (
+        SELECT l.line_no, MIN(dr.id) AS request_id, COUNT(*) AS candidates
+        FROM tmp_statement_lines l
+        JOIN deposit_requests dr
+          ON dr.status = 'pending' AND dr.amount = l.amount AND dr.method = %(method)s
+         AND (l.account IS NULL OR upper(replace(dr.iban, ' ', '')) = upper(replace(l.account, ' ', '')))
+         AND (l.booked_on IS NULL OR dr.created_at::date <= l.booked_on)
+        WHERE NOT EXISTS (SELECT 1 FROM by_reference r WHERE r.line_no = l.line_no)
+        GROUP BY l.line_no
+    ),
+    proposed AS (
+        SELECT l.*,
+               COALESCE(r.request_id, CASE WHEN a.candidates = 1 THEN a.request_id END) AS request_id,
+               CASE
+                   WHEN r.request_id IS NOT NULL AND r.status <> 'pending' THEN 'already_processed'
+                   WHEN r.request_id IS NOT NULL AND r.amount <> l.amount THEN 'amount_mismatch'
+                   WHEN r.request_id IS NOT NULL AND l.account IS NOT NULL
+                        AND upper(replace(r.iban, ' ', '')) <> upper(replace(l.account, ' ', '')) THEN 'account_mismatch'
+                   WHEN r.request_id IS NOT NULL THEN 'matched'
+                   WHEN a.candidates = 1 THEN 'suggested'
+                   WHEN a.candidates > 1 THEN 'ambiguous'
+                   ELSE 'unmatched'
+               END AS match_status
+        FROM tmp_statement_lines l
+        LEFT JOIN by_reference r ON r.line_no = l.line_no
+        LEFT JOIN by_amount a ON a.line_no = l.line_no
+    ),
+    ranked AS (
+        SELECT p.*, ROW_NUMBER() OVER (
+            PARTITION BY request_id ORDER BY match_status = 'matched' DESC, line_no
+        ) AS claim
+        FROM proposed p
+    ),
+    inserted AS (
+        INSERT INTO bank_statement_lines
+            (import_id, line_no, booked_on, amount, currency, account, counterparty_iban,
+             counterparty_name, description, external_id, deposit_request_id, match_status)
+        SELECT %(import_id)s, line_no, booked_on, amount, currency, account, counterparty_iban,
+               counterparty_name, description, external_id, request_id,
+               CASE WHEN request_id IS NOT NULL AND claim > 1 AND match_status IN ('matched', 'suggested')
+                    THEN 'duplicate' ELSE match_status END
+        FROM ranked
+        RETURNING match_status
+    )
+    SELECT match_status, COUNT(*) AS lines FROM inserted GROUP BY match_status
+"""
+
+
+class StatementError(Exception):
+    """File non riconosciuto o non leggibile"""
+    pass
+
+
+def ensure_statement_schema(cur):
+    """Import eseguiti e righe con l'esito dell'abbinamento"""
+    global _statement_schema_ready
+    if not _statement_schema_ready:
+        from backend.shared.database import run_schema_setup
+        _statement_schema_ready = run_schema_setup(cur, _create_statement_schema)[0]
+
+
+def _create_statement_schema(cur):
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bank_statement_imports (
+            id SERIAL PRIMARY KEY,
+            source TEXT NOT NULL CHECK (source IN ('csv', 'camt053', 'crypto')),
+            filename TEXT,
+            account TEXT,
+            lines INT NOT NULL DEFAULT 0,
+            matched INT NOT NULL DEFAULT 0,
+            suggested INT NOT NULL DEFAULT 0,
+            applied INT NOT NULL DEFAULT 0,
+            created_by INT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS bank_statement_lines (
+            import_id INT NOT NULL REFERENCES bank_statement_imports(id) ON DELETE CASCADE,
+            line_no INT NOT NULL,
+            booked_on DATE,
+            amount NUMERIC(15,2) NOT NULL,
+            currency TEXT,
+            account TEXT,
+            counterparty_iban TEXT,
+            counterparty_name TEXT,
+            description TEXT,
+            external_id TEXT,
+            deposit_request_id INT,
+            match_status TEXT NOT NULL,
+            applied_at TIMESTAMPTZ,
+            PRIMARY KEY (import_id, line_no)
+        )
+        """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_bank_statement_lines_request ON bank_statement_lines(deposit_request_id)"
+    )
+
+
+def parse_amount(value, decimal_comma=True):
+    """Importo da testo ('1.234,56', '1,234.56', '-50', '€ 500,00'), arrotondato al centesimo"""
+    text = re.sub(r'[^0-9,.\-+]', '', value or '')
+    if not text:
+        return None
+    if ',' in text and '.' in text:
+        # Il separatore che compare per ultimo è quello dei decimali
+        if text.rfind(',') > text.rfind('.'):
+            text = text.replace('.', '').replace(',', '.')
+        else:
+            text = text.replace(',', '')
+    elif ',' in text:
+        text = text.replace(',', '.') if decimal_comma else text.replace(',', '')
+    try:
+        return Decimal(text).quantize(CENT, rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        return None
+
+
+def parse_date(value):
+    text = (value or '').strip()
+    if not text:
+        return None
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    try:
+        return datetime.fromisoformat(text.replace('Z', '+00:00')).date()
+    except ValueError:
+        return None
+
+
+def reference_tokens(*texts):
+    """Possibili chiavi di richiesta contenute nei testi (causale, riferimenti)"""
+    tokens = []
+    for text in texts:
+        if not text:
+            continue
+        upper = text.upper()
+        tokens += [f"{a}-{b}" for a, b in KEY_PATTERN.findall(upper)]
+        tokens += WORD_PATTERN.findall(text)
+    return list(dict.fromkeys(tokens))[:MAX_TOKENS]
+
+
+def _line(booked_on, amount, description='', external_id=None, account=None,
+          counterparty_iban=None, counterparty_name=None, currency='EUR'):
+    return {
+        'booked_on': booked_on,
+        'amount': amount,
+        'currency': (currency or 'EUR')[:10],
+        'account': account or None,
+        'counterparty_iban': counterparty_iban or None,
+        'counterparty_name': (counterparty_name or '')[:MAX_TEXT] or None,
+        'description': (description or '')[:MAX_TEXT],
+        'external_id': (external_id or '')[:200] or None,
+        'tokens': reference_tokens(description, external_id),
+    }
+
+
+def _columns(header, aliases):
+    """Indice di colonna per ogni campo, dal primo alias presente nell'intestazione"""
+    names = [name.strip().lower() for name in header]
+    found = {}
+    for field, candidates in aliases.items():
+        for candidate in candidates:
+            if candidate in names:
+                found[field] = names.index(candidate)
+                break
+    return found
+
+
+def _parse_csv(text_stream, account=None):
+    """CSV banca (delimitatore ; , o tab) o export transazioni di un explorer (BscScan, Etherscan)"""
+    first = text_stream.readline()
+    if not first.strip():
+        raise StatementError("File vuoto")
+    delimiter = max((';', ',', '\t'), key=first.count)
+    header = next(csv.reader([first], delimiter=delimiter))
+    lowered = {name.strip().lower() for name in header}
+    crypto = bool(lowered & set(CRYPTO_COLUMNS['external_id'])) and 'to' in lowered
+    columns = _columns(header, CRYPTO_COLUMNS if crypto else BANK_COLUMNS)
+    if 'amount' not in columns:
+        raise StatementError("Colonna importo non trovata nell'intestazione")
+
+    def field(row, name):
+        index = columns.get(name)
+        return row[index].strip() if index is not None and index < len(row) else ''
+
+    def lines():
+        for row in csv.reader(text_stream, delimiter=delimiter):
+            if not any(cell.strip() for cell in row):
+                continue
+            amount = parse_amount(field(row, 'amount'), decimal_comma=not crypto)
+            if crypto:
+                booked_on = parse_date(field(row, 'booked_on'))
+                if booked_on is None and field(row, 'timestamp').isdigit():
+                    booked_on = datetime.fromtimestamp(int(field(row, 'timestamp')), timezone.utc).date()
+                yield _line(booked_on, amount, external_id=field(row, 'external_id'),
+                            account=field(row, 'account'), counterparty_iban=field(row, 'counterparty_iban'),
+                            currency=field(row, 'currency') or 'USDT')
+            else:
+                # Solo accrediti: importo positivo e nessun addebito sulla riga
+                if field(row, 'debit') and not field(row, 'amount'):
+                    continue
+                yield _line(parse_date(field(row, 'booked_on')), amount,
+                            description=field(row, 'description'), external_id=field(row, 'external_id'),
+                            account=account, counterparty_iban=field(row, 'counterparty_iban'),
+                            counterparty_name=field(row, 'counterparty_name'),
+                            currency=field(row, 'currency') or 'EUR')
+
+    return ('crypto' if crypto else 'csv'), lines()
+
+
+def _camt_entry(entry, account):
+    """Movimento CAMT.053 (Ntry): solo accrediti"""
+    if (entry.findtext('{*}CdtDbtInd') or '').strip() != 'CRDT':
+        return None
+    amount_node = entry.find('{*}Amt')
+    booked = entry.findtext('{*}BookgDt/{*}Dt') or entry.findtext('{*}BookgDt/{*}DtTm') \
+        or entry.findtext('{*}ValDt/{*}Dt') or ''
+    remittance = ' '.join(
+        (node.text or '').strip() for node in entry.iterfind('.//{*}RmtInf/{*}Ustrd')
+    ) or ' '.join((node.text or '').strip() for node in entry.iterfind('.//{*}RmtInf/{*}Strd//{*}Ref'))
+    return _line(
+        parse_date(booked[:10]),
+        parse_amount(amount_node.text if amount_node is not None else '', decimal_comma=False),
+        description=remittance or entry.findtext('{*}AddtlNtryInf') or '',
+        external_id=entry.findtext('{*}AcctSvcrRef') or entry.findtext('{*}NtryRef')
+        or entry.findtext('.//{*}Refs/{*}EndToEndId'),
+        account=account,
+        counterparty_iban=entry.findtext('.//{*}RltdPties/{*}DbtrAcct/{*}Id/{*}IBAN'),
+        counterparty_name=entry.findtext('.//{*}RltdPties/{*}Dbtr/{*}Nm')
+        or entry.findtext('.//{*}RltdPties/{*}Dbtr/{*}Pty/{*}Nm'),
+        currency=amount_node.get('Ccy') if amount_node is not None else 'EUR',
+    )
+
+
+def _parse_camt053(stream):
+    """CAMT.053 in streaming: ogni Ntry è liberato dopo la lettura"""
+    def lines():
+        account = None
+        path = []
+        try:
+            for event, elem in ET.iterparse(stream, events=('start', 'end')):
+                tag = elem.tag.rsplit('}', 1)[-1]
+                if event == 'start':
+                    path.append(tag)
+                    continue
+                path.pop()
+                if tag == 'IBAN' and path[-3:] == ['Stmt', 'Acct', 'Id']:
+                    account = (elem.text or '').strip()
+                elif tag == 'Ntry':
+                    line = _camt_entry(elem, account)
+                    elem.clear()
+                    if line:
+                        yield line
+        except ET.ParseError as e:
+            raise StatementError(f"XML non valido: {e}")
+
+    return 'camt053', lines()
+
+
+def parse_statement(stream, filename='', account=None):
+    """Formato dal contenuto (XML -> CAMT.053, altrimenti CSV); ritorna (source, righe)"""
+    head = stream.read(64).lstrip(b'\xef\xbb\xbf \t\r\n')
+    stream.seek(0)
+    if head.startswith(b'<') or filename.lower().endswith('.xml'):
+        return _parse_camt053(stream)
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+    return _parse_csv(text_stream, account)
+
+
+def import_statement(cur, stream, filename='', account=None, admin_id=None):
+    """Carica il file, abbina le righe e registra l'import; ritorna il riepilogo"""
+    ensure_statement_schema(cur)
+    source, lines = parse_statement(stream, filename, account)
+    cur.execute(
+        """
+        CREATE TEMP TABLE tmp_statement_lines (
+            line_no INT PRIMARY KEY,
+            booked_on DATE,
+            amount NUMERIC(15,2) NOT NULL,
+            currency TEXT,
+            account TEXT,
+            counterparty_iban TEXT,
+            counterparty_name TEXT,
+            description TEXT,
+            external_id TEXT,
+            tokens TEXT[] NOT NULL
+        ) ON COMMIT DROP
+        """
+    )
+    count = 0
+    skipped = 0
+    with cur.copy(f"COPY tmp_statement_lines ({', '.join(COPY_COLUMNS)}) FROM STDIN") as copy:
+        for line in lines:
+            if line['amount'] is None or line['amount'] <= 0:
+                skipped += 1
+                continue
+            count += 1
+            if count > MAX_LINES:
+                raise StatementError(f"Massimo {MAX_LINES} movimenti per file")
+            line['line_no'] = count
+            copy.write_row([line[column] for column in COPY_COLUMNS])
+    if not count:
+        raise StatementError("Nessun accredito trovato nel file")
+    cur.execute("ANALYZE tmp_statement_lines")
+
+    if source == 'camt053' and account is None:
+        cur.execute("SELECT MIN(account) AS account FROM tmp_statement_lines")
+        account = cur.fetchone()['account']
+    cur.execute(
+        """
+        INSERT INTO bank_statement_imports (source, filename, account, lines, created_by)
+        VALUES (%s, %s, %s, %s, %s)
+        RETURNING id
+        """,
+        (source, filename[:255] or None, account, count, admin_id),
+    )
+    import_id = cur.fetchone()['id']
+    cur.execute(MATCH_SQL, {'import_id': import_id, 'method': 'usdt' if source == 'crypto' else 'bank'})
+    by_status = {row['match_status']: row['lines'] for row in cur.fetchall()}
+    cur.execute(
+        "UPDATE bank_statement_imports SET matched = %s, suggested = %s WHERE id = %s",
+        (by_status.get('matched', 0), by_status.get('suggested', 0), import_id),
+    )
+    cur.execute("DROP TABLE tmp_statement_lines")
+    logger.info(f"Estratto conto #{import_id} ({source}): {count} accrediti, esito {by_status}")
+    return {
+        'import_id': import_id,
+        'source': source,
+        'account': account,
+        'lines': count,
+        'skipped': skipped,
+        'by_status': by_status,
+    }
+
+
+def apply_lines(cur, import_id, admin_id, line_nos=None):
+    """Approva le richieste abbinate: tutte le righe 'matched' o le righe indicate
+    (anche 'suggested', dopo verifica dell'admin); le righe approvate diventano 'applied'"""
+    ensure_statement_schema(cur)
+    cur.execute(
+        """
+        SELECT line_no, deposit_request_id
+        FROM bank_statement_lines
+        WHERE import_id = %(import_id)s AND deposit_request_id IS NOT NULL
+          AND CASE WHEN %(line_nos)s::int[] IS NULL THEN match_status = 'matched'
+                   ELSE line_no = ANY(%(line_nos)s::int[]) AND match_status IN ('matched', 'suggested') END
+        ORDER BY line_no
+        """,
+        {'import_id': import_id, 'line_nos': line_nos},
+    )
+    selected = cur.fetchall()
+    if not selected:
+        return summarize([])
+    results = approve_deposits(cur, [row['deposit_request_id'] for row in selected], admin_id,
+                               f"Estratto conto #{import_id}")
+    approved = [r['id'] for r in results if r['status'] == 'approved']
+    cur.execute(
+        """
+        WITH applied AS (
+            UPDATE bank_statement_lines
+            SET match_status = 'applied', applied_at = NOW()
+            WHERE import_id = %s AND line_no = ANY(%s) AND deposit_request_id = ANY(%s)
+            RETURNING 1
+        )
+        UPDATE bank_statement_imports
+        SET applied = applied + (SELECT COUNT(*) FROM applied)
+        WHERE id = %s
+        """,
+        (import_id, [row['line_no'] for row in selected], approved, import_id),
+    )
+    return summarize(results)
+
+
+def get_import(cur, import_id, status=None):
+    """Import con le righe (filtrabili per esito) e la richiesta abbinata"""
+    ensure_statement_schema(cur)
+    cur.execute("SELECT * FROM bank_statement_imports WHERE id = %s", (import_id,))
+    summary = cur.fetchone()
+    if not summary:
+        return None, []
+    cur.execute(
+        """
+        SELECT l.line_no, l.booked_on, l.amount, l.currency, l.counterparty_iban, l.counterparty_name,
+               l.description, l.external_id, l.match_status, l.deposit_request_id,
+               dr.user_id, dr.amount AS request_amount, dr.unique_key, dr.status AS request_status
+        FROM bank_statement_lines l
+        LEFT JOIN deposit_requests dr ON dr.id = l.deposit_request_id
+        WHERE l.import_id = %s AND (%s::text IS NULL OR l.match_status = %s)
+        ORDER BY l.line_no
+        """,
+        (import_id, status, status),
+    )
+    return summary, cur.fetchall()
@@ -178,12 +178,21 @@ def validate_bank_details(bank_details):
         if not bank_details.get(field):
             raise ValidationError(f"Campo {field} richiesto nei dettagli bancari")
     
-    # Validazione IBAN base
+    # Validazione IBAN: formato e cifre di controllo (mod 97)
     iban = bank_details['iban'].replace(' ', '').upper()
     if len(iban) < 15 or len(iban) > 34:
         raise ValidationError("IBAN non valido")
+    if not re.match(r'^[A-Z]{2}[0-9]{2}[A-Z0-9]+$', iban):
+        raise ValidationError("IBAN non valido")
+    if int(''.join(str(int(c, 36)) for c in iban[4:] + iban[:4])) % 97 != 1:
+        raise ValidationError("IBAN non valido (cifre di controllo errate)")
+    
+    # BIC facoltativo (bonifici SEPA solo IBAN), se presente 8 o 11 caratteri
+    bic = (bank_details.get('bic') or bank_details.get('bic_swift') or '').replace(' ', '').upper()
+    if bic and not re.match(r'^[A-Z]{6}[A-Z0-9]{2}([A-Z0-9]{3})?$', bic):
+        raise ValidationError("BIC non valido")
     
-    return bank_details
+    return {**bank_details, 'iban': iban, 'bic': bic}
 
 def validate_wallet_address(wallet_address, network='BEP20'):
     """Valida indirizzo wallet USDT"""
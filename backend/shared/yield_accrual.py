@@ -0,0 +1,216 @@
+"""
+Maturazione set-based dei rendimenti periodici di un progetto (investment_yields)
+Dato progetto, periodo e tasso annuo, un'unica istruzione registra il rendimento di ogni
+investimento attivo, accredita i profitti e scrive un movimento per investitore.
+Rendimento = importo * tasso / 100 * giorni di detenzione nel periodo / 365.
+Idempotente per (investimento, periodo): gli investimenti con un rendimento già registrato
+su un periodo sovrapposto vengono saltati.
+"""
+
+import hashlib
+import logging
+from datetime import date
+from decimal import Decimal, InvalidOperation
+
+from backend.shared.ledger import ledger_context
+
+logger = logging.getLogger(__name__)
+
+DAYS_PER_YEAR = 365
+MAX_ANNUAL_RATE = 100
+
+# Stati del progetto in cui i rendimenti non maturano più (o non ancora)
+CLOSED_STATUSES = ('draft', 'sold', 'cancelled')
+
+_yield_schema_ready = False
+
+# Rendimenti spettanti: investimenti attivi del progetto senza rendimento sul periodo
+CANDIDATES_SQL = """
+    SELECT investment_id, user_id, principal, days,
+           ROUND(principal * %(annual_rate)s::numeric / 100 * days / %(days_per_year)s, 2) AS amount
+    FROM (
+        SELECT i.id AS investment_id, i.user_id, i.amount AS principal,
+               %(period_end)s::date - GREATEST(%(period_start)s::date, i.created_at::date) + 1 AS days
+        FROM investments i
+        WHERE i.project_id = %(project_id)s AND i.status = 'active' AND i.amount > 0
+          AND i.created_at::date <= %(period_end)s::date
+          AND NOT EXISTS (
+              SELECT 1 FROM investment_yields y
+              WHERE y.investment_id = i.id
+                AND y.period_start <= %(period_end)s::date AND y.period_end >= %(period_start)s::date
+          )
+    ) c
+"""
+
+
+class YieldAccrualError(Exception):
+    """Parametri non validi o progetto senza rendimenti maturabili"""
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def ensure_yield_accrual_schema(cur):
+    """Tasso applicato e indice di idempotenza su investment_yields"""
+    global _yield_schema_ready
+    if not _yield_schema_ready:
+        from backend.shared.database import run_schema_setup
+        _yield_schema_ready = run_schema_setup(cur, _create_yield_accrual_schema)[0]
+
+
+def _create_yield_accrual_schema(cur):
+    cur.execute("ALTER TABLE investment_yields ADD COLUMN IF NOT EXISTS annual_rate NUMERIC(7,4)")
+    cur.execute(
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_investment_yields_period
+        ON investment_yields(investment_id, period_start, period_end)
+        """
+    )
+
+
+def parse_request(data):
+    """Valida periodo e tasso dal body JSON: {period_start, period_end, annual_rate}"""
+    try:
+        period_start = date.fromisoformat(str(data.get('period_start')))
+        period_end = date.fromisoformat(str(data.get('period_end')))
+    except ValueError:
+        raise YieldAccrualError("Periodo non valido (formato AAAA-MM-GG)")
+    if period_end < period_start:
+        raise YieldAccrualError("La fine del periodo precede l'inizio")
+    if period_end >= date.today():
+        raise YieldAccrualError("Il periodo deve essere concluso")
+    try:
+        # Decimal: calcolo in numeric, come la colonna annual_rate NUMERIC(7,4)
+        annual_rate = Decimal(str(data.get('annual_rate'))).quantize(Decimal('0.0001'))
+    except (InvalidOperation, ValueError):
+        raise YieldAccrualError("Tasso annuo non valido")
+    if not annual_rate.is_finite():
+        raise YieldAccrualError("Tasso annuo non valido")
+    if not 0 < annual_rate <= MAX_ANNUAL_RATE:
+        raise YieldAccrualError(f"Il tasso annuo deve essere compreso tra 0 e {MAX_ANNUAL_RATE}")
+    return period_start, period_end, annual_rate
+
+
+def _lock_id(project_id):
+    digest = hashlib.sha1(f"yield_run|{project_id}".encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+
+def _prepare(cur, project_id, period_start, period_end, annual_rate):
+    """Lock del progetto (un run per progetto alla volta) e parametri della query"""
+    ensure_yield_accrual_schema(cur)
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (_lock_id(project_id),))
+    cur.execute("SELECT id, name, status FROM projects WHERE id = %s", (project_id,))
+    project = cur.fetchone()
+    if not project:
+        raise YieldAccrualError("Progetto non trovato", 404)
+    if project['status'] in CLOSED_STATUSES:
+        raise YieldAccrualError(f"Nessun rendimento maturabile per un progetto in stato '{project['status']}'")
+    params = {
+        'project_id': project_id,
+        'period_start': period_start,
+        'period_end': period_end,
+        'annual_rate': annual_rate,
+        'days_per_year': DAYS_PER_YEAR,
+        'description': f"Rendimento {project['name'] or project_id} "
+                       f"{period_start:%d/%m/%Y}-{period_end:%d/%m/%Y}",
+    }
+    return project, params
+
+
+def preview_yields(cur, project_id, period_start, period_end, annual_rate):
+    """Dry-run: rendimenti da registrare e investimenti già coperti sul periodo"""
+    project, params = _prepare(cur, project_id, period_start, period_end, annual_rate)
+    cur.execute(
+        f"""
+        SELECT c.investment_id, c.user_id, u.email, c.principal, c.days, c.amount
+        FROM ({CANDIDATES_SQL}) c
+        JOIN users u ON u.id = c.user_id
+        ORDER BY c.investment_id
+        """,
+        params,
+    )
+    rows = cur.fetchall()
+    cur.execute(
+        """
+        SELECT COUNT(*) AS investments, COALESCE(SUM(y.amount), 0) AS amount
+        FROM investment_yields y
+        JOIN investments i ON i.id = y.investment_id
+        WHERE i.project_id = %s AND y.period_start <= %s AND y.period_end >= %s
+        """,
+        (project_id, period_end, period_start),
+    )
+    existing = cur.fetchone()
+    return {
+        'project_id': project_id,
+        'period_start': period_start.isoformat(),
+        'period_end': period_end.isoformat(),
+        'annual_rate': float(annual_rate),
+        'investments': [
+            {**row, 'principal': float(row['principal']), 'amount': float(row['amount'])}
+            for row in rows
+        ],
+        'investors': len({row['user_id'] for row in rows}),
+        'total_amount': float(sum(row['amount'] for row in rows)),
+        'already_accrued': existing['investments'],
+        'already_accrued_amount': float(existing['amount']),
+    }
+
+
+def accrue_yields(cur, project_id, period_start, period_end, annual_rate):
+    """Registra i rendimenti del periodo e li accredita in profits nella transazione del chiamante"""
+    project, params = _prepare(cur, project_id, period_start, period_end, annual_rate)
+    with ledger_context(cur, 'roi', params['description'], project_id, 'project'):
+        cur.execute(
+            f"""
+            WITH candidates AS ({CANDIDATES_SQL}),
+            inserted AS (
+                INSERT INTO investment_yields (investment_id, period_start, period_end, amount, annual_rate)
+                SELECT investment_id, %(period_start)s, %(period_end)s, amount, %(annual_rate)s
+                FROM candidates
+                WHERE amount > 0
+                ON CONFLICT (investment_id, period_start, period_end) DO NOTHING
+                RETURNING investment_id, amount
+            ),
+            per_user AS (
+                SELECT c.user_id, SUM(ins.amount) AS amount, COUNT(*) AS investments
+                FROM inserted ins
+                JOIN candidates c ON c.investment_id = ins.investment_id
+                GROUP BY c.user_id
+            ),
+            credited AS (
+                INSERT INTO user_portfolios (user_id, free_capital, invested_capital, referral_bonus, profits)
+                SELECT user_id, 0, 0, 0, amount FROM per_user
+                ON CONFLICT (user_id)
+                DO UPDATE SET profits = user_portfolios.profits + EXCLUDED.profits
+                RETURNING user_id, profits
+            ),
+            movements AS (
+                INSERT INTO portfolio_transactions
+                    (user_id, type, amount, balance_before, balance_after, description,
+                     reference_id, reference_type, status)
+                SELECT p.user_id, 'roi', p.amount, c.profits - p.amount, c.profits,
+                       %(description)s, %(project_id)s, 'project', 'completed'
+                FROM per_user p
+                JOIN credited c ON c.user_id = p.user_id
+            )
+            SELECT user_id, amount, investments FROM per_user
+            """,
+            params,
+        )
+        investors = cur.fetchall()
+
+    result = {
+        'project_id': project_id,
+        'period_start': period_start.isoformat(),
+        'period_end': period_end.isoformat(),
+        'annual_rate': float(annual_rate),
+        'investments': sum(row['investments'] for row in investors),
+        'investors': len(investors),
+        'total_amount': float(sum(row['amount'] for row in investors)),
+    }
+    logger.info(
+        f"Rendimenti progetto {project_id} {period_start}..{period_end}: "
+        f"{result['investments']} investimenti, {result['total_amount']:.2f} EUR"
+    )
+    return result
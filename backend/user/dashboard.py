@@ -5,6 +5,7 @@ Compartimento stagno per la dashboard utente
 
 from flask import Blueprint, session, render_template, request, redirect, url_for
 from backend.shared.database import get_connection
+from backend.shared.returns import get_returns, serialize as serialize_returns
 
 # Blueprint isolato per Dashboard
 dashboard_bp = Blueprint("dashboard", __name__)
@@ -76,6 +77,9 @@ def dashboard():
         """, (uid,))
         user_data = cur.fetchone()
         referral_code = user_data['referral_code'] if user_data else None
+
+        # Rendimenti effettivi (XIRR / TWR) - TABELLA: investment_returns
+        returns = get_returns(cur, 'user', user_ids=[uid])
     
     # Calcola valori portfolio
     total_invested = (inv and inv.get('total_invested', 0) or 0) or 0
@@ -85,8 +89,10 @@ def dashboard():
     # Portfolio balance = investimenti + rendimenti + bonus
     portfolio_balance = total_invested + total_yields + referral_bonus_value
     
-    # Portfolio change simulato (in futuro calcolare dai dati storici)
-    portfolio_change = 2.5  # +2.5%
+    # Rendimento annuo effettivo (XIRR) e variazione time-weighted del portafoglio
+    performance = serialize_returns(returns[0]) if returns else {}
+    avg_roi = performance.get('xirr') or 0
+    portfolio_change = performance.get('twr') or 0
     
     # Genera link referral
     base_url = request.url_root.rstrip('/')
@@ -101,6 +107,7 @@ def dashboard():
                          user=user_data,
                          greet_name=greet_name,
                          total_invested=total_invested,
-                         avg_roi=8.5,  # RA medio simulato
+                         avg_roi=avg_roi,
+                         portfolio_change=portfolio_change,
                          current_page="dashboard"
                          )
@@ -5,6 +5,7 @@ Compartimento stagno per nuovi investimenti
 
 from flask import Blueprint, session, render_template, request, redirect, url_for
 from backend.shared.database import get_connection
+from backend.shared.project_funding import FUNDED_SQL, ensure_funding_shards
 
 # Blueprint isolato per New Project
 new_project_bp = Blueprint("new_project", __name__)
@@ -30,8 +31,9 @@ def new_project():
     
     with get_conn() as conn, conn.cursor() as cur:
         # Progetti disponibili - TABELLA: projects
-        cur.execute("""
-            SELECT p.id, p.title, p.description, p.total_amount, p.funded_amount,
+        ensure_funding_shards(cur)
+        cur.execute(f"""
+            SELECT p.id, p.title, p.description, p.total_amount, {FUNDED_SQL} AS funded_amount,
                    p.status, p.created_at, p.code
             FROM projects p 
             WHERE p.status = 'active'
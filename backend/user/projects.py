@@ -4,9 +4,15 @@ Compartimento stagno per i progetti disponibili per investimento
 """
 
 import logging
+from decimal import Decimal
 from flask import Blueprint, session, render_template, request, redirect, url_for, jsonify, flash
 from backend.shared.database import get_connection
 from backend.auth.decorators import can_invest, kyc_verified, login_required
+from backend.shared.idempotency import idempotent
+from backend.shared.balances import SECTIONS as BALANCE_SECTIONS, InsufficientFundsError, debit as debit_balance
+from backend.shared.project_funding import (
+    FUNDED_SQL, FundingError, ensure_funding_shards, get_funding, reserve as reserve_funding,
+)
 
 # Configura logger
 logger = logging.getLogger(__name__)
@@ -30,8 +36,9 @@ def get_project_data(project_id):
     """Ottieni dati aggiornati di un singolo progetto"""
     try:
         with get_conn() as conn, conn.cursor() as cur:
-            cur.execute("""
-                SELECT p.id, p.name as title, p.description, p.total_amount, p.funded_amount,
+            ensure_funding_shards(cur)
+            cur.execute(f"""
+                SELECT p.id, p.name as title, p.description, p.total_amount, {FUNDED_SQL} AS funded_amount,
                        p.status, p.created_at, p.code, p.location, p.min_investment,
                        p.image_url, p.roi, p.sale_price, p.sale_date, p.profit_percentage
                 FROM projects p 
@@ -94,8 +101,9 @@ def projects():
         is_kyc_verified = user and user['kyc_status'] == 'verified'
         
         # 2. PROGETTI ATTIVI (dove si può investire)
-        cur.execute("""
-            SELECT p.id, p.name as title, p.description, p.total_amount, p.funded_amount,
+        ensure_funding_shards(cur)
+        cur.execute(f"""
+            SELECT p.id, p.name as title, p.description, p.total_amount, {FUNDED_SQL} AS funded_amount,
                    p.status, p.created_at, p.code, p.location, p.min_investment,
                    p.image_url, p.roi, p.sale_price, p.sale_date, p.profit_percentage,
                    CASE WHEN user_investments.total_amount IS NOT NULL THEN true ELSE false END as user_invested,
@@ -117,8 +125,9 @@ def projects():
         active_projects = cur.fetchall()
         
         # 2. PROGETTI COMPLETATI (non si può più investire, in attesa vendita)
-        cur.execute("""
-            SELECT p.id, p.name as title, p.description, p.total_amount, p.funded_amount,
+        ensure_funding_shards(cur)
+        cur.execute(f"""
+            SELECT p.id, p.name as title, p.description, p.total_amount, {FUNDED_SQL} AS funded_amount,
                    p.status, p.created_at, p.code, p.location, p.min_investment,
                    p.image_url, p.roi, p.sale_price, p.sale_date, p.profit_percentage,
                    CASE WHEN user_investments.total_amount IS NOT NULL THEN true ELSE false END as user_invested,
@@ -138,8 +147,9 @@ def projects():
         completed_projects = cur.fetchall()
         
         # 3. PROGETTI VENDUTI (con informazioni sui profitti)
-        cur.execute("""
-            SELECT p.id, p.name as title, p.description, p.total_amount, p.funded_amount,
+        ensure_funding_shards(cur)
+        cur.execute(f"""
+            SELECT p.id, p.name as title, p.description, p.total_amount, {FUNDED_SQL} AS funded_amount,
                    p.status, p.created_at, p.code, p.location, p.min_investment,
                    p.image_url, p.roi, p.sale_price, p.sold_at as sale_date, p.profit_percentage,
                    CASE WHEN user_investments.total_amount IS NOT NULL THEN true ELSE false END as user_invested,
@@ -240,6 +250,7 @@ def projects():
 
 @projects_bp.post("/projects/invest")
 @can_invest
+@idempotent
 def invest_in_project():
     """
     Gestisce l'investimento in un progetto
@@ -262,10 +273,11 @@ def invest_in_project():
         
         with get_conn() as conn, conn.cursor() as cur:
             # 1. Verifica che il progetto esista e sia attivo
-            cur.execute("""
-                SELECT id, title, total_amount, funded_amount, min_investment
-                FROM projects 
-                WHERE id = %s AND status = 'active'
+            ensure_funding_shards(cur)
+            cur.execute(f"""
+                SELECT p.id, p.title, p.total_amount, {FUNDED_SQL} AS funded_amount, p.min_investment
+                FROM projects p
+                WHERE p.id = %s AND p.status = 'active'
             """, (project_id,))
             project = cur.fetchone()
             
@@ -277,41 +289,20 @@ def invest_in_project():
                 return jsonify({"error": f"Importo minimo €{project['min_investment']}"}), 400
             
             # 3. Verifica che il progetto non sia già completamente finanziato
+            # (controllo rapido: quello esatto avviene nell'incremento della raccolta)
             if project['funded_amount'] >= project['total_amount']:
                 return jsonify({"error": "Progetto già completamente finanziato"}), 400
             
-            # 4. Verifica che l'utente abbia fondi sufficienti
-            cur.execute("""
-                SELECT free_capital, profits, referral_bonus
-                FROM user_portfolios 
-                WHERE user_id = %s
-            """, (uid,))
-            portfolio = cur.fetchone()
-            
-            if not portfolio:
-                return jsonify({"error": "Portfolio utente non trovato"}), 404
-            
-            # Controlla fondi disponibili in base alla fonte
-            available_funds = 0
-            if fund_source == 'free_capital':
-                available_funds = portfolio['free_capital']
-            elif fund_source == 'profits':
-                available_funds = portfolio['profits']
-            elif fund_source == 'referral_bonus':
-                available_funds = portfolio['referral_bonus']
-            else:
+            if fund_source not in BALANCE_SECTIONS:
                 return jsonify({"error": "Fonte fondi non valida"}), 400
             
-            if available_funds < amount:
-                return jsonify({"error": f"Fondi insufficienti. Disponibili: €{available_funds:.2f}"}), 400
-            
-            # 5. Verifica che l'investimento non superi il limite del progetto
+            # 4. Verifica che l'investimento non superi il limite del progetto
             remaining_capacity = project['total_amount'] - project['funded_amount']
             if amount > remaining_capacity:
                 return jsonify({"error": f"Importo troppo alto. Capacità rimanente: €{remaining_capacity:.2f}"}), 400
             
-            # 6. Esegui l'investimento
-            # 6a. Crea il record di investimento
+            # 5. Esegui l'investimento
+            # 5a. Crea il record di investimento
             cur.execute("""
                 INSERT INTO investments (user_id, project_id, amount, status)
                 VALUES (%s, %s, %s, 'active')
@@ -320,46 +311,25 @@ def invest_in_project():
             
             investment_id = cur.fetchone()['id']
             
-            # 6b. Aggiorna il portfolio dell'utente
-            if fund_source == 'free_capital':
-                cur.execute("""
-                    UPDATE user_portfolios 
-                    SET free_capital = free_capital - %s,
-                        invested_capital = invested_capital + %s,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = %s
-                """, (amount, amount, uid))
-            elif fund_source == 'profits':
-                cur.execute("""
-                    UPDATE user_portfolios 
-                    SET profits = profits - %s,
-                        invested_capital = invested_capital + %s,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = %s
-                """, (amount, amount, uid))
-            elif fund_source == 'referral_bonus':
-                cur.execute("""
-                    UPDATE user_portfolios 
-                    SET referral_bonus = referral_bonus - %s,
-                        invested_capital = invested_capital + %s,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = %s
-                """, (amount, amount, uid))
+            # 5b. Addebito condizionale sulla fonte scelta e spostamento in invested_capital
+            # (un'unica istruzione: il saldo non può andare sotto zero tra controllo e scrittura)
+            try:
+                debit_balance(cur, uid, fund_source, Decimal(str(amount)), 'investment',
+                              f"Investimento progetto {project_id}", investment_id, 'investment',
+                              to_invested=True)
+            except InsufficientFundsError:
+                conn.rollback()
+                return jsonify({"error": "Fondi insufficienti nella fonte selezionata"}), 400
             
-            # 6c. Aggiorna il progetto
-            cur.execute("""
-                UPDATE projects 
-                SET funded_amount = funded_amount + %s
-                WHERE id = %s
-            """, (amount, project_id))
+            # 5c. Aggiorna la raccolta del progetto (contatore partizionato, controllo esatto sul totale)
+            try:
+                reserve_funding(cur, project_id, amount)
+            except FundingError as e:
+                conn.rollback()
+                return jsonify({"error": str(e)}), 400
             
-            # 6d. Ottieni le informazioni aggiornate del progetto per la barra di progresso
-            cur.execute("""
-                SELECT total_amount, funded_amount, status
-                FROM projects 
-                WHERE id = %s
-            """, (project_id,))
-            updated_project = cur.fetchone()
+            # 5d. Ottieni le informazioni aggiornate del progetto per la barra di progresso
+            updated_project = get_funding(cur, project_id)
             
             # Calcola la percentuale di completamento aggiornata
             if updated_project['total_amount'] and updated_project['total_amount'] > 0:
@@ -412,10 +382,11 @@ def get_user_funds(project_id):
                 return jsonify({"error": "Portfolio utente non trovato"}), 404
             
             # Ottieni i dettagli del progetto
-            cur.execute("""
-                SELECT id, title, total_amount, funded_amount, min_investment
-                FROM projects 
-                WHERE id = %s AND status = 'active'
+            ensure_funding_shards(cur)
+            cur.execute(f"""
+                SELECT p.id, p.title, p.total_amount, {FUNDED_SQL} AS funded_amount, p.min_investment
+                FROM projects p
+                WHERE p.id = %s AND p.status = 'active'
             """, (project_id,))
             project = cur.fetchone()
             
@@ -450,8 +421,9 @@ def project_detail(project_id):
     
     with get_conn() as conn, conn.cursor() as cur:
         # Ottieni dettagli progetto
-        cur.execute("""
-            SELECT p.id, p.name as title, p.description, p.total_amount, p.funded_amount,
+        ensure_funding_shards(cur)
+        cur.execute(f"""
+            SELECT p.id, p.name as title, p.description, p.total_amount, {FUNDED_SQL} AS funded_amount,
                    p.status, p.created_at, p.code, p.location, p.min_investment,
                    p.image_url, p.roi, p.sale_price, p.sold_at as sale_date, p.profit_percentage,
                    p.gallery, p.project_details
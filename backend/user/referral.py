@@ -5,6 +5,8 @@ Compartimento stagno per il sistema di referral e bonus
 
 from flask import Blueprint, session, render_template, request, redirect, url_for
 from backend.shared.database import get_connection
+from backend.shared.referral_stats import get_user_referral_stats
+from backend.shared.identifiers import allocate as allocate_identifier
 
 # Blueprint isolato per Referral
 referral_bp = Blueprint("referral", __name__)
@@ -38,20 +40,13 @@ def referral():
         
         # Genera codice referral se non esiste
         if not user_data.get('referral_code'):
-            referral_code = 'REF' + str(uid).zfill(6)
+            referral_code = allocate_identifier(cur, 'referral_code')
             cur.execute("UPDATE users SET referral_code = %s WHERE id = %s", (referral_code, uid))
             user_data['referral_code'] = referral_code
             conn.commit()
         
-        # Statistiche referral - TABELLA: users
-        # Esclude l'utente stesso per evitare auto-referral
-        cur.execute("""
-            SELECT COUNT(*) as total_referrals,
-                   COUNT(CASE WHEN u.kyc_status = 'verified' THEN 1 END) as verified_referrals,
-                   COUNT(CASE WHEN u.kyc_status != 'verified' THEN 1 END) as pending_referrals
-            FROM users u WHERE u.referred_by = %s AND u.id != %s
-        """, (uid, uid))
-        stats = cur.fetchone()
+        # Statistiche referral precalcolate - TABELLA: user_referral_stats
+        referral_stats = get_user_referral_stats(cur, uid)
         
         # Lista referral - TABELLE: users + investments
         # Esclude l'utente stesso per evitare auto-referral
@@ -65,19 +60,19 @@ def referral():
             ORDER BY u.created_at DESC
         """, (uid, uid))
         referrals = cur.fetchall()
-        
-        # Bonus totali - TABELLA: referral_bonuses
-        cur.execute("""
-            SELECT COALESCE(SUM(amount), 0) as total_bonus 
-            FROM referral_bonuses 
-            WHERE receiver_user_id = %s
-        """, (uid,))
-        bonus = cur.fetchone()
+        conn.commit()
+    
+    verified_referrals = sum(1 for r in referrals if r['kyc_status'] == 'verified')
+    stats = {
+        'total_referrals': referral_stats['invited_count'],
+        'verified_referrals': verified_referrals,
+        'pending_referrals': len(referrals) - verified_referrals
+    }
     
     return render_template("user/referral.html", 
                          user_id=uid,
                          user=user_data,
                          stats=stats,
                          referrals=referrals,
-                         total_bonus=bonus['total_bonus'] if bonus else 0,
+                         total_bonus=referral_stats['bonus_earned'],
                          current_page="referral")
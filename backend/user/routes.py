@@ -1,4 +1,5 @@
 import os
+from decimal import Decimal
 from flask import Blueprint, request, session, redirect, url_for, jsonify, render_template, flash, abort
 from backend.shared.database import get_connection
 
@@ -10,6 +11,12 @@ def get_conn():
 
 # Importa decoratori di autorizzazione
 from backend.auth.decorators import login_required, kyc_verified, can_invest
+from backend.shared.referral_stats import get_user_referral_stats
+from backend.shared.balances import SECTIONS as BALANCE_SECTIONS, InsufficientFundsError, debit as debit_balance
+from backend.shared.idempotency import idempotent
+from backend.shared.identifiers import allocate as allocate_identifier
+from backend.shared.ledger import set_context as set_ledger_context
+from backend.shared.project_funding import FUNDED_SQL, FundingError, ensure_funding_shards, reserve as reserve_funding
 
 # =====================================================
 # CONFIGURAZIONI SISTEMA - Dati per depositi
@@ -247,8 +254,9 @@ def new_project():
                 })
             
             # 5. PROGETTI DISPONIBILI
-            cur.execute("""
-                SELECT p.id, p.title, p.description, p.total_amount, p.funded_amount,
+            ensure_funding_shards(cur)
+            cur.execute(f"""
+                SELECT p.id, p.title, p.description, p.total_amount, {FUNDED_SQL} AS funded_amount,
                        p.status, p.created_at, p.code, p.location, p.min_investment
                 FROM projects p 
                 WHERE p.status = 'active'
@@ -302,6 +310,7 @@ def new_project():
 
 @user_bp.post("/invest/<int:project_id>")
 @can_invest
+@idempotent
 def invest(project_id):
     """Gestisce nuovo investimento - Task 2.5 implementazione completa"""
     uid = session.get("user_id")
@@ -330,36 +339,13 @@ def invest(project_id):
     with get_conn() as conn, conn.cursor() as cur:
         # 1. VERIFICA KYC - Già gestito dal decorator @can_invest
         
-        # 2. CONTROLLO BUDGET - Verifica disponibilità saldo
-        cur.execute("""
-            SELECT free_capital, invested_capital, referral_bonus, profits
-            FROM user_portfolios 
-            WHERE user_id = %s
-        """, (uid,))
-        portfolio = cur.fetchone()
-        
-        if not portfolio:
-            flash("Portfolio non trovato", "error")
-            return redirect(url_for('user.new_project'))
-        
-        # 3. SELEZIONE FONTE - Verifica sezione portafoglio scelta
-        available_amount = 0
-        if source_section == 'free_capital':
-            available_amount = portfolio['free_capital']
-        elif source_section == 'referral_bonus':
-            available_amount = portfolio['referral_bonus']
-        elif source_section == 'profits':
-            available_amount = portfolio['profits']
-        else:
+        # 2. SELEZIONE FONTE - Verifica sezione portafoglio scelta
+        # (la disponibilità viene verificata in modo atomico al momento dell'addebito)
+        if source_section not in BALANCE_SECTIONS:
             flash("Sezione portafoglio non valida", "error")
             return redirect(url_for('user.new_project'))
         
-        # 4. CALCOLO DISPONIBILITÀ - Verifica fondi sufficienti
-        if available_amount < amount:
-            flash(f"Fondi insufficienti. Disponibile: €{available_amount:.2f}", "error")
-            return redirect(url_for('user.new_project'))
-        
-        # 5. VERIFICA PROGETTO
+        # 3. VERIFICA PROGETTO
         cur.execute("""
             SELECT id, name, min_investment, total_amount, funded_amount, status
             FROM projects 
@@ -371,12 +357,12 @@ def invest(project_id):
             flash("Progetto non trovato o non disponibile", "error")
             return redirect(url_for('user.new_project'))
         
-        # 6. VALIDAZIONE IMPORTO MINIMO
+        # 4. VALIDAZIONE IMPORTO MINIMO
         if amount < project['min_investment']:
             flash(f"Importo minimo richiesto: €{project['min_investment']:.2f}", "error")
             return redirect(url_for('user.new_project'))
         
-        # 7. WIZARD INVESTIMENTO - Crea investimento
+        # 5. WIZARD INVESTIMENTO - Crea investimento
         try:
             # Inizia transazione
             conn.autocommit = False
@@ -389,49 +375,14 @@ def invest(project_id):
             """, (uid, project_id, amount))
             investment_id = cur.fetchone()['id']
             
-            # Aggiorna portfolio - sottrai dalla sezione scelta
-            if source_section == 'free_capital':
-                new_free_capital = portfolio['free_capital'] - amount
-                cur.execute("""
-                    UPDATE user_portfolios 
-                    SET free_capital = %s, updated_at = NOW()
-                    WHERE user_id = %s
-                """, (new_free_capital, uid))
-            elif source_section == 'referral_bonus':
-                new_referral_bonus = portfolio['referral_bonus'] - amount
-                cur.execute("""
-                    UPDATE user_portfolios 
-                    SET referral_bonus = %s, updated_at = NOW()
-                    WHERE user_id = %s
-                """, (new_referral_bonus, uid))
-            elif source_section == 'profits':
-                new_profits = portfolio['profits'] - amount
-                cur.execute("""
-                    UPDATE user_portfolios 
-                    SET profits = %s, updated_at = NOW()
-                    WHERE user_id = %s
-                """, (new_profits, uid))
-            
-            # Aggiungi a capitale investito
-            cur.execute("""
-                UPDATE user_portfolios 
-                SET invested_capital = invested_capital + %s, updated_at = NOW()
-                WHERE user_id = %s
-            """, (amount, uid))
-            
-            # Aggiorna progetto
-            cur.execute("""
-                UPDATE projects 
-                SET funded_amount = funded_amount + %s
-                WHERE id = %s
-            """, (amount, project_id))
+            # Addebito condizionale sulla sezione scelta e spostamento in invested_capital,
+            # con movimento di portafoglio nella stessa istruzione
+            debit_balance(cur, uid, source_section, amount, 'investment',
+                          f"Investimento in {project['name']}", investment_id, 'investment',
+                          to_invested=True)
             
-            # Registra transazione
-            cur.execute("""
-                INSERT INTO portfolio_transactions 
-                (user_id, type, amount, description, status, reference_type, reference_id)
-                VALUES (%s, 'investment', %s, %s, 'completed', 'investment', %s)
-            """, (uid, amount, f"Investimento in {project['name']}", investment_id))
+            # Raccolta del progetto su contatore partizionato (solo se attivo e non oltre il totale)
+            reserve_funding(cur, project_id, amount)
             
             # Commit transazione
             conn.commit()
@@ -440,6 +391,16 @@ def invest(project_id):
             flash(f"Investimento di €{amount:.2f} in {project['name']} completato con successo!", "success")
             return redirect(url_for('user.portfolio'))
             
+        except InsufficientFundsError:
+            conn.rollback()
+            conn.autocommit = True
+            flash("Fondi insufficienti nella sezione selezionata", "error")
+            return redirect(url_for('user.new_project'))
+        except FundingError as e:
+            conn.rollback()
+            conn.autocommit = True
+            flash(str(e), "error")
+            return redirect(url_for('user.new_project'))
         except Exception as e:
             conn.rollback()
             conn.autocommit = True
@@ -583,7 +544,7 @@ def transfer_capital():
         data = request.get_json()
         from_source = data.get('from_source')
         to_source = data.get('to_source')
-        amount = float(data.get('amount', 0))
+        amount = Decimal(str(data.get('amount', 0)))
         
         # Validazione
         if not from_source or not to_source:
@@ -608,30 +569,20 @@ def transfer_capital():
             return jsonify({"error": "Solo profitti e bonus possono essere spostati a capitale libero"}), 400
         
         with get_conn() as conn, conn.cursor() as cur:
-            # Verifica fondi disponibili
-            cur.execute("""
-                SELECT free_capital, invested_capital, referral_bonus, profits
-                FROM user_portfolios 
-                WHERE user_id = %s
-            """, (uid,))
-            portfolio = cur.fetchone()
-            
-            if not portfolio:
-                return jsonify({"error": "Portafoglio non trovato"}), 404
-            
-            # Controlla fondi sufficienti
-            available_funds = portfolio[from_source]
-            if amount > available_funds:
-                return jsonify({"error": f"Fondi insufficienti. Disponibili: €{available_funds:.2f}"}), 400
-            
-            # Esegui il trasferimento
+            # Trasferimento condizionale: controllo del saldo e scrittura nella stessa istruzione
+            set_ledger_context(cur, 'transfer', f"Trasferimento da {from_source} a {to_source}")
             cur.execute(f"""
                 UPDATE user_portfolios 
                 SET {from_source} = {from_source} - %s,
                     {to_source} = {to_source} + %s,
                     updated_at = CURRENT_TIMESTAMP
-                WHERE user_id = %s
-            """, (amount, amount, uid))
+                WHERE user_id = %s AND {from_source} >= %s
+                RETURNING {from_source} AS remaining
+            """, (amount, amount, uid, amount))
+            
+            if not cur.fetchone():
+                conn.rollback()
+                return jsonify({"error": "Fondi insufficienti"}), 400
             
             conn.commit()
             
@@ -737,14 +688,8 @@ def referral():
     # Versione semplificata per compatibilità
     try:
         with get_conn() as conn, conn.cursor() as cur:
-            # Statistiche referral - Esclude auto-referral
-            cur.execute("""
-                SELECT COUNT(*) as total_referrals,
-                       COUNT(CASE WHEN u.kyc_status = 'verified' THEN 1 END) as verified_referrals,
-                       COUNT(CASE WHEN u.kyc_status != 'verified' THEN 1 END) as pending_referrals
-                FROM users u WHERE u.referred_by = %s AND u.id != %s
-            """, (uid, uid))
-            stats = cur.fetchone()
+            # Statistiche referral precalcolate (user_referral_stats)
+            referral_stats = get_user_referral_stats(cur, uid)
             
             # Lista referral - Esclude auto-referral
             cur.execute("""
@@ -757,6 +702,15 @@ def referral():
                 ORDER BY u.created_at DESC
             """, (uid, uid))
             referrals = cur.fetchall()
+            conn.commit()
+            
+            # Verificati/in attesa dalla lista già caricata
+            verified_referrals = sum(1 for r in referrals if r['kyc_status'] == 'verified')
+            stats = {
+                "total_referrals": referral_stats['invited_count'],
+                "verified_referrals": verified_referrals,
+                "pending_referrals": len(referrals) - verified_referrals
+            }
             
             # Bonus totali dal portfolio
             cur.execute("""
@@ -992,7 +946,10 @@ def get_referral_data():
         
         with get_conn() as conn, conn.cursor() as cur:
             
-            # Trova tutti gli utenti invitati da questo utente
+            # Totali precalcolati (user_referral_stats)
+            referral_stats = get_user_referral_stats(cur, user_id)
+            
+            # Trova tutti gli utenti invitati con i loro investimenti attivi in un'unica query
             # Esclude l'utente stesso per evitare auto-referral
             cur.execute("""
                 SELECT 
@@ -1007,36 +964,28 @@ def get_referral_data():
                         THEN 'active'
                         WHEN u.kyc_status = 'verified' THEN 'pending'
                         ELSE 'inactive'
-                    END as status
+                    END as status,
+                    COALESCE(inv.investments, '[]'::json) as investments
                 FROM users u
                 LEFT JOIN user_portfolios up ON up.user_id = u.id
+                LEFT JOIN LATERAL (
+                    SELECT json_agg(json_build_object('amount', i.amount, 'project_name', p.title)
+                                    ORDER BY i.created_at DESC) as investments
+                    FROM investments i
+                    LEFT JOIN projects p ON p.id = i.project_id
+                    WHERE i.user_id = u.id AND i.status = 'active'
+                ) inv ON true
                 WHERE u.referred_by = %s AND u.id != %s
                 ORDER BY u.created_at DESC
             """, (user_id, user_id))
             invited_users = cur.fetchall()
-            
-            # Ottieni investimenti per ogni utente invitato
-            for user in invited_users:
-                cur.execute("""
-                    SELECT i.amount, p.title as project_name
-                    FROM investments i
-                    LEFT JOIN projects p ON p.id = i.project_id
-                    WHERE i.user_id = %s AND i.status = 'active'
-                    ORDER BY i.created_at DESC
-                """, (user['id'],))
-                user['investments'] = cur.fetchall()
-            
-            # Calcola totali
-            total_invited = len(invited_users)
-            total_invested = sum(user['total_invested'] or 0 for user in invited_users)
-            total_profits = sum(user['total_profits'] or 0 for user in invited_users)
-            bonus_earned = sum(user['bonus_generated'] or 0 for user in invited_users)
+            conn.commit()
             
             return jsonify({
-                'total_invited': total_invited,
-                'total_invested': float(total_invested),
-                'total_profits': float(total_profits),
-                'bonus_earned': float(bonus_earned),
+                'total_invited': referral_stats['invited_count'],
+                'total_invested': float(referral_stats['invitees_invested']),
+                'total_profits': float(referral_stats['invitees_profits']),
+                'bonus_earned': float(referral_stats['invitees_bonus']),
                 'invited_users': invited_users
             })
             
@@ -1123,20 +1072,6 @@ def api_kyc_status():
             "is_admin": user["role"] == "admin"
         })
 
-def generate_referral_code():
-    """Genera un codice referral casuale alfanumerico"""
-    import random
-    import string
-    
-    # Caratteri disponibili: lettere maiuscole, minuscole e numeri (esclusi 0, O, I, l per evitare confusione)
-    chars = string.ascii_uppercase.replace('O', '').replace('I', '') + \
-            string.ascii_lowercase.replace('o', '').replace('i', '').replace('l', '') + \
-            string.digits.replace('0', '')
-    
-    # Genera codice di 8 caratteri
-    code = ''.join(random.choice(chars) for _ in range(8))
-    return f"REF{code}"
-
 def ensure_referral_code(user_id):
     """Assicura che l'utente abbia un codice referral unico"""
     with get_conn() as conn, conn.cursor() as cur:
@@ -1147,25 +1082,18 @@ def ensure_referral_code(user_id):
         if user_data and user_data['referral_code']:
             return user_data['referral_code']
         
-        # Genera nuovo codice unico
-        max_attempts = 10
-        for attempt in range(max_attempts):
-            new_code = generate_referral_code()
-            
-            # Verifica che il codice sia unico
-            cur.execute("SELECT id FROM users WHERE referral_code = %s", (new_code,))
-            if not cur.fetchone():
-                # Codice unico trovato, aggiorna il database
-                cur.execute("UPDATE users SET referral_code = %s WHERE id = %s", (new_code, user_id))
-                conn.commit()
-                return new_code
-        
-        # Se non riesce a generare un codice unico, usa un fallback
-        import random
-        fallback_code = f"REF{user_id:06d}{random.randint(1000, 9999)}"
-        cur.execute("UPDATE users SET referral_code = %s WHERE id = %s", (fallback_code, user_id))
+        # Nuovo codice dal servizio identificatori: univoco senza verifiche né retry
+        new_code = allocate_identifier(cur, 'referral_code')
+        cur.execute(
+            "UPDATE users SET referral_code = %s WHERE id = %s AND COALESCE(referral_code, '') = '' RETURNING referral_code",
+            (new_code, user_id),
+        )
+        if not cur.fetchone():
+            # Assegnato nel frattempo da un'altra richiesta
+            cur.execute("SELECT referral_code FROM users WHERE id = %s", (user_id,))
+            new_code = cur.fetchone()['referral_code']
         conn.commit()
-        return fallback_code
+        return new_code
 
 
 
@@ -3,24 +3,26 @@ Routes per gestione prelievi
 """
 
 import json
-import secrets
-import string
 from datetime import datetime
 from decimal import Decimal
-from flask import Blueprint, request, jsonify, session, render_template
+from flask import Blueprint, Response, request, jsonify, session, render_template, url_for
 from backend.shared.database import get_connection as get_conn
 from backend.auth.decorators import login_required, admin_required, can_withdraw
 from backend.shared.validators import ValidationError
+from backend.shared.search import owner_search_condition, WITHDRAWAL_SEARCH_COLUMNS
+from backend.shared.balances import InsufficientFundsError, debit as debit_balance
+from backend.shared.request_batches import (
+    BatchError, parse_ids as parse_batch_ids, approve_withdrawals, reject_withdrawals, summarize as summarize_batch
+)
+from backend.shared.idempotency import idempotent
+from backend.shared.identifiers import allocate as allocate_identifier
+from backend.shared import sepa_payouts
 import logging
 
 logger = logging.getLogger(__name__)
 
 withdrawals_bp = Blueprint('withdrawals', __name__, url_prefix='/withdrawals')
 
-def generate_unique_key():
-    """Genera una chiave unica di 6 caratteri alfanumerici"""
-    return ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(6))
-
 def ensure_withdrawals_schema():
     """Assicura che lo schema dei prelievi sia aggiornato"""
     try:
@@ -54,12 +56,15 @@ def ensure_withdrawals_schema():
                 cur.execute("ALTER TABLE withdrawal_requests ADD COLUMN network TEXT DEFAULT 'BEP20'")
                 logger.info("Aggiunta colonna 'network' a withdrawal_requests")
             
-            # Aggiorna i record esistenti se necessario
+            # Aggiorna i record esistenti se necessario (chiave derivata dall'id: univoca e
+            # disgiunta dal formato del servizio identificatori)
             cur.execute("""
                 UPDATE withdrawal_requests 
-                SET method = 'bank', unique_key = %s, source_section = 'free_capital'
+                SET method = COALESCE(method, 'bank'),
+                    unique_key = COALESCE(unique_key, 'WR-' || id),
+                    source_section = COALESCE(source_section, 'free_capital')
                 WHERE method IS NULL OR unique_key IS NULL OR source_section IS NULL
-            """, (generate_unique_key(),))
+            """)
             
             conn.commit()
             logger.info("Schema withdrawal_requests aggiornato con successo")
@@ -127,6 +132,7 @@ def get_withdrawal_rate_limit_status():
 
 @withdrawals_bp.route('/api/requests/new', methods=['POST'])
 @can_withdraw
+@idempotent
 def create_withdrawal_request():
     """Crea una nuova richiesta di prelievo"""
     uid = session.get("user_id")
@@ -191,47 +197,36 @@ def create_withdrawal_request():
                         'message': f'Puoi fare una nuova richiesta di prelievo tra {minutes}m {seconds}s',
                         'remaining_seconds': remaining_seconds
                     }), 429
-            # Verifica disponibilità saldo
-            cur.execute("""
-                SELECT free_capital, referral_bonus, profits
-                FROM user_portfolios 
-                WHERE user_id = %s
-            """, (uid,))
-            portfolio = cur.fetchone()
-            
-            if not portfolio:
-                return jsonify({'error': 'Portfolio non trovato'}), 404
-            
-            # Controlla saldo disponibile per la sezione
-            available_amount = 0
-            if source_section == 'free_capital':
-                available_amount = portfolio['free_capital']
-            elif source_section == 'referral_bonus':
-                available_amount = portfolio['referral_bonus']
-            elif source_section == 'profits':
-                available_amount = portfolio['profits']
-            
-            if available_amount < amount:
-                return jsonify({'error': f'Saldo insufficiente nella sezione {source_section}. Disponibile: €{available_amount}'}), 400
-            
-            # Genera chiave unica
-            unique_key = generate_unique_key()
-            
-            # Crea richiesta
-            if method == 'usdt':
-                cur.execute("""
-                    INSERT INTO withdrawal_requests 
-                    (user_id, amount, method, source_section, wallet_address, network, unique_key, status)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, 'pending')
-                    RETURNING id, created_at
-                """, (uid, amount, method, source_section, wallet_address, network, unique_key))
-            else:  # bank
-                cur.execute("""
-                    INSERT INTO withdrawal_requests 
-                    (user_id, amount, method, source_section, bank_details, unique_key, status)
-                    VALUES (%s, %s, %s, %s, %s, %s, 'pending')
-                    RETURNING id, created_at
-                """, (uid, amount, method, source_section, json.dumps(bank_details), unique_key))
+            # Crea richiesta in un'unica istruzione condizionale: inserita solo se il saldo
+            # della sezione copre l'importo più i prelievi già in attesa dalla stessa sezione
+            unique_key = allocate_identifier(cur, 'withdrawal_key')
+            cur.execute(f"""
+                INSERT INTO withdrawal_requests 
+                (user_id, amount, method, source_section, wallet_address, network, bank_details, unique_key, status)
+                SELECT %(uid)s, %(amount)s, %(method)s, %(section)s, %(wallet)s, %(network)s, %(bank)s, %(key)s, 'pending'
+                FROM user_portfolios up
+                WHERE up.user_id = %(uid)s
+                  AND up.{source_section} - (
+                      SELECT COALESCE(SUM(amount), 0) FROM withdrawal_requests
+                      WHERE user_id = %(uid)s AND status = 'pending' AND source_section = %(section)s
+                  ) >= %(amount)s
+                RETURNING id, created_at
+            """, {
+                'uid': uid,
+                'amount': amount,
+                'method': method,
+                'section': source_section,
+                'wallet': wallet_address if method == 'usdt' else None,
+                'network': network if method == 'usdt' else 'BEP20',
+                'bank': json.dumps(bank_details) if method == 'bank' else None,
+                'key': unique_key
+            })
+            if cur.rowcount == 0:
+                cur.execute(f"SELECT {source_section} AS available FROM user_portfolios WHERE user_id = %s", (uid,))
+                portfolio = cur.fetchone()
+                if not portfolio:
+                    return jsonify({'error': 'Portfolio non trovato'}), 404
+                return jsonify({'error': f'Saldo insufficiente nella sezione {source_section} considerando i prelievi in attesa. Saldo sezione: €{portfolio["available"]}'}), 400
             
             new_request = cur.fetchone()
             conn.commit()
@@ -416,63 +411,32 @@ def admin_get_withdrawal_details(withdrawal_id):
 
 @withdrawals_bp.route('/api/admin/approve/<int:request_id>', methods=['POST'])
 @admin_required
+@idempotent
 def admin_approve_withdrawal(request_id):
     """Admin: Approva una richiesta di prelievo"""
     try:
         admin_user_id = session.get('user_id')
         
         with get_conn() as conn, conn.cursor() as cur:
-            # Verifica richiesta esiste e è pending
+            # Passaggio di stato condizionale: solo una approvazione può avere effetto
             cur.execute("""
-                SELECT wr.*, u.email FROM withdrawal_requests wr
-                JOIN users u ON u.id = wr.user_id  
-                WHERE wr.id = %s AND wr.status = 'pending'
-            """, (request_id,))
+                UPDATE withdrawal_requests 
+                SET status = 'approved', approved_at = NOW(), approved_by = %s, updated_at = NOW()
+                WHERE id = %s AND status = 'pending'
+                RETURNING user_id, amount, COALESCE(source_section, 'free_capital') AS source_section
+            """, (admin_user_id, request_id))
             withdrawal = cur.fetchone()
             
             if not withdrawal:
                 return jsonify({'error': 'Richiesta non trovata o già processata'}), 404
             
-            # Aggiorna stato prelievo
-            cur.execute("""
-                UPDATE withdrawal_requests 
-                SET status = 'approved', updated_at = NOW()
-                WHERE id = %s
-            """, (request_id,))
-            
-            # Rimuovi importo dal portfolio utente
-            source_section = withdrawal['source_section']
-            amount = withdrawal['amount']
-            
-            if source_section == 'free_capital':
-                cur.execute("""
-                    UPDATE user_portfolios 
-                    SET free_capital = free_capital - %s, updated_at = NOW()
-                    WHERE user_id = %s
-                """, (amount, withdrawal['user_id']))
-            elif source_section == 'referral_bonus':
-                cur.execute("""
-                    UPDATE user_portfolios 
-                    SET referral_bonus = referral_bonus - %s, updated_at = NOW()
-                    WHERE user_id = %s
-                """, (amount, withdrawal['user_id']))
-            elif source_section == 'profits':
-                cur.execute("""
-                    UPDATE user_portfolios 
-                    SET profits = profits - %s, updated_at = NOW()
-                    WHERE user_id = %s
-                """, (amount, withdrawal['user_id']))
-            
-            # Registra transazione (importo negativo per prelievo)
-            cur.execute("""
-                INSERT INTO portfolio_transactions (
-                    user_id, type, amount, balance_before, balance_after,
-                    description, reference_id, reference_type, status, created_at
-                ) VALUES (
-                    %s, 'withdrawal', -%s, 0, 0, 
-                    'Prelievo approvato da admin', %s, 'withdrawal_request', 'completed', NOW()
-                )
-            """, (withdrawal['user_id'], amount, request_id))
+            # Addebito condizionale sulla sezione e movimento nella stessa istruzione
+            try:
+                debit_balance(cur, withdrawal['user_id'], withdrawal['source_section'], withdrawal['amount'],
+                              'withdrawal', 'Prelievo approvato da admin', request_id, 'withdrawal_request')
+            except InsufficientFundsError:
+                conn.rollback()
+                return jsonify({'error': 'Saldo utente insufficiente per approvare il prelievo'}), 400
             
             conn.commit()
             
@@ -490,6 +454,7 @@ def admin_approve_withdrawal(request_id):
 
 @withdrawals_bp.route('/api/admin/reject/<int:request_id>', methods=['POST'])
 @admin_required
+@idempotent
 def admin_reject_withdrawal(request_id):
     """Admin: Rifiuta una richiesta di prelievo"""
     try:
@@ -498,23 +463,17 @@ def admin_reject_withdrawal(request_id):
         admin_user_id = session.get('user_id')
         
         with get_conn() as conn, conn.cursor() as cur:
-            # Verifica richiesta esiste e è pending
-            cur.execute("""
-                SELECT * FROM withdrawal_requests 
-                WHERE id = %s AND status = 'pending'
-            """, (request_id,))
-            withdrawal = cur.fetchone()
-            
-            if not withdrawal:
-                return jsonify({'error': 'Richiesta non trovata o già processata'}), 404
-            
-            # Aggiorna stato prelievo
+            # Passaggio di stato condizionale (solo richieste in attesa)
             cur.execute("""
                 UPDATE withdrawal_requests 
                 SET status = 'cancelled', admin_notes = %s, approved_at = NOW(), approved_by = %s
-                WHERE id = %s
+                WHERE id = %s AND status = 'pending'
+                RETURNING id
             """, (admin_notes, admin_user_id, request_id))
             
+            if not cur.fetchone():
+                return jsonify({'error': 'Richiesta non trovata o già processata'}), 404
+            
             conn.commit()
             
             logger.info(f"Prelievo {request_id} rifiutato da admin {admin_user_id}: {admin_notes}")
@@ -529,6 +488,149 @@ def admin_reject_withdrawal(request_id):
         logger.exception(f"Errore nel rifiuto prelievo {request_id}: {e}")
         return jsonify({'error': 'Errore interno del server'}), 500
 
+@withdrawals_bp.route('/api/admin/bulk-approve', methods=['POST'])
+@admin_required
+@idempotent
+def admin_bulk_approve_withdrawals():
+    """Admin: Approva più richieste di prelievo in un'unica transazione"""
+    try:
+        data = request.get_json() or {}
+        ids = parse_batch_ids(data.get('request_ids'))
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            results = approve_withdrawals(cur, ids, session.get('user_id'))
+            conn.commit()
+        return jsonify({'success': True, **summarize_batch(results)})
+    except Exception as e:
+        logger.exception(f"Errore nell'approvazione massiva prelievi: {e}")
+        return jsonify({'error': 'Errore interno del server'}), 500
+
+@withdrawals_bp.route('/api/admin/bulk-reject', methods=['POST'])
+@admin_required
+@idempotent
+def admin_bulk_reject_withdrawals():
+    """Admin: Rifiuta più richieste di prelievo in un'unica transazione"""
+    try:
+        data = request.get_json() or {}
+        ids = parse_batch_ids(data.get('request_ids'))
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            results = reject_withdrawals(cur, ids, session.get('user_id'),
+                                         data.get('admin_notes', 'Rifiutato da admin'))
+            conn.commit()
+        return jsonify({'success': True, **summarize_batch(results)})
+    except Exception as e:
+        logger.exception(f"Errore nel rifiuto massivo prelievi: {e}")
+        return jsonify({'error': 'Errore interno del server'}), 500
+
+def _payout_file_response(batch, skipped=0):
+    """File pain.001 della distinta in streaming come allegato (solo distinte esportate)"""
+    if batch['status'] != 'exported':
+        # Distinta annullata: i suoi prelievi possono essere in un'altra distinta, il file non va reinviato
+        return jsonify({'error': f"Distinta {batch['status']}: file non più scaricabile"}), 410
+    return Response(
+        sepa_payouts.stream_batch(batch),
+        mimetype='application/xml',
+        headers={
+            'Content-Disposition': f'attachment; filename={sepa_payouts.filename(batch)}',
+            'X-Payout-Batch-Id': str(batch['id']),
+            'X-Payout-Skipped': str(skipped),
+            # Replay idempotente della creazione: redirect al file della distinta
+            'Content-Location': url_for('withdrawals.admin_download_payout_batch', batch_id=batch['id']),
+        }
+    )
+
+@withdrawals_bp.route('/api/admin/payouts/pending', methods=['GET'])
+@admin_required
+def admin_get_pending_payouts():
+    """Admin: Prelievi bancari approvati pronti per la distinta SEPA"""
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            pending = sepa_payouts.pending_withdrawals(cur)
+            conn.commit()
+        return jsonify(pending)
+    except Exception as e:
+        logger.exception(f"Errore nel riepilogo prelievi da pagare: {e}")
+        return jsonify({'error': 'Errore interno del server'}), 500
+
+@withdrawals_bp.route('/api/admin/payouts', methods=['POST'])
+@admin_required
+@idempotent
+def admin_create_payout_batch():
+    """Admin: Crea la distinta SEPA dei prelievi bancari approvati e scarica il file XML"""
+    data = request.get_json(silent=True) or {}
+    try:
+        execution_date = data.get('execution_date')
+        execution_date = datetime.strptime(execution_date, '%Y-%m-%d').date() if execution_date else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Data di esecuzione non valida (formato AAAA-MM-GG)'}), 400
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            created = sepa_payouts.create_batch(cur, session.get('user_id'), execution_date)
+            conn.commit()
+            batch = sepa_payouts.get_batch(cur, created['batch_id'])
+        if created['invalid']:
+            logger.warning(f"Distinta {created['message_id']}: prelievi esclusi {created['invalid']}")
+        return _payout_file_response(batch, len(created['invalid']))
+    except sepa_payouts.PayoutError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    except Exception as e:
+        logger.exception(f"Errore nella creazione distinta SEPA: {e}")
+        return jsonify({'error': 'Errore interno del server'}), 500
+
+@withdrawals_bp.route('/api/admin/payouts', methods=['GET'])
+@admin_required
+def admin_list_payout_batches():
+    """Admin: Ultime distinte SEPA generate"""
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            batches = sepa_payouts.list_batches(cur)
+            conn.commit()
+        return jsonify({'batches': [
+            {**batch, 'control_sum': float(batch['control_sum']),
+             'file_url': url_for('withdrawals.admin_download_payout_batch', batch_id=batch['id'])
+                         if batch['downloadable'] else None}
+            for batch in batches
+        ]})
+    except Exception as e:
+        logger.exception(f"Errore nel caricamento distinte SEPA: {e}")
+        return jsonify({'error': 'Errore interno del server'}), 500
+
+@withdrawals_bp.route('/api/admin/payouts/<int:batch_id>/file', methods=['GET'])
+@admin_required
+def admin_download_payout_batch(batch_id):
+    """Admin: Scarica di nuovo il file XML di una distinta"""
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            batch = sepa_payouts.get_batch(cur, batch_id)
+            conn.commit()
+        if not batch:
+            return jsonify({'error': 'Distinta non trovata'}), 404
+        return _payout_file_response(batch)
+    except Exception as e:
+        logger.exception(f"Errore nel download distinta {batch_id}: {e}")
+        return jsonify({'error': 'Errore interno del server'}), 500
+
+@withdrawals_bp.route('/api/admin/payouts/<int:batch_id>/cancel', methods=['POST'])
+@admin_required
+@idempotent
+def admin_cancel_payout_batch(batch_id):
+    """Admin: Annulla una distinta non inviata, i prelievi tornano esportabili"""
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            result = sepa_payouts.cancel_batch(cur, batch_id, session.get('user_id'))
+            conn.commit()
+        return jsonify({'success': True, **result})
+    except sepa_payouts.PayoutError as e:
+        return jsonify({'error': str(e)}), e.status_code
+    except Exception as e:
+        logger.exception(f"Errore nell'annullamento distinta {batch_id}: {e}")
+        return jsonify({'error': 'Errore interno del server'}), 500
+
 @withdrawals_bp.route('/api/admin/metrics', methods=['GET'])
 @admin_required
 def admin_get_withdrawals_metrics():
@@ -591,8 +693,10 @@ def admin_get_withdrawals_history():
                 params.append(status_filter)
             
             if search_query:
-                where_conditions.append("(u.nome ILIKE %s OR u.email ILIKE %s)")
-                params.extend([f'%{search_query}%', f'%{search_query}%'])
+                # Nome, email, chiave, IBAN e wallet su indici trigram
+                search_sql, search_params = owner_search_condition(WITHDRAWAL_SEARCH_COLUMNS, 'wr.user_id', search_query)
+                where_conditions.append(search_sql)
+                params.extend(search_params)
             
             where_clause = "WHERE " + " AND ".join(where_conditions) if where_conditions else ""
             
@@ -0,0 +1,35 @@
+-- ============================================
+-- RICERCA ADMIN SU INDICI TRIGRAM (pg_trgm)
+-- ============================================
+-- Gli indici GIN gin_trgm_ops servono sia ILIKE '%...%' sia l'operatore di similarità %
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- ============================================
+-- UTENTI
+-- ============================================
+CREATE INDEX IF NOT EXISTS idx_users_nome_trgm ON users USING GIN (nome gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_cognome_trgm ON users USING GIN (cognome gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_email_trgm ON users USING GIN (email gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_telefono_trgm ON users USING GIN (telefono gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_nome_telegram_trgm ON users USING GIN (nome_telegram gin_trgm_ops);
+
+-- ============================================
+-- DEPOSITI
+-- ============================================
+CREATE INDEX IF NOT EXISTS idx_deposit_requests_payment_reference_trgm ON deposit_requests USING GIN (payment_reference gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_deposit_requests_iban_trgm ON deposit_requests USING GIN (iban gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_deposit_requests_unique_key_trgm ON deposit_requests USING GIN (unique_key gin_trgm_ops);
+
+-- ============================================
+-- PRELIEVI
+-- ============================================
+CREATE INDEX IF NOT EXISTS idx_withdrawal_requests_unique_key_trgm ON withdrawal_requests USING GIN (unique_key gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_withdrawal_requests_iban_trgm ON withdrawal_requests USING GIN ((bank_details->>'iban') gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_withdrawal_requests_wallet_trgm ON withdrawal_requests USING GIN (wallet_address gin_trgm_ops);
+
+-- ============================================
+-- STORICO AZIONI ADMIN
+-- ============================================
+CREATE INDEX IF NOT EXISTS idx_admin_actions_details_trgm ON admin_actions USING GIN (details gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_admin_actions_action_trgm ON admin_actions USING GIN (action gin_trgm_ops);
@@ -0,0 +1,25 @@
+-- ============================================
+-- INDICI LISTA UTENTI ADMIN
+-- ============================================
+-- Paginazione keyset su (created_at, id) e filtri SQL della lista utenti
+
+-- Seek su (created_at, id) in entrambe le direzioni
+CREATE INDEX IF NOT EXISTS idx_users_created_at_id ON users(created_at DESC, id DESC);
+
+-- Filtri ruolo e stato KYC combinati con l'ordinamento keyset
+CREATE INDEX IF NOT EXISTS idx_users_role_created_at_id ON users(role, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_users_kyc_created_at_id ON users(kyc_status, created_at DESC, id DESC);
+
+-- Semi-join "ha investimenti" e statistiche per utente
+CREATE INDEX IF NOT EXISTS idx_investments_user_active ON investments(user_id)
+    INCLUDE (amount)
+    WHERE status IN ('active', 'completed');
+
+-- Filtro per range di saldo complessivo
+CREATE INDEX IF NOT EXISTS idx_user_portfolios_total_balance ON user_portfolios(
+    (free_capital + invested_capital + referral_bonus + profits)
+);
+
+ANALYZE users;
+ANALYZE investments;
+ANALYZE user_portfolios;
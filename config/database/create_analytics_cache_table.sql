@@ -0,0 +1,13 @@
+-- ============================================
+-- CACHE RISULTATI ANALYTICS
+-- ============================================
+-- Payload analytics condivisi tra i worker (stale-while-revalidate)
+-- Il ricalcolo è serializzato per chiave tramite pg_advisory_lock
+
+CREATE TABLE IF NOT EXISTS analytics_cache (
+    cache_key TEXT PRIMARY KEY,
+    payload JSONB NOT NULL,
+    computed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_analytics_cache_computed_at ON analytics_cache(computed_at);
@@ -0,0 +1,40 @@
+-- ============================================
+-- IMPORT ESTRATTI CONTO E ABBINAMENTO DEPOSITI
+-- ============================================
+-- backend/shared/statement_import.py: CSV banca, CAMT.053 ed export wallet vengono caricati
+-- in una tabella temporanea e abbinati alle deposit_requests in attesa per causale
+-- (unique_key), importo e conto di accredito. Esiti per riga:
+--   matched, suggested (solo importo, candidato unico), applied, amount_mismatch,
+--   account_mismatch, already_processed, duplicate, ambiguous, unmatched
+
+CREATE TABLE IF NOT EXISTS bank_statement_imports (
+    id SERIAL PRIMARY KEY,
+    source TEXT NOT NULL CHECK (source IN ('csv', 'camt053', 'crypto')),
+    filename TEXT,
+    account TEXT,
+    lines INT NOT NULL DEFAULT 0,
+    matched INT NOT NULL DEFAULT 0,
+    suggested INT NOT NULL DEFAULT 0,
+    applied INT NOT NULL DEFAULT 0,
+    created_by INT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS bank_statement_lines (
+    import_id INT NOT NULL REFERENCES bank_statement_imports(id) ON DELETE CASCADE,
+    line_no INT NOT NULL,
+    booked_on DATE,
+    amount NUMERIC(15,2) NOT NULL,
+    currency TEXT,
+    account TEXT,
+    counterparty_iban TEXT,
+    counterparty_name TEXT,
+    description TEXT,
+    external_id TEXT,
+    deposit_request_id INT,
+    match_status TEXT NOT NULL,
+    applied_at TIMESTAMPTZ,
+    PRIMARY KEY (import_id, line_no)
+);
+
+CREATE INDEX IF NOT EXISTS idx_bank_statement_lines_request ON bank_statement_lines(deposit_request_id);
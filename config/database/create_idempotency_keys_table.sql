@@ -0,0 +1,27 @@
+-- ============================================
+-- CHIAVI DI IDEMPOTENZA
+-- ============================================
+-- Una riga per (utente, endpoint, Idempotency-Key) sugli endpoint che muovono denaro:
+-- depositi, prelievi, investimenti e approvazioni admin.
+-- La prima richiesta salva stato e risposta (corpo, hash, header); i replay con la stessa
+-- chiave restituiscono la risposta salvata, con un corpo diverso ricevono 422.
+-- Le risposte 5xx non vengono salvate: la chiave resta libera per un nuovo tentativo.
+-- Dopo 24 ore la chiave può essere riutilizzata.
+
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    id BIGSERIAL PRIMARY KEY,
+    user_id INT NOT NULL,
+    endpoint TEXT NOT NULL,
+    idempotency_key TEXT NOT NULL,
+    request_hash TEXT NOT NULL,
+    status TEXT NOT NULL CHECK (status IN ('processing', 'completed', 'failed')),
+    response_status INT,
+    response_body BYTEA,
+    response_headers JSONB,
+    response_hash TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    completed_at TIMESTAMPTZ,
+    UNIQUE (user_id, endpoint, idempotency_key)
+);
+
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at);
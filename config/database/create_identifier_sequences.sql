@@ -0,0 +1,18 @@
+-- ============================================
+-- SERVIZIO IDENTIFICATORI
+-- ============================================
+-- Una sequence per namespace: il codice è nextval permutato con una rete di Feistel
+-- (chiave in identifier_keys, generata al primo uso) e codificato in base32 Crockford,
+-- es. 7K3M-Q9TX, REF-WW70-PZ5F. Biiettivo: nessuna verifica di unicità né retry.
+-- La chiave di un namespace non va mai cambiata: i codici già emessi resterebbero
+-- validi ma i nuovi potrebbero collidere con essi.
+
+CREATE TABLE IF NOT EXISTS identifier_keys (
+    namespace TEXT PRIMARY KEY,
+    secret BYTEA NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE SEQUENCE IF NOT EXISTS identifier_seq_deposit_key;
+CREATE SEQUENCE IF NOT EXISTS identifier_seq_withdrawal_key;
+CREATE SEQUENCE IF NOT EXISTS identifier_seq_referral_code;
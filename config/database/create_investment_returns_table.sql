@@ -0,0 +1,28 @@
+-- ============================================
+-- CACHE RENDIMENTI EFFETTIVI (XIRR / TWR)
+-- ============================================
+-- Calcolati da backend/shared/returns.py sui flussi di cassa degli investimenti
+-- (investimento, rendimenti periodici, vendita o rimborso) per ambito:
+--   user     -> user_id, project_id = 0 (tutto il portafoglio)
+--   project  -> project_id, user_id = 0 (tutti gli investitori)
+--   position -> user_id + project_id
+-- Una riga è ricalcolata quando cambia la firma dei flussi (flows_count, last_flow_at,
+-- net_cash) o, con capitale ancora investito, il giorno successivo al calcolo.
+
+CREATE TABLE IF NOT EXISTS investment_returns (
+    scope TEXT NOT NULL CHECK (scope IN ('user', 'project', 'position')),
+    user_id INT NOT NULL DEFAULT 0,
+    project_id INT NOT NULL DEFAULT 0,
+    xirr NUMERIC(14,6),
+    twr NUMERIC(14,6),
+    invested NUMERIC(15,2) NOT NULL DEFAULT 0,
+    returned NUMERIC(15,2) NOT NULL DEFAULT 0,
+    open_capital NUMERIC(15,2) NOT NULL DEFAULT 0,
+    flows_count INT NOT NULL DEFAULT 0,
+    last_flow_at TIMESTAMPTZ,
+    net_cash NUMERIC(15,2) NOT NULL DEFAULT 0,
+    computed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (scope, user_id, project_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_investment_returns_project ON investment_returns(scope, project_id);
@@ -0,0 +1,35 @@
+-- Distinte SEPA (pain.001.001.03) dei prelievi bancari approvati
+CREATE TABLE IF NOT EXISTS payout_batches (
+    id SERIAL PRIMARY KEY,
+    message_id TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL DEFAULT 'exported' CHECK (status IN ('exported', 'cancelled')),
+    execution_date DATE NOT NULL,
+    debtor_name TEXT NOT NULL,
+    debtor_iban TEXT NOT NULL,
+    debtor_bic TEXT,
+    transactions INT NOT NULL,
+    control_sum NUMERIC(15,2) NOT NULL,
+    created_by INT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    cancelled_by INT,
+    cancelled_at TIMESTAMPTZ
+);
+
+-- Dati di pagamento copiati al momento della distinta (il file si riscarica identico)
+CREATE TABLE IF NOT EXISTS payout_batch_items (
+    batch_id INT NOT NULL REFERENCES payout_batches(id) ON DELETE CASCADE,
+    withdrawal_id INT NOT NULL,
+    end_to_end_id TEXT NOT NULL,
+    amount NUMERIC(15,2) NOT NULL,
+    creditor_name TEXT NOT NULL,
+    creditor_iban TEXT NOT NULL,
+    creditor_bic TEXT,
+    remittance TEXT NOT NULL,
+    PRIMARY KEY (batch_id, withdrawal_id)
+);
+
+-- Prelievo incluso in una distinta attiva (NULL = da pagare)
+ALTER TABLE withdrawal_requests ADD COLUMN IF NOT EXISTS payout_batch_id INT;
+
+CREATE INDEX IF NOT EXISTS idx_withdrawal_requests_payout_pending
+ON withdrawal_requests(id) WHERE status = 'approved' AND method = 'bank' AND payout_batch_id IS NULL;
@@ -0,0 +1,106 @@
+-- ============================================
+-- LEDGER APPEND-ONLY DEI PORTAFOGLI
+-- ============================================
+-- Una riga per movimento e per sezione (free_capital, invested_capital, referral_bonus,
+-- profits) con importo con segno e saldo dopo il movimento. Le righe sono scritte dal
+-- trigger su user_portfolios nella stessa transazione dell'aggiornamento del saldo.
+-- Tipo, descrizione e riferimento arrivano dall'impostazione di transazione
+-- cip.ledger_context (JSON), impostata dall'applicazione (backend/shared/ledger.py).
+-- user_portfolios è una cache: può essere ricostruita sommando il ledger.
+
+CREATE TABLE IF NOT EXISTS portfolio_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    section TEXT NOT NULL CHECK (section IN ('free_capital', 'invested_capital', 'referral_bonus', 'profits')),
+    amount NUMERIC(15,2) NOT NULL,
+    balance_after NUMERIC(15,2) NOT NULL,
+    tx_type TEXT NOT NULL,
+    description TEXT,
+    reference_id INT,
+    reference_type TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+);
+
+-- Storico per utente e saldo a una data per sezione: una lookup indicizzata
+CREATE INDEX IF NOT EXISTS idx_portfolio_ledger_user_time ON portfolio_ledger(user_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_portfolio_ledger_user_section_time ON portfolio_ledger(user_id, section, created_at, id);
+
+-- ============================================
+-- CATTURA DEI MOVIMENTI
+-- ============================================
+
+CREATE OR REPLACE FUNCTION portfolio_ledger_capture() RETURNS trigger AS $$
+DECLARE
+    ctx JSONB;
+    o_free NUMERIC := 0;
+    o_invested NUMERIC := 0;
+    o_bonus NUMERIC := 0;
+    o_profits NUMERIC := 0;
+BEGIN
+    IF current_setting('cip.ledger_rebuild', true) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' THEN
+        o_free := OLD.free_capital;
+        o_invested := OLD.invested_capital;
+        o_bonus := OLD.referral_bonus;
+        o_profits := OLD.profits;
+    END IF;
+    ctx := NULLIF(current_setting('cip.ledger_context', true), '')::JSONB;
+    INSERT INTO portfolio_ledger
+        (user_id, section, amount, balance_after, tx_type, description, reference_id, reference_type)
+    SELECT NEW.user_id, s.section, s.new_value - s.old_value, s.new_value,
+           COALESCE(ctx->>'tx_type', 'adjustment'), ctx->>'description',
+           (ctx->>'reference_id')::INT, ctx->>'reference_type'
+    FROM (VALUES
+        ('free_capital', COALESCE(o_free, 0), COALESCE(NEW.free_capital, 0)),
+        ('invested_capital', COALESCE(o_invested, 0), COALESCE(NEW.invested_capital, 0)),
+        ('referral_bonus', COALESCE(o_bonus, 0), COALESCE(NEW.referral_bonus, 0)),
+        ('profits', COALESCE(o_profits, 0), COALESCE(NEW.profits, 0))
+    ) AS s(section, old_value, new_value)
+    WHERE s.new_value <> s.old_value;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Append-only: consentita solo la cancellazione a cascata dalla cancellazione dell'utente
+CREATE OR REPLACE FUNCTION portfolio_ledger_guard() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' AND pg_trigger_depth() > 1 THEN
+        RETURN OLD;
+    END IF;
+    RAISE EXCEPTION 'portfolio_ledger è append-only';
+END;
+$$ LANGUAGE plpgsql;
+
+-- ============================================
+-- SALDI INIZIALI E TRIGGER
+-- ============================================
+
+BEGIN;
+LOCK TABLE user_portfolios IN SHARE ROW EXCLUSIVE MODE;
+
+INSERT INTO portfolio_ledger (user_id, section, amount, balance_after, tx_type, description)
+SELECT up.user_id, s.section, s.value, s.value, 'opening', 'Saldo iniziale'
+FROM user_portfolios up
+CROSS JOIN LATERAL (VALUES
+    ('free_capital', up.free_capital),
+    ('invested_capital', up.invested_capital),
+    ('referral_bonus', up.referral_bonus),
+    ('profits', up.profits)
+) AS s(section, value)
+WHERE COALESCE(s.value, 0) <> 0
+  AND NOT EXISTS (
+      SELECT 1 FROM portfolio_ledger l WHERE l.user_id = up.user_id AND l.section = s.section
+  );
+
+DROP TRIGGER IF EXISTS trg_portfolio_ledger_guard ON portfolio_ledger;
+CREATE TRIGGER trg_portfolio_ledger_guard
+BEFORE UPDATE OR DELETE ON portfolio_ledger
+FOR EACH ROW EXECUTE FUNCTION portfolio_ledger_guard();
+
+DROP TRIGGER IF EXISTS trg_portfolio_ledger ON user_portfolios;
+CREATE TRIGGER trg_portfolio_ledger
+AFTER INSERT OR UPDATE OF free_capital, invested_capital, referral_bonus, profits ON user_portfolios
+FOR EACH ROW EXECUTE FUNCTION portfolio_ledger_capture();
+COMMIT;
@@ -0,0 +1,41 @@
+-- ============================================
+-- SNAPSHOT GIORNALIERI DEI PORTAFOGLI
+-- ============================================
+-- Una riga per utente e per giorno: saldi delle 4 sezioni a fine giornata e capitale
+-- investito per progetto ({"project_id": importo}). Calcolati ogni notte dal ledger
+-- (backend/shared/portfolio_snapshots.py, timer cip-portfolio-snapshots); rieseguire un
+-- giorno lo sostituisce. Gli utenti senza saldi né investimenti non hanno riga.
+
+CREATE TABLE IF NOT EXISTS portfolio_snapshots (
+    user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    snapshot_date DATE NOT NULL,
+    free_capital NUMERIC(15,2) NOT NULL DEFAULT 0,
+    invested_capital NUMERIC(15,2) NOT NULL DEFAULT 0,
+    referral_bonus NUMERIC(15,2) NOT NULL DEFAULT 0,
+    profits NUMERIC(15,2) NOT NULL DEFAULT 0,
+    invested_by_project JSONB NOT NULL DEFAULT '{}'::jsonb,
+    PRIMARY KEY (user_id, snapshot_date)
+);
+
+CREATE INDEX IF NOT EXISTS idx_portfolio_snapshots_date ON portfolio_snapshots(snapshot_date);
+
+-- ============================================
+-- SNAPSHOT GIORNALIERI DELLA PIATTAFORMA
+-- ============================================
+
+CREATE TABLE IF NOT EXISTS platform_snapshots (
+    snapshot_date DATE PRIMARY KEY,
+    free_capital NUMERIC(15,2) NOT NULL DEFAULT 0,
+    invested_capital NUMERIC(15,2) NOT NULL DEFAULT 0,
+    referral_bonus NUMERIC(15,2) NOT NULL DEFAULT 0,
+    profits NUMERIC(15,2) NOT NULL DEFAULT 0,
+    users_count INT NOT NULL DEFAULT 0,
+    investors_count INT NOT NULL DEFAULT 0,
+    deposits NUMERIC(15,2) NOT NULL DEFAULT 0,
+    withdrawals NUMERIC(15,2) NOT NULL DEFAULT 0,
+    invested_by_project JSONB NOT NULL DEFAULT '{}'::jsonb,
+    computed_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+-- Movimenti di un giorno per tutti gli utenti (calcolo incrementale)
+CREATE INDEX IF NOT EXISTS idx_portfolio_ledger_created_at ON portfolio_ledger(created_at);
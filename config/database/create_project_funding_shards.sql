@@ -0,0 +1,18 @@
+-- ============================================
+-- RACCOLTA PROGETTI SU CONTATORI PARTIZIONATI
+-- ============================================
+-- Ogni investimento incrementa una delle 16 righe shard del progetto invece di
+-- projects.funded_amount, evitando la coda sul lock della riga progetto.
+-- Totale raccolto = projects.funded_amount + SUM(project_funding_shards.amount).
+-- La somma delle capacity degli shard non supera total_amount - funded_amount:
+-- uno shard pieno fa passare l'investimento dal percorso lento (lock del progetto,
+-- consolidamento degli shard nella base e nuova distribuzione della capacità).
+-- capacity NULL = progetto senza importo totale (nessun limite).
+
+CREATE TABLE IF NOT EXISTS project_funding_shards (
+    project_id INT NOT NULL REFERENCES projects(id) ON DELETE CASCADE,
+    shard SMALLINT NOT NULL,
+    amount NUMERIC(14,2) NOT NULL DEFAULT 0 CHECK (amount >= 0),
+    capacity NUMERIC(14,2),
+    PRIMARY KEY (project_id, shard)
+);
@@ -0,0 +1,37 @@
+-- ============================================
+-- RICONCILIAZIONE SALDI
+-- ============================================
+-- Ogni notte (backend/shared/reconciliation.py, timer cip-portfolio-snapshots) i saldi di
+-- user_portfolios sono confrontati con quelli attesi da depositi, prelievi, investimenti,
+-- rendimenti, bonus referral e chiusure dei progetti. Le tabelle sono create anche a runtime.
+
+CREATE TABLE IF NOT EXISTS reconciliation_runs (
+    id SERIAL PRIMARY KEY,
+    mode TEXT NOT NULL CHECK (mode IN ('full', 'incremental')),
+    status TEXT NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'completed', 'failed')),
+    since TIMESTAMPTZ,
+    users_checked INT NOT NULL DEFAULT 0,
+    discrepancies INT NOT NULL DEFAULT 0,
+    resolved INT NOT NULL DEFAULT 0,
+    total_difference NUMERIC(15,2) NOT NULL DEFAULT 0,
+    created_by INT,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    completed_at TIMESTAMPTZ
+);
+
+-- Differenze aperte: una riga per utente e sezione, rimossa quando un run la trova risolta
+CREATE TABLE IF NOT EXISTS reconciliation_discrepancies (
+    user_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    section TEXT NOT NULL,
+    expected NUMERIC(15,2) NOT NULL,
+    actual NUMERIC(15,2) NOT NULL,
+    difference NUMERIC(15,2) NOT NULL,
+    first_run_id INT NOT NULL,
+    last_run_id INT NOT NULL,
+    first_seen_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    last_seen_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (user_id, section)
+);
+
+CREATE INDEX IF NOT EXISTS idx_reconciliation_discrepancies_difference
+    ON reconciliation_discrepancies (ABS(difference) DESC);
@@ -0,0 +1,37 @@
+-- ============================================
+-- BONUS REFERRAL: MATURAZIONE MENSILE SET-BASED
+-- ============================================
+-- I bonus sul profitto degli investimenti venduti sono registrati in referral_bonuses
+-- alla liquidazione (backend/shared/settlement.py), con referrer e aliquota di quel momento,
+-- e pagati dal run mensile (backend/shared/referral_accrual.py), che matura anche
+-- gli investimenti completati senza bonus registrati:
+--   referrer: 3% (5% se VIP) del profitto lordo
+--   piattaforma (utente 2): 2% se l'investitore non ha referrer o il referrer non è VIP
+-- Richiede investments.profit_earned / completed_at (add_investment_profit_columns.sql).
+
+ALTER TABLE referral_bonuses ADD COLUMN IF NOT EXISTS bonus_type TEXT NOT NULL DEFAULT 'referral';
+-- Aliquota applicata (registrata alla vendita per i bonus trattenuti in liquidazione)
+ALTER TABLE referral_bonuses ADD COLUMN IF NOT EXISTS rate NUMERIC(6,4);
+CREATE INDEX IF NOT EXISTS idx_referral_bonuses_investment ON referral_bonuses(investment_id);
+
+-- Idempotenza: un bonus per (mese, investimento, destinatario, tipo)
+CREATE UNIQUE INDEX IF NOT EXISTS uq_referral_bonuses_period_investment
+ON referral_bonuses(month_ref, investment_id, receiver_user_id, bonus_type);
+
+-- ============================================
+-- STORICO DEI RUN
+-- ============================================
+CREATE TABLE IF NOT EXISTS referral_runs (
+    id SERIAL PRIMARY KEY,
+    month_ref DATE NOT NULL,
+    pay BOOLEAN NOT NULL DEFAULT TRUE,
+    status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued','running','completed','failed')),
+    accrued_count INT,
+    accrued_amount NUMERIC(15,2),
+    paid_count INT,
+    paid_amount NUMERIC(15,2),
+    error TEXT,
+    created_by INT REFERENCES users(id) ON DELETE SET NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    completed_at TIMESTAMPTZ
+);
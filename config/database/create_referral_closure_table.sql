@@ -0,0 +1,33 @@
+-- ============================================
+-- ALBERO REFERRAL MATERIALIZZATO (CLOSURE TABLE)
+-- ============================================
+-- Una riga per ogni coppia (antenato, discendente) della rete referral,
+-- inclusa la riga riflessiva (utente, utente, 0).
+-- Mantenuta nella stessa transazione di users.referred_by da registrazione,
+-- spostamento e cancellazione utente.
+
+CREATE TABLE IF NOT EXISTS referral_closure (
+    ancestor_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    descendant_id INT NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    depth INT NOT NULL CHECK (depth >= 0),
+    PRIMARY KEY (ancestor_id, descendant_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_referral_closure_descendant ON referral_closure(descendant_id, depth);
+CREATE INDEX IF NOT EXISTS idx_referral_closure_ancestor_depth ON referral_closure(ancestor_id, depth);
+
+-- ============================================
+-- BACKFILL DA users.referred_by
+-- ============================================
+INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+WITH RECURSIVE tree AS (
+    SELECT id AS ancestor_id, id AS descendant_id, 0 AS depth FROM users
+    UNION ALL
+    SELECT t.ancestor_id, u.id, t.depth + 1
+    FROM tree t
+    JOIN users u ON u.referred_by = t.descendant_id
+    WHERE t.depth < 100
+)
+SELECT ancestor_id, descendant_id, MIN(depth) FROM tree
+GROUP BY ancestor_id, descendant_id
+ON CONFLICT (ancestor_id, descendant_id) DO NOTHING;
@@ -0,0 +1,21 @@
+-- ============================================
+-- JOB EXPORT REPORT
+-- ============================================
+-- Export analytics pesanti generati in background con file scaricabile
+
+CREATE TABLE IF NOT EXISTS report_jobs (
+    id SERIAL PRIMARY KEY,
+    report_type TEXT NOT NULL,
+    format TEXT NOT NULL CHECK (format IN ('excel','pdf')),
+    params JSONB NOT NULL DEFAULT '{}'::jsonb,
+    status TEXT NOT NULL DEFAULT 'queued' CHECK (status IN ('queued','running','completed','failed')),
+    file_path TEXT,
+    row_count INT,
+    error TEXT,
+    created_by INT REFERENCES users(id) ON DELETE SET NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    completed_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_report_jobs_status ON report_jobs(status);
+CREATE INDEX IF NOT EXISTS idx_report_jobs_created_by ON report_jobs(created_by, created_at DESC);
@@ -0,0 +1,14 @@
+-- Log delle richieste di deposito/prelievo annullate per scadenza (backend/shared/request_expiry.py)
+CREATE TABLE IF NOT EXISTS request_expirations (
+    id BIGSERIAL PRIMARY KEY,
+    request_type TEXT NOT NULL CHECK (request_type IN ('deposit', 'withdrawal')),
+    request_id INT NOT NULL,
+    user_id INT NOT NULL,
+    amount NUMERIC(15,2) NOT NULL,
+    requested_at TIMESTAMPTZ NOT NULL,
+    ttl_days INT NOT NULL,
+    expired_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_request_expirations_request ON request_expirations(request_type, request_id);
+CREATE INDEX IF NOT EXISTS idx_request_expirations_user ON request_expirations(user_id, expired_at DESC);
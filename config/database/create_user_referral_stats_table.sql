@@ -0,0 +1,113 @@
+-- ============================================
+-- STATISTICHE REFERRAL PRECALCOLATE
+-- ============================================
+-- Una riga per utente con i totali della sua rete referral.
+-- Aggiornata nella stessa transazione degli eventi che la modificano:
+-- i volumi degli invitati dal trigger su user_portfolios (ogni scrittura sul portafoglio),
+-- la rete da registrazione, spostamento referrer e cancellazione utente, i bonus dal run mensile.
+-- Richiede referral_closure (create_referral_closure_table.sql).
+
+CREATE TABLE IF NOT EXISTS user_referral_stats (
+    user_id INT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    invited_count INT NOT NULL DEFAULT 0,
+    network_size INT NOT NULL DEFAULT 0,
+    invitees_invested NUMERIC(15,2) NOT NULL DEFAULT 0,
+    invitees_profits NUMERIC(15,2) NOT NULL DEFAULT 0,
+    invitees_bonus NUMERIC(15,2) NOT NULL DEFAULT 0,
+    bonus_earned NUMERIC(15,2) NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+BEGIN;
+-- Nessuna scrittura sui portafogli tra backfill e trigger
+LOCK TABLE user_portfolios IN SHARE ROW EXCLUSIVE MODE;
+
+-- ============================================
+-- BACKFILL
+-- ============================================
+INSERT INTO user_referral_stats (
+    user_id, invited_count, network_size,
+    invitees_invested, invitees_profits, invitees_bonus, bonus_earned, updated_at
+)
+SELECT
+    u.id,
+    COALESCE(inv.invited_count, 0),
+    COALESCE(net.network_size, 0),
+    COALESCE(inv.invitees_invested, 0),
+    COALESCE(inv.invitees_profits, 0),
+    COALESCE(inv.invitees_bonus, 0),
+    COALESCE(b.bonus_earned, 0),
+    NOW()
+FROM users u
+LEFT JOIN (
+    SELECT i.referred_by AS user_id,
+           COUNT(*) AS invited_count,
+           COALESCE(SUM(ip.invested_capital), 0) AS invitees_invested,
+           COALESCE(SUM(ip.profits), 0) AS invitees_profits,
+           COALESCE(SUM(ip.referral_bonus), 0) AS invitees_bonus
+    FROM users i
+    LEFT JOIN user_portfolios ip ON ip.user_id = i.id
+    WHERE i.referred_by IS NOT NULL AND i.id != i.referred_by
+    GROUP BY i.referred_by
+) inv ON inv.user_id = u.id
+LEFT JOIN (
+    SELECT receiver_user_id AS user_id, SUM(amount) AS bonus_earned
+    FROM referral_bonuses
+    WHERE status != 'cancelled'
+    GROUP BY receiver_user_id
+) b ON b.user_id = u.id
+LEFT JOIN (
+    SELECT ancestor_id AS user_id, COUNT(*) AS network_size
+    FROM referral_closure
+    WHERE depth > 0
+    GROUP BY ancestor_id
+) net ON net.user_id = u.id
+ON CONFLICT (user_id) DO UPDATE SET
+    invited_count = EXCLUDED.invited_count,
+    network_size = EXCLUDED.network_size,
+    invitees_invested = EXCLUDED.invitees_invested,
+    invitees_profits = EXCLUDED.invitees_profits,
+    invitees_bonus = EXCLUDED.invitees_bonus,
+    bonus_earned = EXCLUDED.bonus_earned,
+    updated_at = EXCLUDED.updated_at;
+
+-- ============================================
+-- VOLUMI DEGLI INVITATI: DELTA SUL REFERRER DIRETTO
+-- ============================================
+CREATE OR REPLACE FUNCTION referral_stats_invitee_delta() RETURNS trigger AS $$
+DECLARE
+    uid INT;
+    d_invested NUMERIC := 0;
+    d_profits NUMERIC := 0;
+    d_bonus NUMERIC := 0;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        uid := OLD.user_id;
+        d_invested := -COALESCE(OLD.invested_capital, 0);
+        d_profits := -COALESCE(OLD.profits, 0);
+        d_bonus := -COALESCE(OLD.referral_bonus, 0);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        uid := NEW.user_id;
+        d_invested := d_invested + COALESCE(NEW.invested_capital, 0);
+        d_profits := d_profits + COALESCE(NEW.profits, 0);
+        d_bonus := d_bonus + COALESCE(NEW.referral_bonus, 0);
+    END IF;
+    IF d_invested <> 0 OR d_profits <> 0 OR d_bonus <> 0 THEN
+        UPDATE user_referral_stats rs
+        SET invitees_invested = rs.invitees_invested + d_invested,
+            invitees_profits = rs.invitees_profits + d_profits,
+            invitees_bonus = rs.invitees_bonus + d_bonus,
+            updated_at = NOW()
+        FROM users u
+        WHERE u.id = uid AND rs.user_id = u.referred_by AND u.referred_by != u.id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_referral_stats_invitees ON user_portfolios;
+CREATE TRIGGER trg_referral_stats_invitees
+AFTER INSERT OR DELETE OR UPDATE OF invested_capital, profits, referral_bonus ON user_portfolios
+FOR EACH ROW EXECUTE FUNCTION referral_stats_invitee_delta();
+COMMIT;
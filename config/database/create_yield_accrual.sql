@@ -0,0 +1,13 @@
+-- ============================================
+-- RENDIMENTI PERIODICI: MATURAZIONE SET-BASED
+-- ============================================
+-- Il run per progetto e periodo (backend/shared/yield_accrual.py, POST /admin/projects/<id>/yields)
+-- registra il rendimento di ogni investimento attivo:
+--   importo * tasso annuo / 100 * giorni di detenzione nel periodo / 365
+-- e lo accredita in user_portfolios.profits con un movimento 'roi' per investitore.
+
+ALTER TABLE investment_yields ADD COLUMN IF NOT EXISTS annual_rate NUMERIC(7,4);
+
+-- Idempotenza: un rendimento per (investimento, periodo)
+CREATE UNIQUE INDEX IF NOT EXISTS uq_investment_yields_period
+ON investment_yields(investment_id, period_start, period_end);
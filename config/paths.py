@@ -13,6 +13,9 @@ TEMPLATES_DIR = os.path.join(FRONTEND_DIR, "templates")
 ASSETS_DIR = os.path.join(FRONTEND_DIR, "assets")
 UPLOADS_DIR = os.path.join(FRONTEND_DIR, "uploads")
 
+# Report generati (export analytics in background)
+REPORTS_DIR = os.path.join(BASE_DIR, "instance", "reports")
+
 # Percorsi backend
 BACKEND_DIR = os.path.join(BASE_DIR, "backend")
 
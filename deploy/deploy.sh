@@ -60,8 +60,11 @@ fi
 # 5. Configurazione servizio systemd
 echo "📋 FASE 5: Configurazione servizio systemd..."
 cp /var/www/CIP/deploy/cip-immobiliare.service /etc/systemd/system/
+cp /var/www/CIP/deploy/cip-portfolio-snapshots.service /etc/systemd/system/
+cp /var/www/CIP/deploy/cip-portfolio-snapshots.timer /etc/systemd/system/
 systemctl daemon-reload
 systemctl enable cip-immobiliare
+systemctl enable --now cip-portfolio-snapshots.timer
 
 # 6. Configurazione SSL (opzionale)
 echo "📋 FASE 6: Configurazione SSL..."
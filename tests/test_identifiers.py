@@ -0,0 +1,25 @@
+"""Permutazione di Feistel e codifica degli identificatori (backend/shared/identifiers.py)"""
+
+import pytest
+
+from backend.shared.identifiers import ALPHABET, encode, permute
+
+
+@pytest.mark.parametrize('bits', [2, 10, 12])
+def test_permute_is_bijection(bits):
+    secret = b'test-secret'
+    images = [permute(secret, value, bits) for value in range(1 << bits)]
+    assert sorted(images) == list(range(1 << bits))
+
+
+def test_permute_depends_on_secret():
+    bits = 12
+    first = [permute(b'secret-a', value, bits) for value in range(64)]
+    second = [permute(b'secret-b', value, bits) for value in range(64)]
+    assert first != second
+
+
+def test_encode_fixed_length_groups():
+    assert encode(0, 8) == '0000-0000'
+    assert encode((1 << 40) - 1, 8) == 'ZZZZ-ZZZZ'
+    assert set(encode(123456789, 8).replace('-', '')) <= set(ALPHABET)
@@ -0,0 +1,58 @@
+"""XIRR e TWR vettoriali (backend/shared/returns.py)"""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from backend.shared.returns import compute
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def flow(at, seq, cash, principal=0, income=0, user=1, project=1):
+    return {'key_user': user, 'key_project': project, 'flow_at': at, 'seq': seq,
+            'cash': cash, 'principal': principal, 'income': income}
+
+
+def test_one_year_ten_percent():
+    """-1000 e +1100 dopo un anno: XIRR e TWR del 10%"""
+    end = START + timedelta(days=365)
+    rows = [
+        flow(START, 0, -1000, principal=1000),
+        flow(end, 1, 100, income=100),
+        flow(end, 2, 1000, principal=-1000),
+    ]
+    [result] = compute(rows, now=end)
+    assert result['xirr'] == pytest.approx(0.10, abs=1e-6)
+    assert result['twr'] == pytest.approx(0.10, abs=1e-6)
+    assert result['invested'] == 1000
+    assert result['returned'] == 1100
+    assert result['open_capital'] == 0
+    assert result['net_cash'] == 100
+
+
+def test_open_position_valued_at_capital():
+    """Posizione aperta senza redditi: valore residuo pari al capitale, rendimento nullo"""
+    rows = [flow(START, 0, -500, principal=500)]
+    [result] = compute(rows, now=START + timedelta(days=180))
+    assert result['open_capital'] == 500
+    assert result['xirr'] == pytest.approx(0.0, abs=1e-6)
+    assert result['twr'] == 0
+
+
+def test_groups_are_independent():
+    end = START + timedelta(days=365)
+    rows = [
+        flow(START, 0, -1000, principal=1000, user=1),
+        flow(end, 1, 100, income=100, user=1),
+        flow(end, 2, 1000, principal=-1000, user=1),
+        flow(START, 0, -1000, principal=1000, user=2),
+        flow(end, 2, 1000, principal=-1000, user=2),
+    ]
+    by_user = {row['user_id']: row for row in compute(rows, now=end)}
+    assert by_user[1]['xirr'] == pytest.approx(0.10, abs=1e-6)
+    assert by_user[2]['xirr'] == pytest.approx(0.0, abs=1e-6)
+
+
+def test_no_flows():
+    assert compute([]) == []
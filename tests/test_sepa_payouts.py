@@ -0,0 +1,64 @@
+"""Validazione IBAN e righe pain.001 delle distinte SEPA (backend/shared/sepa_payouts.py)"""
+
+import re
+from decimal import Decimal
+
+import pytest
+
+from backend.shared.sepa_payouts import xml_transaction
+from backend.shared.validators import ValidationError, validate_bank_details
+
+BANK = {'account_holder': 'Mario Rossi', 'bank_name': 'Banca Test'}
+
+
+@pytest.mark.parametrize('iban', [
+    'IT60X0542811101000000123456',
+    'it60 x054 2811 1010 0000 0123 456',
+    'DE89370400440532013000',
+    'GB82WEST12345698765432',
+])
+def test_valid_iban(iban):
+    assert validate_bank_details({**BANK, 'iban': iban})['iban'] == iban.replace(' ', '').upper()
+
+
+@pytest.mark.parametrize('iban', [
+    'IT61X0542811101000000123456',
+    'DE89370400440532013001',
+    'IT60X05428',
+    'XX6-0542811101000000123456',
+])
+def test_invalid_iban(iban):
+    with pytest.raises(ValidationError):
+        validate_bank_details({**BANK, 'iban': iban})
+
+
+def test_invalid_bic():
+    with pytest.raises(ValidationError):
+        validate_bank_details({**BANK, 'iban': 'DE89370400440532013000', 'bic': 'ABC'})
+
+
+def _item(**overrides):
+    return {
+        'end_to_end_id': 'E2E-1',
+        'amount': Decimal('1234.5'),
+        'creditor_bic': 'BCITITMM',
+        'creditor_name': 'Mario & Figli',
+        'creditor_iban': 'IT60X0542811101000000123456',
+        'remittance': 'Prelievo AB12-CD34',
+        **overrides,
+    }
+
+
+def test_transaction_element_order():
+    """Ordine dello schema pain.001.001.03: PmtId, Amt, CdtrAgt, Cdtr, CdtrAcct, RmtInf"""
+    xml = xml_transaction(_item())
+    children = re.findall(r'<(PmtId|Amt|CdtrAgt|Cdtr|CdtrAcct|RmtInf)>', xml)
+    assert children == ['PmtId', 'Amt', 'CdtrAgt', 'Cdtr', 'CdtrAcct', 'RmtInf']
+    assert '<InstdAmt Ccy="EUR">1234.50</InstdAmt>' in xml
+    assert '<Nm>Mario &amp; Figli</Nm>' in xml
+
+
+def test_transaction_without_bic():
+    xml = xml_transaction(_item(creditor_bic=None))
+    assert '<CdtrAgt>' not in xml
+    assert re.findall(r'<(PmtId|Amt|Cdtr|CdtrAcct|RmtInf)>', xml) == ['PmtId', 'Amt', 'Cdtr', 'CdtrAcct', 'RmtInf']
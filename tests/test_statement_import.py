@@ -0,0 +1,127 @@
+"""Parsing degli estratti conto CSV e CAMT.053 (backend/shared/statement_import.py)"""
+
+import io
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+from backend.shared.statement_import import (
+    StatementError, _parse_camt053, _parse_csv, parse_amount, parse_statement, reference_tokens,
+)
+
+CSV_BANCA = (
+    "Data contabile;Importo;Uscite;Causale;IBAN ordinante;Ordinante;ID operazione\n"
+    "05/03/2024;1.234,56;;Deposito AB12-CD34 Mario;IT60X0542811101000000123456;Mario Rossi;OP-1\n"
+    "06/03/2024;;50,00;Commissioni;;;OP-2\n"
+    ";;;;;;\n"
+    "07/03/2024;500,00;;Bonifico ab12cd35;;Luigi Bianchi;OP-3\n"
+)
+
+CAMT_053 = b"""<?xml version="1.0" encoding="UTF-8"?>
+<Document xmlns="urn:iso:std:iso:20022:tech:xsd:camt.053.001.02">
+  <BkToCstmrStmt>
+    <Stmt>
+      <Acct><Id><IBAN>IT60X0542811101000000654321</IBAN></Id></Acct>
+      <Ntry>
+        <Amt Ccy="EUR">1500.00</Amt>
+        <CdtDbtInd>CRDT</CdtDbtInd>
+        <BookgDt><Dt>2024-03-05</Dt></BookgDt>
+        <AcctSvcrRef>BANK-REF-1</AcctSvcrRef>
+        <NtryDtls><TxDtls>
+          <RltdPties>
+            <Dbtr><Nm>Mario Rossi</Nm></Dbtr>
+            <DbtrAcct><Id><IBAN>IT60X0542811101000000123456</IBAN></Id></DbtrAcct>
+          </RltdPties>
+          <RmtInf><Ustrd>Deposito AB12-CD34</Ustrd></RmtInf>
+        </TxDtls></NtryDtls>
+      </Ntry>
+      <Ntry>
+        <Amt Ccy="EUR">20.00</Amt>
+        <CdtDbtInd>DBIT</CdtDbtInd>
+        <BookgDt><Dt>2024-03-06</Dt></BookgDt>
+      </Ntry>
+    </Stmt>
+  </BkToCstmrStmt>
+</Document>
+"""
+
+
+@pytest.mark.parametrize('text, decimal_comma, expected', [
+    ('1.234,56', True, Decimal('1234.56')),
+    ('1,234.56', True, Decimal('1234.56')),
+    ('€ 500,00', True, Decimal('500.00')),
+    ('-50', True, Decimal('-50.00')),
+    ('1,5', False, Decimal('15.00')),
+    ('10.005', False, Decimal('10.01')),
+    ('', True, None),
+    ('abc', True, None),
+])
+def test_parse_amount(text, decimal_comma, expected):
+    assert parse_amount(text, decimal_comma=decimal_comma) == expected
+
+
+def test_reference_tokens():
+    tokens = reference_tokens('Deposito ab12 cd34 da Mario', 'OP-000123')
+    assert 'AB12-CD34' in tokens
+    assert 'OP-000123' in tokens
+    assert len(tokens) == len(set(tokens))
+
+
+def test_parse_csv_bank_credits_only():
+    source, lines = _parse_csv(io.StringIO(CSV_BANCA), account='IT00CONTO')
+    lines = list(lines)
+    assert source == 'csv'
+    assert [line['external_id'] for line in lines] == ['OP-1', 'OP-3']
+    first = lines[0]
+    assert first['booked_on'] == date(2024, 3, 5)
+    assert first['amount'] == Decimal('1234.56')
+    assert first['counterparty_iban'] == 'IT60X0542811101000000123456'
+    assert first['counterparty_name'] == 'Mario Rossi'
+    assert first['account'] == 'IT00CONTO'
+    assert 'AB12-CD34' in first['tokens']
+    assert 'AB12-CD35' in lines[1]['tokens']
+
+
+def test_parse_csv_crypto_export():
+    text = (
+        'Transaction Hash,UnixTimestamp,DateTime (UTC),From,To,TokenValue,TokenSymbol\n'
+        '0xabc,1709596800,2024-03-05 00:00:00,0xfrom,0xto,"1,250.50",USDT\n'
+    )
+    source, lines = _parse_csv(io.StringIO(text))
+    [line] = list(lines)
+    assert source == 'crypto'
+    assert line['amount'] == Decimal('1250.50')
+    assert line['external_id'] == '0xabc'
+    assert line['account'] == '0xto'
+    assert line['currency'] == 'USDT'
+
+
+def test_parse_csv_without_amount_column():
+    with pytest.raises(StatementError):
+        _parse_csv(io.StringIO('Data;Causale\n01/01/2024;x\n'))
+
+
+def test_parse_camt053_credits_only():
+    source, lines = _parse_camt053(io.BytesIO(CAMT_053))
+    [line] = list(lines)
+    assert source == 'camt053'
+    assert line['booked_on'] == date(2024, 3, 5)
+    assert line['amount'] == Decimal('1500.00')
+    assert line['currency'] == 'EUR'
+    assert line['account'] == 'IT60X0542811101000000654321'
+    assert line['external_id'] == 'BANK-REF-1'
+    assert line['counterparty_iban'] == 'IT60X0542811101000000123456'
+    assert line['counterparty_name'] == 'Mario Rossi'
+    assert 'AB12-CD34' in line['tokens']
+
+
+def test_parse_camt053_invalid_xml():
+    _, lines = _parse_camt053(io.BytesIO(b'<Document><Stmt>'))
+    with pytest.raises(StatementError):
+        list(lines)
+
+
+def test_parse_statement_detects_format():
+    assert parse_statement(io.BytesIO(CAMT_053))[0] == 'camt053'
+    assert parse_statement(io.BytesIO(CSV_BANCA.encode()))[0] == 'csv'